@@ -1,16 +1,7 @@
 import socket
 import dns
 
-from measure_dns import DNSQuery, send_dns_query, DNSFlags
-
-# Function to convert delta time values to nanoseconds based on scale factor
-def _astons(delta, scale):
-    ns_time = delta
-    ns_time = int(ns_time) << (scale - 8)  # Adjust the time based on the scale factor
-    ns_time *= 16 * 16  # Further conversion to align with PDM metric format
-    ns_time /= 10000
-    ns_time /= 100000
-    return int(ns_time)
+from measure_dns import DNSQuery, send_dns_query, DNSFlags, pdm_time_ns
 
 
 if __name__ == "__main__":
@@ -70,7 +61,7 @@ if __name__ == "__main__":
 
                 # Calculate and display latency breakdown
                 print("rtt: ", result.latency_ns)  # Total round-trip time (RTT)
-                server_latency = _astons(pdm_option.deltatlr, pdm_option.scale_dtlr)
+                server_latency = pdm_time_ns(pdm_option.deltatlr, pdm_option.scale_dtlr)
                 print(
                     "server latency: ", server_latency
                 )  # Estimated server processing latency
@@ -1,6 +1,6 @@
 import random
 
-from measure_dns import DNSQuery, send_dns_query, DNSFlags
+from measure_dns import DNSQuery, DNSFlags, MeasurementSession
 if __name__ == "__main__":
     N = 1000
 
@@ -33,9 +33,12 @@ if __name__ == "__main__":
         qname, rdata = qname_rdata_choices[i]
         query_list.append(DNSQuery(qname=qname, rdtype=rdata))
 
+    # The session keeps one connected socket to the server across iterations
+    session = MeasurementSession()
+
     while True:
         # Send a DNS query to the specified server, requesting an A record
-        result = send_dns_query(
+        result = session.query(
             random.choice(query_list),
             dns_server,
             # DNSFlags.PdmMetric  # Requesting PDM (Performance Diagnostic Metrics) option
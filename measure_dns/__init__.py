@@ -1 +1,77 @@
-from .dns_packet import DNSQuery, send_dns_query, DNSFlags, decode_dns_response, build_dns_query
+import importlib
+import typing
+
+from .dns_packet import (
+    DNSQuery,
+    DNSResult,
+    DNSHeader,
+    DNSServer,
+    ResponseBuffer,
+    SourceOptions,
+    send_dns_query,
+    send_dns_queries,
+    fanout_query,
+    DNSFlags,
+    DNSStatus,
+    DNSTransport,
+    decode_dns_response,
+    parse_dns_header,
+    build_dns_query,
+)
+from .query_cache import QueryCache, QueryCacheInfo, query_cache
+from .metrics import Metrics, MetricsSnapshot, StageStats, metrics
+from .capture import (
+    Capture,
+    CapturedExchange,
+    CapturedPacket,
+    PcapWriter,
+    capture,
+    read_capture,
+    read_exchanges,
+)
+from .session import MeasurementSession
+from .monitor import Monitor, MonitorStats
+from .sink import ResultSink, read_results, iter_records, read_qnames
+from .pdm import decode_pdm, latency_breakdown, pdm_from_responses, pdm_from_results, pdm_time_ns
+
+# These modules pull in asyncio, ssl, concurrent.futures and dnspython, so
+# they are only imported when one of their names is first used
+_LAZY_EXPORTS = {
+    "AsyncMeasurer": "aio",
+    "send_dns_query_async": "aio",
+    "DoTSession": "tls",
+    "send_dns_query_tls": "tls",
+    "measure_many": "parallel",
+    "DelegationCache": "trace",
+    "DelegationCacheInfo": "trace",
+    "TraceHop": "trace",
+    "TraceResult": "trace",
+    "delegation_cache": "trace",
+    "trace_resolution": "trace",
+}
+
+if typing.TYPE_CHECKING:
+    from .aio import AsyncMeasurer, send_dns_query_async
+    from .tls import DoTSession, send_dns_query_tls
+    from .parallel import measure_many
+    from .trace import (
+        DelegationCache,
+        DelegationCacheInfo,
+        TraceHop,
+        TraceResult,
+        delegation_cache,
+        trace_resolution,
+    )
+
+
+def __getattr__(name: str):
+    module = _LAZY_EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_EXPORTS))
@@ -0,0 +1,364 @@
+import asyncio
+import ctypes
+import errno
+import random
+import struct
+import time
+import typing
+import weakref
+
+from .dns_packet import (
+    DNS_PORT,
+    DNSFlags,
+    DNSQuery,
+    DNSResult,
+    DNSServer,
+    DNSStatus,
+    SourceOptions,
+    _allocate_responses,
+    _query_to_wire,
+    _result_from_response,
+    _server_of,
+)
+from .capture import capture
+from .metrics import metrics
+from .native import dns_lib, KernelTimestamp
+from .session import MeasurementSession
+
+
+class _Channel:
+    """
+    Per-socket state of an `AsyncMeasurer`: the server, the native session
+    handle, its receive slot and the queries awaiting a response, keyed by
+    DNS ID.
+    """
+
+    def __init__(self, server: DNSServer, handle: int, extra_flags: DNSFlags):
+        self.server = server
+        self.handle = handle
+        self.fd = dns_lib.dns_session_fileno(handle)
+        self.timestamping = bool(extra_flags & DNSFlags.KernelTimestamp)
+        self.response_struct = _allocate_responses(1)[0]
+        self.recv_ns = ctypes.c_int64()
+        # DNS ID -> (future, send time and TX timestamp key of the last
+        # attempt, number of attempts)
+        self.pending: typing.Dict[
+            int, typing.Tuple[asyncio.Future, int, int, int]
+        ] = {}
+        # TX timestamp key -> kernel TX timestamp, until the response arrives
+        self.tx_stamps: typing.Dict[int, KernelTimestamp] = {}
+        # Local (address, port) of the socket, read by the first capture
+        self.local: typing.Optional[typing.Tuple[str, int]] = None
+
+    def drain_tx_timestamps(self) -> None:
+        """
+        Moves every kernel TX timestamp waiting on the error queue into `tx_stamps`.
+        """
+        tx_key = ctypes.c_uint32()
+        while True:
+            stamp = KernelTimestamp()
+            if not dns_lib.dns_session_tx_timestamp(
+                self.handle, ctypes.byref(tx_key), ctypes.byref(stamp)
+            ):
+                return
+            self.tx_stamps[tx_key.value] = stamp
+
+
+class AsyncMeasurer:
+    """
+    Sends DNS queries from an asyncio event loop with many queries in flight.
+
+    Each (server, flags) pair gets one native session socket whose descriptor
+    is registered with the event loop. Queries are written immediately and
+    their responses are demultiplexed by DNS ID when the socket becomes
+    readable, so thousands of outstanding probes need neither threads nor
+    extra sockets. Send and receive times are taken inside the native library
+    right around the `send` and `recvmsg` calls.
+
+    Args:
+        extra_flags (DNSFlags): Default control flags for every query.
+        port (int): Destination port of the servers given as strings.
+        source (SourceOptions): Local address and source port of the
+            sockets. Source-port rotation does not apply, since the sockets
+            stay registered with the event loop.
+
+    Example:
+        ```py
+        import asyncio
+        from measure_dns import AsyncMeasurer, DNSQuery
+
+        async def main():
+            async with AsyncMeasurer() as measurer:
+                queries = [DNSQuery(f"host{i}.example.com", "A") for i in range(1000)]
+                results = await asyncio.gather(
+                    *(measurer.query(query, "8.8.8.8") for query in queries)
+                )
+                print(sum(map(bool, results)))
+
+        asyncio.run(main())
+        ```
+
+    Note:
+        The receive time is taken when the event loop services the socket, so
+        a busy loop adds its own scheduling delay to the measured latency.
+        An `AsyncMeasurer` must only be used from the event loop it first ran on.
+    """
+
+    def __init__(
+        self,
+        extra_flags: DNSFlags = DNSFlags.NoFlag,
+        port: int = DNS_PORT,
+        source: typing.Optional[SourceOptions] = None,
+    ):
+        self.extra_flags = extra_flags
+        self._session = MeasurementSession(extra_flags, port=port, source=source)
+        self._channels: typing.Dict[int, _Channel] = {}
+        # Held weakly, so that a measurer kept for a loop does not keep it alive
+        self._loop: "typing.Optional[weakref.ref[asyncio.AbstractEventLoop]]" = None
+
+    def _channel(self, dns_server: typing.Union[str, DNSServer], extra_flags: DNSFlags) -> _Channel:
+        """
+        Returns the channel for `dns_server`, registering its socket with the
+        running event loop on first use.
+        """
+        server = _server_of(dns_server, self._session.port, extra_flags)
+        handle = self._session._handle(server, extra_flags)
+        channel = self._channels.get(handle)
+        if channel is None:
+            loop = asyncio.get_running_loop()
+            if self._loop is None:
+                self._loop = weakref.ref(loop)
+            channel = _Channel(server, handle, extra_flags)
+            loop.add_reader(channel.fd, self._on_readable, channel)
+            self._channels[handle] = channel
+        return channel
+
+    def _on_readable(self, channel: _Channel) -> None:
+        """
+        Drains every response waiting on the channel socket and resolves the
+        matching futures.
+        """
+        response_struct = channel.response_struct
+        if channel.timestamping:
+            channel.drain_tx_timestamps()
+        while True:
+            response_size = dns_lib.dns_session_recv(
+                channel.handle,
+                ctypes.byref(response_struct),
+                ctypes.byref(channel.recv_ns),
+            )
+            if response_size < 0:
+                # ICMP errors cannot be attributed to a single query and are
+                # skipped; an empty socket or any other error ends the drain.
+                if ctypes.get_errno() in _UNREACHABLE_ERRORS:
+                    continue
+                return
+            if response_size < 2:
+                continue
+
+            query_id = (response_struct.response[0] << 8) | response_struct.response[1]
+            waiter = channel.pending.pop(query_id, None)
+            if waiter is None:
+                continue  # Late or unsolicited response
+            future, sent_ns, tx_key, attempts = waiter
+            if future.done():
+                continue
+            response_struct.latency_ns = channel.recv_ns.value - sent_ns
+            if metrics.enabled:
+                metrics._record_response(response_size, response_struct.latency_ns)
+            response_struct.attempts = attempts
+            tx_stamp = channel.tx_stamps.pop(tx_key, None)
+            if tx_stamp is not None:
+                dns_lib.dns_kernel_latency(
+                    ctypes.byref(tx_stamp), ctypes.byref(response_struct)
+                )
+            writer = capture.writer
+            if writer is not None:
+                writer._write_response(
+                    channel.recv_ns.value,
+                    channel,
+                    self._session.source,
+                    response_struct,
+                    response_size,
+                )
+            future.set_result(_result_from_response(response_struct))
+
+    async def query(
+        self,
+        query: DNSQuery,
+        dns_server: typing.Union[str, DNSServer],
+        extra_flags: typing.Optional[DNSFlags] = None,
+    ) -> DNSResult:
+        """
+        Sends one DNS query and waits for its response without blocking the loop.
+
+        Each attempt waits up to `query.timeout` seconds, and the query is
+        resent up to `query.retries` times. Latency is measured from the last
+        attempt.
+
+        Args:
+            query (DNSQuery): The DNS query to send.
+            dns_server (str or DNSServer): The target DNS server.
+            extra_flags (DNSFlags): Control flags, defaulting to the measurer flags.
+
+        Returns:
+            DNSResult: Decoded DNS response, latency, and any additional
+            parameters. Failed queries carry a `status` instead of a response.
+        """
+        if extra_flags is None:
+            extra_flags = self.extra_flags
+        if extra_flags & (DNSFlags.Tcp | DNSFlags.TcFallback):
+            raise ValueError("AsyncMeasurer only sends queries over UDP")
+        channel = self._channel(dns_server, extra_flags)
+        if len(channel.pending) >= 65536:
+            raise RuntimeError(f"Too many outstanding queries to {dns_server}")
+
+        timed = metrics.enabled
+        if timed:
+            start_ns = time.perf_counter_ns()
+        request = _query_to_wire(query)
+        if timed:
+            metrics._record_build(time.perf_counter_ns() - start_ns)
+        (query_id,) = struct.unpack_from("!H", request)
+        if query_id in channel.pending:
+            while query_id in channel.pending:
+                query_id = random.getrandbits(16)
+            request = struct.pack("!H", query_id) + request[2:]
+
+        future = self._loop().create_future()
+        sent_ns = ctypes.c_int64()
+        tx_key = ctypes.c_uint32()
+        tx_keys = []
+        try:
+            for attempt in range(1, query.retries + 2):
+                if timed:
+                    called_ns = time.perf_counter_ns()
+                if (
+                    dns_lib.dns_session_send(
+                        channel.handle,
+                        request,
+                        len(request),
+                        ctypes.byref(sent_ns),
+                        ctypes.byref(tx_key),
+                    )
+                    < 0
+                ):
+                    error_code = ctypes.get_errno()
+                    if timed:
+                        metrics._record_failure(DNSStatus.SendError, 0)
+                    return _failed_result(
+                        DNSStatus.Unreachable
+                        if error_code in _UNREACHABLE_ERRORS
+                        else DNSStatus.SendError,
+                        attempt - 1,
+                        error_code,
+                    )
+                if timed:
+                    metrics._record_send(len(request), time.perf_counter_ns() - called_ns)
+                tx_keys.append(tx_key.value)
+                writer = capture.writer
+                if writer is not None:
+                    writer._write_query(
+                        sent_ns.value, channel, self._session.source, request
+                    )
+                channel.pending[query_id] = (
+                    future,
+                    sent_ns.value,
+                    tx_key.value,
+                    attempt,
+                )
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(future), query.timeout
+                    )
+                except asyncio.TimeoutError:
+                    continue
+            if timed:
+                metrics._record_failure(DNSStatus.Timeout, time.perf_counter_ns() - start_ns)
+            return _failed_result(DNSStatus.Timeout, query.retries + 1)
+        finally:
+            if channel.pending.get(query_id, (None,))[0] is future:
+                del channel.pending[query_id]
+            for key in tx_keys:
+                channel.tx_stamps.pop(key, None)
+            future.cancel()
+
+    def close(self) -> None:
+        """
+        Unregisters and closes every socket, cancelling outstanding queries.
+        """
+        loop = self._loop() if self._loop is not None else None
+        for channel in self._channels.values():
+            if loop is not None and not loop.is_closed():
+                loop.remove_reader(channel.fd)
+            for future, *_ in channel.pending.values():
+                future.cancel()
+            channel.pending.clear()
+        self._channels.clear()
+        self._session.close()
+
+    async def __aenter__(self) -> "AsyncMeasurer":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
+
+
+_UNREACHABLE_ERRORS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def _failed_result(status: DNSStatus, attempts: int, error_code: int = 0) -> DNSResult:
+    """
+    Builds the result of a query that received no response.
+    """
+    return DNSResult(
+        response=None,
+        latency_ns=0.0,
+        additional_params=[],
+        status=status,
+        error_code=error_code,
+        attempts=attempts,
+    )
+
+
+_default_measurers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncMeasurer]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+async def send_dns_query_async(
+    query: DNSQuery,
+    dns_server: typing.Union[str, DNSServer],
+    extra_flags: DNSFlags = 0,
+) -> DNSResult:
+    """
+    Asynchronous counterpart of `send_dns_query`.
+
+    Queries go through an `AsyncMeasurer` shared by all callers on the running
+    event loop, so concurrent calls share one socket per server. Its sockets
+    are closed once the loop is garbage collected; use an `AsyncMeasurer` in
+    an `async with` block to close them at a known point instead.
+
+    Args:
+        query (DNSQuery): The DNS query to send.
+        dns_server (str or DNSServer): The target DNS server.
+        extra_flags (DNSFlags): Additional control flags (e.g., for metrics).
+
+    Returns:
+        DNSResult: Decoded DNS response, latency, and any additional
+        parameters. Failed queries carry a `status` instead of a response.
+
+    Example:
+        ```py
+        import asyncio
+        from measure_dns import DNSQuery, send_dns_query_async
+        result = asyncio.run(send_dns_query_async(DNSQuery("example.com", "A"), "1.1.1.1"))
+        print(result.latency_ns)
+        ```
+    """
+    loop = asyncio.get_running_loop()
+    measurer = _default_measurers.get(loop)
+    if measurer is None:
+        measurer = _default_measurers[loop] = AsyncMeasurer()
+        weakref.finalize(loop, measurer.close)
+    return await measurer.query(query, dns_server, extra_flags)
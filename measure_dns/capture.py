@@ -0,0 +1,557 @@
+import ctypes
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+import typing
+
+from .native import dns_lib
+
+# Captures are classic pcap files with nanosecond timestamps holding raw IP
+# packets, which Wireshark and tcpdump read as they are
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+SNAPLEN = 65535
+
+_GLOBAL_HEADER = struct.Struct("<IHHiIII")
+_RECORD_HEADER = struct.Struct("<IIII")
+_IPV4_HEADER = struct.Struct("!BBHHHBBH4s4s")
+_IPV6_HEADER = struct.Struct("!IHBB16s16s")
+_UDP_HEADER = struct.Struct("!HHHH")
+_IPPROTO_UDP = 17
+_ETHERTYPE_IPV4, _ETHERTYPE_IPV6, _ETHERTYPE_VLAN = 0x0800, 0x86DD, 0x8100
+# Largest DNS message that fits a UDP datagram in an IPv6 packet
+_MAX_PAYLOAD = 65535 - 40 - 8
+_DNS_HEADER_SIZE = 12
+
+
+class CapturedPacket(typing.NamedTuple):
+    """
+    A UDP packet read from a capture.
+
+    Attributes:
+        timestamp_ns (int): Capture time in nanoseconds since the epoch.
+        source (str): Source IP address.
+        source_port (int): Source UDP port.
+        destination (str): Destination IP address.
+        destination_port (int): Destination UDP port.
+        payload (bytes): The UDP payload, a DNS message for DNS traffic.
+    """
+
+    timestamp_ns: int
+    source: str
+    source_port: int
+    destination: str
+    destination_port: int
+    payload: bytes
+
+
+class CapturedExchange(typing.NamedTuple):
+    """
+    A DNS query read from a capture, with the latency of its response.
+
+    Attributes:
+        timestamp_ns (int): Time the query was sent, in nanoseconds since the
+            epoch.
+        server (str): Address the query was sent to.
+        port (int): Port the query was sent to.
+        request (bytes): The query in wire format.
+        latency_ns (float): Time between the query and its response in the
+            capture, or `None` if it was not answered.
+    """
+
+    timestamp_ns: int
+    server: str
+    port: int
+    request: bytes
+    latency_ns: typing.Optional[float]
+
+
+class PcapWriter:
+    """
+    Writes DNS queries and responses to a pcap file.
+
+    Every query and response becomes one UDP packet inside a raw IPv4 or
+    IPv6 packet, timestamped with nanosecond precision: the query at the
+    time it was sent and the response at that time plus the latency the
+    native layer measured. Packets are built into an in-memory buffer and
+    written with one system call whenever it holds `buffer_size` bytes.
+
+    Args:
+        path (str): File to write, replaced if it exists.
+        buffer_size (int): Bytes buffered before they are written.
+
+    Example:
+        ```py
+        import time
+        from measure_dns import build_dns_query
+        from measure_dns.capture import PcapWriter
+        with PcapWriter("lookup.pcap") as pcap:
+            pcap.write_packet(time.time_ns(), "192.0.2.1", 40000, "8.8.8.8", 53, build_dns_query("example.com", "A"))
+        ```
+
+    Note:
+        Queries written by `capture` are stamped with the time their last
+        attempt was sent and come from the local address and port of the
+        socket that sent them. Responses received over TCP are written
+        as UDP packets as well. UDP checksums are left at zero, which
+        Wireshark does not check by default. Writes are serialized by a lock,
+        so one writer can be shared by threads.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1 << 20):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.packets = 0
+        self._lock = threading.Lock()
+        self._addresses: typing.Dict[str, bytes] = {}
+        self._file = open(path, "wb", buffering=0)
+        self._buffer = bytearray(_GLOBAL_HEADER.pack(PCAP_MAGIC_NS, 2, 4, 0, 0, SNAPLEN, LINKTYPE_RAW))
+        # Turns the native monotonic send and receive times of the socket
+        # sessions into wall-clock time; one offset keeps their differences exact
+        self._native_offset = time.time_ns() - time.clock_gettime_ns(time.CLOCK_MONOTONIC_RAW)
+
+    def write_packet(
+        self,
+        timestamp_ns: int,
+        source: str,
+        source_port: int,
+        destination: str,
+        destination_port: int,
+        payload: typing.Union[bytes, bytearray, memoryview],
+    ) -> None:
+        """
+        Appends one UDP packet.
+
+        Args:
+            timestamp_ns (int): Capture time in nanoseconds since the epoch.
+            source (str): Source IP address, or "" for the unspecified
+                address of the destination's family (and the other way
+                round).
+            source_port (int): Source UDP port.
+            destination (str): Destination IP address.
+            destination_port (int): Destination UDP port.
+            payload (bytes-like): The DNS message.
+        """
+        with self._lock:
+            self._append(timestamp_ns, source, source_port, destination, destination_port, payload)
+            self._flush_full()
+
+    def _append(
+        self,
+        timestamp_ns: int,
+        source: str,
+        source_port: int,
+        destination: str,
+        destination_port: int,
+        payload: typing.Union[bytes, bytearray, memoryview],
+    ) -> None:
+        """
+        Appends one UDP packet to the buffer; the caller holds the lock.
+        """
+        # An empty address is the unspecified address of the other end's family
+        source_bytes = self._packed(source) if source else None
+        destination_bytes = self._packed(destination) if destination else None
+        source_bytes = source_bytes or bytes(len(destination_bytes))
+        destination_bytes = destination_bytes or bytes(len(source_bytes))
+        payload = payload[:_MAX_PAYLOAD]
+        udp_size = 8 + len(payload)
+        if len(destination_bytes) == 4:
+            header = bytearray(
+                _IPV4_HEADER.pack(0x45, 0, 20 + udp_size, 0, 0x4000, 64, _IPPROTO_UDP, 0, source_bytes, destination_bytes)
+            )
+            header[10:12] = _ipv4_checksum(header).to_bytes(2, "big")
+        else:
+            header = _IPV6_HEADER.pack(0x60000000, udp_size, _IPPROTO_UDP, 64, source_bytes, destination_bytes)
+        packet_size = len(header) + udp_size
+        seconds, nanoseconds = divmod(int(timestamp_ns), 1_000_000_000)
+        buffer = self._buffer
+        buffer += _RECORD_HEADER.pack(seconds, nanoseconds, packet_size, packet_size)
+        buffer += header
+        buffer += _UDP_HEADER.pack(source_port, destination_port, udp_size, 0)
+        buffer += payload
+        self.packets += 1
+
+    def _packed(self, address: str) -> bytes:
+        packed = self._addresses.get(address)
+        if packed is None:
+            family = socket.AF_INET6 if ":" in address else socket.AF_INET
+            packed = self._addresses[address] = socket.inet_pton(family, address.partition("%")[0])
+        return packed
+
+    def _write_responses(
+        self,
+        servers: typing.Sequence,
+        source,
+        requests: typing.Sequence[typing.Union[bytes, bytearray, memoryview]],
+        responses: typing.Sequence,
+        count: int,
+    ) -> None:
+        """
+        Appends the queries of one native call and the responses in its
+        filled response slots, sent to `servers[i]` (one `DNSServer` each).
+        Each query is stamped with the time its last attempt was sent and its
+        response with that time plus the latency; slots whose query was
+        never sent are skipped.
+        """
+        with self._lock:
+            if self._file.closed:
+                return  # The capture was stopped during the call
+            for i in range(count):
+                response = responses[i]
+                if not response.sent_ns:
+                    continue
+                server = servers[i]
+                address, port = server.address, server.port
+                if response.local_port:
+                    source_address = _address_string(response.local_address, address)
+                    source_port = response.local_port
+                else:
+                    source_address, source_port = _source_of(source, address)
+                sent_ns = response.sent_ns + self._native_offset
+                self._append(sent_ns, source_address, source_port, address, port, requests[i])
+                response_size = response.response_size
+                if response_size > 0:
+                    self._append(
+                        sent_ns + int(response.latency_ns),
+                        address,
+                        port,
+                        source_address,
+                        source_port,
+                        ctypes.string_at(response.response, response_size),
+                    )
+            self._flush_full()
+
+    def _write_query(self, native_ns: int, channel, source, request: typing.Union[bytes, bytearray, memoryview]) -> None:
+        """
+        Appends a query sent through the socket of `channel`, the channel of
+        an `AsyncMeasurer` or a `Monitor`, at the native monotonic time
+        `native_ns`.
+        """
+        server = channel.server
+        source_address, source_port = _channel_source(channel, source)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._append(
+                native_ns + self._native_offset, source_address, source_port, server.address, server.port, request
+            )
+            self._flush_full()
+
+    def _write_response(self, native_ns: int, channel, source, response, response_size: int) -> None:
+        """
+        Appends the response in the `DNSResponse` slot `response`, received
+        through the socket of `channel` at the native monotonic time
+        `native_ns`.
+        """
+        server = channel.server
+        source_address, source_port = _channel_source(channel, source)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._append(
+                native_ns + self._native_offset,
+                server.address,
+                server.port,
+                source_address,
+                source_port,
+                ctypes.string_at(response.response, response_size),
+            )
+            self._flush_full()
+
+    def _flush_full(self) -> None:
+        if len(self._buffer) >= self.buffer_size:
+            self._file.write(self._buffer)
+            self._buffer.clear()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered packets to disk.
+        """
+        with self._lock:
+            if self._buffer and not self._file.closed:
+                self._file.write(self._buffer)
+                self._buffer.clear()
+
+    def close(self) -> None:
+        """
+        Flushes and closes the file. Writes still in progress on other
+        threads finish first; later ones are dropped.
+        """
+        with self._lock:
+            if not self._file.closed:
+                if self._buffer:
+                    self._file.write(self._buffer)
+                    self._buffer.clear()
+                self._file.close()
+
+    def __enter__(self) -> "PcapWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _address_string(packed, address: str) -> str:
+    """
+    Returns the local address `packed` by the native layer for a socket
+    talking to `address`, which gives its family.
+    """
+    if ":" in address:
+        return socket.inet_ntop(socket.AF_INET6, bytes(packed))
+    return socket.inet_ntop(socket.AF_INET, bytes(packed[:4]))
+
+
+def _channel_source(channel, source) -> typing.Tuple[str, int]:
+    """
+    Returns the local address and port of the socket of `channel`, read
+    once per channel.
+    """
+    local = channel.local
+    if local is None:
+        address = (ctypes.c_ubyte * 16)()
+        port = ctypes.c_int()
+        if dns_lib.dns_session_local_address(channel.handle, address, ctypes.byref(port)) == 0 and port.value:
+            local = (_address_string(address, channel.server.address), port.value)
+        else:
+            local = _source_of(source, channel.server.address)
+        channel.local = local
+    return local
+
+
+def _source_of(source, address: str) -> typing.Tuple[str, int]:
+    """
+    Returns the source address and port of packets sent to `address` from
+    the `SourceOptions` `source`. A source of the other family was not used
+    for the server, so it becomes the unspecified address.
+    """
+    if source is None:
+        return "", 0
+    source_address = source.address or ""
+    if (":" in source_address) != (":" in address):
+        source_address = ""
+    return source_address, source.ports if isinstance(source.ports, int) else 0
+
+
+class Capture:
+    """
+    Records the traffic of the query path to a pcap file.
+
+    While a capture runs, every query sent through `send_dns_query`,
+    `send_dns_queries`, `fanout_query`, a `MeasurementSession`, an
+    `AsyncMeasurer` or a `Monitor`, and every response it received, is
+    written to a `PcapWriter` with the timestamps of the native layer. The
+    capture can be opened in Wireshark, or replayed against another server
+    with `measure_dns.bench.run_replay`. When no capture runs, the query
+    path pays one attribute check per call.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, capture, send_dns_queries
+        capture.start("campaign.pcap")
+        try:
+            send_dns_queries([DNSQuery(f"h{i}.example.com", "A") for i in range(100)], "8.8.8.8")
+        finally:
+            capture.stop()
+        ```
+    """
+
+    def __init__(self):
+        self.writer: typing.Optional[PcapWriter] = None
+
+    def start(self, path: str, buffer_size: int = 1 << 20) -> PcapWriter:
+        """
+        Starts capturing into a new pcap file.
+
+        Args:
+            path (str): File to write, replaced if it exists.
+            buffer_size (int): Bytes buffered before they are written.
+
+        Returns:
+            PcapWriter: The writer of the capture.
+
+        Raises:
+            RuntimeError: If a capture is already running.
+        """
+        if self.writer is not None:
+            raise RuntimeError(f"A capture to {self.writer.path} is already running")
+        self.writer = PcapWriter(path, buffer_size)
+        dns_lib.dns_report_local_addresses(1)
+        return self.writer
+
+    def stop(self) -> None:
+        """
+        Stops the running capture, if any, and closes its file.
+        """
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            dns_lib.dns_report_local_addresses(0)
+            writer.close()
+
+
+def read_capture(path: str) -> typing.Iterator[CapturedPacket]:
+    """
+    Yields the UDP packets of a pcap file.
+
+    The file is memory-mapped, so captures larger than RAM can be read. Both
+    microsecond and nanosecond pcap files are read, of raw IP packets (as
+    written by `PcapWriter`) or Ethernet frames (as written by tcpdump).
+    Packets that are not UDP, or are IP fragments, are skipped.
+
+    Args:
+        path (str): The pcap file.
+
+    Returns:
+        Iterator[CapturedPacket]: The UDP packets in file order.
+
+    Raises:
+        ValueError: If the file is not a pcap file of a supported link type.
+    """
+    with open(path, "rb") as capture_file:
+        if os.fstat(capture_file.fileno()).st_size < _GLOBAL_HEADER.size:
+            raise ValueError(f"{path} is not a pcap file")
+        with mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # The magic number tells the byte order of the writing machine
+            for order in "<>":
+                magic = struct.unpack_from(order + "I", data)[0]
+                if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+                    break
+            else:
+                raise ValueError(f"{path} is not a pcap file")
+            linktype = struct.unpack_from(order + "I", data, 20)[0] & 0xFFFF
+            if linktype not in (LINKTYPE_RAW, LINKTYPE_ETHERNET):
+                raise ValueError(f"{path} holds unsupported link type {linktype}")
+            record_header = struct.Struct(order + "IIII")
+            fraction_ns = 1 if magic == PCAP_MAGIC_NS else 1000
+            offset = _GLOBAL_HEADER.size
+            end = len(data)
+            while offset + record_header.size <= end:
+                seconds, fraction, captured_size, _ = record_header.unpack_from(data, offset)
+                start = offset + record_header.size
+                offset = start + captured_size
+                if offset > end:
+                    return
+                packet = _parse_udp(data, start, offset, linktype)
+                if packet is not None:
+                    yield CapturedPacket(seconds * 1_000_000_000 + fraction * fraction_ns, *packet)
+
+
+def read_exchanges(path: str) -> typing.List[CapturedExchange]:
+    """
+    Returns the DNS queries of a pcap file, each with the latency of its
+    response.
+
+    A response is matched to a query by the DNS ID and by the addresses and
+    ports of the two ends, so the queries of many clients and servers can be
+    mixed in one capture.
+
+    Args:
+        path (str): The pcap file.
+
+    Returns:
+        list: One `CapturedExchange` per query, in capture order.
+
+    Example:
+        ```py
+        from measure_dns.capture import read_exchanges
+        exchanges = read_exchanges("campaign.pcap")
+        answered = [exchange.latency_ns for exchange in exchanges if exchange.latency_ns is not None]
+        print(len(exchanges), sum(answered) / len(answered))
+        ```
+    """
+    exchanges: typing.List[CapturedExchange] = []
+    pending: typing.Dict[tuple, int] = {}
+    for packet in read_capture(path):
+        payload = packet.payload
+        if len(payload) < _DNS_HEADER_SIZE:
+            continue
+        ends = (packet.source, packet.source_port, packet.destination, packet.destination_port)
+        if payload[2] & 0x80:
+            # A response, keyed like the query it answers
+            index = pending.pop((ends[2], ends[3], ends[0], ends[1], payload[:2]), None)
+            if index is not None:
+                exchange = exchanges[index]
+                exchanges[index] = exchange._replace(latency_ns=float(packet.timestamp_ns - exchange.timestamp_ns))
+        else:
+            pending[(*ends, payload[:2])] = len(exchanges)
+            exchanges.append(
+                CapturedExchange(packet.timestamp_ns, packet.destination, packet.destination_port, payload, None)
+            )
+    return exchanges
+
+
+def _parse_udp(data: mmap.mmap, start: int, end: int, linktype: int) -> typing.Optional[tuple]:
+    """
+    Returns the addresses, ports and payload of the UDP packet in
+    `data[start:end]`, or `None` if it is not one.
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        if end - start < 14:
+            return None
+        ethertype = int.from_bytes(data[start + 12 : start + 14], "big")
+        start += 14
+        if ethertype == _ETHERTYPE_VLAN and end - start >= 4:
+            ethertype = int.from_bytes(data[start + 2 : start + 4], "big")
+            start += 4
+        if ethertype not in (_ETHERTYPE_IPV4, _ETHERTYPE_IPV6):
+            return None
+    if end - start < 1:
+        return None
+    version = data[start] >> 4
+    if version == 4:
+        if end - start < 20:
+            return None
+        header_size = (data[start] & 0x0F) * 4
+        fragment = int.from_bytes(data[start + 6 : start + 8], "big")
+        if data[start + 9] != _IPPROTO_UDP or fragment & 0x3FFF:
+            return None
+        family, address_size, source_at, destination_at = socket.AF_INET, 4, start + 12, start + 16
+    elif version == 6:
+        if end - start < 40:
+            return None
+        header_size = 40
+        if data[start + 6] != _IPPROTO_UDP:
+            return None
+        family, address_size, source_at, destination_at = socket.AF_INET6, 16, start + 8, start + 24
+    else:
+        return None
+    udp = start + header_size
+    if end - udp < 8:
+        return None
+    source_port, destination_port, udp_size, _ = _UDP_HEADER.unpack_from(data, udp)
+    return (
+        socket.inet_ntop(family, data[source_at : source_at + address_size]),
+        source_port,
+        socket.inet_ntop(family, data[destination_at : destination_at + address_size]),
+        destination_port,
+        data[udp + 8 : min(udp + udp_size, end)],
+    )
+
+
+def _ipv4_checksum(header: typing.Union[bytes, bytearray]) -> int:
+    total = sum(struct.unpack("!10H", header))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _split_requests(
+    packed: typing.Union[bytes, bytearray, memoryview], sizes: typing.Sequence[int], count: int
+) -> typing.List[memoryview]:
+    """
+    Returns views of the `count` requests packed back to back in `packed`.
+    """
+    view = memoryview(packed)
+    requests, offset = [], 0
+    for i in range(count):
+        requests.append(view[offset : offset + sizes[i]])
+        offset += sizes[i]
+    return requests
+
+
+# Process-wide capture of the query path
+capture = Capture()
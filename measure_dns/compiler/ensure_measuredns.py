@@ -1,35 +1,111 @@
+import importlib.machinery
 import os
-import platform
+import typing
 
-from .gcc_executor import check_gcc,exec_gcc
+SRC_NAME = "measuredns.c"
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_PATH = os.path.join(PACKAGE_DIR, "native", SRC_NAME)
+# Module name of the extension `setup.py` builds at install time
+EXTENSION_NAME = "_measuredns"
 
+# Flags of the fallback build. The library is built on the machine it runs
+# on, so it is first tried for the local CPU and then without `-march`.
+FLAGS = [
+    "-shared",
+    "-fPIC",
+    "-pthread",
+    "-fno-strict-overflow",
+    "-Wsign-compare",
+    "-DNDEBUG",
+    "-g",
+    "-O2",
+    "-Wall",
+]
+MARCH_FLAGS = ["-march=native"]
 
-IS_WINDOWS = platform.system() == "Windows"
-SRC_NAME = "measuredns.c"
 
-SRC_PATH = os.path.join(
-    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-    "native",
-    SRC_NAME
-)
-LIBRARY_NAME = "measuredns.so"
-LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), LIBRARY_NAME)
+def cache_dir() -> str:
+    """
+    Returns the directory fallback builds are kept in: `MEASURE_DNS_CACHE`,
+    or `measure_dns` under the user cache directory.
+    """
+    directory = os.environ.get("MEASURE_DNS_CACHE")
+    if directory:
+        return directory
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "measure_dns")
+
+
+def cached_library_path(flags: typing.Sequence[str]) -> str:
+    """
+    Returns the cache path of a build of the current source with `flags`.
+    Editing the source or the flags gives a new path, so a stale build is
+    never loaded.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(SRC_PATH, "rb") as source:
+        digest.update(source.read())
+    digest.update("\0".join(flags).encode())
+    return os.path.join(cache_dir(), f"measuredns-{digest.hexdigest()[:16]}.so")
+
+
+def installed_library_path() -> typing.Optional[str]:
+    """
+    Returns the path of the extension built by `setup.py`, if there is one.
+    """
+    for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+        path = os.path.join(PACKAGE_DIR, EXTENSION_NAME + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def ensure_measuredns() -> str:
+    """
+    Returns the path of the native library, building it only if neither an
+    installed nor a cached build exists.
+
+    The lookup order is the `MEASURE_DNS_LIBRARY` environment variable, the
+    extension built at install time, and a build of the current source in the
+    cache directory. A missing build is compiled with `-march=native` first
+    and without it if the compiler rejects the flag. Builds are written to a
+    temporary file and renamed, so processes starting together never load a
+    half-written library.
+
+    Raises:
+        ImportError: If no library exists and none can be built.
+    """
+    path = os.environ.get("MEASURE_DNS_LIBRARY") or installed_library_path()
+    if path:
+        return path
+    candidates = [list(FLAGS) + MARCH_FLAGS, list(FLAGS)]
+    for flags in candidates:
+        path = cached_library_path(flags)
+        if os.path.exists(path):
+            return path
+
+    # Only needed to build, which an installed package never does
+    import tempfile
 
+    from .gcc_executor import check_gcc, exec_gcc
 
-def ensure_measuredns() -> bool:
     if not check_gcc("gcc"):
-        print("GCC compiler not found.")
-        exit(-1)
-
-    FLAGS = [
-        "-shared",
-        "-fPIC",
-        "-fno-strict-overflow",
-        "-Wsign-compare",
-        "-DNDEBUG",
-        "-g",
-        "-O2",
-        "-Wall",
-    ]
-
-    return exec_gcc("gcc", FLAGS, LIBRARY_PATH, SRC_PATH)
+        raise ImportError(
+            "The measuredns native library is not built and gcc was not found. "
+            "Install measure_dns with pip, or install gcc."
+        )
+    os.makedirs(cache_dir(), exist_ok=True)
+    for flags in candidates:
+        path = cached_library_path(flags)
+        descriptor, partial = tempfile.mkstemp(suffix=".so", dir=cache_dir())
+        os.close(descriptor)
+        try:
+            if exec_gcc("gcc", flags, partial, SRC_PATH):
+                os.replace(partial, path)
+                return path
+        finally:
+            if os.path.exists(partial):
+                os.unlink(partial)
+    raise ImportError(f"Building the measuredns native library from {SRC_PATH} failed")
@@ -1,4 +1,6 @@
 import subprocess
+import typing
+
 
 def check_gcc(cc_name: str) -> bool:
     try:
@@ -9,11 +11,13 @@ def check_gcc(cc_name: str) -> bool:
     except (subprocess.CalledProcessError, FileNotFoundError):
         return False
 
-def exec_gcc(cc_name: str, flags: list, output_file: str, input_file: str) -> bool:
-    try:
-        cmd = cc_name + " " + " ".join(flags) + f" -o {output_file} {input_file}"
-        subprocess.check_call(cmd, shell=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        print("Compilation failed:", e)
-        return False
\ No newline at end of file
+
+def exec_gcc(cc_name: str, flags: typing.Sequence[str], output_file: str, input_file: str) -> bool:
+    # The compiler output is captured rather than printed; a failed build is
+    # reported by the caller
+    result = subprocess.run(
+        [cc_name, *flags, "-o", output_file, input_file],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
@@ -1,14 +1,47 @@
+from __future__ import annotations
+
 import ctypes
 import enum
+import functools
+import random
+import socket
 import struct
+import time
 import typing
-from dataclasses import dataclass
-from ipaddress import IPv4Address, ip_address
-import dns.message
-import dns.name
-import dns.rdataclass
-from dns.rdataclass import RdataClass
-from .native import dns_lib, DNSResponse, AdditionalParam, PDMOption, DestOptHdr
+from dataclasses import dataclass, field
+from .native import (
+    dns_lib,
+    DNSResponse,
+    PDMOption,
+    MAX_BATCH_QUERIES,
+    MAX_DNS_MESSAGE_SIZE,
+    DNSEndpoint,
+)
+from .capture import _split_requests, capture
+from .metrics import _clock, metrics
+from .query_cache import query_cache
+
+if typing.TYPE_CHECKING:
+    # dnspython takes longer to import than the rest of the package, so it
+    # is only imported once a query is built or a response decoded
+    import dns.edns
+    import dns.message
+    import dns.name
+    import dns.rdataclass
+    import dns.rdatatype
+
+# Receive buffer of a response slot: the EDNS payload size recommended by DNS
+# Flag Day 2020, which UDP responses are not expected to exceed
+DEFAULT_RESPONSE_SIZE = 1232
+# Destination port of plain DNS
+DNS_PORT = 53
+# Seconds a `DNSServer` uses a resolved hostname before resolving it again
+DEFAULT_RESOLVE_TTL = 300.0
+
+# Packed `sockaddr_in` and `sockaddr_in6`; the port and flow info are passed
+# in network byte order
+_SOCKADDR_IN = struct.Struct("=H2s4s8x")
+_SOCKADDR_IN6 = struct.Struct("=H2s4s16sI")
 class DNSFlags(enum.IntEnum):
     """
     DNSFlags represent bitmask values to control extended DNS query behaviors.
@@ -21,6 +54,12 @@ class DNSFlags(enum.IntEnum):
         PdmMetric (int): Include Performance Diagnostic Metrics (PDM) in the query.
         PreResolve4 (int): Resolve the DNS server domain to an IPv4 address before querying.
         PreResolve6 (int): Resolve the DNS server domain to an IPv6 address before querying.
+        KernelTimestamp (int): Enable `SO_TIMESTAMPING` so the kernel (or the NIC,
+            when it is configured for hardware timestamping) stamps the query and
+            the response, and report the resulting RTT as `kernel_latency_ns`.
+        Tcp (int): Send queries over TCP (RFC 7766). Sessions keep the
+            connection open and pipeline the queries of a batch on it.
+        TcFallback (int): Ask again over TCP when a UDP response is truncated.
 
     Example:
         ```py
@@ -39,7 +78,64 @@ class DNSFlags(enum.IntEnum):
     PdmMetric = 0x0001
     PreResolve4 = 0x0010  # Resolves the DNS Server domain IPv4
     PreResolve6 = 0x0100  # Resolves the DNS Server domain IPv6
-    # DummyFlagB = 0x1000
+    KernelTimestamp = 0x1000  # Kernel / NIC timestamps via SO_TIMESTAMPING
+    Tcp = 0x2000  # Persistent, pipelined TCP connection
+    TcFallback = 0x4000  # Retry truncated UDP responses over TCP
+
+
+# Flags that choose the address family a hostname is resolved to
+_PRE_RESOLVE = DNSFlags.PreResolve4 | DNSFlags.PreResolve6
+# Flags a fan-out cannot honor: it only sends over UDP, on sockets shared by
+# every server
+_FANOUT_UNSUPPORTED = DNSFlags.Tcp | DNSFlags.PdmMetric | DNSFlags.KernelTimestamp
+
+
+class DNSStatus(enum.IntEnum):
+    """
+    DNSStatus describes the outcome of a query sent through the native layer.
+
+    Attributes:
+        Ok (int): A response was received.
+        Timeout (int): No response arrived before the timeout, after all retries.
+        Unreachable (int): The kernel reported an ICMP unreachable for the server.
+        SendError (int): The query could not be sent.
+        ReceiveError (int): The response could not be received.
+        Truncated (int): A response was received but is truncated, either
+            because the TC bit is set or because it did not fit the buffer.
+        SocketError (int): The socket or server address could not be set up.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, DNSStatus, send_dns_query
+        result = send_dns_query(DNSQuery(qname="example.com", rdtype="A", timeout=1), "192.0.2.1")
+        if result.status == DNSStatus.Timeout:
+            print(f"No answer after {result.attempts} attempt(s)")
+        ```
+    """
+
+    Ok = 0
+    Timeout = 1
+    Unreachable = 2
+    SendError = 3
+    ReceiveError = 4
+    Truncated = 5
+    SocketError = 6
+
+
+class DNSTransport(enum.IntEnum):
+    """
+    DNSTransport tells which transport a response was received over.
+
+    Attributes:
+        Udp (int): A UDP datagram.
+        Tcp (int): A TCP connection, requested with `DNSFlags.Tcp` or reached
+            through `DNSFlags.TcFallback`.
+        Tls (int): A DNS-over-TLS connection (RFC 7858) of a `DoTSession`.
+    """
+
+    Udp = 0
+    Tcp = 1
+    Tls = 2
 
 
 @dataclass
@@ -66,6 +162,9 @@ class DNSQuery:
         id (int): Query ID.
         flags (int): DNS flags field (default 256).
         pad (int): Padding bytes for EDNS0.
+        timeout (float): Seconds to wait for a response per attempt, or `None`
+            to wait indefinitely.
+        retries (int): Number of times the query is resent after a timeout.
 
     Example:
         ```py
@@ -77,7 +176,7 @@ class DNSQuery:
 
     qname: typing.Union[dns.name.Name, str]
     rdtype: typing.Union[dns.rdatatype.RdataType, str]
-    rdclass: typing.Union[dns.rdataclass.RdataClass, str] = RdataClass.IN
+    rdclass: typing.Union[dns.rdataclass.RdataClass, str] = "IN"
     use_edns: typing.Union[int, bool, None] = None
     want_dnssec: bool = False
     ednsflags: typing.Union[int, None] = None
@@ -88,6 +187,328 @@ class DNSQuery:
     id: typing.Union[int, None] = None
     flags: int = 256
     pad: int = 0
+    timeout: typing.Union[float, None] = 5.0
+    retries: int = 0
+
+
+@dataclass(frozen=True)
+class SourceOptions:
+    """
+    Local end of the sockets queries are sent from.
+
+    Attributes:
+        address (str): Local IP address to send from, e.g. to pick the
+            interface of a multi-homed probe host. `None` lets the kernel
+            choose.
+        ports (int or Tuple[int, int]): Source port to pin, or an inclusive
+            range of source ports. Ports of a range are handed out
+            round-robin, skipping those already in use. `None` uses an
+            ephemeral port.
+        rotate_every (int): Move the UDP socket of a `MeasurementSession` to
+            the next port of the range after this many queries. Probes are
+            spread over the range (and the ECMP paths it hashes to) while a
+            fixed set of ports is reused, instead of drawing a new ephemeral
+            port per socket. 0 keeps one socket.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, MeasurementSession, SourceOptions
+        source = SourceOptions("192.0.2.10", ports=(40000, 40063), rotate_every=100)
+        with MeasurementSession(source=source) as session:
+            session.query_batch([DNSQuery(f"h{i}.example.com", "A") for i in range(1000)], "8.8.8.8")
+        ```
+    """
+
+    address: typing.Optional[str] = None
+    ports: typing.Union[int, typing.Tuple[int, int], None] = None
+    rotate_every: int = 0
+
+    @property
+    def port_range(self) -> typing.Tuple[int, int]:
+        """
+        The inclusive source port range, `(0, 0)` for ephemeral ports.
+        """
+        if self.ports is None:
+            return (0, 0)
+        if isinstance(self.ports, int):
+            return (self.ports, self.ports)
+        return tuple(self.ports)
+
+
+class DNSServer:
+    """
+    A DNS server whose address is parsed, and for hostnames resolved, once.
+
+    Given a server string, every query would have to work out its address
+    family and parse it again. A `DNSServer` does this once and keeps the
+    packed `sockaddr` the native layer sends to, so reusing it costs no
+    address handling per query. A hostname is resolved again once `ttl`
+    seconds have passed; IP addresses never expire.
+
+    Args:
+        host (str): IP address or hostname of the server.
+        port (int): Destination port of the server.
+        extra_flags (DNSFlags): `DNSFlags.PreResolve4` or
+            `DNSFlags.PreResolve6` resolve a hostname to an IPv4 or an IPv6
+            address only. With neither or both, the first address returned by
+            `getaddrinfo` is used. Other flags are ignored.
+        ttl (float): Seconds a resolved hostname is used for.
+
+    Raises:
+        ValueError: If the port or the TTL is out of range.
+        socket.gaierror: If the hostname does not resolve.
+
+    Example:
+        ```py
+        from measure_dns import DNSFlags, DNSQuery, DNSServer, send_dns_query
+        server = DNSServer("dns.google", extra_flags=DNSFlags.PreResolve6)
+        for _ in range(100):
+            print(send_dns_query(DNSQuery("example.com", "A"), server).latency_ns)
+        ```
+
+    Note:
+        String servers passed to `send_dns_query`, `send_dns_queries` and the
+        sessions are turned into `DNSServer` objects through a small cache,
+        so they too are parsed only once.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = DNS_PORT,
+        extra_flags: DNSFlags = DNSFlags.NoFlag,
+        ttl: float = DEFAULT_RESOLVE_TTL,
+    ):
+        if not 1 <= port <= 65535:
+            raise ValueError(f"Invalid destination port {port}")
+        if ttl < 0:
+            raise ValueError("ttl must not be negative")
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        pre_resolve = extra_flags & _PRE_RESOLVE
+        if pre_resolve == DNSFlags.PreResolve4:
+            self.family = socket.AF_INET
+        elif pre_resolve == DNSFlags.PreResolve6:
+            self.family = socket.AF_INET6
+        else:
+            self.family = socket.AF_UNSPEC
+        self.resolve()
+
+    def resolve(self) -> str:
+        """
+        Resolves the server now, whether or not its TTL has passed.
+
+        Returns:
+            str: The address queries are sent to.
+
+        Raises:
+            socket.gaierror: If the hostname does not resolve.
+        """
+        try:
+            infos = socket.getaddrinfo(
+                self.host, self.port, socket.AF_UNSPEC, socket.SOCK_DGRAM, 0, socket.AI_NUMERICHOST
+            )
+            self._expires = None
+        except socket.gaierror:
+            infos = socket.getaddrinfo(self.host, self.port, self.family, socket.SOCK_DGRAM)
+            self._expires = time.monotonic() + self.ttl
+        family, _, _, _, address = infos[0]
+        port = self.port.to_bytes(2, "big")
+        if family == socket.AF_INET6:
+            self._sockaddr = _SOCKADDR_IN6.pack(
+                family,
+                port,
+                address[2].to_bytes(4, "big"),
+                socket.inet_pton(family, address[0].partition("%")[0]),
+                address[3],
+            )
+        else:
+            self._sockaddr = _SOCKADDR_IN.pack(family, port, socket.inet_pton(family, address[0]))
+        self._address = address[0]
+        self._use_ipv6 = family == socket.AF_INET6
+        self._endpoints: typing.Dict[typing.Hashable, DNSEndpoint] = {}
+        return self._address
+
+    def _current(self) -> None:
+        """
+        Resolves the server again if its TTL has passed.
+        """
+        if self._expires is not None and time.monotonic() >= self._expires:
+            self.resolve()
+
+    @property
+    def address(self) -> str:
+        """
+        The IP address queries are sent to.
+        """
+        self._current()
+        return self._address
+
+    @property
+    def use_ipv6(self) -> bool:
+        """
+        Whether the server is reached over IPv6.
+        """
+        self._current()
+        return self._use_ipv6
+
+    @property
+    def sockaddr(self) -> bytes:
+        """
+        The packed `sockaddr_in` or `sockaddr_in6` of the server.
+        """
+        self._current()
+        return self._sockaddr
+
+    def _native(self, source: typing.Optional[SourceOptions] = None) -> DNSEndpoint:
+        """
+        Returns the native endpoint settings that send to this server from
+        `source`, built once per source and address.
+        """
+        self._current()
+        key = None if source is None else (source.address, source.port_range, source.rotate_every)
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = _endpoint(self.port, source) or DNSEndpoint()
+            endpoint.server_addr = self._sockaddr
+            endpoint.server_addr_len = len(self._sockaddr)
+            self._endpoints[key] = endpoint
+        return endpoint
+
+    def __getstate__(self) -> dict:
+        # Native endpoints hold pointers and are rebuilt on first use
+        state = self.__dict__.copy()
+        state["_endpoints"] = {}
+        return state
+
+    def __repr__(self) -> str:
+        return f"DNSServer({self.host!r}, port={self.port}, address={self._address!r})"
+
+
+@functools.lru_cache(maxsize=1024)
+def _cached_server(host: str, port: int, pre_resolve: int) -> DNSServer:
+    """
+    Returns the shared `DNSServer` of a server string.
+    """
+    return DNSServer(host, port, DNSFlags(pre_resolve))
+
+
+def _server_of(
+    dns_server: typing.Union[str, DNSServer], port: int, extra_flags: int
+) -> DNSServer:
+    """
+    Returns `dns_server` as a `DNSServer`, looking strings up in the shared
+    cache. `port` only applies to strings.
+    """
+    if isinstance(dns_server, DNSServer):
+        return dns_server
+    return _cached_server(dns_server, port, int(extra_flags) & _PRE_RESOLVE)
+
+
+class DNSHeader(typing.NamedTuple):
+    """
+    Fixed 12-byte header of a DNS message, as returned by `parse_dns_header`.
+
+    Attributes:
+        id (int): DNS message ID.
+        flags (int): The 16-bit flags field, including opcode and RCODE.
+        qdcount (int): Number of entries in the question section.
+        ancount (int): Number of records in the answer section.
+        nscount (int): Number of records in the authority section.
+        arcount (int): Number of records in the additional section.
+    """
+
+    id: int
+    flags: int
+    qdcount: int
+    ancount: int
+    nscount: int
+    arcount: int
+
+    @property
+    def rcode(self) -> int:
+        """
+        Response code from the header (without the EDNS extended bits).
+        """
+        return self.flags & 0x000F
+
+    @property
+    def truncated(self) -> bool:
+        """
+        Whether the TC bit is set.
+        """
+        return bool(self.flags & 0x0200)
+
+
+_HEADER = struct.Struct("!6H")
+
+
+def parse_dns_header(response_bytes: bytes) -> DNSHeader:
+    """
+    Parses the fixed header of a DNS message without dnspython.
+
+    Only the first 12 bytes are read, so this is far cheaper than
+    `decode_dns_response` when the ID, RCODE, TC bit or section counts are
+    all that is needed.
+
+    Args:
+        response_bytes (bytes): Raw DNS message, or any buffer holding one.
+
+    Returns:
+        DNSHeader: The unpacked header fields.
+
+    Raises:
+        ValueError: If the message is shorter than a DNS header.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, parse_dns_header, send_dns_query
+        result = send_dns_query(DNSQuery("example.com", "A"), "8.8.8.8")
+        print(parse_dns_header(result.wire).rcode)
+        ```
+    """
+    if len(response_bytes) < _HEADER.size:
+        raise ValueError("DNS message is shorter than its 12-byte header")
+    return DNSHeader._make(_HEADER.unpack_from(response_bytes))
+
+
+class _Undecoded:
+    """
+    Default of `DNSResult.response`: decode from `DNSResult.wire` on access.
+    """
+
+    def __repr__(self) -> str:
+        return "<undecoded>"
+
+
+_UNDECODED = _Undecoded()
+
+
+class _LazyResponse:
+    """
+    Data descriptor behind `DNSResult.response`. Unless a decoded message is
+    passed in, the response is decoded from `DNSResult.wire` the first time it
+    is read and kept afterwards.
+    """
+
+    def __get__(self, result, owner=None):
+        if result is None:
+            return _UNDECODED
+        response = result.__dict__.get("_response", _UNDECODED)
+        if response is _UNDECODED:
+            response = (
+                None if result.wire is None else decode_dns_response(bytes(result.wire))
+            )
+            result.__dict__["_response"] = response
+        return response
+
+    def __set__(self, result, value) -> None:
+        # The dataclass passes the descriptor itself as the default
+        if value is _UNDECODED or value is self:
+            result.__dict__.pop("_response", None)
+        else:
+            result.__dict__["_response"] = value
 
 
 @dataclass
@@ -96,33 +517,183 @@ class DNSResult:
     Represents the parsed result of a DNS query. Encapsulates the result
     of a DNS query made using the native C-extension
 
+    A result is truthy only if it carries a response, so failed queries can
+    be filtered with `if result:`.
+
     Attributes:
-        response (dns.message.Message): Decoded DNS response.
+        response (dns.message.Message): Decoded DNS response, or `None` if no
+            response was received. It is decoded from `wire` on first access,
+            so latency-only measurements never pay for dnspython parsing.
         latency_ns (float): Round-trip time in nanoseconds.
         additional_params (list): Parsed PDM or diagnostic options.
+        status (DNSStatus): Outcome of the query.
+        error_code (int): `errno` of the failing system call, 0 on success.
+        attempts (int): Number of times the query was sent.
+        kernel_latency_ns (float): Round-trip time between the kernel TX and RX
+            timestamps, free of syscall and scheduler jitter. `None` unless
+            `DNSFlags.KernelTimestamp` was set and both timestamps were available.
+        hardware_timestamps (bool): Whether `kernel_latency_ns` comes from NIC
+            hardware timestamps rather than kernel software timestamps.
+        wire (bytes or memoryview): Raw response as received, or `None`. It
+            is a `memoryview` into the receive slot when the query used a
+            zero-copy `ResponseBuffer`.
+        transport (DNSTransport): Transport the response was received over.
+        connect_ns (float): TCP handshake time in nanoseconds if this query
+            opened the connection, else `None`. It is not part of `latency_ns`,
+            which only covers the query itself.
+        tls_handshake_ns (float): TLS handshake time in nanoseconds if this
+            query opened a DNS-over-TLS connection, else `None`. Like
+            `connect_ns`, it is not part of `latency_ns`.
+        tls_resumed (bool): Whether that TLS handshake resumed an earlier TLS
+            session, or `None` if the query did not open a connection.
     """
 
-    response: dns.message.QueryMessage
-    latency_ns: float
-    additional_params: list
+    # Left out of repr and equality, which compare `wire`, so neither decodes
+    response: typing.Union[dns.message.QueryMessage, None] = field(
+        default=_LazyResponse(), repr=False, compare=False
+    )
+    latency_ns: float = 0.0
+    additional_params: list = field(default_factory=list)
+    status: DNSStatus = DNSStatus.Ok
+    error_code: int = 0
+    attempts: int = 1
+    kernel_latency_ns: typing.Union[float, None] = None
+    hardware_timestamps: bool = False
+    wire: typing.Union[bytes, memoryview, None] = None
+    transport: DNSTransport = DNSTransport.Udp
+    connect_ns: typing.Union[float, None] = None
+    tls_handshake_ns: typing.Union[float, None] = None
+    tls_resumed: typing.Union[bool, None] = None
+
+    @property
+    def header(self) -> typing.Union[DNSHeader, None]:
+        """
+        Header of the response parsed without dnspython, or `None` if no
+        response was received.
+        """
+        if self.wire is None:
+            return None
+        return parse_dns_header(self.wire)
+
+    @property
+    def rcode(self) -> typing.Union[int, None]:
+        """
+        RCODE of the response header, or `None` if no response was received.
+        """
+        if self.wire is None:
+            return None
+        return parse_dns_header(self.wire).rcode
+
+    def __bool__(self) -> bool:
+        return self.wire is not None or self.response is not None
+
+
+class ResponseBuffer:
+    """
+    Reusable native storage for DNS responses.
+
+    Every call to `send_dns_query` or `send_dns_queries` otherwise allocates
+    fresh `DNSResponse` slots for the native layer to fill. Passing the same
+    `ResponseBuffer` to repeated calls reuses its slots instead, so
+    long-running measurement loops allocate nothing per query on the native
+    side. The buffer grows to fit the largest batch it has been used for.
+
+    Args:
+        capacity (int): Number of response slots to allocate up front.
+        zero_copy (bool): Hand out responses as `memoryview`s into the buffer
+            instead of copying them into `bytes`.
+        response_size (int): Bytes reserved for each response, up to 65535.
+            Larger responses are cut and reported as `DNSStatus.Truncated`;
+            raise it for large EDNS payloads (e.g. DNSSEC). Calls with
+            `DNSFlags.Tcp` or `DNSFlags.TcFallback` grow it to 65535.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, ResponseBuffer, send_dns_query
+        buffer = ResponseBuffer()
+        for _ in range(1000):
+            result = send_dns_query(DNSQuery("example.com", "A"), "8.8.8.8", buffer=buffer)
+        ```
+
+    Note:
+        By default responses are copied out of the buffer before a call
+        returns, so a `DNSResult` stays valid after the buffer is reused. With
+        `zero_copy=True` the `wire` of a result is only valid until the next
+        call using the same buffer; read it or decode `response` before then.
+        A buffer must not be shared between threads.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 1,
+        zero_copy: bool = False,
+        response_size: int = DEFAULT_RESPONSE_SIZE,
+    ):
+        if capacity < 1:
+            raise ValueError("A response buffer needs at least one slot")
+        if not 12 <= response_size <= MAX_DNS_MESSAGE_SIZE:
+            raise ValueError(
+                f"response_size must be between 12 and {MAX_DNS_MESSAGE_SIZE} bytes"
+            )
+        self.zero_copy = zero_copy
+        self._slots = _bind_slots(capacity, response_size)
+
+    @property
+    def capacity(self) -> int:
+        """
+        Number of response slots currently allocated.
+        """
+        return len(self._slots)
+
+    @property
+    def response_size(self) -> int:
+        """
+        Bytes reserved for each response.
+        """
+        return self._slots[0].response_capacity
+
+    def reserve(self, count: int, response_size: typing.Optional[int] = None) -> ctypes.Array:
+        """
+        Returns the slot array, growing it to hold at least `count` responses
+        of at least `response_size` bytes.
+        """
+        current_size = self.response_size
+        if count > len(self._slots) or (response_size or 0) > current_size:
+            self._slots = _bind_slots(
+                max(count, len(self._slots)), max(response_size or 0, current_size)
+            )
+        return self._slots
 
 
 def send_dns_query(
-    query: DNSQuery, dns_server: str, extra_flags: DNSFlags = 0
+    query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+    dns_server: typing.Union[str, DNSServer],
+    extra_flags: DNSFlags = 0,
+    buffer: typing.Optional[ResponseBuffer] = None,
+    port: int = DNS_PORT,
+    source: typing.Optional[SourceOptions] = None,
 ) -> DNSResult:
     """
     Sends a DNS query to the specified server and returns the response.
 
     Sends a DNS query using the native `measuredns` C extension and collects response metrics. It
-    uses `build_dns_query` to generate the wire format. converts the query into a C-compatible
-    format via `ctypes`. Then calls the `query_dns` function from the compiled shared object.
-    It then extracts latency and any additional diagnostics (e.g., PDM) and parses the binary
-    response back into a `dns.message.QueryMessage`.
+    takes the wire format from the shared `query_cache`, so dnspython only builds each
+    distinct query once. The request is handed to the `query_dns` function of the compiled
+    shared object without copying it.
+    It then extracts latency and any additional diagnostics (e.g., PDM). The binary response
+    is only parsed into a `dns.message.QueryMessage` when `DNSResult.response` is first read.
 
     Args:
-        query (DNSQuery): The DNS query to send.
-        dns_server (str): The target DNS server IP or hostname.
+        query (DNSQuery or bytes-like): The DNS query to send, or an already
+            serialized query in any buffer-protocol object. Raw queries use
+            the default `DNSQuery` timeout and no retries.
+        dns_server (str or DNSServer): The target DNS server IP or hostname,
+            or a `DNSServer` resolved beforehand.
         extra_flags (DNSFlags): Additional control flags (e.g., for metrics or pre-resolve).
+        buffer (ResponseBuffer): Optional storage for the native response,
+            reused across calls instead of allocating a new slot.
+        port (int): Destination port of a server given as a string.
+        source (SourceOptions): Local address and source ports to send from.
 
     Returns:
         DNSResult: Decoded DNS response, latency, and any additional parameters.
@@ -136,67 +707,516 @@ def send_dns_query(
         ```
 
     Note:
-        This function may return `None` if the native C-layer call fails.
-    """
-    request = build_dns_query(
-        qname=query.qname,
-        rdtype=query.rdtype,
-        rdclass=query.rdclass,
-        use_edns=query.use_edns,
-        want_dnssec=query.want_dnssec,
-        ednsflags=query.ednsflags,
-        payload=query.payload,
-        request_payload=query.request_payload,
-        options=query.options,
-        idna_codec=query.idna_codec,
-        id=query.id,
-        flags=query.flags,
-        pad=query.pad,
+        The native layer waits at most `query.timeout` seconds per attempt and
+        resends the query up to `query.retries` times. If no response arrives,
+        the returned result has no `response` and its `status` tells why.
+        The GIL is released while the native call runs, and concurrent calls
+        share no socket or working memory, so threaded probers can call this
+        from many threads at once as long as each passes its own `buffer`.
+    """
+    clock = _clock()
+    request, timeout, retries = _request_of(query)
+    if clock:
+        clock.lap()
+    server = _server_of(dns_server, port, extra_flags)
+    endpoint = server._native(source)
+
+    response_struct = _allocate_responses(1, buffer, _response_size_for(extra_flags))[0]
+    writer = capture.writer
+    if clock:
+        clock.lap()
+    dns_lib.query_dns(
+        None,  # The server address and family come packed in the endpoint
+        request,
+        len(request),
+        ctypes.byref(response_struct),
+        0,
+        ctypes.c_int(extra_flags),
+        _timeout_ms(timeout),
+        retries,
+        endpoint,
     )
-    request_size = len(request)
+    if clock:
+        clock.lap()
+    result = _result_from_response(response_struct, _zero_copy(buffer))
+    if clock:
+        clock.finish(len(request), (response_struct,), 1)
+    if writer is not None:
+        writer._write_responses((server,), source, (request,), (response_struct,), 1)
+    return result
+
+
+def send_dns_queries(
+    queries: typing.Sequence[typing.Union[DNSQuery, bytes, bytearray, memoryview]],
+    dns_server: typing.Union[str, DNSServer],
+    extra_flags: DNSFlags = 0,
+    timeout: typing.Optional[float] = None,
+    retries: typing.Optional[int] = None,
+    buffer: typing.Optional[ResponseBuffer] = None,
+    port: int = DNS_PORT,
+    source: typing.Optional[SourceOptions] = None,
+) -> typing.List[DNSResult]:
+    """
+    Sends a batch of DNS queries to one server in a single native call.
+
+    All queries are serialized up front and handed to the `query_dns_batch`
+    function of the compiled shared object, which writes them with `sendmmsg`
+    over one socket, drains the replies with `recvmmsg` and matches each reply
+    back to its query by DNS ID. This avoids the socket setup and the ctypes
+    round trip that `send_dns_query` pays for every single query.
 
-    request_ctypes = (ctypes.c_ubyte * request_size)(*request)
-    dns_server_ctypes = ctypes.c_char_p(dns_server.encode())
+    Args:
+        queries (Sequence[DNSQuery]): The DNS queries to send (at most 65536),
+            either as `DNSQuery` objects or already serialized.
+        dns_server (str or DNSServer): The target DNS server IP or hostname,
+            or a `DNSServer` resolved beforehand.
+        extra_flags (DNSFlags): Additional control flags (e.g., for metrics).
+        timeout (float): Seconds to wait for outstanding replies once the last
+            query of a round has been sent. Defaults to the largest
+            `DNSQuery.timeout` of the batch.
+        retries (int): Number of rounds resending the unanswered queries.
+            Defaults to the largest `DNSQuery.retries` of the batch.
+        buffer (ResponseBuffer): Optional storage for the native responses,
+            grown to the batch size and reused across calls.
+        port (int): Destination port of a server given as a string.
+        source (SourceOptions): Local address and source port to send from.
+
+    Returns:
+        list: One `DNSResult` per query, in the same order. Queries that got
+        no reply have no `response` and a `status` explaining why.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, send_dns_queries
+        queries = [DNSQuery(qname=name, rdtype="A") for name in ("a.in", "b.in")]
+        for result in send_dns_queries(queries, "8.8.8.8"):
+            print(result.latency_ns if result else result.status)
+        ```
 
-    use_ipv6_ctypes = ctypes.c_int(
-        0 if type(ip_address(dns_server)) is IPv4Address else 1
+    Note:
+        Queries that share a DNS ID are given fresh random IDs, since the ID is
+        what ties a reply to its query. Latency of a query is measured from the
+        `sendmmsg` call that carried it. Like `send_dns_query`, this runs
+        without the GIL and can be called from many threads at once.
+    """
+    num_queries = len(queries)
+    if num_queries == 0:
+        return []
+    if num_queries > MAX_BATCH_QUERIES:
+        raise ValueError(f"At most {MAX_BATCH_QUERIES} queries can be sent in one batch")
+
+    clock = _clock()
+    requests_ctypes, sizes_ctypes = _pack_queries(queries)
+    if clock:
+        clock.lap()
+    server = _server_of(dns_server, port, extra_flags)
+    endpoint = server._native(source)
+    timeout, retries = _batch_timeout(queries, timeout, retries)
+    responses = _allocate_responses(num_queries, buffer, _response_size_for(extra_flags))
+
+    writer = capture.writer
+    if clock:
+        clock.lap()
+    dns_lib.query_dns_batch(
+        None,  # The server address and family come packed in the endpoint
+        requests_ctypes,
+        sizes_ctypes,
+        num_queries,
+        responses,
+        0,
+        ctypes.c_int(extra_flags),
+        _timeout_ms(timeout),
+        retries,
+        endpoint,
     )
-    extra_flags_ctypes = ctypes.c_int(extra_flags)
-
-    response_struct = DNSResponse()
-    response_struct.num_additional_params = 0
-    response_size = dns_lib.query_dns(
-        dns_server_ctypes,
-        request_ctypes,
-        request_size,
-        ctypes.byref(response_struct),
-        use_ipv6_ctypes,
-        extra_flags_ctypes,
+    if clock:
+        clock.lap()
+    storage = _zero_copy(buffer)
+    results = [_result_from_response(responses[i], storage) for i in range(num_queries)]
+    if clock:
+        clock.finish(sizes_ctypes, responses, num_queries)
+    if writer is not None:
+        requests = _split_requests(requests_ctypes, sizes_ctypes, num_queries)
+        writer._write_responses([server] * num_queries, source, requests, responses, num_queries)
+    return results
+
+
+def fanout_query(
+    query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+    servers: typing.Sequence[typing.Union[str, DNSServer]],
+    extra_flags: DNSFlags = 0,
+    buffer: typing.Optional[ResponseBuffer] = None,
+    port: int = DNS_PORT,
+    source: typing.Optional[SourceOptions] = None,
+) -> typing.Dict[typing.Union[str, DNSServer], DNSResult]:
+    """
+    Sends one DNS query to a whole set of servers at once and measures each.
+
+    The query is serialized once and handed to the `query_dns_fanout`
+    function of the compiled shared object, which writes it to every server
+    with `sendmmsg` over one socket per address family, so IPv4 and IPv6
+    servers can be mixed. Each server gets its own DNS ID, and every reply
+    is matched to its server by that ID and by its source address. The set
+    is therefore measured in about one round trip of its slowest server,
+    with all servers probed at nearly the same moment, instead of one round
+    trip per server.
+
+    Args:
+        query (DNSQuery or bytes-like): The DNS query to send, or an already
+            serialized query.
+        servers (Sequence[str or DNSServer]): The target server IPs or
+            hostnames, or `DNSServer`s resolved beforehand (at most 65536).
+        extra_flags (DNSFlags): Additional control flags. With
+            `DNSFlags.TcFallback` truncated responses are asked again over
+            TCP, one server after the other.
+        buffer (ResponseBuffer): Optional storage for the native responses,
+            grown to the number of servers and reused across calls.
+        port (int): Destination port of the servers given as strings.
+        source (SourceOptions): Local address and source port to send from.
+            The address only applies to servers of its address family.
+
+    Returns:
+        dict: The `DNSResult` of every server, keyed by the server as given
+        and in the order of `servers`. Servers that did not reply have no
+        `response` and a `status` explaining why.
+
+    Raises:
+        ValueError: If a server is listed twice, or if `extra_flags` asks
+            for TCP, PDM or kernel timestamps, which a fan-out does not
+            support.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, fanout_query
+        servers = ["13.127.175.92", "65.0.92.216", "2406:da1a:8e8:e863:ab7a:cb7e:2cf9:dc78"]
+        table = fanout_query(DNSQuery("testprotocol.in", "NS"), servers)
+        for server, result in table.items():
+            print(f"{server:<40} {result.latency_ns / 1e6:.2f} ms" if result else f"{server:<40} {result.status.name}")
+        ```
+
+    Note:
+        The query timeout applies once the last server of a round has been
+        sent to, and `query.retries` further rounds resend to the servers
+        still silent. Like `send_dns_query`, this runs without the GIL.
+    """
+    num_servers = len(servers)
+    if num_servers == 0:
+        return {}
+    if num_servers > MAX_BATCH_QUERIES:
+        raise ValueError(f"At most {MAX_BATCH_QUERIES} servers can be queried at once")
+    if extra_flags & _FANOUT_UNSUPPORTED:
+        raise ValueError("fanout_query does not support DNSFlags.Tcp, PdmMetric or KernelTimestamp")
+    if len(set(servers)) != num_servers:
+        raise ValueError("Every server must be listed once")
+
+    clock = _clock()
+    request, timeout, retries = _request_of(query)
+    if clock:
+        clock.lap()
+    # The resolved servers own the packed addresses the endpoints point to
+    resolved = [_server_of(server, port, extra_flags) for server in servers]
+    endpoints = (DNSEndpoint * num_servers)(*(server._native(source) for server in resolved))
+    responses = _allocate_responses(num_servers, buffer, _response_size_for(extra_flags))
+
+    writer = capture.writer
+    if clock:
+        clock.lap()
+    dns_lib.query_dns_fanout(
+        request,
+        len(request),
+        endpoints,
+        num_servers,
+        responses,
+        ctypes.c_int(extra_flags),
+        _timeout_ms(timeout),
+        retries,
     )
-    additional_params_list = []
-    for i in range(response_struct.num_additional_params):
-        params = response_struct.additional_params[i]
-        if params.type == 59:
-            # Destination Option
-            dstopt = ctypes.cast(params.data, ctypes.POINTER(DestOptHdr)).contents
+    if clock:
+        clock.lap()
+    storage = _zero_copy(buffer)
+    results = {server: _result_from_response(responses[i], storage) for i, server in enumerate(servers)}
+    if clock:
+        clock.finish(len(request), responses, num_servers)
+    if writer is not None:
+        # Server i was sent the query with the ID of the request plus i
+        first_id = int.from_bytes(bytes(request[:2]), "big")
+        requests = [((first_id + i) & 0xFFFF).to_bytes(2, "big") + bytes(request[2:]) for i in range(num_servers)]
+        writer._write_responses(resolved, source, requests, responses, num_servers)
+    return results
+
+
+def _query_to_wire(query: DNSQuery) -> bytes:
+    """
+    Serializes a `DNSQuery` into wire format through the shared `query_cache`.
+    """
+    return query_cache.wire(query)
+
+
+def _native_buffer(
+    request: typing.Union[bytes, bytearray, memoryview],
+) -> typing.Union[bytes, ctypes.Array]:
+    """
+    Returns a serialized request in a form the native layer reads in place:
+    `bytes` as they are and writable buffers through `from_buffer`. Only
+    read-only buffers other than `bytes` are copied.
+    """
+    if isinstance(request, bytes):
+        return request
+    view = memoryview(request)
+    if view.readonly or not view.c_contiguous:
+        return view.tobytes()
+    return (ctypes.c_ubyte * view.nbytes).from_buffer(view)
+
+
+def _request_of(
+    query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+) -> typing.Tuple[typing.Union[bytes, ctypes.Array], typing.Optional[float], int]:
+    """
+    Returns the native request buffer, timeout and retry count of a query,
+    which is either a `DNSQuery` or an already serialized request.
+    """
+    if isinstance(query, DNSQuery):
+        return _query_to_wire(query), query.timeout, query.retries
+    return _native_buffer(query), DNSQuery.timeout, 0
 
-            # Extract PDM Option (first 10 bytes of options)
-            pdm_raw = bytes(dstopt.options[:12])
 
-            # Cast the extracted bytes into a PDMOption structure
-            pdm_option = PDMOption.from_buffer_copy(pdm_raw)
-            additional_params_list.append(pdm_option)
+def _zero_copy(buffer: typing.Optional[ResponseBuffer]) -> typing.Optional[ctypes.Array]:
+    """
+    Returns the response storage of a zero-copy `buffer`, or `None` if
+    responses must be copied out.
+    """
+    if buffer is None or not buffer.zero_copy:
+        return None
+    return buffer._slots._storage
+
+
+def _endpoint(
+    port: int, source: typing.Optional[SourceOptions]
+) -> typing.Optional[DNSEndpoint]:
+    """
+    Returns the native endpoint settings for `port` and `source`, or `None`
+    when both are the defaults.
+    """
+    if not 1 <= port <= 65535:
+        raise ValueError(f"Invalid destination port {port}")
+    if source is None:
+        return None if port == DNS_PORT else DNSEndpoint(port=port)
+    port_min, port_max = source.port_range
+    if not (0 <= port_min <= port_max <= 65535) or (port_min == 0 and port_max != 0):
+        raise ValueError(f"Invalid source port range {source.ports}")
+    if source.rotate_every < 0:
+        raise ValueError("rotate_every must not be negative")
+    return DNSEndpoint(
+        port=port,
+        bind_address=None if source.address is None else source.address.encode(),
+        source_port_min=port_min,
+        source_port_max=port_max,
+        rotate_every=source.rotate_every,
+    )
+
+
+def _response_size_for(extra_flags: int) -> int:
+    """
+    Default receive buffer size for queries sent with `extra_flags`: TCP
+    responses can be as large as a DNS message gets.
+    """
+    if extra_flags & (DNSFlags.Tcp | DNSFlags.TcFallback):
+        return MAX_DNS_MESSAGE_SIZE
+    return DEFAULT_RESPONSE_SIZE
+
+
+def _bind_slots(count: int, response_size: int) -> ctypes.Array:
+    """
+    Allocates `count` response slots, each receiving into its own
+    `response_size` bytes of one shared storage block. The slot array keeps
+    the storage alive.
+    """
+    slots = (DNSResponse * count)()
+    slots._storage = (ctypes.c_ubyte * (count * response_size))()
+    dns_lib.dns_bind_responses(slots, count, slots._storage, response_size)
+    return slots
+
+
+# `AdditionalParam.type` of IPv6 destination options, and the Pad1 and PDM
+# options (RFC 8250) they may carry
+_IPV6_DSTOPTS = 59
+_PAD1 = 0
+_PDM_OPTION_TYPE = 0x0F
+_PDM_OPT_LEN = ctypes.sizeof(PDMOption) - 2
+
+# Kernel timestamp sources reported by the native layer
+_TIMESTAMP_NONE = 0
+_TIMESTAMP_HARDWARE = 2
+
+
+def _timeout_ms(timeout: typing.Optional[float]) -> int:
+    """
+    Converts a timeout in seconds to the native milliseconds convention,
+    where a value <= 0 waits forever.
+    """
+    if timeout is None:
+        return 0
+    return max(1, int(timeout * 1000))
+
+
+def _batch_timeout(
+    queries: typing.Sequence[DNSQuery],
+    timeout: typing.Optional[float],
+    retries: typing.Optional[int],
+) -> typing.Tuple[typing.Optional[float], int]:
+    """
+    Resolves the timeout and retry count of a batch, defaulting to the most
+    patient settings among its queries.
+    """
+    # Serialized requests carry no settings and count as DNSQuery defaults
+    if timeout is None:
+        timeouts = [getattr(query, "timeout", DNSQuery.timeout) for query in queries]
+        timeout = None if None in timeouts else max(timeouts)
+    if retries is None:
+        retries = max(getattr(query, "retries", 0) for query in queries)
+    return timeout, retries
+
+
+def _pack_queries(
+    queries: typing.Sequence[typing.Union[DNSQuery, bytes, bytearray, memoryview]],
+) -> typing.Tuple[typing.Union[bytes, ctypes.Array], ctypes.Array]:
+    """
+    Serializes a batch of queries into one contiguous buffer plus an array of
+    packet sizes, as expected by the native batch functions.
 
-    if response_size > 0:
+    Packing the requests back to back is the one copy a batch makes; a
+    single request is handed over in place like in `send_dns_query`.
+    """
+    requests = _unique_requests(queries)
+    sizes_ctypes = (ctypes.c_int * len(requests))(*map(len, requests))
+    if len(requests) == 1:
+        return _native_buffer(requests[0]), sizes_ctypes
+    return b"".join(requests), sizes_ctypes
+
+
+def _unique_requests(
+    queries: typing.Sequence[typing.Union[DNSQuery, bytes, bytearray, memoryview]],
+) -> typing.List[typing.Union[bytes, bytearray, memoryview]]:
+    """
+    Serializes a batch of queries. Queries that share a DNS ID are given
+    fresh random IDs, since the ID is what ties a reply to its query.
+    Already serialized queries are kept as the caller's buffers; only those
+    whose ID is rewritten are copied.
+    """
+    requests = []
+    used_ids = set()
+    for query in queries:
+        if isinstance(query, DNSQuery):
+            request = _query_to_wire(query)
+        elif isinstance(query, memoryview) and query.itemsize != 1:
+            request = query.cast("B")
+        else:
+            request = query
+        (query_id,) = struct.unpack_from("!H", request)
+        if query_id in used_ids:
+            while query_id in used_ids:
+                query_id = random.getrandbits(16)
+            request = bytearray(request)
+            struct.pack_into("!H", request, 0, query_id)
+        used_ids.add(query_id)
+        requests.append(request)
+    return requests
+
+
+def _allocate_responses(
+    num_responses: int,
+    buffer: typing.Optional[ResponseBuffer] = None,
+    response_size: int = DEFAULT_RESPONSE_SIZE,
+) -> ctypes.Array:
+    """
+    Returns native response slots for a batch, taken from `buffer` when one is
+    given. The array may be longer than `num_responses`. Fresh slots receive
+    up to `response_size` bytes. A buffer keeps its own response size unless
+    `response_size` asks for more than the default, as it does for TCP, so
+    large TCP answers are not cut to the size of a UDP buffer.
+    """
+    if buffer is None:
+        return _bind_slots(num_responses, response_size)
+    return buffer.reserve(num_responses, response_size if response_size > DEFAULT_RESPONSE_SIZE else None)
+
+
+def _result_from_response(
+    response_struct: DNSResponse, storage: typing.Optional[ctypes.Array] = None
+) -> DNSResult:
+    """
+    Converts a filled native response slot into a `DNSResult`. Given the
+    response `storage` of the slot, the result's `wire` is a view into it.
+    """
+    response_size = response_struct.response_size
+    if response_size <= 0:
         return DNSResult(
-            response=decode_dns_response(
-                bytes(response_struct.response[:response_size])
-            ),
-            latency_ns=response_struct.latency_ns,
-            additional_params=additional_params_list,
+            response=None,
+            latency_ns=0.0,
+            additional_params=[],
+            status=DNSStatus(response_struct.status),
+            error_code=response_struct.error_code,
+            attempts=response_struct.attempts,
+            transport=DNSTransport(response_struct.transport),
+            connect_ns=response_struct.connect_ns or None,
         )
+    if storage is None:
+        wire = ctypes.string_at(response_struct.response, response_size)
     else:
-        return None
+        offset = ctypes.cast(response_struct.response, ctypes.c_void_p).value - ctypes.addressof(storage)
+        wire = memoryview(storage).cast("B")[offset : offset + response_size]
+    return DNSResult(
+        wire=wire,
+        latency_ns=response_struct.latency_ns,
+        additional_params=_extract_additional_params(response_struct),
+        status=DNSStatus(response_struct.status),
+        error_code=response_struct.error_code,
+        attempts=response_struct.attempts,
+        kernel_latency_ns=(
+            response_struct.kernel_latency_ns
+            if response_struct.timestamp_source != _TIMESTAMP_NONE
+            else None
+        ),
+        hardware_timestamps=response_struct.timestamp_source == _TIMESTAMP_HARDWARE,
+        transport=DNSTransport(response_struct.transport),
+        connect_ns=response_struct.connect_ns or None,
+    )
+
+
+def _extract_additional_params(response_struct: DNSResponse) -> list:
+    """
+    Extracts the PDM options carried in the additional parameters of a native
+    response. Destination options headers without a PDM option are dropped.
+    """
+    additional_params_list = []
+    for i in range(response_struct.num_additional_params):
+        params = response_struct.additional_params[i]
+        if params.type == _IPV6_DSTOPTS:
+            pdm_option = _find_pdm_option(params.data)
+            if pdm_option is not None:
+                additional_params_list.append(pdm_option)
+    return additional_params_list
+
+
+def _find_pdm_option(header) -> typing.Optional[PDMOption]:
+    """
+    Returns the PDM option of a raw destination options header, skipping the
+    Pad1 and PadN options in front of it like `pdm.decode_pdm`, or `None` if
+    the header carries none.
+    """
+    length = len(header)
+    offset = 2
+    while offset + 2 <= length:
+        if header[offset] == _PAD1:
+            offset += 1
+            continue
+        if (
+            header[offset] == _PDM_OPTION_TYPE
+            and header[offset + 1] == _PDM_OPT_LEN
+            and offset + 2 + _PDM_OPT_LEN <= length
+        ):
+            return PDMOption.from_buffer_copy(bytes(header[offset : offset + 2 + _PDM_OPT_LEN]))
+        offset += 2 + header[offset + 1]
+    return None
 
 
 def decode_dns_response(response_bytes) -> dns.message.QueryMessage:
@@ -219,19 +1239,29 @@ def decode_dns_response(response_bytes) -> dns.message.QueryMessage:
 
     Note:
         If parsing fails, a dictionary with the error message is returned.
+        While `metrics` is enabled, the decode time is recorded and failures
+        are counted as decode errors.
     """
+    import dns.message
+
+    timed = metrics.enabled
+    if timed:
+        start_ns = time.perf_counter_ns()
     try:
         message = dns.message.from_wire(response_bytes)
-        return message
-
     except Exception as e:
+        if timed:
+            metrics._record_decode(time.perf_counter_ns() - start_ns, True)
         return {"error": f"Failed to decode response: {e}"}
+    if timed:
+        metrics._record_decode(time.perf_counter_ns() - start_ns, False)
+    return message
 
 
 def build_dns_query(
     qname: typing.Union[dns.name.Name, str],
     rdtype: typing.Union[dns.rdatatype.RdataType, str],
-    rdclass: typing.Union[dns.rdataclass.RdataClass, str] = RdataClass.IN,
+    rdclass: typing.Union[dns.rdataclass.RdataClass, str] = "IN",
     use_edns: typing.Union[int, bool, None] = None,
     want_dnssec: bool = False,
     ednsflags: typing.Union[int, None] = None,
@@ -278,6 +1308,8 @@ def build_dns_query(
     Note:
         This function does not send the query; it only serializes it.
     """
+    import dns.message
+
     query = dns.message.make_query(
         qname=qname,
         rdtype=rdtype,
@@ -0,0 +1,389 @@
+import os
+import threading
+import time
+import typing
+
+# Stages of a query, in the order they happen
+STAGES = ("build", "marshal", "syscall", "wait", "decode")
+# Counters kept by `Metrics`, with the name and help text of their exported metric
+COUNTERS = {
+    "sent": ("queries_sent", "Queries sent, counting every retry"),
+    "received": ("responses_received", "Queries that received a response"),
+    "timeouts": ("timeouts", "Queries that got no response before their timeout"),
+    "errors": ("errors", "Queries that failed otherwise, e.g. ICMP unreachable or send errors"),
+    "decode_errors": ("decode_errors", "Responses dnspython could not decode"),
+    "bytes_sent": ("sent_bytes", "Bytes of DNS messages sent"),
+    "bytes_received": ("received_bytes", "Bytes of DNS responses received"),
+}
+
+# Durations are counted in power-of-two buckets of nanoseconds: bucket `i`
+# holds the durations below `2 ** i` ns and at least half that, and the last
+# bucket everything longer
+_BUCKETS = 40
+# Bucket bounds written by `to_openmetrics`, from about 1 us to 17 s
+_EXPORTED_BUCKETS = range(10, 35)
+# DNSStatus.Timeout, without importing dns_packet
+_STATUS_TIMEOUT = 1
+
+# Layout of a thread's recorder, one flat list of integers: the counters in the
+# order of `COUNTERS`, then per stage its count, total and buckets
+_SENT, _RECEIVED, _TIMEOUTS, _ERRORS, _DECODE_ERRORS, _BYTES_SENT, _BYTES_RECEIVED = range(len(COUNTERS))
+_STAGE_SIZE = 2 + _BUCKETS
+_BUILD, _MARSHAL, _SYSCALL, _WAIT, _DECODE = (len(COUNTERS) + i * _STAGE_SIZE for i in range(len(STAGES)))
+_RECORDER_SIZE = len(COUNTERS) + len(STAGES) * _STAGE_SIZE
+_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class StageStats(typing.NamedTuple):
+    """
+    Durations recorded for one stage of the query path.
+
+    Attributes:
+        count (int): Number of durations recorded.
+        total_ns (int): Sum of the durations in nanoseconds.
+        buckets (tuple): Number of durations per power-of-two bucket: entry
+            `i` counts those below `2 ** i` nanoseconds and at least
+            `2 ** (i - 1)`.
+    """
+
+    count: int
+    total_ns: int
+    buckets: typing.Tuple[int, ...]
+
+    @property
+    def mean_ns(self) -> float:
+        """
+        Mean duration in nanoseconds, 0.0 if nothing was recorded.
+        """
+        return self.total_ns / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """
+        Returns an upper bound of the duration below which `percent` percent
+        of the recorded durations fall, at most twice the exact value, or
+        0.0 if nothing was recorded.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1.0, percent / 100.0 * self.count)
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return float(1 << index)
+        return float(1 << (len(self.buckets) - 1))
+
+
+class MetricsSnapshot(typing.NamedTuple):
+    """
+    Counters and stage durations of a `Metrics` instance at one moment.
+
+    Attributes:
+        counters (dict): Value of every counter, keyed by the names of
+            `COUNTERS`.
+        stages (dict): `StageStats` of every stage, keyed by the names of
+            `STAGES`.
+    """
+
+    counters: typing.Dict[str, int]
+    stages: typing.Dict[str, StageStats]
+
+
+def _add_duration(recorder: typing.List[int], offset: int, duration_ns: float) -> None:
+    """
+    Adds a duration to the stage of `recorder` starting at `offset`.
+    """
+    duration_ns = int(duration_ns) if duration_ns > 0 else 0
+    recorder[offset] += 1
+    recorder[offset + 1] += duration_ns
+    recorder[offset + 2 + min(duration_ns.bit_length(), _BUCKETS - 1)] += 1
+
+
+class Metrics:
+    """
+    Opt-in instrumentation of the query path.
+
+    When enabled, every query sent through `send_dns_query`,
+    `send_dns_queries`, `fanout_query` or a `MeasurementSession` has its
+    time split into stages, each counted in a histogram:
+
+    - `build`: serializing the queries (dnspython on a `query_cache` miss).
+    - `marshal`: ctypes work around the native call, preparing the server
+      endpoint and response slots and turning the slots into results.
+    - `syscall`: the native call minus the time spent waiting for responses,
+      i.e. socket setup, `sendto`/`recvmsg` and polling overhead.
+    - `wait`: time the native call spent waiting for the network, the
+      latency of the query (the slowest one of a batch), or the whole
+      native call when a query timed out.
+    - `decode`: decoding a response with dnspython.
+
+    Queries of an `AsyncMeasurer` are counted as well. Their `syscall` stage
+    is each `send` call and their `wait` the latency of the answered
+    attempt, or the whole time a query waited when it timed out; they
+    record no `marshal` stage.
+
+    Counters keep the queries sent and received, timeouts, other errors,
+    decode errors and the bytes sent and received. Each thread records into
+    its own counters, so recording takes no lock. Disabled, the query path
+    pays a single attribute check per call.
+
+    Instrumentation starts disabled, unless the `MEASURE_DNS_METRICS`
+    environment variable is set to a non-empty value other than `0`.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, metrics, send_dns_query
+        metrics.enable()
+        for _ in range(1000):
+            send_dns_query(DNSQuery("example.com", "A"), "127.0.0.1").response
+        snapshot = metrics.snapshot()
+        print(snapshot.counters["received"], snapshot.stages["build"].mean_ns)
+        print(metrics.to_openmetrics())
+        ```
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Each thread records into its own list, so recording takes no lock;
+        # snapshots add up the lists of all threads
+        self._recorders: typing.List[typing.List[int]] = []
+
+    def enable(self) -> None:
+        """
+        Starts recording.
+        """
+        self.enabled = True
+
+    def disable(self) -> None:
+        """
+        Stops recording. What was recorded so far is kept.
+        """
+        self.enabled = False
+
+    def reset(self) -> None:
+        """
+        Drops everything recorded so far.
+        """
+        with self._lock:
+            # Threads pick up fresh recorders on their next record
+            self._local = threading.local()
+            self._recorders = []
+
+    def _recorder(self) -> typing.List[int]:
+        """
+        Returns the recorder of the calling thread.
+        """
+        local = self._local
+        recorder = getattr(local, "recorder", None)
+        if recorder is None:
+            recorder = local.recorder = [0] * _RECORDER_SIZE
+            with self._lock:
+                if local is self._local:
+                    self._recorders.append(recorder)
+        return recorder
+
+    def _record_exchange(
+        self,
+        build_ns: int,
+        marshal_ns: int,
+        native_ns: int,
+        sizes: typing.Union[int, typing.Sequence[int]],
+        responses: typing.Sequence,
+        count: int,
+    ) -> None:
+        """
+        Records one native call over `count` filled response slots, whose
+        requests were `sizes` bytes long (one size for all, or one each).
+        """
+        recorder = self._recorder()
+        wait_ns = 0.0
+        for i in range(count):
+            response = responses[i]
+            attempts = response.attempts
+            response_size = response.response_size
+            recorder[_SENT] += attempts
+            recorder[_BYTES_SENT] += attempts * (sizes if isinstance(sizes, int) else sizes[i])
+            if response_size > 0:
+                recorder[_RECEIVED] += 1
+                recorder[_BYTES_RECEIVED] += response_size
+                latency_ns = response.latency_ns
+                if latency_ns > wait_ns:
+                    wait_ns = latency_ns
+            elif response.status == _STATUS_TIMEOUT:
+                recorder[_TIMEOUTS] += 1
+                wait_ns = native_ns
+            else:
+                recorder[_ERRORS] += 1
+        if wait_ns > native_ns:
+            wait_ns = native_ns
+        _add_duration(recorder, _BUILD, build_ns)
+        _add_duration(recorder, _MARSHAL, marshal_ns)
+        _add_duration(recorder, _SYSCALL, native_ns - wait_ns)
+        _add_duration(recorder, _WAIT, wait_ns)
+
+    def _record_build(self, duration_ns: int) -> None:
+        """
+        Records serializing one query of the asynchronous path.
+        """
+        _add_duration(self._recorder(), _BUILD, duration_ns)
+
+    def _record_send(self, size: int, duration_ns: int) -> None:
+        """
+        Records one attempt of the asynchronous path, a `size` byte request
+        whose `send` call took `duration_ns`.
+        """
+        recorder = self._recorder()
+        recorder[_SENT] += 1
+        recorder[_BYTES_SENT] += size
+        _add_duration(recorder, _SYSCALL, duration_ns)
+
+    def _record_response(self, size: int, latency_ns: float) -> None:
+        """
+        Records a response of the asynchronous path, which waited `latency_ns`.
+        """
+        recorder = self._recorder()
+        recorder[_RECEIVED] += 1
+        recorder[_BYTES_RECEIVED] += size
+        _add_duration(recorder, _WAIT, latency_ns)
+
+    def _record_failure(self, status: int, wait_ns: int) -> None:
+        """
+        Records a query of the asynchronous path that got no response, after
+        waiting `wait_ns` if it timed out.
+        """
+        recorder = self._recorder()
+        if status == _STATUS_TIMEOUT:
+            recorder[_TIMEOUTS] += 1
+            _add_duration(recorder, _WAIT, wait_ns)
+        else:
+            recorder[_ERRORS] += 1
+
+    def _record_decode(self, duration_ns: int, failed: bool) -> None:
+        """
+        Records one response decoded with dnspython.
+        """
+        recorder = self._recorder()
+        _add_duration(recorder, _DECODE, duration_ns)
+        if failed:
+            recorder[_DECODE_ERRORS] += 1
+
+    def snapshot(self) -> MetricsSnapshot:
+        """
+        Returns the counters and stage durations recorded so far, summed
+        over all threads.
+        """
+        with self._lock:
+            recorders = list(self._recorders)
+        totals = [sum(values) for values in zip(*recorders)] or [0] * _RECORDER_SIZE
+        counters = dict(zip(COUNTERS, totals))
+        stages = {}
+        for index, stage in enumerate(STAGES):
+            offset = len(COUNTERS) + index * _STAGE_SIZE
+            stages[stage] = StageStats(
+                totals[offset], totals[offset + 1], tuple(totals[offset + 2 : offset + _STAGE_SIZE])
+            )
+        return MetricsSnapshot(counters, stages)
+
+    def to_openmetrics(self, prefix: str = "measure_dns") -> str:
+        """
+        Returns a snapshot in the OpenMetrics text format, which Prometheus
+        scrapes. Counters become `<prefix>_<name>_total` and the stages the
+        `<prefix>_stage_seconds` histogram, labeled by `stage`.
+
+        Args:
+            prefix (str): Prefix of every metric name.
+
+        Returns:
+            str: The exposition, ending with `# EOF`.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, (metric, help_text) in COUNTERS.items():
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            lines.append(f"# HELP {prefix}_{metric} {help_text}.")
+            lines.append(f"{prefix}_{metric}_total {snapshot.counters[name]}")
+
+        histogram = f"{prefix}_stage_seconds"
+        lines.append(f"# TYPE {histogram} histogram")
+        lines.append(f"# UNIT {histogram} seconds")
+        lines.append(f"# HELP {histogram} Time spent in each stage of the query path.")
+        for stage, stats in snapshot.stages.items():
+            cumulative = sum(stats.buckets[: _EXPORTED_BUCKETS.start])
+            for index in _EXPORTED_BUCKETS:
+                cumulative += stats.buckets[index]
+                lines.append(f'{histogram}_bucket{{stage="{stage}",le="{(1 << index) / 1e9!r}"}} {cumulative}')
+            lines.append(f'{histogram}_bucket{{stage="{stage}",le="+Inf"}} {stats.count}')
+            lines.append(f'{histogram}_count{{stage="{stage}"}} {stats.count}')
+            lines.append(f'{histogram}_sum{{stage="{stage}"}} {stats.total_ns / 1e9!r}')
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, address: str = "127.0.0.1", port: int = 9153):
+        """
+        Serves `to_openmetrics` at `/metrics` over HTTP from a background
+        thread, for Prometheus to scrape.
+
+        Args:
+            address (str): Local address to listen on.
+            port (int): TCP port to listen on.
+
+        Returns:
+            http.server.ThreadingHTTPServer: The running server; call its
+            `shutdown` method to stop it.
+        """
+        import http.server
+
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.to_openmetrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", _CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # The library never writes to stderr
+
+        server = http.server.ThreadingHTTPServer((address, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class _Clock:
+    """
+    Lap times of one instrumented call: its start, the end of the build, the
+    start and end of the native call, and its end.
+    """
+
+    __slots__ = ("laps",)
+
+    def __init__(self):
+        self.laps = [time.perf_counter_ns()]
+
+    def lap(self) -> None:
+        self.laps.append(time.perf_counter_ns())
+
+    def finish(self, sizes: typing.Union[int, typing.Sequence[int]], responses: typing.Sequence, count: int) -> None:
+        self.lap()
+        start, built, called, returned, done = self.laps
+        metrics._record_exchange(built - start, (called - built) + (done - returned), returned - called, sizes, responses, count)
+
+
+def _clock() -> typing.Optional[_Clock]:
+    """
+    Returns a clock for an instrumented call, or `None` while disabled.
+    """
+    return _Clock() if metrics.enabled else None
+
+
+# Process-wide instrumentation of the query path
+metrics = Metrics(os.environ.get("MEASURE_DNS_METRICS", "0") not in ("", "0"))
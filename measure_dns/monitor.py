@@ -0,0 +1,448 @@
+import array
+import ctypes
+import errno
+import heapq
+import math
+import random
+import selectors
+import struct
+import time
+import typing
+
+from .dns_packet import (
+    DNS_PORT,
+    DNSFlags,
+    DNSQuery,
+    DNSResult,
+    DNSServer,
+    DNSStatus,
+    SourceOptions,
+    _allocate_responses,
+    _query_to_wire,
+    _result_from_response,
+    _server_of,
+)
+from .capture import capture
+from .session import MeasurementSession
+from .native import dns_lib
+
+# Probes kept per target for the rolling statistics
+DEFAULT_WINDOW = 128
+
+_UNREACHABLE_ERRORS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+_ID = struct.Struct("!H")
+
+
+class MonitorStats(typing.NamedTuple):
+    """
+    Statistics of one `Monitor` target.
+
+    The counters cover the whole run; the latency figures and the loss ratio
+    cover the last `window` probes that completed.
+
+    Attributes:
+        sent (int): Probes sent.
+        received (int): Probes that got a response.
+        lost (int): Probes that timed out.
+        errors (int): Probes that could not be sent.
+        min_ns (float): Smallest latency of the window, `None` without responses.
+        avg_ns (float): Mean latency of the window.
+        p50_ns (float): Median latency of the window.
+        p99_ns (float): 99th percentile latency of the window.
+        loss_ratio (float): Fraction of the window that timed out or failed.
+    """
+
+    sent: int
+    received: int
+    lost: int
+    errors: int
+    min_ns: typing.Optional[float]
+    avg_ns: typing.Optional[float]
+    p50_ns: typing.Optional[float]
+    p99_ns: typing.Optional[float]
+    loss_ratio: float
+
+
+class _Target:
+    """
+    Schedule and rolling statistics of one monitored (server, query) pair.
+    The window is a ring of the latest latencies, NaN for failed probes, so
+    a target keeps the same memory however long it runs.
+    """
+
+    __slots__ = (
+        "index", "server", "query", "request", "interval", "due", "channel",
+        "sent", "received", "lost", "errors", "window", "position", "filled",
+    )
+
+    def __init__(self, index: int, server, query: DNSQuery, interval: float, window: int):
+        self.index = index
+        self.server = server
+        self.query = query
+        self.request = _query_to_wire(query)  # Sent with a fresh DNS ID each time
+        self.interval = interval
+        self.due = 0.0  # Slot of the next probe, before jitter
+        self.channel: typing.Optional[_Channel] = None
+        self.sent = self.received = self.lost = self.errors = 0
+        self.window = array.array("d", [math.nan]) * window
+        self.position = 0
+        self.filled = 0
+
+    def record(self, latency_ns: float) -> None:
+        self.window[self.position] = latency_ns
+        self.position = (self.position + 1) % len(self.window)
+        self.filled = min(self.filled + 1, len(self.window))
+
+    def stats(self) -> MonitorStats:
+        latencies = sorted(value for value in self.window[: self.filled] if value == value)
+        loss_ratio = 1.0 - len(latencies) / self.filled if self.filled else 0.0
+        if not latencies:
+            return MonitorStats(
+                self.sent, self.received, self.lost, self.errors, None, None, None, None, loss_ratio
+            )
+        return MonitorStats(
+            self.sent,
+            self.received,
+            self.lost,
+            self.errors,
+            latencies[0],
+            sum(latencies) / len(latencies),
+            _percentile(latencies, 50.0),
+            _percentile(latencies, 99.0),
+            loss_ratio,
+        )
+
+
+class _Channel:
+    """
+    A native session socket shared by every target of one server, with the
+    probes awaiting a response keyed by DNS ID.
+    """
+
+    def __init__(self, server: DNSServer, handle: int):
+        self.server = server
+        self.handle = handle
+        self.fd = dns_lib.dns_session_fileno(handle)
+        # DNS ID -> (target, send time in native monotonic nanoseconds,
+        # sequence number of the probe)
+        self.pending: typing.Dict[int, typing.Tuple[_Target, int, int]] = {}
+        # Local (address, port) of the socket, read by the first capture
+        self.local: typing.Optional[typing.Tuple[str, int]] = None
+
+
+class Monitor:
+    """
+    Continuously probes many (server, query) targets, each at its own interval.
+
+    Targets are kept in a heap ordered by their next send time. Every pass of
+    the loop pops all probes that are due and sends them back to back over one
+    shared native socket per server, then waits in `select` for responses
+    until the next probe or timeout is due. Each probe is scheduled from the
+    previous slot rather than from the time it was actually sent, so a late
+    pass never shifts the schedule, and a random jitter of up to `jitter`
+    times the interval is added to every send so that targets started
+    together do not stay in lockstep. A target keeps rolling min / avg /
+    p50 / p99 / loss statistics over its last `window` probes.
+
+    Args:
+        targets (Iterable[Tuple[str or DNSServer, DNSQuery, float]]): The
+            (server, query, interval in seconds) triples to probe.
+        extra_flags (DNSFlags): Control flags for every probe.
+        jitter (float): Largest random offset of a send, as a fraction of
+            the interval of its target, between 0 and 0.5.
+        window (int): Number of probes the rolling statistics cover.
+        port (int): Destination port of the servers given as strings.
+        source (SourceOptions): Local address and source port of the sockets.
+        on_result (Callable[[int, DNSResult], None]): Called with the target
+            index and the result of every completed probe, e.g. to write it to
+            a `ResultSink`. Results are only built when a callback is given.
+
+    Attributes:
+        max_lag (float): Largest delay, in seconds, between the time a probe
+            was due and the time it was sent. It stays near zero as long as
+            the loop keeps up with the targets.
+
+    Raises:
+        ValueError: If an interval, the jitter or the window is out of range,
+            or the flags ask for TCP.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, Monitor
+        targets = [(server, DNSQuery("example.com", "A", timeout=1), 10.0) for server in ("1.1.1.1", "8.8.8.8")]
+        with Monitor(targets) as monitor:
+            monitor.run(duration=60)
+            for (server, _, _), stats in zip(targets, monitor.stats()):
+                print(server, stats.p50_ns, stats.loss_ratio)
+        ```
+
+    Note:
+        Each probe is sent once and waits `query.timeout` seconds (the
+        interval of its target if `None`); `query.retries` is not used, since
+        the next probe follows anyway.
+        Latency is taken from the native send and receive timestamps, but a
+        response is only read when the loop gets to it, so an overloaded loop
+        shows up in `max_lag` first. A server with a probe in flight for
+        each of the 65536 DNS IDs counts further probes as send errors.
+        A `Monitor` must only be run from one thread; `stop` may be called
+        from any thread.
+    """
+
+    def __init__(
+        self,
+        targets: typing.Iterable[typing.Tuple[typing.Union[str, DNSServer], DNSQuery, float]],
+        extra_flags: DNSFlags = DNSFlags.NoFlag,
+        jitter: float = 0.1,
+        window: int = DEFAULT_WINDOW,
+        port: int = DNS_PORT,
+        source: typing.Optional[SourceOptions] = None,
+        on_result: typing.Optional[typing.Callable[[int, DNSResult], None]] = None,
+    ):
+        if extra_flags & (DNSFlags.Tcp | DNSFlags.TcFallback):
+            raise ValueError("Monitor only sends queries over UDP")
+        if not 0.0 <= jitter <= 0.5:
+            raise ValueError("jitter must be between 0 and 0.5")
+        if window < 1:
+            raise ValueError("window must be positive")
+        self.extra_flags = extra_flags
+        self.jitter = jitter
+        self.on_result = on_result
+        self._targets: typing.List[_Target] = []
+        for server, query, interval in targets:
+            if not interval > 0:
+                raise ValueError(f"Invalid interval {interval}")
+            self._targets.append(_Target(len(self._targets), server, query, interval, window))
+        self._session = MeasurementSession(extra_flags, port=port, source=source)
+        self._channels: typing.Dict[int, _Channel] = {}
+        self._selector = selectors.DefaultSelector()
+        self._schedule: typing.List[typing.Tuple[float, int]] = []
+        # (deadline, sequence, channel, DNS ID) of every probe in flight
+        self._deadlines: typing.List[typing.Tuple[float, int, _Channel, int]] = []
+        self._sequence = 0
+        self._response_struct = _allocate_responses(1)[0]
+        self._sent_ns = ctypes.c_int64()
+        self._recv_ns = ctypes.c_int64()
+        self._tx_key = ctypes.c_uint32()
+        self._running = False
+        self.max_lag = 0.0
+
+    def __len__(self) -> int:
+        return len(self._targets)
+
+    def run(self, duration: typing.Optional[float] = None) -> None:
+        """
+        Probes the targets until `duration` seconds have passed or `stop` is
+        called. Calling `run` again resumes the schedule where it stopped.
+
+        Args:
+            duration (float): Seconds to run for, or `None` to run until `stop`.
+        """
+        now = time.monotonic()
+        end = math.inf if duration is None else now + duration
+        if not self._schedule:
+            # Spread the first probes of every target over its interval
+            for index, target in enumerate(self._targets):
+                target.due = now + random.uniform(0.0, target.interval)
+                self._schedule.append((target.due, index))
+            heapq.heapify(self._schedule)
+
+        self._running = True
+        try:
+            while self._running:
+                now = time.monotonic()
+                if now >= end:
+                    break
+                self._send_due(now)
+                self._expire(now)
+                wake_at = min(end, self._schedule[0][0] if self._schedule else math.inf)
+                if self._deadlines:
+                    wake_at = min(wake_at, self._deadlines[0][0])
+                timeout = max(0.0, wake_at - time.monotonic())
+                if not self._channels:
+                    time.sleep(min(timeout, 1.0))
+                    continue
+                for key, _ in self._selector.select(min(timeout, 1.0)):
+                    self._drain(key.data)
+        finally:
+            self._running = False
+
+    def stop(self) -> None:
+        """
+        Makes `run` return at its next pass.
+        """
+        self._running = False
+
+    def stats(self, index: typing.Optional[int] = None):
+        """
+        Returns the statistics of target `index`, or of every target in the
+        order they were given.
+
+        Args:
+            index (int): Position of the target, or `None` for all of them.
+
+        Returns:
+            MonitorStats or List[MonitorStats]: The statistics.
+        """
+        if index is not None:
+            return self._targets[index].stats()
+        return [target.stats() for target in self._targets]
+
+    def _channel(self, target: _Target) -> _Channel:
+        """
+        Returns the channel of the server of `target`, registering its socket
+        with the selector on first use.
+        """
+        server = _server_of(target.server, self._session.port, self.extra_flags)
+        handle = self._session._handle(server, self.extra_flags)
+        channel = self._channels.get(handle)
+        if channel is None:
+            channel = self._channels[handle] = _Channel(server, handle)
+            self._selector.register(channel.fd, selectors.EVENT_READ, channel)
+        return channel
+
+    def _send_due(self, now: float) -> None:
+        """
+        Sends every probe that is due and schedules the next probe of each.
+        """
+        schedule = self._schedule
+        while schedule and schedule[0][0] <= now:
+            fire_at, index = heapq.heappop(schedule)
+            target = self._targets[index]
+            self.max_lag = max(self.max_lag, now - fire_at)
+            self._send(target, now)
+
+            target.due += target.interval
+            if target.due < now:
+                # Fell more than an interval behind: skip the missed slots
+                # rather than sending them in a burst
+                target.due += math.ceil((now - target.due) / target.interval) * target.interval
+            jitter = random.uniform(-self.jitter, self.jitter) * target.interval
+            heapq.heappush(schedule, (target.due + jitter, index))
+
+    def _send(self, target: _Target, now: float) -> None:
+        """
+        Sends one probe of `target` without waiting for its response.
+        """
+        if target.channel is None:
+            target.channel = self._channel(target)
+        channel = target.channel
+        target.sent += 1
+        if len(channel.pending) >= 65536:
+            # Every DNS ID of the server is taken by a probe in flight
+            self._send_failed(target, errno.EBUSY)
+            return
+        query_id = random.getrandbits(16) if target.query.id is None else target.query.id
+        while query_id in channel.pending:
+            query_id = random.getrandbits(16)
+        request = _ID.pack(query_id) + target.request[2:]
+
+        if (
+            dns_lib.dns_session_send(
+                channel.handle,
+                request,
+                len(request),
+                ctypes.byref(self._sent_ns),
+                ctypes.byref(self._tx_key),
+            )
+            < 0
+        ):
+            self._send_failed(target, ctypes.get_errno())
+            return
+        writer = capture.writer
+        if writer is not None:
+            writer._write_query(self._sent_ns.value, channel, self._session.source, request)
+        self._sequence += 1
+        channel.pending[query_id] = (target, self._sent_ns.value, self._sequence)
+        timeout = target.interval if target.query.timeout is None else target.query.timeout
+        heapq.heappush(self._deadlines, (now + timeout, self._sequence, channel, query_id))
+
+    def _send_failed(self, target: _Target, error_code: int) -> None:
+        """
+        Records a probe of `target` that could not be sent.
+        """
+        target.errors += 1
+        target.record(math.nan)
+        if self.on_result is not None:
+            status = DNSStatus.Unreachable if error_code in _UNREACHABLE_ERRORS else DNSStatus.SendError
+            self.on_result(target.index, DNSResult(status=status, error_code=error_code, attempts=0))
+
+    def _drain(self, channel: _Channel) -> None:
+        """
+        Reads every response waiting on the channel socket and records it
+        with its target.
+        """
+        response_struct = self._response_struct
+        while True:
+            response_size = dns_lib.dns_session_recv(
+                channel.handle, ctypes.byref(response_struct), ctypes.byref(self._recv_ns)
+            )
+            if response_size < 0:
+                # ICMP errors cannot be attributed to a single probe and are
+                # skipped, those probes time out; an empty socket or any
+                # other error ends the drain
+                if ctypes.get_errno() in _UNREACHABLE_ERRORS:
+                    continue
+                return
+            if response_size < 2:
+                continue
+            query_id = (response_struct.response[0] << 8) | response_struct.response[1]
+            waiter = channel.pending.pop(query_id, None)
+            if waiter is None:
+                continue  # Late or unsolicited response
+            target, sent_ns, _ = waiter
+            latency_ns = self._recv_ns.value - sent_ns
+            target.received += 1
+            writer = capture.writer
+            if writer is not None:
+                writer._write_response(
+                    self._recv_ns.value, channel, self._session.source, response_struct, response_size
+                )
+            target.record(latency_ns)
+            if self.on_result is not None:
+                response_struct.latency_ns = latency_ns
+                response_struct.attempts = 1
+                self.on_result(target.index, _result_from_response(response_struct))
+
+    def _expire(self, now: float) -> None:
+        """
+        Counts the probes whose timeout has passed as lost.
+        """
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, sequence, channel, query_id = heapq.heappop(deadlines)
+            waiter = channel.pending.get(query_id)
+            if waiter is None or waiter[2] != sequence:
+                continue  # Answered in time, the ID may since carry a new probe
+            del channel.pending[query_id]
+            target = waiter[0]
+            target.lost += 1
+            target.record(math.nan)
+            if self.on_result is not None:
+                self.on_result(target.index, DNSResult(status=DNSStatus.Timeout, attempts=1))
+
+    def close(self) -> None:
+        """
+        Closes every socket of the monitor.
+        """
+        for channel in self._channels.values():
+            self._selector.unregister(channel.fd)
+        self._channels.clear()
+        for target in self._targets:
+            target.channel = None
+        self._deadlines.clear()
+        self._selector.close()
+        self._session.close()
+
+    def __enter__(self) -> "Monitor":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _percentile(values: typing.Sequence[float], percent: float) -> float:
+    """
+    Returns the nearest-rank percentile of sorted, non-empty `values`.
+    """
+    rank = max(1, math.ceil(percent / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
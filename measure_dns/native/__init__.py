@@ -1 +1,13 @@
-from .c_interface import dns_lib, DNSResponse, AdditionalParam, PDMOption, DestOptHdr
+from .c_interface import (
+    dns_lib,
+    DNSResponse,
+    AdditionalParam,
+    PDMOption,
+    DestOptHdr,
+    PDMFlow,
+    KernelTimestamp,
+    DNSEndpoint,
+    MAX_ADDITIONAL_PARAMS,
+    MAX_BATCH_QUERIES,
+    MAX_DNS_MESSAGE_SIZE,
+)
@@ -1,19 +1,18 @@
 import ctypes
-import os
 
-# Get the absolute path of the shared library
-LIBRARY_NAME = "measuredns.so"  # Change to "measuredns.dll" for Windows if needed
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # goes up from 'native'
-LIBRARY_PATH = os.path.join(BASE_DIR, 'compiler', LIBRARY_NAME)
+from measure_dns.compiler.ensure_measuredns import ensure_measuredns
 
-if not os.path.exists(LIBRARY_PATH):
-    from measure_dns.compiler.ensure_measuredns import ensure_measuredns
-
-    print("building `measuredns`", end=" :\t")
-    print(ensure_measuredns())
+# Path of the shared library: the extension built at install time, or a
+# cached build of the current source (see `ensure_measuredns`)
+LIBRARY_PATH = ensure_measuredns()
 
 # Load shared C library safely
-dns_lib = ctypes.CDLL(LIBRARY_PATH)
+dns_lib = ctypes.CDLL(LIBRARY_PATH, use_errno=True)
+
+# Limits mirrored from measuredns.c
+MAX_DNS_MESSAGE_SIZE = 65535
+MAX_ADDITIONAL_PARAMS = 5
+MAX_BATCH_QUERIES = 65536
 
 
 class AdditionalParam(ctypes.Structure):
@@ -31,10 +30,13 @@ class AdditionalParam(ctypes.Structure):
     ]
 
 
-class PDMOption(ctypes.Structure):
+class PDMOption(ctypes.BigEndianStructure):
     """
     Represents the Performance and Diagnostic Metrics (PDM) option structure.
 
+    The option is laid out as on the wire (RFC 8250), so its 16-bit fields
+    are read in network byte order.
+
     Attributes:
         option_type (int): Type identifier for the option (usually 0x0F).
         opt_len (int): Length of the option data.
@@ -75,37 +77,288 @@ class DestOptHdr(ctypes.Structure):
     ]
 
 
+class PDMFlow(ctypes.Structure):
+    """
+    Represents the RFC 8250 state of the PDM flow of a measurement session.
+
+    Attributes:
+        psn_next (int): Packet sequence number of the next packet sent.
+        psn_last_received (int): Packet sequence number of the last PDM option
+            received from the server, 0 if it sent none.
+        packets_sent (int): Packets sent with a PDM option.
+        packets_received (int): Packets received on the flow.
+        last_sent_ns (int): Monotonic time of the last send in nanoseconds.
+        last_received_ns (int): Monotonic time of the last receive in nanoseconds.
+        delta_last_sent_ns (int): Time from the send preceding the last receive
+            to that receive, sent as DeltaTLS.
+    """
+
+    _fields_ = [
+        ("psn_next", ctypes.c_uint16),
+        ("psn_last_received", ctypes.c_uint16),
+        ("packets_sent", ctypes.c_uint32),
+        ("packets_received", ctypes.c_uint32),
+        ("last_sent_ns", ctypes.c_int64),
+        ("last_received_ns", ctypes.c_int64),
+        ("delta_last_sent_ns", ctypes.c_int64),
+    ]
+
+
+class KernelTimestamp(ctypes.Structure):
+    """
+    Represents the kernel timestamps (CLOCK_REALTIME) of one packet.
+
+    Attributes:
+        software_ns (int): Software timestamp taken by the kernel, 0 if unavailable.
+        hardware_ns (int): Raw hardware timestamp taken by the NIC, 0 if unavailable.
+    """
+
+    _fields_ = [
+        ("software_ns", ctypes.c_int64),
+        ("hardware_ns", ctypes.c_int64),
+    ]
+
+
+class DNSEndpoint(ctypes.Structure):
+    """
+    Represents the endpoint settings of native sockets. Zero fields keep the
+    defaults.
+
+    Attributes:
+        port (int): Destination port, 53 if 0.
+        bind_address (bytes): Local IP address to send from, or `None` to let
+            the kernel choose.
+        source_port_min (int): First source port to bind, or 0 for an
+            ephemeral port.
+        source_port_max (int): Last source port to bind, `source_port_min` if 0.
+        rotate_every (int): Queries after which a session moves its UDP
+            socket to the next source port, 0 to never rotate.
+        server_addr (bytes): Packed `sockaddr_in` or `sockaddr_in6` of the
+            server, including its port. When set, the server string, address
+            family and `port` passed to the native call are ignored.
+        server_addr_len (int): Length of `server_addr`.
+    """
+
+    _fields_ = [
+        ("port", ctypes.c_int),
+        ("bind_address", ctypes.c_char_p),
+        ("source_port_min", ctypes.c_int),
+        ("source_port_max", ctypes.c_int),
+        ("rotate_every", ctypes.c_int),
+        ("server_addr", ctypes.c_char_p),
+        ("server_addr_len", ctypes.c_int),
+    ]
+
+
 class DNSResponse(ctypes.Structure):
     """
     Represents the raw DNS response returned from the C library.
 
     Attributes:
         response_size (int): Size of the DNS response in bytes.
-        latency_ns (float): Latency of the DNS request in nanoseconds.
-        response (bytes): Raw DNS response (max 512 bytes).
+        latency_ns (float): Latency of the DNS request in nanoseconds,
+            excluding any TCP handshake.
+        response (POINTER(c_ubyte)): Storage the raw DNS response is received
+            into, bound with `dns_bind_responses`.
+        response_capacity (int): Size of the `response` storage in bytes.
         num_additional_params (int): Number of additional diagnostic parameters returned.
-        additional_params (pointer): Pointer to the array of AdditionalParam.
+        additional_params (Array): Received IPv6 Destination Options, stored
+            inline; only the first `num_additional_params` entries are valid.
+        status (int): Outcome of the query, one of the `DNSStatus` codes.
+        error_code (int): `errno` of the failing system call, 0 on success.
+        attempts (int): Number of times the query was sent.
+        kernel_latency_ns (float): RTT between the kernel TX and RX timestamps,
+            0 if unavailable.
+        timestamp_source (int): 0 for none, 1 for kernel software and 2 for
+            NIC hardware timestamps.
+        kernel_rx (KernelTimestamp): Kernel receive timestamp of the response.
+        transport (int): 0 if the response came over UDP, 1 over TCP.
+        connect_ns (float): TCP handshake time paid by this query, 0 if none.
+        sent_ns (int): Native monotonic time the last attempt was sent, 0 if
+            the query was never sent.
+        local_address (Array): Address the last attempt was sent from, in
+            the first 4 bytes for IPv4.
+        local_port (int): Port it was sent from, 0 unless local addresses
+            are reported (see `dns_report_local_addresses`).
     """
 
     _fields_ = [
         ("response_size", ctypes.c_int),
         ("latency_ns", ctypes.c_double),
-        ("response", ctypes.c_ubyte * 512),
+        ("response", ctypes.POINTER(ctypes.c_ubyte)),
+        ("response_capacity", ctypes.c_int),
         ("num_additional_params", ctypes.c_int),
-        ("additional_params", ctypes.POINTER(AdditionalParam)),
+        ("additional_params", AdditionalParam * MAX_ADDITIONAL_PARAMS),
+        ("status", ctypes.c_int),
+        ("error_code", ctypes.c_int),
+        ("attempts", ctypes.c_int),
+        ("kernel_latency_ns", ctypes.c_double),
+        ("timestamp_source", ctypes.c_int),
+        ("kernel_rx", KernelTimestamp),
+        ("transport", ctypes.c_int),
+        ("connect_ns", ctypes.c_double),
+        ("sent_ns", ctypes.c_int64),
+        ("local_address", ctypes.c_ubyte * 16),
+        ("local_port", ctypes.c_int),
     ]
 
 
+# Configure the helper binding response slots to their receive storage
+# Signature:
+#   void dns_bind_responses(DNSResponse*, int, uint8_t*, int);
+dns_lib.dns_bind_responses.argtypes = [
+    ctypes.POINTER(DNSResponse),
+    ctypes.c_int,  # number of slots
+    ctypes.c_void_p,  # storage of count * capacity bytes
+    ctypes.c_int,  # capacity of each slot in bytes
+]
+dns_lib.dns_bind_responses.restype = None
+
 # Configure argument and return type of the native query_dns function
 # Ensures safe interoperation between Python and C
 # Signature:
-#   int query_dns(char*, uint8_t*, int, DNSResponse*, int, int);
+#   int query_dns(char*, uint8_t*, int, DNSResponse*, int, int, int, int, DNSEndpoint*);
 dns_lib.query_dns.argtypes = [
     ctypes.c_char_p,
-    ctypes.POINTER(ctypes.c_ubyte),
+    ctypes.c_void_p,  # request: bytes or any ctypes buffer, passed without copying
     ctypes.c_int,
     ctypes.POINTER(DNSResponse),
     ctypes.c_int,  # use_ipv6 flag
     ctypes.c_int,  # additional flags (e.g., IPv6 traffic class)
+    ctypes.c_int,  # timeout per attempt in milliseconds (<= 0 waits forever)
+    ctypes.c_int,  # number of retries after a timeout
+    ctypes.POINTER(DNSEndpoint),  # endpoint settings, NULL for the defaults
 ]
-dns_lib.query_dns.restype = ctypes.c_int
\ No newline at end of file
+dns_lib.query_dns.restype = ctypes.c_int
+
+# Configure argument and return type of the native query_dns_batch function
+# Signature:
+#   int query_dns_batch(char*, uint8_t*, int*, int, DNSResponse*, int, int, int, int, DNSEndpoint*);
+dns_lib.query_dns_batch.argtypes = [
+    ctypes.c_char_p,
+    ctypes.c_void_p,  # requests, packed back to back
+    ctypes.POINTER(ctypes.c_int),  # size of each request
+    ctypes.c_int,  # number of requests
+    ctypes.POINTER(DNSResponse),  # one response slot per request
+    ctypes.c_int,  # use_ipv6 flag
+    ctypes.c_int,  # additional flags
+    ctypes.c_int,  # timeout in milliseconds after the last send of a round
+    ctypes.c_int,  # number of retry rounds for unanswered queries
+    ctypes.POINTER(DNSEndpoint),  # endpoint settings, NULL for the defaults
+]
+dns_lib.query_dns_batch.restype = ctypes.c_int
+
+# Configure argument and return type of the native query_dns_fanout function
+# Signature:
+#   int query_dns_fanout(uint8_t*, int, DNSEndpoint*, int, DNSResponse*, int, int, int);
+dns_lib.query_dns_fanout.argtypes = [
+    ctypes.c_void_p,  # request, shared by every server and passed without copying
+    ctypes.c_int,  # request size
+    ctypes.POINTER(DNSEndpoint),  # one endpoint per server, each with its server_addr
+    ctypes.c_int,  # number of servers
+    ctypes.POINTER(DNSResponse),  # one response slot per server
+    ctypes.c_int,  # additional flags
+    ctypes.c_int,  # timeout in milliseconds after the last send of a round
+    ctypes.c_int,  # number of retry rounds for silent servers
+]
+dns_lib.query_dns_fanout.restype = ctypes.c_int
+
+
+# Configure the native measurement session functions. A session is an opaque
+# handle owning one connected socket to a single DNS server.
+# Signatures:
+#   DNSSession* dns_session_open(char*, int, int, DNSEndpoint*);
+#   int dns_session_query(DNSSession*, uint8_t*, int, DNSResponse*, int, int);
+#   int dns_session_query_batch(DNSSession*, uint8_t*, int*, int, DNSResponse*, int, int);
+#   int dns_session_fileno(DNSSession*);
+#   int dns_session_send(DNSSession*, uint8_t*, int, int64_t*, uint32_t*);
+#   int dns_session_recv(DNSSession*, DNSResponse*, int64_t*);
+#   int dns_session_tx_timestamp(DNSSession*, uint32_t*, KernelTimestamp*);
+#   int dns_session_local_address(DNSSession*, uint8_t*, int*);
+#   int dns_session_pdm_flow(DNSSession*, PDMFlow*);
+#   void dns_session_close(DNSSession*);
+dns_lib.dns_session_open.argtypes = [
+    ctypes.c_char_p,
+    ctypes.c_int,  # use_ipv6 flag
+    ctypes.c_int,  # additional flags
+    ctypes.POINTER(DNSEndpoint),  # endpoint settings, NULL for the defaults
+]
+dns_lib.dns_session_open.restype = ctypes.c_void_p
+
+dns_lib.dns_session_query.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_void_p,  # request: bytes or any ctypes buffer
+    ctypes.c_int,
+    ctypes.POINTER(DNSResponse),
+    ctypes.c_int,  # timeout per attempt in milliseconds (<= 0 waits forever)
+    ctypes.c_int,  # number of retries after a timeout
+]
+dns_lib.dns_session_query.restype = ctypes.c_int
+
+dns_lib.dns_session_query_batch.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_void_p,  # requests, packed back to back
+    ctypes.POINTER(ctypes.c_int),  # size of each request
+    ctypes.c_int,  # number of requests
+    ctypes.POINTER(DNSResponse),  # one response slot per request
+    ctypes.c_int,  # timeout in milliseconds after the last send of a round
+    ctypes.c_int,  # number of retry rounds for unanswered queries
+]
+dns_lib.dns_session_query_batch.restype = ctypes.c_int
+
+dns_lib.dns_session_fileno.argtypes = [ctypes.c_void_p]
+dns_lib.dns_session_fileno.restype = ctypes.c_int
+
+dns_lib.dns_session_send.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_void_p,  # request: bytes or any ctypes buffer
+    ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64),  # monotonic send time in nanoseconds
+    ctypes.POINTER(ctypes.c_uint32),  # key of the kernel TX timestamp
+]
+dns_lib.dns_session_send.restype = ctypes.c_int
+
+dns_lib.dns_session_recv.argtypes = [
+    ctypes.c_void_p,
+    ctypes.POINTER(DNSResponse),
+    ctypes.POINTER(ctypes.c_int64),  # monotonic receive time in nanoseconds
+]
+dns_lib.dns_session_recv.restype = ctypes.c_int
+
+dns_lib.dns_session_tx_timestamp.argtypes = [
+    ctypes.c_void_p,
+    ctypes.POINTER(ctypes.c_uint32),  # key of the timestamped datagram
+    ctypes.POINTER(KernelTimestamp),
+]
+dns_lib.dns_session_tx_timestamp.restype = ctypes.c_int
+
+dns_lib.dns_session_local_address.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_void_p,  # 16 bytes receiving the address
+    ctypes.POINTER(ctypes.c_int),
+]
+dns_lib.dns_session_local_address.restype = ctypes.c_int
+
+dns_lib.dns_session_pdm_flow.argtypes = [ctypes.c_void_p, ctypes.POINTER(PDMFlow)]
+dns_lib.dns_session_pdm_flow.restype = ctypes.c_int
+
+dns_lib.dns_session_close.argtypes = [ctypes.c_void_p]
+dns_lib.dns_session_close.restype = None
+
+
+# Configure the kernel latency helper, which pairs a TX timestamp with the
+# RX timestamp stored in a response.
+# Signature:
+#   void dns_kernel_latency(KernelTimestamp*, DNSResponse*);
+dns_lib.dns_kernel_latency.argtypes = [
+    ctypes.POINTER(KernelTimestamp),
+    ctypes.POINTER(DNSResponse),
+]
+dns_lib.dns_kernel_latency.restype = None
+
+# Configure the switch that makes exchanges report the local address of
+# each query, which captures write as the source of the packets.
+# Signature:
+#   void dns_report_local_addresses(int);
+dns_lib.dns_report_local_addresses.argtypes = [ctypes.c_int]
+dns_lib.dns_report_local_addresses.restype = None
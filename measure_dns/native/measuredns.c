@@ -1,31 +1,83 @@
 /*
  * Compile with:
- * $ gcc -shared -o measuredns.so -fPIC measuredns.c 
+ * $ gcc -shared -pthread -o measuredns.so -fPIC measuredns.c
  *
  * This code sends a DNS query with optional PDM metrics and processes the response.
- * It supports both IPv4 and IPv6.
+ * It supports both IPv4 and IPv6, over UDP or persistent TCP connections.
+ *
+ * Every entry point may be called from many threads at once: calls share no
+ * state except atomic counters, errors are reported through return values,
+ * `status` and errno, and nothing is written to stdout or stderr. A session
+ * must only be used by one thread at a time.
  */
 
-#include <stdio.h>
+#define _GNU_SOURCE  // Required for sendmmsg / recvmmsg
+
 #include <stdlib.h>
 #include <string.h>
 #include <unistd.h>
-#include <fcntl.h>
+#include <errno.h>
+#include <poll.h>
+#include <pthread.h>
+#include <stdint.h>
+#include <sys/socket.h>
+#include <sys/random.h>
 #include <arpa/inet.h>
 #include <netinet/in.h>
+#include <netinet/tcp.h>
 #include <linux/ipv6.h>
+#include <linux/errqueue.h>
+#include <linux/net_tstamp.h>
 #include <sys/time.h>
 #include <time.h>
 
 
-#define MAX_DNS_PACKET_SIZE 512  // Max size of a DNS packet
+#define MAX_DNS_MESSAGE_SIZE 65535  // Max size of a DNS message (TCP length prefix)
+#define TCP_RX_BUF_SIZE (2 * (MAX_DNS_MESSAGE_SIZE + 2))  // Always fits a whole framed message
 #define PDM_EXTHDR_SIZE 16       // PDM Extension Header size
+#define MAX_BATCH_QUERIES 65536  // One slot per possible DNS ID
+#define BATCH_CHUNK 64           // Messages per sendmmsg / recvmmsg call
+#define CTRL_BUF_SIZE 256        // Ancillary data buffer per received message
+#define SOCKET_RCVBUF (1 << 20)  // Receive buffer requested for bursts of responses
+#define PDM_OPTION_TYPE 0x0F     // IPv6 option type of PDM (RFC 8250)
+#define PDM_OPT_LEN 10           // PDM option length, excluding type and length
+#define DNS_PORT 53              // Default destination port
+#define FANOUT_FAMILIES 2        // Sockets of a fan-out: one IPv4 and one IPv6
 
 // DNS Flag Definitions
 #define DNS_FLAG_NO_FLAG       0x0000  // No special flag
 #define DNS_FLAG_PDM_METRIC    0x0001  // Enable PDM metric extension
 #define DNS_FLAG_PRE_RESOLVE4  0x0010  // Pre-resolve IPv4 address
 #define DNS_FLAG_PRE_RESOLVE6  0x0100  // Pre-resolve IPv6 address
+#define DNS_FLAG_KERNEL_TIMESTAMP 0x1000  // Kernel / NIC timestamps via SO_TIMESTAMPING
+#define DNS_FLAG_TCP           0x2000  // Send over a persistent TCP connection
+#define DNS_FLAG_TC_FALLBACK   0x4000  // Retry truncated UDP responses over TCP
+
+// Query Status Definitions
+#define DNS_STATUS_OK           0  // Response received
+#define DNS_STATUS_TIMEOUT      1  // No response before the deadline
+#define DNS_STATUS_UNREACHABLE  2  // ICMP unreachable reported by the kernel
+#define DNS_STATUS_SEND_ERROR   3  // The query could not be sent
+#define DNS_STATUS_RECV_ERROR   4  // The response could not be received
+#define DNS_STATUS_TRUNCATED    5  // Response truncated (TC bit or short buffer)
+#define DNS_STATUS_SOCKET_ERROR 6  // Socket or server address setup failed
+
+// Kernel Timestamp Source Definitions
+#define DNS_TIMESTAMP_NONE      0  // No kernel timestamps available
+#define DNS_TIMESTAMP_SOFTWARE  1  // Kernel software timestamps
+#define DNS_TIMESTAMP_HARDWARE  2  // NIC hardware timestamps
+
+// Transports a response can be received over
+#define DNS_TRANSPORT_UDP 0
+#define DNS_TRANSPORT_TCP 1
+
+// Timestamping requested on sockets opened with DNS_FLAG_KERNEL_TIMESTAMP.
+// OPT_ID tags every TX timestamp with a per-socket packet counter and
+// OPT_TSONLY keeps the packet payload out of the error queue.
+#define DNS_TIMESTAMPING_FLAGS ( \
+    SOF_TIMESTAMPING_SOFTWARE | SOF_TIMESTAMPING_TX_SOFTWARE | SOF_TIMESTAMPING_RX_SOFTWARE | \
+    SOF_TIMESTAMPING_RAW_HARDWARE | SOF_TIMESTAMPING_TX_HARDWARE | SOF_TIMESTAMPING_RX_HARDWARE | \
+    SOF_TIMESTAMPING_OPT_ID | SOF_TIMESTAMPING_OPT_TSONLY)
 
 // Structure for IPv6 Destination Options Header (Including PDM)
 struct dest_opt_hdr {
@@ -46,6 +98,9 @@ struct pdm_option {
     uint16_t deltatls;      // Delta Time Last Sent
 } __attribute__((aligned(4)));  // Ensure 4-byte alignment
 
+// Control message space of one outgoing Destination Options header
+#define PDM_CMSG_SPACE CMSG_SPACE(sizeof(struct dest_opt_hdr))
+
 // Maximum additional parameters for DNS response
 #define MAX_ADDITIONAL_PARAMS 5
 #define MAX_PARAM_SIZE 32  // Size of additional parameter buffer
@@ -56,176 +111,2281 @@ typedef struct {
     unsigned char data[MAX_PARAM_SIZE]; // Parameter data buffer
 } AdditionalParam;
 
+// Kernel timestamps (CLOCK_REALTIME) of one packet, 0 when unavailable
+typedef struct {
+    int64_t software_ns;  // Software timestamp taken by the kernel
+    int64_t hardware_ns;  // Raw hardware timestamp taken by the NIC
+} KernelTimestamp;
+
 // Structure to hold DNS response details
 typedef struct {
     int response_size;  // Response size in bytes
-    double latency_ns;  // Query latency in nanoseconds
-    unsigned char response[MAX_DNS_PACKET_SIZE];  // Buffer for DNS response
+    double latency_ns;  // Query latency in nanoseconds, excluding any TCP handshake
+    unsigned char* response;  // Buffer for the DNS response, bound by dns_bind_responses
+    int response_capacity;    // Size of `response` in bytes
 
     int num_additional_params;  // Number of additional parameters
-    AdditionalParam *additional_params;  // Pointer to additional parameters array
+    AdditionalParam additional_params[MAX_ADDITIONAL_PARAMS];  // Additional parameters, stored inline
+
+    int status;      // One of the DNS_STATUS_* codes
+    int error_code;  // errno of the failing call, 0 on success
+    int attempts;    // Number of times the query was sent
+
+    double kernel_latency_ns;  // RTT between the kernel TX and RX timestamps, 0 if unavailable
+    int timestamp_source;      // One of the DNS_TIMESTAMP_* codes
+    KernelTimestamp kernel_rx; // Kernel receive timestamp of the response
+
+    int transport;      // One of the DNS_TRANSPORT_* codes
+    double connect_ns;  // TCP handshake time paid by this query, 0 if none
+    int64_t sent_ns;    // Time the last attempt was sent (CLOCK_MONOTONIC_RAW), 0 if never sent
+    unsigned char local_address[16];  // Address the last attempt was sent from, 4 bytes for IPv4
+    int local_port;                   // Port it was sent from, 0 unless local addresses are reported
 } DNSResponse;
-// Generate a random Packet Sequence Number (PSN) using /dev/urandom
-uint16_t get_random_psn() {
-    uint16_t psn;
-    int fd = open("/dev/urandom", O_RDONLY);
-    if (fd < 0 || read(fd, &psn, sizeof(psn)) != sizeof(psn)) {
-        perror("Failed to generate PSN");
-        exit(EXIT_FAILURE);
-    }
-    close(fd);
-    return psn;
-}
+
+/*
+ * Local and remote endpoint settings of the sockets of a session. Every field
+ * is optional: 0 (or NULL) keeps the default. A NULL `DNSEndpoint*` keeps
+ * all defaults.
+ *
+ * A caller that resolved the server itself passes its packed `sockaddr_in`
+ * or `sockaddr_in6` as `server_addr`; the server string, address family and
+ * `port` arguments are then ignored and no address is parsed.
+ */
+typedef struct {
+    int port;                  // Destination port, DNS_PORT if 0
+    const char* bind_address;  // Local address to send from, chosen by the kernel if NULL
+    int source_port_min;       // First source port to bind, an ephemeral port if 0
+    int source_port_max;       // Last source port to bind, source_port_min if 0
+    int rotate_every;          // Queries after which a UDP socket moves to the next source port, 0 never
+    const struct sockaddr* server_addr;  // Pre-parsed server address including its port, or NULL
+    int server_addr_len;                 // Length of server_addr
+} DNSEndpoint;
+
+/*
+ * Working memory of a batch exchange. It is kept by the session and only
+ * grows, so repeated batches of the same size allocate nothing.
+ */
+typedef struct {
+    int capacity;                                 // Requests the per-request arrays can hold
+    int *slots;                                   // DNS ID -> request index
+    int *queue;                                   // Indices sent in the current round
+    unsigned char **packets;                      // Start of each request
+    struct timespec *sent_at;                     // Send time of each request
+    KernelTimestamp *tx_stamps;                   // Kernel TX timestamp of each request
+    int *todo;                                    // Indices a TCP exchange has to send
+    int recv_size;                                // Size of each receive buffer
+    unsigned char *recv_bufs;                     // Receive buffers for one recvmmsg call
+    char (*ctrl_bufs)[CTRL_BUF_SIZE];             // Ancillary data for one recvmmsg call
+} BatchScratch;
+
+/*
+ * A persistent TCP connection to the server of a session (RFC 7766). Queries
+ * are pipelined on it and the responses, which may come in any order, are
+ * reassembled from the byte stream in `rx`.
+ */
+typedef struct {
+    int fd;                // Connected TCP socket, -1 when not connected
+    unsigned char *rx;     // Stream reassembly buffer of TCP_RX_BUF_SIZE bytes
+    size_t rx_len;         // Bytes buffered in `rx`
+    double connect_ns;     // Handshake time of the connection, until charged to a query
+} TCPConn;
+
+/*
+ * RFC 8250 state of the PDM flow of a session. Every packet sent carries the
+ * next PSN, the PSN of the last packet received from the server and the
+ * times elapsed since, so the deltas can be computed across queries.
+ */
+typedef struct {
+    uint16_t psn_next;           // PSNTP of the next packet sent
+    uint16_t psn_last_received;  // PSNTP of the last PDM option received, 0 before
+    uint32_t packets_sent;       // Packets sent with a PDM option
+    uint32_t packets_received;   // Packets received on the flow
+    int64_t last_sent_ns;        // Monotonic time of the last send, 0 before
+    int64_t last_received_ns;    // Monotonic time of the last receive, 0 before
+    int64_t delta_last_sent_ns;  // Time from the send preceding the last receive to it
+} PDMFlow;
+
+/*
+ * A measurement session owns one pre-configured, connected socket to a single
+ * DNS server. Repeated queries through the session skip socket creation,
+ * socket option setup and address parsing.
+ */
+typedef struct {
+    int sockfd;       // Connected UDP socket, -1 for TCP sessions
+    int use_ipv6;     // Address family of the server
+    int flags;        // DNS flags the socket was configured with
+    uint32_t tx_seq;  // Datagrams sent so far, the key of the next TX timestamp
+    int pdm;          // Whether packets carry a PDM option from `pdm_flow`
+    PDMFlow pdm_flow; // PDM state, kept across queries
+    struct sockaddr_storage dest;  // Server address
+    socklen_t dest_len;
+    struct sockaddr_storage source;  // Local address to bind, valid if `bind_source`
+    int bind_source;                 // Whether sockets are bound before connecting
+    int source_port_min;             // Source port range, 0 for ephemeral ports
+    int source_port_max;
+    int rotate_every;                // Queries per UDP socket before rotating, 0 never
+    int queries_on_socket;           // Queries sent since the UDP socket was opened
+    TCPConn tcp;      // TCP connection, for DNS_FLAG_TCP and DNS_FLAG_TC_FALLBACK
+    BatchScratch scratch;  // Reusable batch working memory
+} DNSSession;
 
 // Get the current time in nanoseconds
 static inline void time_get_real_ns(struct timespec *ts) {
     clock_gettime(CLOCK_MONOTONIC_RAW, ts);
 }
 
+// Convert a timestamp to nanoseconds
+static inline int64_t timespec_to_ns(const struct timespec *ts) {
+    return (int64_t)ts->tv_sec * 1000000000LL + ts->tv_nsec;
+}
+
 /*
- * Sends a raw DNS query and receives the response.
- * Supports both IPv4 and IPv6. If PDM metrics are enabled, they are embedded
- * in the IPv6 Destination Options Header.
+ * Returns the initial PSN of a new PDM flow. The generator is seeded once
+ * per process with getrandom(); flows then draw from it without system calls.
  */
-int dns_query(const char* dns_server, unsigned char* request, int req_size, DNSResponse* result, int use_ipv6, int flags) {
-    int sockfd;
-    struct sockaddr_storage dest;
-    struct timespec start, end;
-    socklen_t dest_len;
-    int opt = 1;
+static uint16_t pdm_initial_psn(void) {
+    static uint64_t state;
+    uint64_t seed = __atomic_load_n(&state, __ATOMIC_RELAXED);
+
+    if (seed == 0) {
+        struct timespec now;
+        if (getrandom(&seed, sizeof(seed), GRND_NONBLOCK) != sizeof(seed)) {
+            clock_gettime(CLOCK_REALTIME, &now);
+            seed = (uint64_t)timespec_to_ns(&now);
+        }
+        uint64_t expected = 0;
+        __atomic_compare_exchange_n(&state, &expected, seed | 1, 0, __ATOMIC_RELAXED, __ATOMIC_RELAXED);
+    }
+
+    // splitmix64, mixed with the PID so forked workers start apart
+    uint64_t z = __atomic_add_fetch(&state, 0x9E3779B97F4A7C15ULL, __ATOMIC_RELAXED) ^ (uint64_t)getpid();
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return (uint16_t)(z ^ (z >> 31));
+}
+
+// Encode a time in nanoseconds as a PDM delta and scale (delta << scale attoseconds)
+static void pdm_encode_time(int64_t ns, uint16_t* delta, uint8_t* scale) {
+    unsigned __int128 attoseconds = ns > 0 ? (unsigned __int128)ns * 1000000000u : 0;
+    uint8_t shift = 0;
+
+    while (attoseconds > 0xFFFF) {
+        attoseconds >>= 1;
+        shift++;
+    }
+    *delta = (uint16_t)attoseconds;
+    *scale = shift;
+}
+
+/*
+ * Builds the Destination Options header of the next packet of `flow`, sent
+ * at `now_ns` with PSN `psn`.
+ */
+static void pdm_build_header(const PDMFlow* flow, uint16_t psn, int64_t now_ns, struct dest_opt_hdr* dstopt) {
+    struct pdm_option pdm = { .option_type = PDM_OPTION_TYPE, .opt_len = PDM_OPT_LEN };
+    uint16_t delta;
+
+    pdm.psntp = htons(psn);
+    if (flow->packets_received) {
+        pdm.psnlr = htons(flow->psn_last_received);
+        pdm_encode_time(now_ns - flow->last_received_ns, &delta, &pdm.scale_dtlr);
+        pdm.deltatlr = htons(delta);
+        pdm_encode_time(flow->delta_last_sent_ns, &delta, &pdm.scale_dtls);
+        pdm.deltatls = htons(delta);
+    }
+
+    memset(dstopt, 0, sizeof(*dstopt));
+    dstopt->next_header = IPPROTO_UDP;
+    dstopt->hdr_ext_len = 1;  // Length in 8-octet units, excluding the first 8 octets
+    memcpy(dstopt->options, &pdm, sizeof(pdm));  // The rest is Pad1 padding
+}
+
+/*
+ * Writes an IPV6_DSTOPTS control message carrying the PDM option of the
+ * packet with PSN `psn` into `ctrl`. Returns the length of the control data.
+ */
+static size_t pdm_control(const PDMFlow* flow, uint16_t psn, int64_t now_ns, char* ctrl) {
+    struct dest_opt_hdr dstopt;
+    struct msghdr msg = { .msg_control = ctrl, .msg_controllen = PDM_CMSG_SPACE };
+    struct cmsghdr* cmsg = CMSG_FIRSTHDR(&msg);
 
-    // Inside dns_query, after receiving the message
+    memset(ctrl, 0, PDM_CMSG_SPACE);
+    pdm_build_header(flow, psn, now_ns, &dstopt);
+    cmsg->cmsg_level = IPPROTO_IPV6;
+    cmsg->cmsg_type = IPV6_DSTOPTS;
+    cmsg->cmsg_len = CMSG_LEN(sizeof(dstopt));
+    memcpy(CMSG_DATA(cmsg), &dstopt, sizeof(dstopt));
+    return PDM_CMSG_SPACE;
+}
+
+// Record `count` packets of the flow sent at `now_ns`
+static inline void pdm_flow_sent(PDMFlow* flow, int count, int64_t now_ns) {
+    flow->psn_next += count;
+    flow->packets_sent += count;
+    flow->last_sent_ns = now_ns;
+}
+
+// Find the PDM option of a received Destination Options header. Returns NULL if absent.
+static const unsigned char* find_pdm_option(const unsigned char* header) {
+    size_t len = ((size_t)header[1] + 1) * 8;
+    size_t offset = 2;
+
+    if (len > MAX_PARAM_SIZE) {
+        len = MAX_PARAM_SIZE;
+    }
+    while (offset < len) {
+        if (header[offset] == 0) {
+            offset++;  // Pad1
+            continue;
+        }
+        if (offset + 2 > len) {
+            break;
+        }
+        if (header[offset] == PDM_OPTION_TYPE && header[offset + 1] == PDM_OPT_LEN &&
+            offset + 2 + PDM_OPT_LEN <= len) {
+            return header + offset;
+        }
+        offset += 2 + header[offset + 1];
+    }
+    return NULL;
+}
+
+/*
+ * Record a response received at `now_ns` on the flow. The PSN of the
+ * server's PDM option, when it sent one, becomes the next PSNLR.
+ */
+static void pdm_flow_received(PDMFlow* flow, const DNSResponse* result, int64_t now_ns) {
+    int i;
+
+    flow->packets_received++;
+    flow->delta_last_sent_ns = now_ns - flow->last_sent_ns;
+    flow->last_received_ns = now_ns;
+    for (i = 0; i < result->num_additional_params; i++) {
+        const AdditionalParam* param = &result->additional_params[i];
+        const unsigned char* option;
+        if (param->type == IPV6_DSTOPTS && (option = find_pdm_option(param->data)) != NULL) {
+            flow->psn_last_received = (option[4] << 8) | option[5];
+            break;
+        }
+    }
+}
+
+// Difference between two timestamps in nanoseconds
+static inline int64_t timespec_diff_ns(const struct timespec *start, const struct timespec *end) {
+    return (int64_t)(end->tv_sec - start->tv_sec) * 1000000000LL + (end->tv_nsec - start->tv_nsec);
+}
+
+// Set `deadline` to `timeout_ms` milliseconds after `start`
+static inline void deadline_after_ms(struct timespec *deadline, const struct timespec *start, int timeout_ms) {
+    deadline->tv_sec = start->tv_sec + timeout_ms / 1000;
+    deadline->tv_nsec = start->tv_nsec + (long)(timeout_ms % 1000) * 1000000L;
+    if (deadline->tv_nsec >= 1000000000L) {
+        deadline->tv_sec += 1;
+        deadline->tv_nsec -= 1000000000L;
+    }
+}
+
+// Milliseconds left until `deadline` (rounded up), 0 if it has passed
+static inline int ms_until(const struct timespec *deadline) {
+    struct timespec now;
+    time_get_real_ns(&now);
+    int64_t remaining = timespec_diff_ns(&now, deadline);
+    return remaining > 0 ? (int)((remaining + 999999) / 1000000) : 0;
+}
+
+// Errors through which the kernel reports ICMP unreachable messages
+static inline int is_unreachable_error(int err) {
+    return err == ECONNREFUSED || err == EHOSTUNREACH || err == ENETUNREACH;
+}
+
+// Status of a received response: truncated if cut short or if the TC bit is set
+static inline int response_status(const unsigned char* response, ssize_t size, int msg_flags) {
+    if ((msg_flags & MSG_TRUNC) || (size >= 3 && (response[2] & 0x02))) {
+        return DNS_STATUS_TRUNCATED;
+    }
+    return DNS_STATUS_OK;
+}
+
+// Reset the per-query outcome fields of a response slot
+static inline void reset_response(DNSResponse* result, int status) {
+    result->response_size = 0;
+    result->latency_ns = 0;
     result->num_additional_params = 0;
-    result->additional_params = (AdditionalParam *)malloc(MAX_ADDITIONAL_PARAMS * sizeof(AdditionalParam));
- 
-    if (use_ipv6) {
-        struct sockaddr_in6* dest6 = (struct sockaddr_in6*)&dest;
+    result->status = status;
+    result->error_code = 0;
+    result->attempts = 0;
+    result->kernel_latency_ns = 0;
+    result->timestamp_source = DNS_TIMESTAMP_NONE;
+    memset(&result->kernel_rx, 0, sizeof(result->kernel_rx));
+    result->transport = DNS_TRANSPORT_UDP;
+    result->connect_ns = 0;
+    result->sent_ns = 0;
+    result->local_port = 0;
+}
 
-        sockfd = socket(AF_INET6, SOCK_DGRAM, IPPROTO_UDP);
+/*
+ * Fills in the kernel latency of `result` from the TX timestamp of its query
+ * and the RX timestamp of its response. Hardware timestamps are preferred
+ * when both ends have one.
+ */
+void dns_kernel_latency(const KernelTimestamp* tx, DNSResponse* result) {
+    const KernelTimestamp* rx = &result->kernel_rx;
 
-        // If PDM metric flag is set, configure PDM in IPv6 Destination Options
-        if (flags & DNS_FLAG_PDM_METRIC) {
-            struct pdm_option pdm = {
-                .option_type = 0x0F,   // PDM Option Type
-                .opt_len = 10,         // Length (excluding type and len fields)
-                .scale_dtlr = 0,       // Example scale for Delta Time Last Received
-                .scale_dtls = 0,       // Example scale for Delta Time Last Sent
-                .psntp = htons(get_random_psn()),  // Example Packet Sequence Number This Packet
-                .psnlr = htons(0),     // Example Packet Sequence Number Last Received
-                .deltatlr = htons(0),  // Example Delta Time Last Received
-                .deltatls = htons(0)  // Example Delta Time Last Sent
-            };
+    if (tx->hardware_ns && rx->hardware_ns) {
+        result->kernel_latency_ns = rx->hardware_ns - tx->hardware_ns;
+        result->timestamp_source = DNS_TIMESTAMP_HARDWARE;
+    } else if (tx->software_ns && rx->software_ns) {
+        result->kernel_latency_ns = rx->software_ns - tx->software_ns;
+        result->timestamp_source = DNS_TIMESTAMP_SOFTWARE;
+    } else {
+        result->kernel_latency_ns = 0;
+        result->timestamp_source = DNS_TIMESTAMP_NONE;
+    }
+}
 
-            // Create the Destination Options Header and embed PDM
-            struct dest_opt_hdr dstopt = {0};
-            dstopt.next_header = 17;  // IPPROTO_UDP  (Next header is UDP)
-            dstopt.hdr_ext_len = 1;   // Length in 8-octet units, excluding first 8 octets
+// Copy the timestamps of an SCM_TIMESTAMPING control message
+static inline void read_scm_timestamping(struct cmsghdr* cmsg, KernelTimestamp* ts) {
+    struct scm_timestamping stamps;
 
-            // Copy PDM into options field and add padding
-            memcpy(dstopt.options, &pdm, sizeof(pdm));
-            memset(dstopt.options + sizeof(pdm), 0x00, 14 - sizeof(pdm));
+    memcpy(&stamps, CMSG_DATA(cmsg), sizeof(stamps));
+    ts->software_ns = timespec_to_ns(&stamps.ts[0]);
+    ts->hardware_ns = timespec_to_ns(&stamps.ts[2]);
+}
 
-            // Set Destination Options Header in socket
-            if (setsockopt(sockfd, IPPROTO_IPV6, IPV6_DSTOPTS, &dstopt, sizeof(dstopt)) < 0) {
-                perror("setsockopt DSTOPT");
-            }
+/*
+ * Reads one TX timestamp from the socket error queue without blocking.
+ * `key` receives the OPT_ID packet counter the timestamp belongs to.
+ * Returns 1 if a timestamp was read, 0 otherwise.
+ */
+static int read_tx_timestamp(int sockfd, uint32_t* key, KernelTimestamp* ts) {
+    char ctrl_buf[CTRL_BUF_SIZE];
+    struct msghdr msg = { .msg_control = ctrl_buf, .msg_controllen = sizeof(ctrl_buf) };
+    struct cmsghdr *cmsg;
+    int found_ts = 0, found_key = 0;
+
+    if (recvmsg(sockfd, &msg, MSG_ERRQUEUE | MSG_DONTWAIT) < 0) {
+        return 0;
+    }
 
-            // Allow kernel to pass destination options to application
-            if (setsockopt(sockfd, IPPROTO_IPV6, IPV6_RECVDSTOPTS, &opt, sizeof(opt)) < 0) {
-                perror("setsockopt IPV6_RECVDSTOPTS");
-                close(sockfd);
+    memset(ts, 0, sizeof(*ts));
+    for (cmsg = CMSG_FIRSTHDR(&msg); cmsg != NULL; cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+        if (cmsg->cmsg_level == SOL_SOCKET && cmsg->cmsg_type == SCM_TIMESTAMPING) {
+            read_scm_timestamping(cmsg, ts);
+            found_ts = 1;
+        } else if ((cmsg->cmsg_level == IPPROTO_IP && cmsg->cmsg_type == IP_RECVERR) ||
+                   (cmsg->cmsg_level == IPPROTO_IPV6 && cmsg->cmsg_type == IPV6_RECVERR)) {
+            struct sock_extended_err err;
+            memcpy(&err, CMSG_DATA(cmsg), sizeof(err));
+            if (err.ee_origin == SO_EE_ORIGIN_TIMESTAMPING) {
+                *key = err.ee_data;
+                found_key = 1;
             }
         }
+    }
+    return found_ts && found_key;
+}
 
-        if (sockfd < 0) {
-            perror("Socket creation failed (IPv6)");
+/*
+ * Parse `address` (NULL for the wildcard address) and `port` into `addr`,
+ * in the address family of the session. Returns the address length, or -1
+ * with errno set.
+ */
+static socklen_t parse_address(const DNSSession* session, const char* address, int port, struct sockaddr_storage* addr) {
+    memset(addr, 0, sizeof(*addr));
+
+    if (session->use_ipv6) {
+        struct sockaddr_in6* addr6 = (struct sockaddr_in6*)addr;
+        addr6->sin6_family = AF_INET6;
+        addr6->sin6_port = htons(port);
+        addr6->sin6_addr = in6addr_any;
+        if (address != NULL && inet_pton(AF_INET6, address, &addr6->sin6_addr) <= 0) {
+            errno = EINVAL;  // Invalid IPv6 address
             return -1;
         }
-
-        dest6->sin6_family = AF_INET6;
-        dest6->sin6_port = htons(53);
-        if (inet_pton(AF_INET6, dns_server, &dest6->sin6_addr) <= 0) {
-            perror("Invalid IPv6 address");
-            close(sockfd);
+        return sizeof(struct sockaddr_in6);
+    } else {
+        struct sockaddr_in* addr4 = (struct sockaddr_in*)addr;
+        addr4->sin_family = AF_INET;
+        addr4->sin_port = htons(port);
+        addr4->sin_addr.s_addr = htonl(INADDR_ANY);
+        if (address != NULL && inet_pton(AF_INET, address, &addr4->sin_addr) <= 0) {
+            errno = EINVAL;  // Invalid IPv4 address
             return -1;
         }
-        dest_len = sizeof(struct sockaddr_in6);
+        return sizeof(struct sockaddr_in);
+    }
+}
 
-        // Set socket options if needed
-        if (setsockopt(sockfd, IPPROTO_IPV6, IPV6_TCLASS, &flags, sizeof(flags)) < 0) {
-            perror("Failed to set IPv6 traffic class");
-        }
+/*
+ * Copy a pre-parsed server address into the session, taking the address
+ * family of the session and the destination `port` from it. Returns the
+ * address length, or -1 with errno set.
+ */
+static socklen_t copy_address(DNSSession* session, const struct sockaddr* addr, int addr_len, int* port) {
+    if (addr->sa_family == AF_INET6 && addr_len == sizeof(struct sockaddr_in6)) {
+        *port = ntohs(((const struct sockaddr_in6*)addr)->sin6_port);
+    } else if (addr->sa_family == AF_INET && addr_len == sizeof(struct sockaddr_in)) {
+        *port = ntohs(((const struct sockaddr_in*)addr)->sin_port);
+    } else {
+        errno = EAFNOSUPPORT;
+        return -1;
+    }
+    session->use_ipv6 = addr->sa_family == AF_INET6;
+    memset(&session->dest, 0, sizeof(session->dest));
+    memcpy(&session->dest, addr, addr_len);
+    return addr_len;
+}
+
+/*
+ * Store the server address and the local endpoint settings in the session.
+ * Returns 0, or -1 with errno set.
+ */
+static int session_set_endpoint(DNSSession* session, const char* dns_server, const DNSEndpoint* endpoint) {
+    int port = endpoint && endpoint->port ? endpoint->port : DNS_PORT;
+    socklen_t len;
 
+    if (endpoint && endpoint->server_addr) {
+        len = copy_address(session, endpoint->server_addr, endpoint->server_addr_len, &port);
     } else {
-        struct sockaddr_in* dest4 = (struct sockaddr_in*)&dest;
-        sockfd = socket(AF_INET, SOCK_DGRAM, IPPROTO_UDP);
+        len = parse_address(session, dns_server, port, &session->dest);
+    }
+    if (len == (socklen_t)-1) {
+        return -1;
+    }
+    session->dest_len = len;
+    if (endpoint == NULL) {
+        return 0;
+    }
 
-        if (sockfd < 0) {
-            perror("Socket creation failed (IPv4)");
+    session->source_port_min = endpoint->source_port_min;
+    session->source_port_max = endpoint->source_port_max ? endpoint->source_port_max : endpoint->source_port_min;
+    if (port < 1 || port > 65535 || session->source_port_min < 0 ||
+        session->source_port_max > 65535 || session->source_port_max < session->source_port_min) {
+        errno = EINVAL;
+        return -1;
+    }
+    session->rotate_every = endpoint->rotate_every > 0 ? endpoint->rotate_every : 0;
+    if (endpoint->bind_address != NULL || session->source_port_min > 0) {
+        if (parse_address(session, endpoint->bind_address, 0, &session->source) == (socklen_t)-1) {
             return -1;
         }
+        session->bind_source = 1;
+    }
+    return 0;
+}
+
+/*
+ * Bind `sockfd` to the local endpoint of the session, if it has one. With a
+ * source port range, the ports are handed out round-robin across all
+ * sessions of the process, skipping ports already in use. Returns 0, or -1
+ * with errno set (EADDRINUSE once every port of the range is taken).
+ */
+static int bind_source(DNSSession* session, int sockfd) {
+    static uint32_t next_port;
+    struct sockaddr_storage local = session->source;
+    in_port_t* port = session->use_ipv6
+        ? &((struct sockaddr_in6*)&local)->sin6_port
+        : &((struct sockaddr_in*)&local)->sin_port;
+    socklen_t len = session->use_ipv6 ? sizeof(struct sockaddr_in6) : sizeof(struct sockaddr_in);
+    uint32_t span, tries;
 
-        dest4->sin_family = AF_INET;
-        dest4->sin_port = htons(53);
-        dest4->sin_addr.s_addr = inet_addr(dns_server);
-        dest_len = sizeof(struct sockaddr_in);
+    if (!session->bind_source) {
+        return 0;
+    }
+    if (session->source_port_min == 0) {
+        return bind(sockfd, (struct sockaddr*)&local, len);
     }
 
-    // Measure start time
-    time_get_real_ns(&start);
+    span = (uint32_t)(session->source_port_max - session->source_port_min) + 1;
+    for (tries = 0; tries < span; tries++) {
+        uint32_t offset = __atomic_fetch_add(&next_port, 1, __ATOMIC_RELAXED) % span;
+        *port = htons(session->source_port_min + offset);
+        if (bind(sockfd, (struct sockaddr*)&local, len) == 0) {
+            return 0;
+        }
+        if (errno != EADDRINUSE) {
+            return -1;
+        }
+    }
+    errno = EADDRINUSE;
+    return -1;
+}
 
-    // Send the DNS query
-    if (sendto(sockfd, request, req_size, 0, (struct sockaddr*)&dest, dest_len) < 0) {
-        perror("Query sending failed");
-        close(sockfd);
+// Set the IPv6 traffic class from the low byte of the flags; best effort, queries go out unmarked otherwise
+static void set_traffic_class(int sockfd, int use_ipv6, int flags) {
+    int tclass = flags & 0xFF;  // Only the low byte of the flags fits the traffic class
+
+    if (use_ipv6) {
+        setsockopt(sockfd, IPPROTO_IPV6, IPV6_TCLASS, &tclass, sizeof(tclass));
+    }
+}
+
+/*
+ * Opens a UDP socket and, if `connected`, connects it to the session server.
+ * If PDM metrics are requested (IPv6 only), the first Destination Options
+ * header of `session->pdm_flow` is installed on the socket. The session then
+ * attaches an up-to-date header to every packet it sends.
+ * If kernel timestamps are requested, SO_TIMESTAMPING is enabled for both
+ * directions.
+ * Connecting lets the kernel drop datagrams from other peers and removes the
+ * need for a destination address on every send.
+ * Returns the socket descriptor, or -1 with errno set on failure.
+ */
+static int open_udp_socket(DNSSession* session, int connected) {
+    int sockfd;
+    int opt = 1;
+    int flags = session->flags;
+
+    sockfd = socket(session->use_ipv6 ? AF_INET6 : AF_INET, SOCK_DGRAM, IPPROTO_UDP);
+    if (sockfd < 0) {
         return -1;
     }
 
+    // If PDM metric flag is set, configure PDM in IPv6 Destination Options
+    if (session->use_ipv6 && (flags & DNS_FLAG_PDM_METRIC)) {
+        struct dest_opt_hdr dstopt;
+        pdm_build_header(&session->pdm_flow, session->pdm_flow.psn_next, 0, &dstopt);
 
-    // Prepare to receive response
-    char ctrl_buf[1024];
-    struct iovec iov = { .iov_base = result->response, .iov_len = MAX_DNS_PACKET_SIZE };
-    struct msghdr msg = { 
-        .msg_iov = &iov, .msg_iovlen = 1, 
-        .msg_control = ctrl_buf, .msg_controllen = sizeof(ctrl_buf) 
-    };
+        // Set Destination Options Header in socket. Like the per-packet
+        // headers this needs CAP_NET_RAW, so they stay off if it fails,
+        // which dns_session_pdm_flow reports.
+        if (setsockopt(sockfd, IPPROTO_IPV6, IPV6_DSTOPTS, &dstopt, sizeof(dstopt)) == 0) {
+            session->pdm = 1;
+        }
 
-    ssize_t resp_size = recvmsg(sockfd, &msg, 0);
-    time_get_real_ns(&end);
+        // Allow kernel to pass destination options to application; without
+        // it responses simply carry no PDM option
+        setsockopt(sockfd, IPPROTO_IPV6, IPV6_RECVDSTOPTS, &opt, sizeof(opt));
+    }
+    set_traffic_class(sockfd, session->use_ipv6, flags);
 
-    if (resp_size < 0) {
-        perror("Response receiving failed");
+    // Many queries in flight can answer faster than the caller drains them;
+    // best effort, as the kernel caps the size at net.core.rmem_max
+    int rcvbuf = SOCKET_RCVBUF;
+    setsockopt(sockfd, SOL_SOCKET, SO_RCVBUF, &rcvbuf, sizeof(rcvbuf));
+
+    // Request kernel (and, where the NIC is configured for it, hardware) timestamps
+    if (flags & DNS_FLAG_KERNEL_TIMESTAMP) {
+        int ts_flags = DNS_TIMESTAMPING_FLAGS;
+        if (setsockopt(sockfd, SOL_SOCKET, SO_TIMESTAMPING, &ts_flags, sizeof(ts_flags)) < 0) {
+            int err = errno;
+            close(sockfd);
+            errno = err;
+            return -1;
+        }
+    }
+
+    if (bind_source(session, sockfd) < 0 ||
+        (connected && connect(sockfd, (struct sockaddr*)&session->dest, session->dest_len) < 0)) {
+        int err = errno;
         close(sockfd);
+        errno = err;
+        return -1;
+    }
+
+    return sockfd;
+}
+
+// Opens the connected UDP socket of a session, see open_udp_socket
+static int open_dns_socket(DNSSession* session) {
+    return open_udp_socket(session, 1);
+}
+
+/*
+ * Open `session` towards `dns_server`, with the endpoint settings of
+ * `endpoint` (NULL for the defaults). UDP sessions connect their socket
+ * right away; TCP connections are only established by the first query, so
+ * its handshake time can be reported. Returns 0, or -1 with errno set on
+ * failure.
+ */
+static int session_init(DNSSession* session, const char* dns_server, int use_ipv6, int flags, const DNSEndpoint* endpoint) {
+    memset(session, 0, sizeof(*session));
+    session->sockfd = -1;
+    session->tcp.fd = -1;
+    session->use_ipv6 = use_ipv6;
+    session->flags = flags;
+    if (session_set_endpoint(session, dns_server, endpoint) < 0) {
+        return -1;
+    }
+    if (flags & DNS_FLAG_TCP) {
+        return 0;
+    }
+    if (flags & DNS_FLAG_PDM_METRIC) {
+        session->pdm_flow.psn_next = pdm_initial_psn();
+    }
+    session->sockfd = open_dns_socket(session);
+    return session->sockfd < 0 ? -1 : 0;
+}
+
+// Release the batch working memory of a session
+static void scratch_free(BatchScratch* scratch) {
+    free(scratch->slots);
+    free(scratch->queue);
+    free(scratch->packets);
+    free(scratch->sent_at);
+    free(scratch->tx_stamps);
+    free(scratch->todo);
+    free(scratch->recv_bufs);
+    free(scratch->ctrl_bufs);
+    memset(scratch, 0, sizeof(*scratch));
+}
+
+/*
+ * Make sure `scratch` can hold `num_requests` requests and receive buffers
+ * of `recv_size` bytes. Returns 0, or -1 on failure.
+ */
+static int scratch_reserve(BatchScratch* scratch, int num_requests, int recv_size) {
+    if (scratch->capacity >= num_requests && scratch->recv_size >= recv_size) {
+        return 0;
+    }
+    if (num_requests < scratch->capacity) {
+        num_requests = scratch->capacity;
+    }
+    if (recv_size < scratch->recv_size) {
+        recv_size = scratch->recv_size;
+    }
+    scratch_free(scratch);
+
+    scratch->slots = malloc(MAX_BATCH_QUERIES * sizeof(int));
+    scratch->queue = malloc(num_requests * sizeof(int));
+    scratch->packets = malloc(num_requests * sizeof(unsigned char*));
+    scratch->sent_at = malloc(num_requests * sizeof(struct timespec));
+    scratch->tx_stamps = malloc(num_requests * sizeof(KernelTimestamp));
+    scratch->todo = malloc(num_requests * sizeof(int));
+    scratch->recv_bufs = malloc((size_t)BATCH_CHUNK * recv_size);
+    scratch->ctrl_bufs = malloc(BATCH_CHUNK * CTRL_BUF_SIZE);
+
+    if (!scratch->slots || !scratch->queue || !scratch->packets || !scratch->sent_at ||
+        !scratch->tx_stamps || !scratch->todo || !scratch->recv_bufs || !scratch->ctrl_bufs) {
+        scratch_free(scratch);
+        return -1;
+    }
+    scratch->capacity = num_requests;
+    scratch->recv_size = recv_size;
+    return 0;
+}
+
+/*
+ * Working memory of the one-shot dns_query and dns_query_batch calls, kept
+ * per thread so concurrent calls share nothing and repeated calls from one
+ * thread allocate nothing. It is released when the thread exits.
+ */
+typedef struct {
+    BatchScratch scratch;
+    unsigned char *tcp_rx;
+} ThreadMemory;
+
+static pthread_key_t thread_memory_key;
+static pthread_once_t thread_memory_once = PTHREAD_ONCE_INIT;
+
+static void thread_memory_free(void* memory) {
+    ThreadMemory* mem = memory;
+    scratch_free(&mem->scratch);
+    free(mem->tcp_rx);
+    free(mem);
+}
+
+static void thread_memory_key_create(void) {
+    pthread_key_create(&thread_memory_key, thread_memory_free);
+}
+
+// Returns the working memory of the calling thread, or NULL if it cannot be allocated
+static ThreadMemory* thread_memory(void) {
+    ThreadMemory* mem;
+
+    pthread_once(&thread_memory_once, thread_memory_key_create);
+    mem = pthread_getspecific(thread_memory_key);
+    if (mem == NULL && (mem = calloc(1, sizeof(*mem))) != NULL &&
+        pthread_setspecific(thread_memory_key, mem) != 0) {
+        free(mem);
+        mem = NULL;
+    }
+    return mem;
+}
+
+// Lend the working memory of the calling thread to a one-shot session
+static void session_borrow_memory(DNSSession* session, ThreadMemory* mem) {
+    if (mem != NULL) {
+        session->scratch = mem->scratch;
+        session->tcp.rx = mem->tcp_rx;
+    }
+}
+
+// Take back the working memory lent to a session, as grown by its exchanges
+static void session_return_memory(DNSSession* session, ThreadMemory* mem) {
+    if (mem != NULL) {
+        mem->scratch = session->scratch;
+        mem->tcp_rx = session->tcp.rx;
+        memset(&session->scratch, 0, sizeof(session->scratch));
+        session->tcp.rx = NULL;
+    }
+}
+
+// Close the TCP connection of a session
+static void tcp_disconnect(TCPConn* tcp) {
+    if (tcp->fd >= 0) {
+        close(tcp->fd);
+        tcp->fd = -1;
+    }
+    tcp->rx_len = 0;
+}
+
+// Close every socket of a session and release its working memory
+static void session_release(DNSSession* session) {
+    if (session->sockfd >= 0) {
+        close(session->sockfd);
+        session->sockfd = -1;
+    }
+    tcp_disconnect(&session->tcp);
+    free(session->tcp.rx);
+    session->tcp.rx = NULL;
+    scratch_free(&session->scratch);
+}
+
+/*
+ * Connects the TCP connection of a session, waiting up to `timeout_ms`
+ * (forever if <= 0) for the handshake, whose duration is kept in
+ * `tcp->connect_ns`. Returns 0, or -1 with errno set on failure.
+ */
+static int tcp_connect(DNSSession* session, int timeout_ms) {
+    TCPConn* tcp = &session->tcp;
+    struct timespec start, end;
+    int opt = 1, err = 0, ready;
+    socklen_t err_len = sizeof(err);
+
+    if (tcp->rx == NULL && (tcp->rx = malloc(TCP_RX_BUF_SIZE)) == NULL) {
+        errno = ENOMEM;
         return -1;
     }
 
-    // Iterate through ancillary data to find the destination options header
+    int fd = socket(session->use_ipv6 ? AF_INET6 : AF_INET, SOCK_STREAM | SOCK_NONBLOCK, IPPROTO_TCP);
+    if (fd < 0) {
+        return -1;
+    }
+    // Pipelined queries must not wait for the ACK of the previous one
+    setsockopt(fd, IPPROTO_TCP, TCP_NODELAY, &opt, sizeof(opt));
+    set_traffic_class(fd, session->use_ipv6, session->flags);
+    if (bind_source(session, fd) < 0) {
+        goto fail;
+    }
+
+    time_get_real_ns(&start);
+    if (connect(fd, (struct sockaddr*)&session->dest, session->dest_len) < 0) {
+        struct pollfd pfd = { .fd = fd, .events = POLLOUT };
+
+        if (errno != EINPROGRESS) {
+            goto fail;
+        }
+        do {
+            ready = poll(&pfd, 1, timeout_ms > 0 ? timeout_ms : -1);
+        } while (ready < 0 && errno == EINTR);
+        if (ready == 0) {
+            errno = ETIMEDOUT;
+            goto fail;
+        }
+        if (ready < 0) {
+            goto fail;
+        }
+        if (getsockopt(fd, SOL_SOCKET, SO_ERROR, &err, &err_len) < 0) {
+            goto fail;
+        }
+        if (err) {
+            errno = err;
+            goto fail;
+        }
+    }
+    time_get_real_ns(&end);
+
+    tcp->fd = fd;
+    tcp->rx_len = 0;
+    tcp->connect_ns = timespec_diff_ns(&start, &end);
+    return 0;
+
+fail:
+    err = errno;
+    close(fd);
+    errno = err;
+    return -1;
+}
+
+/*
+ * Walks the ancillary data of a received response. IPv6 Destination Options
+ * are copied into `result->additional_params` and SCM_TIMESTAMPING data into
+ * `result->kernel_rx`.
+ */
+static void collect_additional_params(struct msghdr* msg, DNSResponse* result) {
     struct cmsghdr *cmsg;
-    for (cmsg = CMSG_FIRSTHDR(&msg); cmsg != NULL; cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+
+    for (cmsg = CMSG_FIRSTHDR(msg); cmsg != NULL; cmsg = CMSG_NXTHDR(msg, cmsg)) {
         if (cmsg->cmsg_level == IPPROTO_IPV6 && cmsg->cmsg_type == IPV6_DSTOPTS) {
             // cmsg->cmsg_data points to the received destination options header.
-            // You can cast it to a structure pointer (if defined) to process it.
-            // For example:
-            // struct ipv6_destopt *dstopts = (struct ipv6_destopt *)CMSG_DATA(cmsg);
             if (result->num_additional_params < MAX_ADDITIONAL_PARAMS) {
                 result->additional_params[result->num_additional_params].type = IPV6_DSTOPTS;
                 memcpy(result->additional_params[result->num_additional_params].data, CMSG_DATA(cmsg), MAX_PARAM_SIZE);
                 result->num_additional_params++;
             }
+        } else if (cmsg->cmsg_level == SOL_SOCKET && cmsg->cmsg_type == SCM_TIMESTAMPING) {
+            read_scm_timestamping(cmsg, &result->kernel_rx);
         }
     }
+}
 
-    result->latency_ns = (end.tv_sec - start.tv_sec) * 1000000000LL + (end.tv_nsec - start.tv_nsec);
-    result->response_size = resp_size;
+// Whether exchanges record the local address of their sockets, see dns_report_local_addresses
+static int report_local_addresses = 0;
 
-    close(sockfd);
+/*
+ * Reads the local address of `sockfd` into `address` (4 bytes for IPv4, 16
+ * for IPv6) and its port into `port`. Returns 0, or -1 if it is unknown.
+ */
+static int read_local_address(int sockfd, unsigned char address[16], int* port) {
+    struct sockaddr_storage local;
+    socklen_t len = sizeof(local);
+
+    if (sockfd < 0 || getsockname(sockfd, (struct sockaddr*)&local, &len) < 0) {
+        return -1;
+    }
+    if (local.ss_family == AF_INET) {
+        const struct sockaddr_in* in = (const struct sockaddr_in*)&local;
+        memcpy(address, &in->sin_addr, 4);
+        *port = ntohs(in->sin_port);
+    } else if (local.ss_family == AF_INET6) {
+        const struct sockaddr_in6* in6 = (const struct sockaddr_in6*)&local;
+        memcpy(address, &in6->sin6_addr, 16);
+        *port = ntohs(in6->sin6_port);
+    } else {
+        return -1;
+    }
+    return 0;
+}
+
+/*
+ * Stores the local address of `sockfd` in each of `count` slots whose last
+ * attempt went out over `transport` from it. One getsockname call covers
+ * the whole call, since the socket does not change within an exchange.
+ */
+static void record_local_address(int sockfd, DNSResponse* results, int count, int transport) {
+    unsigned char address[16];
+    int port, i;
+
+    if (read_local_address(sockfd, address, &port) < 0) {
+        return;
+    }
+    for (i = 0; i < count; i++) {
+        if (results[i].sent_ns && results[i].transport == transport) {
+            memcpy(results[i].local_address, address, sizeof(address));
+            results[i].local_port = port;
+        }
+    }
+}
+
+// Record the local addresses of an exchange through `session`, if they are reported
+static inline void record_session_addresses(DNSSession* session, DNSResponse* results, int count) {
+    if (report_local_addresses) {
+        record_local_address(session->sockfd, results, count, DNS_TRANSPORT_UDP);
+        record_local_address(session->tcp.fd, results, count, DNS_TRANSPORT_TCP);
+    }
+}
+
+/*
+ * Record the local address of a fan-out slot sent from the unconnected
+ * `sockfd`. Its address is the wildcard unless a source was bound, so the
+ * address the kernel sends from to the endpoint is looked up by connecting
+ * a throwaway socket, which only consults the routing table.
+ */
+static void record_fanout_address(int sockfd, const DNSEndpoint* endpoint, DNSResponse* result) {
+    unsigned char address[16], routed[16];
+    int port, routed_port, fd;
+    static const unsigned char wildcard[16] = { 0 };
+
+    if (!result->sent_ns || read_local_address(sockfd, address, &port) < 0) {
+        return;
+    }
+    if (memcmp(address, wildcard, endpoint->server_addr->sa_family == AF_INET ? 4 : 16) == 0) {
+        fd = socket(endpoint->server_addr->sa_family, SOCK_DGRAM, IPPROTO_UDP);
+        if (fd >= 0) {
+            if (connect(fd, endpoint->server_addr, endpoint->server_addr_len) == 0 &&
+                read_local_address(fd, routed, &routed_port) == 0) {
+                memcpy(address, routed, sizeof(address));
+            }
+            close(fd);
+        }
+    }
+    memcpy(result->local_address, address, sizeof(address));
+    result->local_port = port;
+}
+
+/*
+ * Send one datagram at `now`, advancing the TX timestamp key of the session.
+ * On a PDM flow the packet carries the current PDM option.
+ */
+static inline ssize_t session_send(DNSSession* session, unsigned char* request, int req_size, const struct timespec* now) {
+    ssize_t sent;
+
+    if (session->pdm) {
+        char ctrl[PDM_CMSG_SPACE];
+        int64_t now_ns = timespec_to_ns(now);
+        struct iovec iov = { .iov_base = request, .iov_len = req_size };
+        struct msghdr msg = { .msg_iov = &iov, .msg_iovlen = 1, .msg_control = ctrl };
+
+        msg.msg_controllen = pdm_control(&session->pdm_flow, session->pdm_flow.psn_next, now_ns, ctrl);
+        sent = sendmsg(session->sockfd, &msg, 0);
+        if (sent >= 0) {
+            pdm_flow_sent(&session->pdm_flow, 1, now_ns);
+        }
+    } else {
+        sent = send(session->sockfd, request, req_size, 0);
+    }
+    if (sent >= 0) {
+        session->tx_seq++;
+    }
+    return sent;
+}
+
+/*
+ * Sends one raw DNS query over the UDP socket of a session and receives its
+ * response. Each attempt waits up to `timeout_ms` (forever if `timeout_ms` <= 0) and
+ * the query is resent up to `retries` times. Latency is measured from the
+ * last attempt. Datagrams whose DNS ID does not match the request (e.g. late
+ * replies to an earlier query on a reused socket) are discarded.
+ * The outcome is reported through `result->status` and `result->error_code`.
+ * Returns the response size, or -1 if no response was received.
+ */
+static int exchange_udp(DNSSession* session, unsigned char* request, int req_size, DNSResponse* result, int timeout_ms, int retries) {
+    struct timespec start, end, deadline;
+    KernelTimestamp tx_stamp = {0}, stamp;
+    uint32_t tx_key = 0, key;
+    ssize_t resp_size;
+    int attempt;
+    int sockfd = session->sockfd;
+    int timestamping = session->flags & DNS_FLAG_KERNEL_TIMESTAMP;
+
+    // Prepare to receive response
+    char ctrl_buf[1024];
+    struct iovec iov = { .iov_base = result->response, .iov_len = result->response_capacity };
+    struct msghdr msg = { 
+        .msg_iov = &iov, .msg_iovlen = 1, 
+        .msg_control = ctrl_buf, .msg_controllen = sizeof(ctrl_buf) 
+    };
+    struct pollfd pfd = { .fd = sockfd, .events = POLLIN };
+
+    for (attempt = 0; attempt <= retries; attempt++) {
+        tx_key = session->tx_seq;
+
+        // Measure start time
+        time_get_real_ns(&start);
+
+        // Send the DNS query
+        if (session_send(session, request, req_size, &start) < 0) {
+            result->status = is_unreachable_error(errno) ? DNS_STATUS_UNREACHABLE : DNS_STATUS_SEND_ERROR;
+            result->error_code = errno;
+            return -1;
+        }
+        result->attempts++;
+        result->sent_ns = timespec_to_ns(&start);
+        deadline_after_ms(&deadline, &start, timeout_ms);
+
+        for (;;) {
+            int wait_ms = timeout_ms > 0 ? ms_until(&deadline) : -1;
+            if (wait_ms == 0) {
+                break;  // Attempt timed out
+            }
+
+            int ready = poll(&pfd, 1, wait_ms);
+            if (ready < 0) {
+                if (errno == EINTR) {
+                    continue;
+                }
+                result->status = DNS_STATUS_RECV_ERROR;
+                result->error_code = errno;
+                return -1;
+            }
+            if (ready == 0) {
+                break;  // Attempt timed out
+            }
+
+            // TX timestamps wake poll through the error queue
+            while (timestamping && read_tx_timestamp(sockfd, &key, &stamp)) {
+                if (key == tx_key) {
+                    tx_stamp = stamp;
+                }
+            }
+
+            msg.msg_controllen = sizeof(ctrl_buf);
+            resp_size = recvmsg(sockfd, &msg, MSG_DONTWAIT);
+            time_get_real_ns(&end);
+
+            if (resp_size < 0) {
+                if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+                    continue;
+                }
+                result->status = is_unreachable_error(errno) ? DNS_STATUS_UNREACHABLE : DNS_STATUS_RECV_ERROR;
+                result->error_code = errno;
+                return -1;
+            }
+            if (req_size >= 2 && (resp_size < 2 || memcmp(result->response, request, 2) != 0)) {
+                continue;  // Not the response to this query
+            }
+
+            // Iterate through ancillary data to find the destination options header
+            collect_additional_params(&msg, result);
+            if (session->pdm) {
+                pdm_flow_received(&session->pdm_flow, result, timespec_to_ns(&end));
+            }
+
+            result->latency_ns = timespec_diff_ns(&start, &end);
+            result->response_size = resp_size;
+            result->status = response_status(result->response, resp_size, msg.msg_flags);
+
+            if (timestamping) {
+                while (read_tx_timestamp(sockfd, &key, &stamp)) {
+                    if (key == tx_key) {
+                        tx_stamp = stamp;
+                    }
+                }
+                dns_kernel_latency(&tx_stamp, result);
+            }
+            return resp_size;
+        }
+    }
+
+    result->status = DNS_STATUS_TIMEOUT;
+    return -1;
+}
+
+/*
+ * Reads every pending TX timestamp of a batch round. Keys are assigned in
+ * send order, so `key - key_base` is the position of the datagram in `queue`.
+ */
+static void drain_batch_tx_timestamps(int sockfd, uint32_t key_base, int* queue, int sent, KernelTimestamp* tx_stamps) {
+    KernelTimestamp stamp;
+    uint32_t key;
+
+    while (read_tx_timestamp(sockfd, &key, &stamp)) {
+        uint32_t pos = key - key_base;
+        if (pos < (uint32_t)sent) {
+            tx_stamps[queue[pos]] = stamp;
+        }
+    }
+}
+
+/*
+ * Prepares a batch: reserves the session scratch, locates every request in
+ * `requests` and resets the response slots. Returns the size of the
+ * smallest response buffer, or -1 on failure.
+ */
+static int batch_prepare(DNSSession* session, unsigned char* requests, int* req_sizes, int num_requests, DNSResponse* results) {
+    int i, recv_size = MAX_DNS_MESSAGE_SIZE;
+    unsigned char *cursor = requests;
+
+    if (num_requests <= 0 || num_requests > MAX_BATCH_QUERIES) {
+        return -1;
+    }
+    for (i = 0; i < num_requests; i++) {
+        if (results[i].response_capacity < recv_size) {
+            recv_size = results[i].response_capacity;
+        }
+    }
+    if (recv_size <= 0) {
+        return -1;  // Response slots without bound storage
+    }
+    // TCP-only sessions read the stream into the connection buffer instead
+    if (scratch_reserve(&session->scratch, num_requests, session->sockfd >= 0 ? recv_size : 1) < 0) {
+        return -1;
+    }
+
+    for (i = 0; i < num_requests; i++) {
+        session->scratch.packets[i] = cursor;
+        cursor += req_sizes[i];
+        reset_response(&results[i], DNS_STATUS_TIMEOUT);
+    }
+    return recv_size;
+}
+
+/*
+ * Sends a prepared batch of raw DNS queries over the UDP socket of a session
+ * and collects the responses into buffers of `recv_size` bytes. See
+ * dns_query_batch for the layout of the arguments.
+ * Returns the number of responses received, or -1 on failure.
+ */
+static int exchange_udp_batch(
+    DNSSession* session, int* req_sizes, int num_requests,
+    DNSResponse* results, int recv_size, int timeout_ms, int retries
+) {
+    struct timespec now, deadline = { 0, 0 };  // Set once a round has been sent
+    int i, n, attempt;
+    int received = 0;
+    int send_errno = 0, unreachable_errno = 0;
+    int sockfd = session->sockfd;
+    int timestamping = session->flags & DNS_FLAG_KERNEL_TIMESTAMP;
+    struct mmsghdr msgs[BATCH_CHUNK];
+    struct iovec iovs[BATCH_CHUNK];
+
+    int *slots = session->scratch.slots;
+    int *queue = session->scratch.queue;
+    unsigned char **packets = session->scratch.packets;
+    struct timespec *sent_at = session->scratch.sent_at;
+    KernelTimestamp *tx_stamps = session->scratch.tx_stamps;
+    unsigned char *recv_bufs = session->scratch.recv_bufs;
+    char (*ctrl_bufs)[CTRL_BUF_SIZE] = session->scratch.ctrl_bufs;
+
+    memset(slots, 0xff, MAX_BATCH_QUERIES * sizeof(int));
+    if (timestamping) {
+        memset(tx_stamps, 0, num_requests * sizeof(KernelTimestamp));
+    }
+    for (i = 0; i < num_requests; i++) {
+        if (req_sizes[i] >= 2) {
+            slots[(packets[i][0] << 8) | packets[i][1]] = i;
+        }
+    }
+
+    // Every round (re)sends the queries still unanswered
+    for (attempt = 0; attempt <= retries && received < num_requests && !send_errno; attempt++) {
+        int queue_len = 0, next = 0;
+        uint32_t key_base = session->tx_seq;
+
+        for (i = 0; i < num_requests; i++) {
+            if (results[i].response_size == 0) {
+                queue[queue_len++] = i;
+            }
+        }
+
+        while (received < num_requests) {
+            struct pollfd pfd = { .fd = sockfd, .events = POLLIN };
+            int wait_ms = -1;
+
+            if (next < queue_len) {
+                pfd.events |= POLLOUT;
+            } else if (timeout_ms > 0) {
+                wait_ms = ms_until(&deadline);
+                if (wait_ms == 0) {
+                    break;  // Round timed out
+                }
+            }
+
+            if (poll(&pfd, 1, wait_ms) < 0) {
+                if (errno == EINTR) {
+                    continue;
+                }
+                send_errno = errno;
+                break;
+            }
+
+            if (pfd.revents & POLLOUT) {
+                int count = queue_len - next < BATCH_CHUNK ? queue_len - next : BATCH_CHUNK;
+                for (i = 0; i < count; i++) {
+                    int idx = queue[next + i];
+                    iovs[i].iov_base = packets[idx];
+                    iovs[i].iov_len = req_sizes[idx];
+                    memset(&msgs[i], 0, sizeof(msgs[i]));
+                    msgs[i].msg_hdr.msg_iov = &iovs[i];
+                    msgs[i].msg_hdr.msg_iovlen = 1;
+                }
+
+                time_get_real_ns(&now);
+                if (session->pdm) {
+                    // Number the packets of the chunk; only those sent are counted
+                    for (i = 0; i < count; i++) {
+                        msgs[i].msg_hdr.msg_control = ctrl_bufs[i];
+                        msgs[i].msg_hdr.msg_controllen = pdm_control(
+                            &session->pdm_flow, session->pdm_flow.psn_next + i, timespec_to_ns(&now), ctrl_bufs[i]);
+                    }
+                }
+                n = sendmmsg(sockfd, msgs, count, MSG_DONTWAIT);
+                if (n < 0) {
+                    if (is_unreachable_error(errno)) {
+                        unreachable_errno = errno;
+                    } else if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+                        send_errno = errno;
+                        break;
+                    }
+                }
+                for (i = 0; i < n; i++) {
+                    int idx = queue[next + i];
+                    sent_at[idx] = now;
+                    results[idx].attempts++;
+                    results[idx].sent_ns = timespec_to_ns(&now);
+                }
+                if (n > 0) {
+                    next += n;
+                    session->tx_seq += n;
+                    if (session->pdm) {
+                        pdm_flow_sent(&session->pdm_flow, n, timespec_to_ns(&now));
+                    }
+                }
+                if (next == queue_len) {
+                    deadline_after_ms(&deadline, &now, timeout_ms);
+                }
+            }
+
+            if (timestamping && (pfd.revents & POLLERR)) {
+                drain_batch_tx_timestamps(sockfd, key_base, queue, next, tx_stamps);
+            }
+
+            if (pfd.revents & (POLLIN | POLLERR)) {
+                for (i = 0; i < BATCH_CHUNK; i++) {
+                    iovs[i].iov_base = recv_bufs + (size_t)i * recv_size;
+                    iovs[i].iov_len = recv_size;
+                    memset(&msgs[i], 0, sizeof(msgs[i]));
+                    msgs[i].msg_hdr.msg_iov = &iovs[i];
+                    msgs[i].msg_hdr.msg_iovlen = 1;
+                    msgs[i].msg_hdr.msg_control = ctrl_bufs[i];
+                    msgs[i].msg_hdr.msg_controllen = CTRL_BUF_SIZE;
+                }
+
+                n = recvmmsg(sockfd, msgs, BATCH_CHUNK, MSG_DONTWAIT, NULL);
+                time_get_real_ns(&now);
+                if (n < 0) {
+                    // ICMP errors surface here on a connected socket; keep collecting
+                    if (is_unreachable_error(errno)) {
+                        unreachable_errno = errno;
+                    }
+                    continue;
+                }
+
+                for (i = 0; i < n; i++) {
+                    unsigned int len = msgs[i].msg_len;
+                    unsigned char *buf = recv_bufs + (size_t)i * recv_size;
+                    if (len < 2) {
+                        continue;
+                    }
+                    int idx = slots[(buf[0] << 8) | buf[1]];
+                    if (idx < 0 || results[idx].attempts == 0 || results[idx].response_size > 0) {
+                        continue;  // Unknown, unsent or duplicate response
+                    }
+                    memcpy(results[idx].response, buf, len);
+                    results[idx].response_size = len;
+                    results[idx].latency_ns = timespec_diff_ns(&sent_at[idx], &now);
+                    results[idx].status = response_status(buf, len, msgs[i].msg_hdr.msg_flags);
+                    collect_additional_params(&msgs[i].msg_hdr, &results[idx]);
+                    if (session->pdm) {
+                        pdm_flow_received(&session->pdm_flow, &results[idx], timespec_to_ns(&now));
+                    }
+                    received++;
+                }
+            }
+        }
+
+        if (timestamping) {
+            drain_batch_tx_timestamps(sockfd, key_base, queue, next, tx_stamps);
+        }
+    }
+
+    // Explain why the remaining queries went unanswered
+    for (i = 0; i < num_requests; i++) {
+        if (results[i].response_size > 0) {
+            if (timestamping) {
+                dns_kernel_latency(&tx_stamps[i], &results[i]);
+            }
+            continue;
+        }
+        if (send_errno) {
+            results[i].status = DNS_STATUS_SEND_ERROR;
+            results[i].error_code = send_errno;
+        } else if (unreachable_errno) {
+            results[i].status = DNS_STATUS_UNREACHABLE;
+            results[i].error_code = unreachable_errno;
+        }
+    }
+    return received;
+}
+
+// Whether an errno reports a TCP connection closed by the peer
+static inline int is_closed_error(int err) {
+    return err == ECONNRESET || err == EPIPE || err == ENOTCONN;
+}
+
+/*
+ * Sends the queries listed in `todo` over the persistent TCP connection of
+ * a session and collects their responses (RFC 7766). The queries are
+ * pipelined: each is written with its two-byte length prefix as soon as the
+ * socket accepts it, and responses are matched to their query by DNS ID in
+ * whatever order they arrive. Slots are not reset, so attempts made earlier
+ * (e.g. over UDP) keep counting.
+ *
+ * The connection is opened on demand. Its handshake time is charged to the
+ * first query sent on it and is not part of any query latency. If the
+ * server closes the connection with queries outstanding, they are resent
+ * once on a new connection. `timeout_ms` and `retries` work as for
+ * dns_query_batch. The session scratch must hold every index of `todo`.
+ * Returns the number of responses received.
+ */
+static int exchange_tcp(
+    DNSSession* session, int* req_sizes, int* todo, int todo_len,
+    DNSResponse* results, int timeout_ms, int retries
+) {
+    TCPConn* tcp = &session->tcp;
+    struct timespec now, deadline = { 0, 0 };  // Set once a round has been written
+    int i, attempt;
+    int received = 0, reconnected = 0;
+    int fail_errno = 0, closed_errno = 0;
+    size_t offset = 0;  // Bytes of the query being written already sent, prefix included
+    unsigned char prefixes[BATCH_CHUNK][2];
+    struct iovec iovs[2 * BATCH_CHUNK];
+
+    int *slots = session->scratch.slots;
+    int *queue = session->scratch.queue;
+    unsigned char **packets = session->scratch.packets;
+    struct timespec *sent_at = session->scratch.sent_at;
+
+    // A single query is matched directly, without clearing the whole ID table
+    if (todo_len > 1) {
+        memset(slots, 0xff, MAX_BATCH_QUERIES * sizeof(int));
+        for (i = 0; i < todo_len; i++) {
+            int idx = todo[i];
+            if (req_sizes[idx] >= 2) {
+                slots[(packets[idx][0] << 8) | packets[idx][1]] = idx;
+            }
+        }
+    }
+    for (i = 0; i < todo_len; i++) {
+        results[todo[i]].transport = DNS_TRANSPORT_TCP;
+    }
+
+    for (attempt = 0; attempt <= retries && received < todo_len && !fail_errno; attempt++) {
+        int queue_len = 0, next = 0;
+
+        offset = 0;
+        for (i = 0; i < todo_len; i++) {
+            if (results[todo[i]].response_size == 0) {
+                queue[queue_len++] = todo[i];
+            }
+        }
+
+        while (received < todo_len) {
+            int wait_ms = -1;
+
+            if (tcp->fd < 0 && tcp_connect(session, timeout_ms) < 0) {
+                fail_errno = errno;
+                break;
+            }
+
+            struct pollfd pfd = { .fd = tcp->fd, .events = POLLIN };
+            if (next < queue_len) {
+                pfd.events |= POLLOUT;
+            } else if (timeout_ms > 0) {
+                wait_ms = ms_until(&deadline);
+                if (wait_ms == 0) {
+                    break;  // Round timed out
+                }
+            }
+
+            if (poll(&pfd, 1, wait_ms) < 0) {
+                if (errno == EINTR) {
+                    continue;
+                }
+                fail_errno = errno;
+                break;
+            }
+
+            if ((pfd.revents & POLLOUT) && next < queue_len) {
+                int count = queue_len - next < BATCH_CHUNK ? queue_len - next : BATCH_CHUNK;
+                int iovcnt = 0;
+                for (i = 0; i < count; i++) {
+                    int idx = queue[next + i];
+                    prefixes[i][0] = req_sizes[idx] >> 8;
+                    prefixes[i][1] = req_sizes[idx] & 0xFF;
+                    iovs[iovcnt].iov_base = prefixes[i];
+                    iovs[iovcnt++].iov_len = 2;
+                    iovs[iovcnt].iov_base = packets[idx];
+                    iovs[iovcnt++].iov_len = req_sizes[idx];
+                }
+                // Skip what a previous partial write already sent
+                size_t skip = offset;
+                int first = 0;
+                while (skip >= iovs[first].iov_len) {
+                    skip -= iovs[first++].iov_len;
+                }
+                iovs[first].iov_base = (unsigned char*)iovs[first].iov_base + skip;
+                iovs[first].iov_len -= skip;
+
+                struct msghdr msg = { .msg_iov = iovs + first, .msg_iovlen = iovcnt - first };
+                time_get_real_ns(&now);
+                ssize_t written = sendmsg(tcp->fd, &msg, MSG_DONTWAIT | MSG_NOSIGNAL);
+                if (written < 0) {
+                    if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+                        continue;
+                    }
+                    if (!is_closed_error(errno)) {
+                        fail_errno = errno;
+                        break;
+                    }
+                    closed_errno = errno;
+                    goto closed;
+                }
+
+                // Advance over the queries written completely
+                size_t total = offset + written;
+                while (next < queue_len && total >= (size_t)req_sizes[queue[next]] + 2) {
+                    int idx = queue[next++];
+                    total -= req_sizes[idx] + 2;
+                    sent_at[idx] = now;
+                    results[idx].attempts++;
+                    results[idx].sent_ns = timespec_to_ns(&now);
+                    if (tcp->connect_ns) {
+                        results[idx].connect_ns = tcp->connect_ns;
+                        tcp->connect_ns = 0;
+                    }
+                }
+                offset = total;
+                if (next == queue_len) {
+                    deadline_after_ms(&deadline, &now, timeout_ms);
+                }
+            }
+
+            if (pfd.revents & (POLLIN | POLLERR | POLLHUP)) {
+                ssize_t got = recv(tcp->fd, tcp->rx + tcp->rx_len, TCP_RX_BUF_SIZE - tcp->rx_len, MSG_DONTWAIT);
+                time_get_real_ns(&now);
+                if (got < 0) {
+                    if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+                        continue;
+                    }
+                    if (!is_closed_error(errno)) {
+                        fail_errno = errno;
+                        break;
+                    }
+                    closed_errno = errno;
+                    goto closed;
+                }
+                if (got == 0) {
+                    closed_errno = ECONNRESET;
+                    goto closed;
+                }
+                tcp->rx_len += got;
+
+                // Deliver every complete message of the stream
+                size_t pos = 0;
+                while (tcp->rx_len - pos >= 2) {
+                    unsigned char *message = tcp->rx + pos + 2;
+                    size_t len = (tcp->rx[pos] << 8) | tcp->rx[pos + 1];
+                    if (tcp->rx_len - pos - 2 < len) {
+                        break;
+                    }
+                    pos += 2 + len;
+                    if (len < 2) {
+                        continue;
+                    }
+
+                    int idx;
+                    if (todo_len > 1) {
+                        idx = slots[(message[0] << 8) | message[1]];
+                    } else {
+                        idx = memcmp(message, packets[todo[0]], 2) == 0 ? todo[0] : -1;
+                    }
+                    if (idx < 0 || results[idx].attempts == 0 || results[idx].response_size > 0) {
+                        continue;  // Unknown, unsent or duplicate response
+                    }
+                    size_t stored = len < (size_t)results[idx].response_capacity ? len : (size_t)results[idx].response_capacity;
+                    memcpy(results[idx].response, message, stored);
+                    results[idx].response_size = stored;
+                    results[idx].latency_ns = timespec_diff_ns(&sent_at[idx], &now);
+                    results[idx].status = stored < len ? DNS_STATUS_TRUNCATED : response_status(message, len, 0);
+                    received++;
+                }
+                memmove(tcp->rx, tcp->rx + pos, tcp->rx_len - pos);
+                tcp->rx_len -= pos;
+            }
+            continue;
+
+closed:
+            // The server may close idle or busy connections (RFC 7766, 6.2.3)
+            tcp_disconnect(tcp);
+            if (reconnected) {
+                break;
+            }
+            reconnected = 1;
+            queue_len = next = 0;
+            offset = 0;
+            for (i = 0; i < todo_len; i++) {
+                if (results[todo[i]].response_size == 0) {
+                    queue[queue_len++] = todo[i];
+                }
+            }
+        }
+    }
+
+    // A connection left in the middle of a query cannot be reused
+    if (offset > 0 || fail_errno) {
+        tcp_disconnect(tcp);
+    }
+
+    // Explain why the remaining queries went unanswered
+    for (i = 0; i < todo_len; i++) {
+        DNSResponse* result = &results[todo[i]];
+        if (result->response_size > 0) {
+            continue;
+        }
+        if (fail_errno == ETIMEDOUT) {
+            result->status = DNS_STATUS_TIMEOUT;
+            result->error_code = fail_errno;
+        } else if (fail_errno) {
+            result->status = is_unreachable_error(fail_errno) ? DNS_STATUS_UNREACHABLE : DNS_STATUS_SEND_ERROR;
+            result->error_code = fail_errno;
+        } else if (closed_errno) {
+            result->status = DNS_STATUS_RECV_ERROR;
+            result->error_code = closed_errno;
+        }
+    }
+    return received;
+}
+
+/*
+ * Resends the queries whose UDP response came back truncated over TCP, if
+ * the session asks for the fallback. Their UDP attempts keep counting.
+ * Returns the number of queries resent.
+ */
+static int tc_fallback(DNSSession* session, int* req_sizes, int num_requests, DNSResponse* results, int timeout_ms, int retries) {
+    int i, todo_len = 0;
+    int *todo = session->scratch.todo;
+
+    if (!(session->flags & DNS_FLAG_TC_FALLBACK)) {
+        return 0;
+    }
+    for (i = 0; i < num_requests; i++) {
+        if (results[i].status == DNS_STATUS_TRUNCATED) {
+            results[i].response_size = 0;
+            results[i].num_additional_params = 0;
+            results[i].timestamp_source = DNS_TIMESTAMP_NONE;
+            results[i].status = DNS_STATUS_TIMEOUT;
+            todo[todo_len++] = i;
+        }
+    }
+    if (todo_len > 0) {
+        exchange_tcp(session, req_sizes, todo, todo_len, results, timeout_ms, retries);
+    }
+    return todo_len;
+}
+
+/*
+ * Moves the UDP socket of a session to the next source port of its range
+ * once it has carried `rotate_every` queries, then counts the `count`
+ * queries about to be sent. Responses still due on the old socket are lost,
+ * so this only runs between exchanges. If no new socket can be opened the
+ * old one is kept.
+ */
+static void rotate_source_port(DNSSession* session, int count) {
+    if (session->rotate_every > 0 && session->queries_on_socket >= session->rotate_every) {
+        int old_fd = session->sockfd;
+        int sockfd = open_dns_socket(session);
+        if (sockfd >= 0) {
+            close(old_fd);
+            session->sockfd = sockfd;
+            session->tx_seq = 0;  // TX timestamp keys count per socket
+            session->queries_on_socket = 0;
+        }
+    }
+    session->queries_on_socket += count;
+}
+
+/*
+ * Sends one raw DNS query through a session and receives its response, over
+ * UDP or the session's TCP connection. See exchange_udp and exchange_tcp.
+ * Returns the response size, or -1 if no response was received.
+ */
+static int exchange_query(DNSSession* session, unsigned char* request, int req_size, DNSResponse* result, int timeout_ms, int retries) {
+    if (result->response_capacity <= 0) {
+        reset_response(result, DNS_STATUS_RECV_ERROR);
+        result->error_code = EINVAL;  // No storage bound to the slot
+        return -1;
+    }
+    if (session->sockfd >= 0) {
+        rotate_source_port(session, 1);
+        reset_response(result, DNS_STATUS_TIMEOUT);
+        exchange_udp(session, request, req_size, result, timeout_ms, retries);
+        if (result->status != DNS_STATUS_TRUNCATED || !(session->flags & DNS_FLAG_TC_FALLBACK)) {
+            return result->response_size > 0 ? result->response_size : -1;
+        }
+    }
+
+    if (scratch_reserve(&session->scratch, 1, 1) < 0) {
+        reset_response(result, DNS_STATUS_SOCKET_ERROR);
+        result->error_code = ENOMEM;
+        return -1;
+    }
+    session->scratch.packets[0] = request;
+    if (session->sockfd < 0) {
+        reset_response(result, DNS_STATUS_TIMEOUT);
+        session->scratch.todo[0] = 0;
+        exchange_tcp(session, &req_size, session->scratch.todo, 1, result, timeout_ms, retries);
+    } else {
+        tc_fallback(session, &req_size, 1, result, timeout_ms, retries);
+    }
+    return result->response_size > 0 ? result->response_size : -1;
+}
+
+/*
+ * Sends a batch of raw DNS queries through a session and collects the
+ * responses, over UDP or the session's TCP connection. See dns_query_batch
+ * for the layout of the arguments.
+ * Returns the number of responses received, or -1 on failure.
+ */
+static int exchange_batch(
+    DNSSession* session, unsigned char* requests, int* req_sizes, int num_requests,
+    DNSResponse* results, int timeout_ms, int retries
+) {
+    int i, received;
+    int recv_size = batch_prepare(session, requests, req_sizes, num_requests, results);
+
+    if (recv_size < 0) {
+        return -1;
+    }
+    if (session->sockfd < 0) {
+        for (i = 0; i < num_requests; i++) {
+            session->scratch.todo[i] = i;
+        }
+        return exchange_tcp(session, req_sizes, session->scratch.todo, num_requests, results, timeout_ms, retries);
+    }
+
+    rotate_source_port(session, num_requests);
+    received = exchange_udp_batch(session, req_sizes, num_requests, results, recv_size, timeout_ms, retries);
+    if (received > 0 && tc_fallback(session, req_sizes, num_requests, results, timeout_ms, retries) > 0) {
+        received = 0;
+        for (i = 0; i < num_requests; i++) {
+            received += results[i].response_size > 0;
+        }
+    }
+    return received;
+}
+
+/*
+ * Sends a raw DNS query and receives the response.
+ * Supports both IPv4 and IPv6. If PDM metrics are enabled, they are embedded
+ * in the IPv6 Destination Options Header. Each attempt waits up to
+ * `timeout_ms` (forever if <= 0) and the query is resent up to `retries` times.
+ * `endpoint` sets the destination port and local address (NULL for port 53
+ * from an address and port chosen by the kernel).
+ * The outcome is reported through `result->status`.
+ */
+int dns_query(
+    const char* dns_server, unsigned char* request, int req_size, DNSResponse* result,
+    int use_ipv6, int flags, int timeout_ms, int retries, const DNSEndpoint* endpoint
+) {
+    DNSSession session;
+    ThreadMemory* mem = thread_memory();
+    int resp_size;
+
+    if (session_init(&session, dns_server, use_ipv6, flags, endpoint) < 0) {
+        reset_response(result, DNS_STATUS_SOCKET_ERROR);
+        result->error_code = errno;
+        return -1;
+    }
+
+    session_borrow_memory(&session, mem);
+    resp_size = exchange_query(&session, request, req_size, result, timeout_ms, retries);
+    session_return_memory(&session, mem);
+    record_session_addresses(&session, result, 1);
+
+    session_release(&session);
     return resp_size;
 }
 
+/*
+ * Sends a batch of raw DNS queries to one server over a single socket and
+ * collects the responses.
+ *
+ * `requests` holds `num_requests` wire-format packets back to back, the size
+ * of each given in `req_sizes`. Every packet must carry a distinct DNS ID,
+ * which is used to match responses back to their request slot in `results`.
+ * Queries are written with sendmmsg and responses drained with recvmmsg,
+ * interleaved through poll so the socket buffer never has to hold the whole
+ * batch. A round ends once every query is answered or `timeout_ms` elapses
+ * after its last query was sent (never if `timeout_ms` <= 0); up to `retries`
+ * further rounds resend the queries still unanswered.
+ *
+ * With DNS_FLAG_TCP the queries are pipelined over one TCP connection
+ * instead, and with DNS_FLAG_TC_FALLBACK truncated UDP responses are asked
+ * again over TCP.
+ *
+ * Unanswered slots are left with `response_size` 0 and a status explaining
+ * why (timeout, ICMP unreachable or send error). `endpoint` works as for
+ * dns_query.
+ *
+ * Returns the number of responses received, or -1 on failure.
+ */
+int dns_query_batch(
+    const char* dns_server, unsigned char* requests, int* req_sizes, int num_requests,
+    DNSResponse* results, int use_ipv6, int flags, int timeout_ms, int retries,
+    const DNSEndpoint* endpoint
+) {
+    DNSSession session;
+    ThreadMemory* mem = thread_memory();
+    int received;
+    int i;
+
+    if (num_requests <= 0 || num_requests > MAX_BATCH_QUERIES) {
+        return -1;
+    }
+
+    if (session_init(&session, dns_server, use_ipv6, flags, endpoint) < 0) {
+        int err = errno;
+        for (i = 0; i < num_requests; i++) {
+            reset_response(&results[i], DNS_STATUS_SOCKET_ERROR);
+            results[i].error_code = err;
+        }
+        return -1;
+    }
+
+    session_borrow_memory(&session, mem);
+    received = exchange_batch(&session, requests, req_sizes, num_requests, results, timeout_ms, retries);
+    session_return_memory(&session, mem);
+    record_session_addresses(&session, results, num_requests);
+
+    session_release(&session);
+    return received;
+}
+
+/*
+ * Socket index of the server of `endpoint` in a fan-out: 0 for IPv4, 1 for
+ * IPv6, or -1 if it carries no valid pre-parsed address.
+ */
+static int fanout_family(const DNSEndpoint* endpoint) {
+    const struct sockaddr* addr = endpoint->server_addr;
+
+    if (addr == NULL) {
+        return -1;
+    }
+    if (addr->sa_family == AF_INET && endpoint->server_addr_len == sizeof(struct sockaddr_in)) {
+        return 0;
+    }
+    if (addr->sa_family == AF_INET6 && endpoint->server_addr_len == sizeof(struct sockaddr_in6)) {
+        return 1;
+    }
+    return -1;
+}
+
+// Whether `addr`, the peer of a datagram, is the server address of `endpoint`
+static int is_endpoint_address(const struct sockaddr_storage* addr, const DNSEndpoint* endpoint) {
+    struct sockaddr_storage server;
+
+    memcpy(&server, endpoint->server_addr, endpoint->server_addr_len);
+    if (addr->ss_family != server.ss_family) {
+        return 0;
+    }
+    if (server.ss_family == AF_INET6) {
+        const struct sockaddr_in6* a = (const struct sockaddr_in6*)addr;
+        const struct sockaddr_in6* b = (const struct sockaddr_in6*)&server;
+        return a->sin6_port == b->sin6_port && memcmp(&a->sin6_addr, &b->sin6_addr, sizeof(a->sin6_addr)) == 0;
+    }
+    const struct sockaddr_in* a = (const struct sockaddr_in*)addr;
+    const struct sockaddr_in* b = (const struct sockaddr_in*)&server;
+    return a->sin_port == b->sin_port && a->sin_addr.s_addr == b->sin_addr.s_addr;
+}
+
+/*
+ * Opens the unconnected UDP socket of a fan-out, with the source settings of
+ * `endpoint`. ICMP errors of an unconnected socket are only reported through
+ * its error queue, so IP_RECVERR is enabled. Returns 0, or -1 with errno set.
+ */
+static int fanout_open(DNSSession* session, const DNSEndpoint* endpoint, int flags) {
+    int opt = 1;
+
+    session->flags = flags;
+    if (session_set_endpoint(session, NULL, endpoint) < 0) {
+        return -1;
+    }
+    session->sockfd = open_udp_socket(session, 0);
+    if (session->sockfd < 0) {
+        return -1;
+    }
+    if (session->use_ipv6) {
+        setsockopt(session->sockfd, IPPROTO_IPV6, IPV6_RECVERR, &opt, sizeof(opt));
+    } else {
+        setsockopt(session->sockfd, IPPROTO_IP, IP_RECVERR, &opt, sizeof(opt));
+    }
+    return 0;
+}
+
+/*
+ * Reads one error from the error queue of a fan-out socket without blocking.
+ * For an ICMP error, `dest` receives the destination of the datagram that
+ * caused it and `err` its errno. Returns 1 for an ICMP error, 0 for any
+ * other error and -1 once the queue is empty.
+ */
+static int read_icmp_error(int sockfd, struct sockaddr_storage* dest, int* err) {
+    char ctrl_buf[CTRL_BUF_SIZE];
+    unsigned char payload[16];  // Start of the offending datagram, unused
+    struct iovec iov = { .iov_base = payload, .iov_len = sizeof(payload) };
+    struct msghdr msg = {
+        .msg_name = dest, .msg_namelen = sizeof(*dest),
+        .msg_iov = &iov, .msg_iovlen = 1,
+        .msg_control = ctrl_buf, .msg_controllen = sizeof(ctrl_buf)
+    };
+    struct cmsghdr *cmsg;
+
+    if (recvmsg(sockfd, &msg, MSG_ERRQUEUE | MSG_DONTWAIT) < 0) {
+        return -1;
+    }
+    for (cmsg = CMSG_FIRSTHDR(&msg); cmsg != NULL; cmsg = CMSG_NXTHDR(&msg, cmsg)) {
+        if ((cmsg->cmsg_level == IPPROTO_IP && cmsg->cmsg_type == IP_RECVERR) ||
+            (cmsg->cmsg_level == IPPROTO_IPV6 && cmsg->cmsg_type == IPV6_RECVERR)) {
+            struct sock_extended_err ee;
+            memcpy(&ee, CMSG_DATA(cmsg), sizeof(ee));
+            if (ee.ee_origin == SO_EE_ORIGIN_ICMP || ee.ee_origin == SO_EE_ORIGIN_ICMP6) {
+                *err = ee.ee_errno;
+                return 1;
+            }
+        }
+    }
+    return 0;
+}
+
+// Whether a fan-out server was sent the query and has neither answered nor failed yet
+static inline int fanout_pending(const DNSResponse* result) {
+    return result->response_size == 0 && result->status == DNS_STATUS_TIMEOUT;
+}
+
+/*
+ * Sends one raw DNS query to `num_servers` servers at once and collects
+ * their responses, one slot of `results` per entry of `endpoints`.
+ *
+ * Every server is given by the pre-parsed `server_addr` of its endpoint; the
+ * source settings of the first IPv4 and the first IPv6 endpoint apply to all
+ * servers of that family. The query goes out over one unconnected UDP socket
+ * per address family, written with sendmmsg in the order of `endpoints`, so
+ * the whole set is sent within microseconds. The packet is shared: each
+ * server gets its own DNS ID (the ID of `request` plus its index), carried
+ * in a two-byte iovec ahead of the rest of `request`, and a response is
+ * matched to its server by ID and checked against its source address.
+ *
+ * A round ends once every server answered or `timeout_ms` elapsed after the
+ * last query was sent (never if <= 0); up to `retries` further rounds resend
+ * to the servers still silent. ICMP errors mark their server unreachable.
+ * With DNS_FLAG_TC_FALLBACK truncated responses are asked again over TCP,
+ * one server after the other. PDM, kernel timestamps and DNS_FLAG_TCP are
+ * not supported: `fanout_query` rejects them with a ValueError, and they are
+ * masked off here as well so that other callers get plain UDP.
+ *
+ * Returns the number of responses received, or -1 on failure.
+ */
+int dns_query_fanout(
+    unsigned char* request, int req_size, const DNSEndpoint* endpoints, int num_servers,
+    DNSResponse* results, int flags, int timeout_ms, int retries
+) {
+    DNSSession sockets[FANOUT_FAMILIES];
+    int open_errno[FANOUT_FAMILIES] = { 0, 0 };
+    ThreadMemory* mem = thread_memory();
+    BatchScratch local = { 0 };
+    BatchScratch* scratch = mem != NULL ? &mem->scratch : &local;
+    struct timespec now, deadline = { 0, 0 };  // Set once a round has been sent
+    struct mmsghdr msgs[BATCH_CHUNK];
+    struct iovec iovs[2 * BATCH_CHUNK];
+    struct sockaddr_storage names[BATCH_CHUNK];
+    unsigned char ids[BATCH_CHUNK][2];
+    int i, f, n, attempt, err;
+    int recv_size = MAX_DNS_MESSAGE_SIZE, done = 0, received = 0, poll_errno = 0;
+    unsigned int id_base;
+
+    if (num_servers <= 0 || num_servers > MAX_BATCH_QUERIES || req_size < 2) {
+        return -1;
+    }
+    for (i = 0; i < num_servers; i++) {
+        if (results[i].response_capacity < recv_size) {
+            recv_size = results[i].response_capacity;
+        }
+        reset_response(&results[i], DNS_STATUS_TIMEOUT);
+    }
+    if (recv_size <= 0) {
+        return -1;  // Response slots without bound storage
+    }
+    if (scratch_reserve(scratch, num_servers, recv_size) < 0) {
+        for (i = 0; i < num_servers; i++) {
+            results[i].status = DNS_STATUS_SOCKET_ERROR;
+            results[i].error_code = ENOMEM;
+        }
+        return -1;
+    }
+
+    // Rejected by the Python wrapper; masked in case of other callers
+    flags &= ~(DNS_FLAG_PDM_METRIC | DNS_FLAG_KERNEL_TIMESTAMP | DNS_FLAG_TCP);
+    for (f = 0; f < FANOUT_FAMILIES; f++) {
+        memset(&sockets[f], 0, sizeof(sockets[f]));
+        sockets[f].sockfd = -1;
+        sockets[f].tcp.fd = -1;
+    }
+
+    // Open the sockets and assign the DNS IDs
+    id_base = (request[0] << 8) | request[1];
+    memset(scratch->slots, 0xff, MAX_BATCH_QUERIES * sizeof(int));
+    for (i = 0; i < num_servers; i++) {
+        f = fanout_family(&endpoints[i]);
+        err = f < 0 ? EAFNOSUPPORT : open_errno[f];
+        if (!err && sockets[f].sockfd < 0 && fanout_open(&sockets[f], &endpoints[i], flags) < 0) {
+            err = open_errno[f] = errno ? errno : EINVAL;
+        }
+        if (err) {
+            results[i].status = DNS_STATUS_SOCKET_ERROR;
+            results[i].error_code = err;
+            done++;
+            continue;
+        }
+        scratch->slots[(id_base + i) & 0xffff] = i;
+    }
+
+    // Every round (re)sends the query to the servers still silent
+    for (attempt = 0; attempt <= retries && done < num_servers && !poll_errno; attempt++) {
+        int *queue = scratch->queue;
+        int queue_len = 0, next = 0;
+
+        for (i = 0; i < num_servers; i++) {
+            if (fanout_pending(&results[i])) {
+                queue[queue_len++] = i;
+            }
+        }
+
+        while (done < num_servers) {
+            struct pollfd pfds[FANOUT_FAMILIES];
+            int send_family = next < queue_len ? fanout_family(&endpoints[queue[next]]) : -1;
+            int wait_ms = -1;
+
+            for (f = 0; f < FANOUT_FAMILIES; f++) {
+                pfds[f].fd = sockets[f].sockfd;  // poll skips negative descriptors
+                pfds[f].events = POLLIN | (f == send_family ? POLLOUT : 0);
+                pfds[f].revents = 0;
+            }
+            if (send_family < 0 && timeout_ms > 0) {
+                wait_ms = ms_until(&deadline);
+                if (wait_ms == 0) {
+                    break;  // Round timed out
+                }
+            }
+
+            if (poll(pfds, FANOUT_FAMILIES, wait_ms) < 0) {
+                if (errno == EINTR) {
+                    continue;
+                }
+                poll_errno = errno;
+                break;
+            }
+
+            if (send_family >= 0 && (pfds[send_family].revents & POLLOUT)) {
+                int count = 0;
+
+                // A run of servers of the same family goes out in one call
+                while (count < BATCH_CHUNK && next + count < queue_len &&
+                       fanout_family(&endpoints[queue[next + count]]) == send_family) {
+                    int idx = queue[next + count];
+                    unsigned int id = (id_base + idx) & 0xffff;
+
+                    ids[count][0] = id >> 8;
+                    ids[count][1] = id & 0xff;
+                    iovs[2 * count].iov_base = ids[count];
+                    iovs[2 * count].iov_len = 2;
+                    iovs[2 * count + 1].iov_base = request + 2;
+                    iovs[2 * count + 1].iov_len = req_size - 2;
+                    memset(&msgs[count], 0, sizeof(msgs[count]));
+                    msgs[count].msg_hdr.msg_name = (void*)endpoints[idx].server_addr;
+                    msgs[count].msg_hdr.msg_namelen = endpoints[idx].server_addr_len;
+                    msgs[count].msg_hdr.msg_iov = &iovs[2 * count];
+                    msgs[count].msg_hdr.msg_iovlen = 2;
+                    count++;
+                }
+
+                time_get_real_ns(&now);
+                n = sendmmsg(sockets[send_family].sockfd, msgs, count, MSG_DONTWAIT);
+                if (n < 0 && errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+                    // Unconnected sockets fail per destination, so only this server is lost
+                    int idx = queue[next++];
+                    results[idx].status = is_unreachable_error(errno) ? DNS_STATUS_UNREACHABLE : DNS_STATUS_SEND_ERROR;
+                    results[idx].error_code = errno;
+                    results[idx].attempts++;
+                    done++;
+                }
+                for (i = 0; i < n; i++) {
+                    int idx = queue[next + i];
+                    scratch->sent_at[idx] = now;
+                    results[idx].attempts++;
+                    results[idx].sent_ns = timespec_to_ns(&now);
+                }
+                if (n > 0) {
+                    next += n;
+                }
+                if (next == queue_len) {
+                    deadline_after_ms(&deadline, &now, timeout_ms);
+                }
+            }
+
+            for (f = 0; f < FANOUT_FAMILIES; f++) {
+                struct sockaddr_storage dest;
+
+                if (!(pfds[f].revents & POLLERR)) {
+                    continue;
+                }
+                while ((n = read_icmp_error(sockets[f].sockfd, &dest, &err)) >= 0) {
+                    for (i = 0; n > 0 && i < num_servers; i++) {
+                        if (fanout_family(&endpoints[i]) == f && fanout_pending(&results[i]) &&
+                            results[i].attempts > 0 && is_endpoint_address(&dest, &endpoints[i])) {
+                            results[i].status = DNS_STATUS_UNREACHABLE;
+                            results[i].error_code = err;
+                            done++;
+                        }
+                    }
+                }
+            }
+
+            for (f = 0; f < FANOUT_FAMILIES; f++) {
+                if (!(pfds[f].revents & POLLIN)) {
+                    continue;
+                }
+                for (i = 0; i < BATCH_CHUNK; i++) {
+                    iovs[i].iov_base = scratch->recv_bufs + (size_t)i * recv_size;
+                    iovs[i].iov_len = recv_size;
+                    memset(&msgs[i], 0, sizeof(msgs[i]));
+                    msgs[i].msg_hdr.msg_name = &names[i];
+                    msgs[i].msg_hdr.msg_namelen = sizeof(names[i]);
+                    msgs[i].msg_hdr.msg_iov = &iovs[i];
+                    msgs[i].msg_hdr.msg_iovlen = 1;
+                }
+
+                n = recvmmsg(sockets[f].sockfd, msgs, BATCH_CHUNK, MSG_DONTWAIT, NULL);
+                time_get_real_ns(&now);
+                for (i = 0; i < n; i++) {
+                    unsigned int len = msgs[i].msg_len;
+                    unsigned char *buf = scratch->recv_bufs + (size_t)i * recv_size;
+                    if (len < 2) {
+                        continue;
+                    }
+                    int idx = scratch->slots[(buf[0] << 8) | buf[1]];
+                    if (idx < 0 || results[idx].attempts == 0 || !fanout_pending(&results[idx]) ||
+                        !is_endpoint_address(&names[i], &endpoints[idx])) {
+                        continue;  // Unknown, unsent, duplicate or spoofed response
+                    }
+                    memcpy(results[idx].response, buf, len);
+                    results[idx].response_size = len;
+                    results[idx].latency_ns = timespec_diff_ns(&scratch->sent_at[idx], &now);
+                    results[idx].status = response_status(buf, len, msgs[i].msg_hdr.msg_flags);
+                    received++;
+                    done++;
+                }
+            }
+        }
+    }
+
+    if (report_local_addresses) {
+        for (i = 0; i < num_servers; i++) {
+            f = fanout_family(&endpoints[i]);
+            if (f >= 0) {
+                record_fanout_address(sockets[f].sockfd, &endpoints[i], &results[i]);
+            }
+        }
+    }
+    for (f = 0; f < FANOUT_FAMILIES; f++) {
+        session_release(&sockets[f]);
+    }
+    if (mem == NULL) {
+        scratch_free(&local);
+    }
+    for (i = 0; i < num_servers; i++) {
+        if (poll_errno && fanout_pending(&results[i])) {
+            results[i].status = DNS_STATUS_RECV_ERROR;
+            results[i].error_code = poll_errno;
+        }
+    }
+
+    // The TCP queries borrow the thread memory, which the fan-out is done with
+    if (flags & DNS_FLAG_TC_FALLBACK) {
+        for (i = 0; i < num_servers; i++) {
+            if (results[i].status == DNS_STATUS_TRUNCATED) {
+                int attempts = results[i].attempts;
+
+                dns_query(NULL, request, req_size, &results[i], 0,
+                          (flags & ~DNS_FLAG_TC_FALLBACK) | DNS_FLAG_TCP, timeout_ms, retries, &endpoints[i]);
+                results[i].attempts += attempts;
+                received -= results[i].response_size == 0;
+            }
+        }
+    }
+    return received;
+}
+
+/*
+ * Open a session towards `dns_server`, see dns_query for `endpoint`. With
+ * `endpoint->rotate_every`, the UDP socket moves to the next source port of
+ * the range between exchanges; dns_session_send and dns_session_recv keep
+ * using the current socket. Returns NULL with errno set on failure.
+ */
+DNSSession* dns_session_open(const char* dns_server, int use_ipv6, int flags, const DNSEndpoint* endpoint) {
+    DNSSession* session = malloc(sizeof(DNSSession));
+    if (session == NULL) {
+        return NULL;
+    }
+
+    if (session_init(session, dns_server, use_ipv6, flags, endpoint) < 0) {
+        int err = errno;
+        free(session);
+        errno = err;
+        return NULL;
+    }
+    return session;
+}
+
+// Send one query through an open session. See exchange_query.
+int dns_session_query(DNSSession* session, unsigned char* request, int req_size, DNSResponse* result, int timeout_ms, int retries) {
+    int resp_size = exchange_query(session, request, req_size, result, timeout_ms, retries);
+
+    record_session_addresses(session, result, 1);
+    return resp_size;
+}
+
+// Send a batch of queries through an open session. See dns_query_batch.
+int dns_session_query_batch(
+    DNSSession* session, unsigned char* requests, int* req_sizes, int num_requests,
+    DNSResponse* results, int timeout_ms, int retries
+) {
+    int received = exchange_batch(session, requests, req_sizes, num_requests, results, timeout_ms, retries);
+
+    record_session_addresses(session, results, num_requests);
+    return received;
+}
+
+// Socket descriptor of the session, for registration with an event loop.
+int dns_session_fileno(DNSSession* session) {
+    return session->sockfd;
+}
+
+/*
+ * Sends one query through the session without waiting for the response.
+ * The monotonic send time, taken right before the send call, is stored in
+ * `sent_ns` and the key its kernel TX timestamp will carry in `tx_key`.
+ * Returns the number of bytes sent, or -1 on failure.
+ */
+int dns_session_send(DNSSession* session, unsigned char* request, int req_size, int64_t* sent_ns, uint32_t* tx_key) {
+    struct timespec start;
+
+    if (session->sockfd < 0) {
+        errno = EOPNOTSUPP;  // TCP sessions are only driven through exchanges
+        return -1;
+    }
+
+    *tx_key = session->tx_seq;
+    time_get_real_ns(&start);
+    *sent_ns = timespec_to_ns(&start);
+    return session_send(session, request, req_size, &start);
+}
+
+/*
+ * Reads one pending response from the session socket without blocking.
+ * The monotonic receive time, taken right after the receive call, is stored
+ * in `recv_ns`. Returns the response size, or -1 with errno set if nothing
+ * could be read (EAGAIN when no response is pending).
+ */
+int dns_session_recv(DNSSession* session, DNSResponse* result, int64_t* recv_ns) {
+    struct timespec end;
+    char ctrl_buf[1024];
+    struct iovec iov = { .iov_base = result->response, .iov_len = result->response_capacity };
+    struct msghdr msg = {
+        .msg_iov = &iov, .msg_iovlen = 1,
+        .msg_control = ctrl_buf, .msg_controllen = sizeof(ctrl_buf)
+    };
+
+    reset_response(result, DNS_STATUS_RECV_ERROR);
+    if (session->sockfd < 0) {
+        result->error_code = EOPNOTSUPP;
+        errno = EOPNOTSUPP;
+        return -1;
+    }
+    ssize_t resp_size = recvmsg(session->sockfd, &msg, MSG_DONTWAIT);
+    time_get_real_ns(&end);
+    if (resp_size < 0) {
+        result->status = is_unreachable_error(errno) ? DNS_STATUS_UNREACHABLE : DNS_STATUS_RECV_ERROR;
+        result->error_code = errno;
+        return -1;
+    }
+
+    collect_additional_params(&msg, result);
+    result->response_size = resp_size;
+    result->status = response_status(result->response, resp_size, msg.msg_flags);
+    *recv_ns = timespec_to_ns(&end);
+    if (session->pdm) {
+        pdm_flow_received(&session->pdm_flow, result, *recv_ns);
+    }
+    return resp_size;
+}
+
+/*
+ * Reads one kernel TX timestamp of the session from the socket error queue
+ * without blocking. Pair it with the response through `tx_key` and
+ * dns_kernel_latency. Returns 1 if a timestamp was read, 0 otherwise.
+ */
+int dns_session_tx_timestamp(DNSSession* session, uint32_t* tx_key, KernelTimestamp* stamp) {
+    return read_tx_timestamp(session->sockfd, tx_key, stamp);
+}
+
+/*
+ * Reads the local address of the session's UDP socket, as for the
+ * `local_address` and `local_port` of a response slot. Returns 0, or -1 if
+ * the session has no UDP socket or it is not bound yet.
+ */
+int dns_session_local_address(DNSSession* session, unsigned char* address, int* port) {
+    return read_local_address(session->sockfd, address, port);
+}
+
+/*
+ * Makes exchanges store the local address and port each query was sent
+ * from in its response slot (`enabled` 1) or not (0, the default). It costs
+ * one getsockname call per socket and call, so it is only turned on while
+ * a capture needs it.
+ */
+void dns_report_local_addresses(int enabled) {
+    report_local_addresses = enabled;
+}
+
+/*
+ * Copies the PDM flow state of the session into `flow`. Returns 0, or -1 if
+ * the session does not send PDM options.
+ */
+int dns_session_pdm_flow(DNSSession* session, PDMFlow* flow) {
+    if (!session->pdm) {
+        return -1;
+    }
+    *flow = session->pdm_flow;
+    return 0;
+}
+
+// Close the session socket and release the session.
+void dns_session_close(DNSSession* session) {
+    if (session == NULL) {
+        return;
+    }
+    session_release(session);
+    free(session);
+}
+
+/*
+ * Points the `response` buffer of each of `count` slots at its own
+ * `capacity` bytes of `storage`, which must hold `count * capacity` bytes.
+ */
+void dns_bind_responses(DNSResponse* results, int count, unsigned char* storage, int capacity) {
+    int i;
+
+    for (i = 0; i < count; i++) {
+        results[i].response = storage + (size_t)i * capacity;
+        results[i].response_capacity = capacity;
+        results[i].response_size = 0;
+    }
+}
+
 // Wrapper function for dns_query
 int query_dns(
     const char* dns_server, unsigned char* request, int req_size, 
-    DNSResponse* result, int use_ipv6, int flags
+    DNSResponse* result, int use_ipv6, int flags, int timeout_ms, int retries,
+    const DNSEndpoint* endpoint
 ) {
-    return dns_query(dns_server, request, req_size, result, use_ipv6, flags);
-}
\ No newline at end of file
+    return dns_query(dns_server, request, req_size, result, use_ipv6, flags, timeout_ms, retries, endpoint);
+}
+
+// Wrapper function for dns_query_batch
+int query_dns_batch(
+    const char* dns_server, unsigned char* requests, int* req_sizes, int num_requests,
+    DNSResponse* results, int use_ipv6, int flags, int timeout_ms, int retries,
+    const DNSEndpoint* endpoint
+) {
+    return dns_query_batch(
+        dns_server, requests, req_sizes, num_requests, results, use_ipv6, flags, timeout_ms, retries, endpoint);
+}
+
+// Wrapper function for dns_query_fanout
+int query_dns_fanout(
+    unsigned char* request, int req_size, const DNSEndpoint* endpoints, int num_servers,
+    DNSResponse* results, int flags, int timeout_ms, int retries
+) {
+    return dns_query_fanout(request, req_size, endpoints, num_servers, results, flags, timeout_ms, retries);
+}
@@ -0,0 +1,219 @@
+import collections
+import concurrent.futures
+import ctypes
+import itertools
+import math
+import os
+import struct
+import typing
+
+from .dns_packet import (
+    DNS_PORT,
+    DNSFlags,
+    DNSQuery,
+    DNSResult,
+    DNSStatus,
+    DNSTransport,
+    SourceOptions,
+    _endpoint,
+)
+from .native import PDMOption
+from .session import MeasurementSession
+
+# Fixed part of a result record: job index, errno, status, attempts, flag
+# bits, transport, latency, kernel latency, TCP connect time, response size
+# and number of PDM options. The response bytes and the raw PDM options
+# follow it.
+_RECORD = struct.Struct("<IiBBBBdddHB")
+_PDM_SIZE = ctypes.sizeof(PDMOption)
+_HAS_KERNEL_LATENCY = 0x1
+_HARDWARE_TIMESTAMPS = 0x2
+_HAS_CONNECT = 0x4
+
+# Session of the current pool worker, opened by `_init_worker`
+_worker_session: typing.Optional[MeasurementSession] = None
+
+
+def measure_many(
+    jobs: typing.Iterable[typing.Tuple[DNSQuery, str]],
+    workers: typing.Optional[int] = None,
+    extra_flags: DNSFlags = DNSFlags.NoFlag,
+    chunk_size: int = 1024,
+    port: int = DNS_PORT,
+    source: typing.Optional[SourceOptions] = None,
+) -> typing.List[DNSResult]:
+    """
+    Measures many (query, server) pairs in parallel on a pool of processes.
+
+    The jobs are grouped by server and cut into chunks that are handed to a
+    process pool. Every worker owns a `MeasurementSession`, so it keeps one
+    native socket per server and sends the queries of a chunk to each server
+    with a single batched native call. Query building, ctypes marshaling and
+    result handling therefore run on all cores instead of being serialized
+    on the GIL. Workers return their results as packed binary records, which
+    are merged back into `DNSResult`s in job order.
+
+    Args:
+        jobs (Iterable[Tuple[DNSQuery, str]]): The (query, server IP) pairs to
+            measure, e.g. the product of a list of queries and a list of
+            nameservers.
+        workers (int): Number of worker processes, defaulting to the number of
+            CPUs.
+        extra_flags (DNSFlags): Control flags for every query.
+        chunk_size (int): Maximum number of jobs sent to a worker at once.
+        port (int): Destination port of the servers given as strings.
+        source (SourceOptions): Local address and source ports of the worker
+            sockets. Workers share a port range, each taking free ports of it.
+
+    Returns:
+        list: One `DNSResult` per job, in the order of `jobs`.
+
+    Example:
+        ```py
+        import itertools
+        from measure_dns import DNSQuery, measure_many
+        queries = [DNSQuery("example.com", "A"), DNSQuery("example.com", "AAAA")]
+        servers = ["8.8.8.8", "1.1.1.1", "9.9.9.9"]
+        jobs = list(itertools.product(queries, servers))
+        for (query, server), result in zip(jobs, measure_many(jobs, workers=4)):
+            print(server, query.rdtype, result.latency_ns)
+        ```
+
+    Note:
+        Queries of one chunk to the same server are sent as one batch, so they
+        share the timeout and retry count of their most patient query. Call
+        this from a `if __name__ == "__main__":` block on platforms that do not
+        fork. Responses are only decoded when `DNSResult.response` is read.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError("At least one worker is needed")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    _endpoint(port, source)  # Reject bad endpoint settings before forking
+
+    # Spread every server over the chunks so no worker waits on a slow one alone
+    by_server: typing.Dict[str, typing.List[typing.Tuple[int, DNSQuery]]] = (
+        collections.defaultdict(list)
+    )
+    for index, (query, server) in enumerate(jobs):
+        by_server[server].append((index, query))
+    chunk_size = min(chunk_size, math.ceil(len(jobs) / workers))
+    chunks = []
+    for server, server_jobs in by_server.items():
+        for start in range(0, len(server_jobs), chunk_size):
+            chunks.append((server, server_jobs[start : start + chunk_size]))
+
+    results: typing.List[typing.Optional[DNSResult]] = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(workers, len(chunks)),
+        initializer=_init_worker,
+        initargs=(int(extra_flags), port, source),
+    ) as executor:
+        futures = [executor.submit(_measure_chunk, *chunk) for chunk in chunks]
+        for future in concurrent.futures.as_completed(futures):
+            for index, result in _unpack_results(future.result()):
+                results[index] = result
+    return results
+
+
+def _init_worker(extra_flags: int, port: int, source: typing.Optional[SourceOptions]) -> None:
+    global _worker_session
+    _worker_session = MeasurementSession(DNSFlags(extra_flags), port=port, source=source)
+
+
+def _measure_chunk(
+    server: str, chunk: typing.List[typing.Tuple[int, DNSQuery]]
+) -> bytes:
+    """
+    Measures one chunk of jobs to `server` in a worker and packs the results.
+    """
+    indices = [index for index, _ in chunk]
+    queries = [query for _, query in chunk]
+    try:
+        results = _worker_session.query_batch(queries, server)
+    except OSError as error:
+        results = [
+            DNSResult(status=DNSStatus.SocketError, error_code=error.errno or 0, attempts=0)
+        ] * len(chunk)
+    return b"".join(_pack_result(index, result) for index, result in zip(indices, results))
+
+
+def _pack_result(index: int, result: DNSResult) -> bytes:
+    """
+    Packs a result into a binary record.
+    """
+    wire = b"" if result.wire is None else bytes(result.wire)
+    flags = 0
+    if result.kernel_latency_ns is not None:
+        flags |= _HAS_KERNEL_LATENCY
+    if result.hardware_timestamps:
+        flags |= _HARDWARE_TIMESTAMPS
+    if result.connect_ns is not None:
+        flags |= _HAS_CONNECT
+    header = _RECORD.pack(
+        index,
+        result.error_code,
+        result.status,
+        result.attempts,
+        flags,
+        result.transport,
+        result.latency_ns,
+        result.kernel_latency_ns or 0.0,
+        result.connect_ns or 0.0,
+        len(wire),
+        len(result.additional_params),
+    )
+    return b"".join(
+        itertools.chain(
+            (header, wire), (bytes(option) for option in result.additional_params)
+        )
+    )
+
+
+def _unpack_results(
+    records: bytes,
+) -> typing.Iterator[typing.Tuple[int, DNSResult]]:
+    """
+    Unpacks the records of a chunk into (job index, `DNSResult`) pairs.
+    """
+    view = memoryview(records)
+    offset = 0
+    while offset < len(records):
+        (
+            index,
+            error_code,
+            status,
+            attempts,
+            flags,
+            transport,
+            latency_ns,
+            kernel_latency_ns,
+            connect_ns,
+            wire_size,
+            num_options,
+        ) = _RECORD.unpack_from(records, offset)
+        offset += _RECORD.size
+        wire = bytes(view[offset : offset + wire_size]) if wire_size else None
+        offset += wire_size
+        options = [
+            PDMOption.from_buffer_copy(view[start : start + _PDM_SIZE])
+            for start in range(offset, offset + num_options * _PDM_SIZE, _PDM_SIZE)
+        ]
+        offset += num_options * _PDM_SIZE
+        yield index, DNSResult(
+            latency_ns=latency_ns,
+            additional_params=options,
+            status=DNSStatus(status),
+            error_code=error_code,
+            attempts=attempts,
+            kernel_latency_ns=kernel_latency_ns if flags & _HAS_KERNEL_LATENCY else None,
+            hardware_timestamps=bool(flags & _HARDWARE_TIMESTAMPS),
+            wire=wire,
+            transport=DNSTransport(transport),
+            connect_ns=connect_ns if flags & _HAS_CONNECT else None,
+        )
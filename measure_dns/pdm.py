@@ -0,0 +1,302 @@
+import ctypes
+import typing
+
+from .dns_packet import DNSResult, ResponseBuffer
+from .native import AdditionalParam, DNSResponse, MAX_ADDITIONAL_PARAMS, PDMOption
+
+# IPv6 option type of the PDM destination option and its fixed size (RFC 8250)
+PDM_OPTION_TYPE = 0x0F
+PDM_OPTION_SIZE = ctypes.sizeof(PDMOption)
+_PDM_OPT_LEN = PDM_OPTION_SIZE - 2
+
+# Padding options that may precede PDM in a destination options header
+_PAD1 = 0
+_PADN = 1
+# `AdditionalParam.type` of IPv6 destination options (IPPROTO_DSTOPTS)
+_DSTOPTS = 59
+# Attoseconds per nanosecond, the base unit of PDM delta times
+_AS_PER_NS = 1e9
+
+# Fields of the arrays returned by the PDM decoders, in native byte order
+PDM_FIELDS = (
+    ("valid", "?"),
+    ("scale_dtlr", "u1"),
+    ("scale_dtls", "u1"),
+    ("psntp", "u2"),
+    ("psnlr", "u2"),
+    ("deltatlr", "u2"),
+    ("deltatls", "u2"),
+)
+
+# Layout of the option on the wire, multi-byte fields in network byte order
+_WIRE_FIELDS = (
+    ("option_type", "u1"),
+    ("opt_len", "u1"),
+    ("scale_dtlr", "u1"),
+    ("scale_dtls", "u1"),
+    ("psntp", ">u2"),
+    ("psnlr", ">u2"),
+    ("deltatlr", ">u2"),
+    ("deltatls", ">u2"),
+)
+
+
+def pdm_time_ns(delta, scale):
+    """
+    Converts PDM delta times to nanoseconds.
+
+    RFC 8250 carries times as a 16-bit delta and a scale, meaning
+    `delta << scale` attoseconds. This works on plain integers as well as on
+    whole NumPy columns, e.g. the `deltatlr` and `scale_dtlr` fields returned
+    by `decode_pdm`.
+
+    Args:
+        delta (int or numpy.ndarray): DeltaTLR or DeltaTLS values.
+        scale (int or numpy.ndarray): The matching ScaleDTLR or ScaleDTLS values.
+
+    Returns:
+        float or numpy.ndarray: The times in nanoseconds.
+
+    Example:
+        ```py
+        from measure_dns import pdm_time_ns
+        pdm_time_ns(14896, 36)  # ~1.02 ms
+        ```
+    """
+    return delta * 2.0**scale / _AS_PER_NS
+
+
+def latency_breakdown(latency_ns, deltatlr, scale_dtlr, valid=None):
+    """
+    Splits round-trip times into server time and network time.
+
+    The DeltaTLR of the PDM option in a response is the time the server took
+    between receiving the query and sending the response. Subtracting it
+    from the measured round-trip time leaves the time spent in the network.
+    The computation is vectorized over whole columns.
+
+    Args:
+        latency_ns (numpy.ndarray): Round-trip times in nanoseconds.
+        deltatlr (numpy.ndarray): DeltaTLR of the responses.
+        scale_dtlr (numpy.ndarray): ScaleDTLR of the responses.
+        valid (numpy.ndarray): Optional mask of the rows carrying a PDM
+            option; the times of the other rows are NaN.
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: Server time and network time in
+        nanoseconds, as float64 columns.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+
+    Example:
+        ```py
+        from measure_dns import latency_breakdown, read_results
+        records = read_results("probes.bin")
+        server_ns, network_ns = latency_breakdown(
+            records["latency_ns"],
+            records["pdm_deltatlr"],
+            records["pdm_scale_dtlr"],
+            records["has_pdm"],
+        )
+        ```
+    """
+    numpy = _import_numpy("latency_breakdown")
+    server_ns = pdm_time_ns(
+        numpy.asarray(deltatlr, dtype=numpy.float64),
+        numpy.asarray(scale_dtlr, dtype=numpy.float64),
+    )
+    network_ns = numpy.asarray(latency_ns, dtype=numpy.float64) - server_ns
+    if valid is not None:
+        invalid = ~numpy.asarray(valid, dtype=bool)
+        server_ns[invalid] = numpy.nan
+        network_ns[invalid] = numpy.nan
+    return server_ns, network_ns
+
+
+def decode_pdm(buffers, width: typing.Optional[int] = None):
+    """
+    Decodes the PDM options of a batch of raw IPv6 destination options headers.
+
+    Each buffer is one destination options header as received with
+    `IPV6_RECVDSTOPTS`: the next-header and length bytes followed by the
+    options. The PDM option is located behind an optional Pad1 or PadN
+    option, and all of its fields are converted from network byte order in
+    one pass over the batch.
+
+    Args:
+        buffers: A 2-D `uint8` array with one header per row, a bytes-like
+            object holding headers of `width` bytes back to back, or a
+            sequence of bytes-like headers.
+        width (int): Size of each header in a bytes-like `buffers`,
+            defaulting to the size of `AdditionalParam.data`.
+
+    Returns:
+        numpy.ndarray: A structured array with the fields of `PDM_FIELDS`, one
+        element per header. Rows without a PDM option have `valid` unset and
+        all other fields zero.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+
+    Example:
+        ```py
+        from measure_dns import decode_pdm, pdm_time_ns
+        pdm = decode_pdm(headers)
+        server_ns = pdm_time_ns(pdm["deltatlr"], pdm["scale_dtlr"])
+        ```
+    """
+    numpy = _import_numpy("decode_pdm")
+    rows = _header_rows(numpy, buffers, width)
+    count, row_width = rows.shape
+    # Short rows are padded so an option at offset 2 can always be gathered
+    if row_width < 2 + PDM_OPTION_SIZE:
+        rows = numpy.pad(rows, ((0, 0), (0, 2 + PDM_OPTION_SIZE - row_width)))
+
+    first = rows[:, 2]
+    offsets = numpy.full(count, 2, dtype=numpy.intp)
+    offsets[first == _PAD1] = 3
+    padn = first == _PADN
+    offsets[padn] = 4 + rows[padn, 3].astype(numpy.intp)
+    in_bounds = offsets + PDM_OPTION_SIZE <= row_width
+    offsets[~in_bounds] = 2
+
+    columns = offsets[:, None] + numpy.arange(PDM_OPTION_SIZE)
+    options = numpy.take_along_axis(rows, columns, axis=1)
+    return _decode_options(numpy, options, in_bounds)
+
+
+def pdm_from_responses(
+    responses: typing.Union[ResponseBuffer, ctypes.Array],
+    count: typing.Optional[int] = None,
+):
+    """
+    Decodes the PDM options of filled native response slots.
+
+    The slots are read in place as one NumPy array, so the PDM fields of a
+    whole batch are extracted without touching the responses one by one.
+
+    Args:
+        responses (ResponseBuffer or ctypes.Array): The buffer passed to
+            `send_dns_queries`, or an array of `DNSResponse` slots.
+        count (int): Number of leading slots to decode, defaulting to all.
+
+    Returns:
+        numpy.ndarray: A structured array with the fields of `PDM_FIELDS`,
+        one element per slot.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+
+    Example:
+        ```py
+        from measure_dns import DNSFlags, ResponseBuffer, pdm_from_responses, send_dns_queries
+        buffer = ResponseBuffer()
+        results = send_dns_queries(queries, "2001:db8::53", DNSFlags.PdmMetric, buffer=buffer)
+        pdm = pdm_from_responses(buffer, len(results))
+        ```
+    """
+    numpy = _import_numpy("pdm_from_responses")
+    slots = responses._slots if isinstance(responses, ResponseBuffer) else responses
+    if count is None:
+        count = len(slots)
+    if count > len(slots):
+        raise ValueError(f"Only {len(slots)} response slots are available")
+
+    size = count * ctypes.sizeof(DNSResponse)
+    raw = numpy.frombuffer((ctypes.c_ubyte * size).from_buffer(slots), dtype=numpy.uint8)
+    raw = raw.reshape(count, ctypes.sizeof(DNSResponse))
+    num_params = _field(numpy, raw, DNSResponse.num_additional_params.offset, numpy.intc)
+
+    # Use the first destination options header of each slot
+    headers = numpy.zeros((count, AdditionalParam.data.size), dtype=numpy.uint8)
+    found = numpy.zeros(count, dtype=bool)
+    base = DNSResponse.additional_params.offset
+    for index in range(MAX_ADDITIONAL_PARAMS):
+        start = base + index * ctypes.sizeof(AdditionalParam)
+        param_type = _field(numpy, raw, start + AdditionalParam.type.offset, numpy.intc)
+        take = ~found & (index < num_params) & (param_type == _DSTOPTS)
+        data = start + AdditionalParam.data.offset
+        headers[take] = raw[take, data : data + AdditionalParam.data.size]
+        found |= take
+    pdm = decode_pdm(headers)
+    pdm["valid"] &= found
+    return pdm
+
+
+def pdm_from_results(results: typing.Sequence[DNSResult]):
+    """
+    Collects the PDM options of `DNSResult`s into one NumPy array.
+
+    Args:
+        results (Sequence[DNSResult]): Results of queries sent with
+            `DNSFlags.PdmMetric`.
+
+    Returns:
+        numpy.ndarray: A structured array with the fields of `PDM_FIELDS`, one
+        element per result.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+    """
+    numpy = _import_numpy("pdm_from_results")
+    missing = bytes(PDM_OPTION_SIZE)
+    options = b"".join(
+        next(
+            (bytes(option) for option in result.additional_params if isinstance(option, PDMOption)),
+            missing,
+        )
+        for result in results
+    )
+    rows = numpy.frombuffer(options, dtype=numpy.uint8).reshape(-1, PDM_OPTION_SIZE)
+    return _decode_options(numpy, rows, numpy.ones(len(rows), dtype=bool))
+
+
+def _decode_options(numpy, options, valid):
+    """
+    Converts rows of raw PDM options into a `PDM_FIELDS` array.
+    """
+    wire = numpy.ascontiguousarray(options).view(numpy.dtype(list(_WIRE_FIELDS)))[:, 0]
+    valid = valid & (wire["option_type"] == PDM_OPTION_TYPE) & (wire["opt_len"] == _PDM_OPT_LEN)
+    pdm = numpy.zeros(len(wire), dtype=numpy.dtype(list(PDM_FIELDS)))
+    pdm["valid"] = valid
+    for name, _ in PDM_FIELDS[1:]:
+        pdm[name] = numpy.where(valid, wire[name], 0)
+    return pdm
+
+
+def _header_rows(numpy, buffers, width):
+    if isinstance(buffers, (bytes, bytearray, memoryview)):
+        width = width or AdditionalParam.data.size
+        rows = numpy.frombuffer(buffers, dtype=numpy.uint8)
+        if len(rows) % width:
+            raise ValueError(f"The buffer does not hold whole {width}-byte headers")
+        return rows.reshape(-1, width)
+    if isinstance(buffers, numpy.ndarray):
+        if buffers.ndim != 2:
+            raise ValueError("Expected a 2-D array with one header per row")
+        return buffers.astype(numpy.uint8, copy=False)
+
+    buffers = [bytes(buffer) for buffer in buffers]
+    rows = numpy.zeros((len(buffers), max(map(len, buffers), default=0)), dtype=numpy.uint8)
+    for row, buffer in zip(rows, buffers):
+        row[: len(buffer)] = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    return rows
+
+
+def _field(numpy, raw, offset: int, dtype):
+    """
+    Reads a native integer field out of every row of raw structure bytes.
+    """
+    size = numpy.dtype(dtype).itemsize
+    return numpy.ascontiguousarray(raw[:, offset : offset + size]).view(dtype)[:, 0]
+
+
+def _import_numpy(feature: str):
+    try:
+        import numpy
+    except ImportError as error:
+        raise ImportError(
+            f"{feature} requires NumPy; install it with `pip install numpy`"
+        ) from error
+    return numpy
@@ -0,0 +1,172 @@
+import collections
+import random
+import struct
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    from .dns_packet import DNSQuery
+
+
+class QueryCacheInfo(typing.NamedTuple):
+    """
+    Statistics of a `QueryCache`, in the spirit of `functools.lru_cache`.
+
+    Attributes:
+        hits (int): Lookups served from a cached template.
+        misses (int): Lookups that had to build the query with dnspython.
+        maxsize (int): Maximum number of cached templates.
+        currsize (int): Number of templates currently cached.
+    """
+
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class QueryCache:
+    """
+    LRU cache of compiled wire-format DNS queries.
+
+    Building a query through dnspython costs more CPU than the round trip of
+    the query itself, yet measurement loops send the same `DNSQuery` over and
+    over. The cache builds the wire format of each distinct query once, keyed
+    on every `DNSQuery` field that ends up on the wire, and afterwards only
+    patches the 16-bit DNS ID into a copy of the stored template.
+
+    Args:
+        maxsize (int): Maximum number of templates kept. The least recently
+            used template is evicted first. A `maxsize` of 0 disables caching.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, query_cache
+        query = DNSQuery("example.com", "A")
+        wire = query_cache.wire(query)
+        wire = query_cache.wire(query)
+        print(query_cache.cache_info())
+        ```
+
+    Note:
+        Queries with `id=None` get a fresh random ID on every call, exactly as
+        `build_dns_query` would give them. EDNS padding only depends on the
+        message length, which is fixed for a given template, so padded
+        queries are cached like any other.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates: "collections.OrderedDict[tuple, bytes]" = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def wire(self, query: "DNSQuery") -> bytes:
+        """
+        Returns the wire format of `query`, building it only on a cache miss.
+
+        Args:
+            query (DNSQuery): The DNS query to serialize.
+
+        Returns:
+            bytes: Raw wire-format DNS query carrying the query's ID, or a
+            random ID when `query.id` is `None`.
+        """
+        query_id = random.getrandbits(16) if query.id is None else query.id
+        if self.maxsize == 0:
+            with self._lock:
+                self.misses += 1
+            return _build_template(query, query_id)
+
+        key = _template_key(query)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return struct.pack("!H", query_id) + template[2:]
+            self.misses += 1
+
+        template = _build_template(query, query_id)
+        with self._lock:
+            self._templates[key] = template
+            if len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def cache_info(self) -> QueryCacheInfo:
+        """
+        Returns the hit and miss counters and the size of the cache.
+        """
+        return QueryCacheInfo(
+            self.hits, self.misses, self.maxsize, len(self._templates)
+        )
+
+    def clear(self) -> None:
+        """
+        Drops every cached template and resets the counters.
+        """
+        with self._lock:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._templates)
+
+
+def _template_key(query: "DNSQuery") -> tuple:
+    """
+    Returns the cache key of `query`: every field that shapes the wire format
+    except the ID. EDNS options are not hashable and are keyed by their wire
+    form instead.
+    """
+    options = query.options
+    if options is not None:
+        options = tuple((option.otype, option.to_wire()) for option in options)
+    return (
+        query.qname,
+        query.rdtype,
+        query.rdclass,
+        query.use_edns,
+        query.want_dnssec,
+        query.ednsflags,
+        query.payload,
+        query.request_payload,
+        options,
+        query.idna_codec,
+        query.flags,
+        query.pad,
+    )
+
+
+def _build_template(query: "DNSQuery", query_id: int) -> bytes:
+    """
+    Serializes `query` with dnspython, using `query_id` as its DNS ID.
+    """
+    import dns.message
+
+    return dns.message.make_query(
+        qname=query.qname,
+        rdtype=query.rdtype,
+        rdclass=query.rdclass,
+        use_edns=query.use_edns,
+        want_dnssec=query.want_dnssec,
+        ednsflags=query.ednsflags,
+        payload=query.payload,
+        request_payload=query.request_payload,
+        options=query.options,
+        idna_codec=query.idna_codec,
+        id=query_id,
+        flags=query.flags,
+        pad=query.pad,
+    ).to_wire()
+
+
+# Process-wide cache used by every query sent through `measure_dns`
+query_cache = QueryCache()
@@ -0,0 +1,350 @@
+import ctypes
+import os
+import time
+import typing
+
+from .dns_packet import (
+    DNS_PORT,
+    DNSFlags,
+    DNSQuery,
+    DNSResult,
+    DNSServer,
+    ResponseBuffer,
+    SourceOptions,
+    _allocate_responses,
+    _batch_timeout,
+    _endpoint,
+    _pack_queries,
+    _request_of,
+    _response_size_for,
+    _result_from_response,
+    _server_of,
+    _timeout_ms,
+    _zero_copy,
+)
+from .capture import _split_requests, capture
+from .metrics import _clock, _Clock
+from .native import dns_lib, MAX_BATCH_QUERIES, PDMFlow
+
+if typing.TYPE_CHECKING:
+    from .sink import ResultSink
+
+
+class MeasurementSession:
+    """
+    Reusable measurement session holding persistent native sockets.
+
+    A `MeasurementSession` keeps one pre-configured, connected socket per
+    (server, flags) pair, opened through the `dns_session_open` function of the
+    compiled shared object. Repeated queries to the same nameserver skip socket
+    creation, socket option setup and address parsing, which makes high-rate
+    polling loops considerably cheaper than calling `send_dns_query`.
+
+    Args:
+        extra_flags (DNSFlags): Default control flags for every query sent
+            through this session.
+        buffer (ResponseBuffer): Storage the session fills responses into.
+            Pass a zero-copy `ResponseBuffer` to get results whose `wire` is
+            a `memoryview` into it. By default the session uses its own
+            buffer, sized for TCP responses when the flags ask for TCP, and
+            copies responses out.
+        port (int): Destination port of the servers given as strings.
+        source (SourceOptions): Local address and source ports of the session
+            sockets, including source-port rotation.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, MeasurementSession
+        with MeasurementSession() as session:
+            for _ in range(1000):
+                result = session.query(DNSQuery("example.com", "A"), "8.8.8.8")
+                print(result.latency_ns)
+        ```
+
+    Note:
+        A session is not thread-safe; use one session per thread. Sockets stay
+        open until `close` is called or the session is used as a context manager.
+        Response slots and batch working memory are reused across queries, so
+        a session allocates no native memory per query once warmed up.
+        With `DNSFlags.Tcp` the session holds one TCP connection per server,
+        reopened when the server closes it; the handshake time is reported
+        as `connect_ns` of the first query sent over each connection.
+    """
+
+    def __init__(
+        self,
+        extra_flags: DNSFlags = DNSFlags.NoFlag,
+        buffer: typing.Optional[ResponseBuffer] = None,
+        port: int = DNS_PORT,
+        source: typing.Optional[SourceOptions] = None,
+    ):
+        self.extra_flags = extra_flags
+        self.port = port
+        self.source = source
+        _endpoint(port, source)  # Reject bad endpoint settings up front
+        self._handles: typing.Dict[typing.Tuple[bytes, int], int] = {}
+        self._buffer = ResponseBuffer() if buffer is None else buffer
+
+    def _handle(self, dns_server: typing.Union[str, DNSServer], extra_flags: DNSFlags) -> int:
+        """
+        Returns the native session handle for `dns_server`, opening it on first use.
+        Handles are keyed by the server address, so a hostname that resolves
+        to a new address gets a new socket.
+        """
+        server = _server_of(dns_server, self.port, extra_flags)
+        key = (server.sockaddr, int(extra_flags))
+        handle = self._handles.get(key)
+        if handle is None:
+            handle = dns_lib.dns_session_open(
+                None,  # The server address and family come packed in the endpoint
+                0,
+                ctypes.c_int(extra_flags),
+                server._native(self.source),
+            )
+            if not handle:
+                error_code = ctypes.get_errno()
+                raise OSError(
+                    error_code,
+                    f"Failed to open a measurement socket to {server.address}: "
+                    f"{os.strerror(error_code)}",
+                )
+            self._handles[key] = handle
+        return handle
+
+    def query(
+        self,
+        query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+        dns_server: typing.Union[str, DNSServer],
+        extra_flags: typing.Optional[DNSFlags] = None,
+    ) -> DNSResult:
+        """
+        Sends one DNS query over the session socket for `dns_server`.
+
+        The query's `timeout` and `retries` are enforced by the native layer.
+
+        Args:
+            query (DNSQuery or bytes-like): The DNS query to send, or an
+                already serialized query.
+            dns_server (str or DNSServer): The target DNS server.
+            extra_flags (DNSFlags): Control flags, defaulting to the session flags.
+
+        Returns:
+            DNSResult: Decoded DNS response, latency, and any additional
+            parameters. Failed queries carry a `status` instead of a response.
+        """
+        if extra_flags is None:
+            extra_flags = self.extra_flags
+        clock = _clock()
+        request, timeout, retries = _request_of(query)
+        if clock:
+            clock.lap()
+        handle = self._handle(dns_server, extra_flags)
+        response_struct = self._responses(1, extra_flags)[0]
+
+        writer = capture.writer
+        if clock:
+            clock.lap()
+        dns_lib.dns_session_query(
+            handle,
+            request,
+            len(request),
+            ctypes.byref(response_struct),
+            _timeout_ms(timeout),
+            retries,
+        )
+        if clock:
+            clock.lap()
+        result = _result_from_response(response_struct, _zero_copy(self._buffer))
+        if clock:
+            clock.finish(len(request), (response_struct,), 1)
+        if writer is not None:
+            server = _server_of(dns_server, self.port, extra_flags)
+            writer._write_responses((server,), self.source, (request,), (response_struct,), 1)
+        return result
+
+    def query_batch(
+        self,
+        queries: typing.Sequence[typing.Union[DNSQuery, bytes, bytearray, memoryview]],
+        dns_server: typing.Union[str, DNSServer],
+        extra_flags: typing.Optional[DNSFlags] = None,
+        timeout: typing.Optional[float] = None,
+        retries: typing.Optional[int] = None,
+    ) -> typing.List[DNSResult]:
+        """
+        Sends a batch of DNS queries over the session socket for `dns_server`.
+
+        Behaves like `send_dns_queries`, but reuses the session socket.
+
+        Args:
+            queries (Sequence[DNSQuery]): The DNS queries to send (at most
+                65536), either as `DNSQuery` objects or already serialized.
+            dns_server (str or DNSServer): The target DNS server.
+            extra_flags (DNSFlags): Control flags, defaulting to the session flags.
+            timeout (float): Seconds to wait for outstanding replies once the
+                last query of a round has been sent. Defaults to the largest
+                `DNSQuery.timeout` of the batch.
+            retries (int): Number of rounds resending the unanswered queries.
+                Defaults to the largest `DNSQuery.retries` of the batch.
+
+        Returns:
+            list: One `DNSResult` per query, in the same order.
+        """
+        num_queries = len(queries)
+        if num_queries == 0:
+            return []
+        responses, sizes, clock = self._exchange_batch(queries, dns_server, extra_flags, timeout, retries)
+        zero_copy = _zero_copy(self._buffer)
+        results = [_result_from_response(responses[i], zero_copy) for i in range(num_queries)]
+        if clock:
+            clock.finish(sizes, responses, num_queries)
+        return results
+
+    def query_batch_into(
+        self,
+        sink: "ResultSink",
+        queries: typing.Sequence[typing.Union[DNSQuery, bytes, bytearray, memoryview]],
+        dns_server: typing.Union[str, DNSServer],
+        extra_flags: typing.Optional[DNSFlags] = None,
+        timeout: typing.Optional[float] = None,
+        retries: typing.Optional[int] = None,
+    ) -> int:
+        """
+        Sends a batch of DNS queries and streams the outcomes into `sink`.
+
+        Behaves like `query_batch`, but writes one fixed-width record per query
+        straight from the native response slots, without creating a
+        `DNSResult` or decoding any response. All records of the batch carry
+        the wall-clock time at which the batch was sent.
+
+        Args:
+            sink (ResultSink): The sink the records are appended to.
+            queries (Sequence[DNSQuery]): The DNS queries to send (at most 65536).
+            dns_server (str or DNSServer): The target DNS server.
+            extra_flags (DNSFlags): Control flags, defaulting to the session flags.
+            timeout (float): Seconds to wait for outstanding replies once the
+                last query of a round has been sent.
+            retries (int): Number of rounds resending the unanswered queries.
+
+        Returns:
+            int: Number of queries that received a response.
+        """
+        num_queries = len(queries)
+        if num_queries == 0:
+            return 0
+        timestamp_ns = time.time_ns()
+        responses, sizes, clock = self._exchange_batch(queries, dns_server, extra_flags, timeout, retries)
+        received = 0
+        for i in range(num_queries):
+            response_struct = responses[i]
+            sink._write_response(queries[i], dns_server, response_struct, timestamp_ns)
+            received += response_struct.response_size > 0
+        if clock:
+            clock.finish(sizes, responses, num_queries)
+        return received
+
+    def _exchange_batch(
+        self,
+        queries: typing.Sequence[typing.Union[DNSQuery, bytes, bytearray, memoryview]],
+        dns_server: typing.Union[str, DNSServer],
+        extra_flags: typing.Optional[DNSFlags],
+        timeout: typing.Optional[float],
+        retries: typing.Optional[int],
+    ) -> typing.Tuple[ctypes.Array, ctypes.Array, typing.Optional[_Clock]]:
+        """
+        Runs a non-empty batch through the native session and returns the
+        filled response slots, the request sizes, and the running clock of
+        the call while `metrics` is enabled.
+        """
+        if extra_flags is None:
+            extra_flags = self.extra_flags
+        num_queries = len(queries)
+        if num_queries > MAX_BATCH_QUERIES:
+            raise ValueError(
+                f"At most {MAX_BATCH_QUERIES} queries can be sent in one batch"
+            )
+        clock = _clock()
+        requests_ctypes, sizes_ctypes = _pack_queries(queries)
+        if clock:
+            clock.lap()
+        handle = self._handle(dns_server, extra_flags)
+        timeout, retries = _batch_timeout(queries, timeout, retries)
+        responses = self._responses(num_queries, extra_flags)
+
+        writer = capture.writer
+        if clock:
+            clock.lap()
+        dns_lib.dns_session_query_batch(
+            handle,
+            requests_ctypes,
+            sizes_ctypes,
+            num_queries,
+            responses,
+            _timeout_ms(timeout),
+            retries,
+        )
+        if clock:
+            clock.lap()
+        if writer is not None:
+            server = _server_of(dns_server, self.port, extra_flags)
+            requests = _split_requests(requests_ctypes, sizes_ctypes, num_queries)
+            writer._write_responses([server] * num_queries, self.source, requests, responses, num_queries)
+        return responses, sizes_ctypes, clock
+
+    def _responses(self, num_responses: int, extra_flags: DNSFlags) -> ctypes.Array:
+        """
+        Returns response slots for `num_responses` queries sent with
+        `extra_flags`, growing the session buffer to the response size those
+        flags need.
+        """
+        return _allocate_responses(num_responses, self._buffer, _response_size_for(extra_flags))
+
+    def pdm_flow(
+        self, dns_server: typing.Union[str, DNSServer], extra_flags: typing.Optional[DNSFlags] = None
+    ) -> typing.Optional[PDMFlow]:
+        """
+        Returns the PDM flow state of the socket for `dns_server`.
+
+        Every socket opened with `DNSFlags.PdmMetric` towards an IPv6 server
+        keeps an RFC 8250 flow across queries: PSNTP counts up from a random
+        start, PSNLR echoes the last PSN received from the server, and
+        DeltaTLR/DeltaTLS carry the times since the last receive and from the
+        preceding send to that receive.
+
+        Args:
+            dns_server (str or DNSServer): The target DNS server.
+            extra_flags (DNSFlags): Flags the socket was opened with,
+                defaulting to the session flags.
+
+        Returns:
+            PDMFlow: A snapshot of the flow, or None if no socket to the
+            server sends PDM options (e.g. IPv4, or setting IPv6 destination
+            options was not permitted).
+        """
+        if extra_flags is None:
+            extra_flags = self.extra_flags
+        server = _server_of(dns_server, self.port, extra_flags)
+        handle = self._handles.get((server.sockaddr, int(extra_flags)))
+        flow = PDMFlow()
+        if handle is None or dns_lib.dns_session_pdm_flow(handle, ctypes.byref(flow)) < 0:
+            return None
+        return flow
+
+    def close(self) -> None:
+        """
+        Closes every socket owned by the session.
+        """
+        while self._handles:
+            _, handle = self._handles.popitem()
+            dns_lib.dns_session_close(handle)
+
+    def __enter__(self) -> "MeasurementSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
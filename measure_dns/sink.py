@@ -0,0 +1,379 @@
+import math
+import os
+import socket
+import struct
+import time
+import typing
+
+from .dns_packet import (
+    DNS_PORT,
+    DNSQuery,
+    DNSResult,
+    DNSServer,
+    DNSStatus,
+    _IPV6_DSTOPTS,
+    _find_pdm_option,
+    _server_of,
+)
+from .native import DNSResponse, PDMOption
+
+# File layout: a 64-byte header followed by fixed-width 64-byte records, so a
+# file can be memory-mapped as an array. Query names are interned in a text
+# sidecar file, one name per line, and records refer to them by line number.
+MAGIC = b"MDNSREC1"
+_FILE_HEADER = struct.Struct("<8sII48x")
+_RECORD = struct.Struct("<qdd16sIHhHBBHHHHBBBx")
+HEADER_SIZE = _FILE_HEADER.size
+RECORD_SIZE = _RECORD.size
+FORMAT_VERSION = 1
+
+# `qname_id` of records whose query was sent already serialized
+UNKNOWN_QNAME = 0xFFFFFFFF
+# `rcode` of records without a response
+NO_RCODE = -1
+
+RECORD_FIELDS = (
+    ("timestamp_ns", "<i8"),
+    ("latency_ns", "<f8"),
+    ("kernel_latency_ns", "<f8"),
+    ("server", "u1", (16,)),
+    ("qname_id", "<u4"),
+    ("rdtype", "<u2"),
+    ("rcode", "<i2"),
+    ("response_size", "<u2"),
+    ("status", "u1"),
+    ("attempts", "u1"),
+    ("pdm_psntp", "<u2"),
+    ("pdm_psnlr", "<u2"),
+    ("pdm_deltatlr", "<u2"),
+    ("pdm_deltatls", "<u2"),
+    ("pdm_scale_dtlr", "u1"),
+    ("pdm_scale_dtls", "u1"),
+    ("has_pdm", "u1"),
+    ("reserved", "u1"),
+)
+
+_NO_PDM = (0, 0, 0, 0, 0, 0, 0)
+
+
+class ResultSink:
+    """
+    Appends measurements to a binary file of fixed-width records.
+
+    Keeping millions of `DNSResult`s alive means millions of decoded
+    `dns.message.Message`s. A sink instead streams one 64-byte record per
+    measurement to disk holding the timestamp, server address, query name
+    id, record type, RCODE, status, latency, response size and PDM fields.
+    The file can later be loaded as a NumPy structured array with
+    `read_results`, without parsing it record by record.
+
+    Args:
+        path (str): File to append to. It is created with a header when it
+            does not exist or is empty; query names go to `path + ".qnames"`,
+            which is replaced along with it.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, MeasurementSession, ResultSink, read_results
+        queries = [DNSQuery(f"host{i}.example.com", "A") for i in range(1000)]
+        with ResultSink("probes.bin") as sink, MeasurementSession() as session:
+            session.query_batch_into(sink, queries, "8.8.8.8")
+        records = read_results("probes.bin")
+        print(records["latency_ns"].mean())
+        ```
+
+    Note:
+        Records are buffered; call `flush` or `close` before reading a file
+        that is still being written. A sink must not be shared between threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._qnames: typing.Dict[str, int] = {}
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            _check_header(path)
+            self._qnames = {name: i for i, name in enumerate(read_qnames(path))}
+            self._file = open(path, "ab", buffering=1 << 20)
+            self._names_file = open(path + ".qnames", "a", encoding="utf-8")
+        else:
+            self._file = open(path, "wb", buffering=1 << 20)
+            self._file.write(_FILE_HEADER.pack(MAGIC, FORMAT_VERSION, RECORD_SIZE))
+            # A names file left without its records would shift every index
+            self._names_file = open(path + ".qnames", "w", encoding="utf-8")
+        self.records = 0
+        self._servers: typing.Dict[str, bytes] = {}
+
+    def write(
+        self,
+        query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+        dns_server: typing.Union[str, DNSServer],
+        result: DNSResult,
+        timestamp_ns: typing.Optional[int] = None,
+    ) -> None:
+        """
+        Appends the record of one measurement.
+
+        Args:
+            query (DNSQuery): The query that was sent.
+            dns_server (str or DNSServer): The server it was sent to.
+            result (DNSResult): The outcome of the query.
+            timestamp_ns (int): Wall-clock time of the measurement in
+                nanoseconds since the epoch, defaulting to now.
+        """
+        wire = result.wire
+        pdm = _NO_PDM
+        for option in result.additional_params:
+            if isinstance(option, PDMOption):
+                pdm = _pdm_fields(option)
+                break
+        self._write(
+            query,
+            dns_server,
+            time.time_ns() if timestamp_ns is None else timestamp_ns,
+            result.latency_ns,
+            result.kernel_latency_ns,
+            NO_RCODE if wire is None or len(wire) < 4 else wire[3] & 0x0F,
+            0 if wire is None else len(wire),
+            result.status,
+            result.attempts,
+            pdm,
+        )
+
+    def _write_response(
+        self,
+        query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+        dns_server: typing.Union[str, DNSServer],
+        response_struct: DNSResponse,
+        timestamp_ns: int,
+    ) -> None:
+        """
+        Appends the record of a filled native response slot, without building
+        a `DNSResult`.
+        """
+        response_size = max(response_struct.response_size, 0)
+        pdm = _NO_PDM
+        for i in range(response_struct.num_additional_params):
+            params = response_struct.additional_params[i]
+            if params.type == _IPV6_DSTOPTS:
+                # Only an option of the PDM type and size is recorded as PDM
+                option = _find_pdm_option(params.data)
+                if option is not None:
+                    pdm = _pdm_fields(option)
+                    break
+        self._write(
+            query,
+            dns_server,
+            timestamp_ns,
+            response_struct.latency_ns,
+            response_struct.kernel_latency_ns if response_struct.timestamp_source else None,
+            response_struct.response[3] & 0x0F if response_size >= 4 else NO_RCODE,
+            response_size,
+            response_struct.status,
+            response_struct.attempts,
+            pdm,
+        )
+
+    def _write(
+        self,
+        query,
+        dns_server: typing.Union[str, DNSServer],
+        timestamp_ns: int,
+        latency_ns: float,
+        kernel_latency_ns: typing.Optional[float],
+        rcode: int,
+        response_size: int,
+        status: int,
+        attempts: int,
+        pdm: tuple,
+    ) -> None:
+        if isinstance(query, DNSQuery):
+            import dns.rdatatype
+
+            qname_id = self._qname_id(str(query.qname))
+            rdtype = dns.rdatatype.RdataType.make(query.rdtype)
+        else:
+            qname_id, rdtype = UNKNOWN_QNAME, 0
+        self._file.write(
+            _RECORD.pack(
+                timestamp_ns,
+                latency_ns,
+                math.nan if kernel_latency_ns is None else kernel_latency_ns,
+                self._server_bytes(dns_server),
+                qname_id,
+                rdtype,
+                rcode,
+                response_size,
+                status,
+                min(attempts, 255),
+                *pdm,
+            )
+        )
+        self.records += 1
+
+    def _qname_id(self, qname: str) -> int:
+        qname_id = self._qnames.get(qname)
+        if qname_id is None:
+            qname_id = self._qnames[qname] = len(self._qnames)
+            self._names_file.write(qname + "\n")
+        return qname_id
+
+    def _server_bytes(self, dns_server: typing.Union[str, DNSServer]) -> bytes:
+        if isinstance(dns_server, DNSServer):
+            dns_server = dns_server.address
+        packed = self._servers.get(dns_server)
+        if packed is None:
+            # Hostnames are stored as the address they resolved to
+            address = _server_of(dns_server, DNS_PORT, 0).address
+            packed = self._servers[dns_server] = pack_address(address)
+        return packed
+
+    def flush(self) -> None:
+        """
+        Writes buffered records and query names to disk.
+        """
+        self._names_file.flush()
+        self._file.flush()
+
+    def close(self) -> None:
+        """
+        Flushes and closes the sink files.
+        """
+        if not self._file.closed:
+            self._names_file.close()
+            self._file.close()
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def pack_address(address: str) -> bytes:
+    """
+    Packs an IP address into the 16-byte form stored in records, mapping IPv4
+    addresses into `::ffff:0:0/96`. The scope of an IPv6 address is dropped.
+    """
+    if ":" in address:
+        return socket.inet_pton(socket.AF_INET6, address.partition("%")[0])
+    return b"\x00" * 10 + b"\xff\xff" + socket.inet_pton(socket.AF_INET, address)
+
+
+def unpack_address(packed: bytes) -> str:
+    """
+    Returns the text form of an address packed by `pack_address`.
+    """
+    packed = bytes(packed)
+    if packed[:12] == b"\x00" * 10 + b"\xff\xff":
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def read_qnames(path: str) -> typing.List[str]:
+    """
+    Returns the interned query names of a result file; `qname_id` indexes it.
+    """
+    try:
+        with open(path + ".qnames", encoding="utf-8") as names:
+            return names.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def iter_records(path: str) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    """
+    Yields the records of a result file as dictionaries, without NumPy.
+
+    Args:
+        path (str): A file written by `ResultSink`.
+
+    Returns:
+        Iterator[dict]: One dictionary per record, keyed by field name, with
+        `server` as text and `qname` resolved from the sidecar file.
+    """
+    qnames = read_qnames(path)
+    names = [field[0] for field in RECORD_FIELDS]
+    with open(path, "rb") as results:
+        _check_header_bytes(path, results.read(HEADER_SIZE))
+        while True:
+            chunk = results.read(RECORD_SIZE * 4096)
+            for values in _RECORD.iter_unpack(chunk[: len(chunk) - len(chunk) % RECORD_SIZE]):
+                record = dict(zip(names, values))
+                record["server"] = unpack_address(record["server"])
+                qname_id = record["qname_id"]
+                record["qname"] = qnames[qname_id] if qname_id < len(qnames) else None
+                record["status"] = DNSStatus(record["status"])
+                yield record
+            if len(chunk) < RECORD_SIZE * 4096:
+                return
+
+
+def read_results(path: str, mmap: bool = True):
+    """
+    Loads a result file as a NumPy structured array.
+
+    Args:
+        path (str): A file written by `ResultSink`.
+        mmap (bool): Map the file read-only instead of reading it into memory,
+            so files larger than RAM can be analysed.
+
+    Returns:
+        numpy.ndarray: One element per record with the fields of
+        `RECORD_FIELDS`. Missing kernel latencies are NaN and `rcode` is -1
+        for queries without a response.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+
+    Example:
+        ```py
+        import numpy as np
+        from measure_dns import read_results
+        records = read_results("probes.bin")
+        answered = records[records["rcode"] >= 0]
+        print(np.percentile(answered["latency_ns"], [50, 99]))
+        ```
+    """
+    try:
+        import numpy
+    except ImportError as error:
+        raise ImportError(
+            "read_results requires NumPy; install it with `pip install numpy`"
+        ) from error
+
+    with open(path, "rb") as results:
+        _check_header_bytes(path, results.read(HEADER_SIZE))
+    dtype = numpy.dtype(list(RECORD_FIELDS))
+    count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_SIZE
+    if count == 0:
+        return numpy.zeros(0, dtype=dtype)
+    if mmap:
+        return numpy.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+    return numpy.fromfile(path, dtype=dtype, count=count, offset=HEADER_SIZE)
+
+
+def _check_header(path: str) -> None:
+    with open(path, "rb") as results:
+        _check_header_bytes(path, results.read(HEADER_SIZE))
+
+
+def _check_header_bytes(path: str, header: bytes) -> None:
+    if len(header) < HEADER_SIZE:
+        raise ValueError(f"{path} is not a measure_dns result file")
+    magic, version, record_size = _FILE_HEADER.unpack(header)
+    if magic != MAGIC or record_size != RECORD_SIZE:
+        raise ValueError(f"{path} is not a measure_dns result file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} uses unsupported format version {version}")
+
+
+def _pdm_fields(option: PDMOption) -> tuple:
+    return (
+        option.psntp,
+        option.psnlr,
+        option.deltatlr,
+        option.deltatls,
+        option.scale_dtlr,
+        option.scale_dtls,
+        1,
+    )
@@ -0,0 +1,324 @@
+import multiprocessing
+import socket
+import ssl
+import struct
+import threading
+import typing
+
+_HEADER = struct.Struct("!6H")
+# Answer appended to A queries: a pointer to the question name, type A, class
+# IN, TTL 60 and the address 127.0.0.1
+_A_ANSWER = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 60, 4) + bytes((127, 0, 0, 1))
+_TYPE_A = 1
+_TYPE_NS = 2
+_TYPE_OPT = 41
+_RCVBUF = 4 << 20
+# Answer to A queries for names whose first label is `big`: 200 records for
+# 127.0.0.1 to 127.0.0.200
+_BIG_ANSWERS = 200
+_BIG_ANSWER = b"".join(_A_ANSWER[:-1] + bytes((i,)) for i in range(1, _BIG_ANSWERS + 1))
+# Largest UDP response to a query without an EDNS OPT record (RFC 1035)
+_UDP_PAYLOAD = 512
+_TCP_LENGTH = struct.Struct("!H")
+
+
+class StubServer:
+    """
+    Minimal UDP, TCP and DNS-over-TLS server for benchmarks and tests.
+
+    The server answers every A query with 127.0.0.1 and every other query
+    with an empty NOERROR response. Names whose first label is `drop` are
+    never answered, which simulates packet loss, and names whose first label
+    is `big` get 200 A records. UDP responses larger than the payload size
+    advertised by the query (512 bytes without EDNS) are cut to the header
+    and question with the TC bit set, like a real server does. Responses are
+    assembled directly from the query bytes without dnspython, so the server
+    keeps up with the load generated by `measure_dns.bench` on the loopback
+    interface.
+
+    Args:
+        address (str): Local IP address to listen on.
+        port (int): UDP (and TCP) port to listen on.
+        process (bool): Answer from a forked child process instead of a
+            thread, so the server does not compete for the GIL with the
+            measuring process. `queries` is not updated in that mode.
+        tcp (bool): Also accept TCP connections, answering pipelined queries
+            in order on each of them.
+        tls_context (ssl.SSLContext): Server-side TLS settings, holding the
+            certificate chain. When given, DNS-over-TLS connections are
+            accepted on `tls_port` as well.
+        tls_port (int): TCP port of the DNS-over-TLS listener.
+        delegations (dict): Zones the server delegates, mapping each zone
+            name to its `(nameserver, address)` pairs. Queries for names in
+            a delegated zone get a referral: the NS records in the authority
+            section and, for nameservers with an address, A glue in the
+            additional section. An address of `None` leaves the nameserver
+            without glue. This lets stubs act as root and TLD servers.
+        delegation_ttl (int): TTL of the NS and glue records of referrals.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, send_dns_query
+        from measure_dns.stub import StubServer
+        with StubServer() as server:
+            result = send_dns_query(DNSQuery("example.com", "A"), server.address)
+            print(result.latency_ns)
+        ```
+
+    Note:
+        Binding to ports 53 and 853 requires privileges (root or
+        `CAP_NET_BIND_SERVICE`), and `PermissionError` is raised by `start`
+        otherwise.
+    """
+
+    def __init__(
+        self,
+        address: str = "127.0.0.1",
+        port: int = 53,
+        process: bool = False,
+        tcp: bool = False,
+        tls_context: typing.Optional[ssl.SSLContext] = None,
+        tls_port: int = 853,
+        delegations: typing.Optional[
+            typing.Mapping[str, typing.Sequence[typing.Tuple[str, typing.Optional[str]]]]
+        ] = None,
+        delegation_ttl: int = 60,
+    ):
+        self.address = address
+        self.port = port
+        self.process = process
+        self.tcp = tcp
+        self.tls_context = tls_context
+        self.tls_port = tls_port
+        self._referrals = {
+            _labels(zone): _referral(zone, nameservers, delegation_ttl)
+            for zone, nameservers in (delegations or {}).items()
+        }
+        self.queries = 0
+        self.connections = 0
+        self._sock: typing.Optional[socket.socket] = None
+        # Stream listeners and the TLS context of their connections
+        self._listeners: typing.List[typing.Tuple[socket.socket, typing.Optional[ssl.SSLContext]]] = []
+        self._worker: typing.Union[threading.Thread, multiprocessing.Process, None] = None
+
+    def start(self) -> "StubServer":
+        """
+        Binds the server socket and starts answering in a background thread.
+        """
+        family = socket.AF_INET6 if ":" in self.address else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        # Batched clients send bursts of thousands of queries
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _RCVBUF)
+        listeners = []
+        try:
+            sock.bind((self.address, self.port))
+            if self.tcp:
+                listeners.append((_listen(family, self.address, self.port), None))
+            if self.tls_context is not None:
+                listeners.append((_listen(family, self.address, self.tls_port), self.tls_context))
+        except OSError:
+            sock.close()
+            for listener, _ in listeners:
+                listener.close()
+            raise
+        self._sock = sock
+        self._listeners = listeners
+        if self.process:
+            context = multiprocessing.get_context("fork")
+            self._worker = context.Process(target=self._run, args=(sock, listeners), daemon=True)
+        else:
+            self._worker = threading.Thread(target=self._run, args=(sock, listeners), daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops the server thread or process and closes its socket.
+        """
+        sock, self._sock = self._sock, None
+        listeners, self._listeners = self._listeners, []
+        if sock is None:
+            return
+        if self.process:
+            self._worker.terminate()
+        else:
+            # Wakes up the blocked recvfrom and accept calls of the server threads
+            for server_sock in [sock] + [listener for listener, _ in listeners]:
+                try:
+                    server_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self._worker.join()
+        sock.close()
+        for listener, _ in listeners:
+            listener.close()
+
+    def _run(self, sock: socket.socket, listeners: list) -> None:
+        for listener, tls_context in listeners:
+            threading.Thread(target=self._accept, args=(listener, tls_context), daemon=True).start()
+        self._serve(sock)
+
+    def _accept(self, listener: socket.socket, tls_context: typing.Optional[ssl.SSLContext]) -> None:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve_tcp, args=(conn, tls_context), daemon=True).start()
+
+    def _serve_tcp(self, conn: socket.socket, tls_context: typing.Optional[ssl.SSLContext]) -> None:
+        if tls_context is not None:
+            try:
+                conn = tls_context.wrap_socket(conn, server_side=True)
+            except OSError:
+                conn.close()
+                return
+        with conn:
+            stream = b""
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                stream += data
+                responses = []
+                while len(stream) >= 2:
+                    (length,) = _TCP_LENGTH.unpack_from(stream)
+                    if len(stream) < 2 + length:
+                        break
+                    wire, stream = stream[2 : 2 + length], stream[2 + length :]
+                    self.queries += 1
+                    response = _stub_response(wire, None, self._referrals)
+                    if response is not None:
+                        responses.append(_TCP_LENGTH.pack(len(response)) + response)
+                try:
+                    conn.sendall(b"".join(responses))
+                except OSError:
+                    return
+
+    def _serve(self, sock: socket.socket) -> None:
+        while True:
+            try:
+                wire, peer = sock.recvfrom(4096)
+            except OSError:
+                return
+            if not wire:
+                return  # Socket shut down
+            self.queries += 1
+            response = _stub_response(wire, referrals=self._referrals)
+            if response is not None:
+                sock.sendto(response, peer)
+
+    def __enter__(self) -> "StubServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def _listen(family: int, address: str, port: int) -> socket.socket:
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((address, port))
+        listener.listen(64)
+    except OSError:
+        listener.close()
+        raise
+    return listener
+
+
+def _labels(name: str) -> typing.Tuple[bytes, ...]:
+    return tuple(label.encode().lower() for label in name.strip(".").split(".") if label)
+
+
+def _encode_name(name: str) -> bytes:
+    return b"".join(bytes((len(label),)) + label for label in _labels(name)) + b"\0"
+
+
+def _referral(
+    zone: str, nameservers: typing.Sequence[typing.Tuple[str, typing.Optional[str]]], ttl: int
+) -> typing.Tuple[bytes, int, int]:
+    """
+    Builds the authority and additional sections of a referral to `zone`,
+    returned with their record counts.
+    """
+    owner = _encode_name(zone)
+    records, glue = [], []
+    for nameserver, address in nameservers:
+        target = _encode_name(nameserver)
+        records.append(owner + struct.pack("!HHIH", _TYPE_NS, 1, ttl, len(target)) + target)
+        if address is not None:
+            glue.append(target + struct.pack("!HHIH", _TYPE_A, 1, ttl, 4) + socket.inet_aton(address))
+    return b"".join(records + glue), len(records), len(glue)
+
+
+def _stub_response(
+    wire: bytes,
+    max_size: typing.Optional[int] = _UDP_PAYLOAD,
+    referrals: typing.Optional[typing.Mapping[tuple, typing.Tuple[bytes, int, int]]] = None,
+) -> typing.Optional[bytes]:
+    """
+    Builds the response to a raw query, or returns `None` for queries that
+    are malformed or must be dropped. Responses larger than `max_size`, or
+    than the EDNS payload size of the query if that is larger, are truncated
+    to the question with the TC bit set. Names in a zone of `referrals` get
+    the referral to the deepest such zone.
+    """
+    if len(wire) < _HEADER.size:
+        return None
+    query_id, flags, qdcount, _, _, arcount = _HEADER.unpack_from(wire)
+    if qdcount != 1:
+        return None
+
+    # Walk the labels of the question name
+    offset = _HEADER.size
+    first_label = None
+    while offset < len(wire) and wire[offset]:
+        length = wire[offset]
+        if length & 0xC0:
+            return None
+        if first_label is None:
+            first_label = wire[offset + 1 : offset + 1 + length]
+        offset += 1 + length
+    question_end = offset + 5
+    if question_end > len(wire) or first_label == b"drop":
+        return None
+    (qtype,) = struct.unpack_from("!H", wire, offset + 1)
+    # QR and RA set; opcode and RD copied from the query
+    flags = 0x8080 | (flags & 0x7900)
+    question = wire[_HEADER.size : question_end]
+
+    if referrals:
+        labels = _question_labels(wire)
+        for start in range(len(labels)):
+            referral = referrals.get(labels[start:])
+            if referral is not None:
+                records, nscount, arcount = referral
+                return _HEADER.pack(query_id, flags, 1, 0, nscount, arcount) + question + records
+
+    answer, answers = b"", 0
+    if qtype == _TYPE_A:
+        answer, answers = (_BIG_ANSWER, _BIG_ANSWERS) if first_label == b"big" else (_A_ANSWER, 1)
+    if max_size is not None:
+        # An OPT record right after the question carries the payload size
+        opt = wire[question_end : question_end + 5]
+        if arcount and len(opt) == 5 and opt[:3] == b"\x00\x00" + bytes((_TYPE_OPT,)):
+            (payload,) = struct.unpack_from("!H", opt, 3)
+            max_size = max(max_size, payload)
+        if _HEADER.size + len(question) + len(answer) > max_size:
+            return _HEADER.pack(query_id, flags | 0x0200, 1, 0, 0, 0) + question
+    return _HEADER.pack(query_id, flags, 1, answers, 0, 0) + question + answer
+
+
+def _question_labels(wire: bytes) -> typing.Tuple[bytes, ...]:
+    labels, offset = [], _HEADER.size
+    while wire[offset]:
+        length = wire[offset]
+        labels.append(wire[offset + 1 : offset + 1 + length].lower())
+        offset += 1 + length
+    return tuple(labels)
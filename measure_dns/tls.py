@@ -0,0 +1,394 @@
+import errno
+import socket
+import ssl
+import struct
+import time
+import typing
+
+from .dns_packet import (
+    DNSQuery,
+    DNSResult,
+    DNSStatus,
+    DNSTransport,
+    _batch_timeout,
+    _unique_requests,
+)
+
+# Port of DNS over TLS (RFC 7858)
+DOT_PORT = 853
+_LENGTH = struct.Struct("!H")
+
+
+class _Connection:
+    """
+    An open DNS-over-TLS connection of a `DoTSession`, with the timings of
+    its setup until they are charged to the first query sent over it.
+    """
+
+    def __init__(self, sock: ssl.SSLSocket, connect_ns: float, handshake_ns: float):
+        self.sock = sock
+        self.rx = bytearray()
+        self.setup: typing.Optional[typing.Tuple[float, float, bool]] = (
+            connect_ns,
+            handshake_ns,
+            sock.session_reused,
+        )
+
+    def read_message(self, deadline: typing.Optional[int]) -> typing.Optional[bytes]:
+        """
+        Returns the next DNS message of the stream, or `None` if the server
+        closed the connection. Raises `socket.timeout` past `deadline`.
+        """
+        while True:
+            if len(self.rx) >= 2:
+                (length,) = _LENGTH.unpack_from(self.rx)
+                if len(self.rx) >= 2 + length:
+                    message = bytes(self.rx[2 : 2 + length])
+                    del self.rx[: 2 + length]
+                    return message
+            if deadline is not None:
+                remaining = deadline - time.perf_counter_ns()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                self.sock.settimeout(remaining / 1e9)
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.rx += data
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class DoTSession:
+    """
+    Measures DNS-over-TLS resolvers (RFC 7858) over reused connections.
+
+    The session keeps a pool of open TLS connections, one per (server,
+    server name) pair, and pipelines the queries of a batch on it: all
+    queries are written before the responses are read and matched by DNS ID
+    (RFC 7766). The TLS session of every connection is kept as well, so a
+    connection that has to be reopened resumes it instead of running a full
+    handshake.
+
+    The setup of a connection is timed in phases and charged to the first
+    query sent over it: `DNSResult.connect_ns` is the TCP handshake,
+    `tls_handshake_ns` the TLS handshake and `tls_resumed` tells whether it
+    was resumed. `latency_ns` always covers the query alone, from writing the
+    batch until its response was read, so the first query and the queries
+    pipelined behind it can be compared directly.
+
+    Args:
+        context (ssl.SSLContext): TLS settings, defaulting to
+            `ssl.create_default_context()`, which verifies the server
+            certificate against the system trust store.
+        server_hostname (str): Name to verify the certificate against (and to
+            send as SNI), defaulting to the server address.
+        port (int): TCP port of the resolvers.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, DoTSession
+        with DoTSession(server_hostname="dns.google") as session:
+            first = session.query(DNSQuery("example.com", "A"), "8.8.8.8")
+            print(first.connect_ns, first.tls_handshake_ns, first.latency_ns)
+            session.disconnect("8.8.8.8")
+            resumed = session.query(DNSQuery("example.com", "A"), "8.8.8.8")
+            print(resumed.tls_resumed, resumed.tls_handshake_ns)
+        ```
+
+    Note:
+        TLS 1.3 early data (0-RTT) is not used: the `ssl` module cannot send
+        it, so a resumed connection still costs one round trip before the
+        first query. Queries are not resent, since TCP already retransmits;
+        a query whose connection was closed by the server is sent again once
+        over a new connection. A session is not thread-safe; use one session
+        per thread.
+    """
+
+    def __init__(
+        self,
+        context: typing.Optional[ssl.SSLContext] = None,
+        server_hostname: typing.Optional[str] = None,
+        port: int = DOT_PORT,
+    ):
+        self.context = ssl.create_default_context() if context is None else context
+        self.server_hostname = server_hostname
+        self.port = port
+        self._connections: typing.Dict[typing.Tuple[str, str], _Connection] = {}
+        self._tls_sessions: typing.Dict[typing.Tuple[str, str], ssl.SSLSession] = {}
+
+    def query(
+        self,
+        query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+        dns_server: str,
+        server_hostname: typing.Optional[str] = None,
+    ) -> DNSResult:
+        """
+        Sends one DNS query over the TLS connection to `dns_server`.
+
+        Args:
+            query (DNSQuery or bytes-like): The DNS query to send, or an
+                already serialized query. Its `timeout` bounds the
+                connection setup and the wait for the response.
+            dns_server (str): The target DNS server IP.
+            server_hostname (str): Name to verify the certificate against,
+                defaulting to the session's.
+
+        Returns:
+            DNSResult: The response, latency and connection timings. Failed
+            queries carry a `status` instead of a response.
+        """
+        return self.query_batch([query], dns_server, server_hostname)[0]
+
+    def query_batch(
+        self,
+        queries: typing.Sequence[typing.Union[DNSQuery, bytes, bytearray, memoryview]],
+        dns_server: str,
+        server_hostname: typing.Optional[str] = None,
+        timeout: typing.Optional[float] = None,
+    ) -> typing.List[DNSResult]:
+        """
+        Pipelines a batch of DNS queries on the TLS connection to `dns_server`.
+
+        Args:
+            queries (Sequence[DNSQuery]): The DNS queries to send, either as
+                `DNSQuery` objects or already serialized.
+            dns_server (str): The target DNS server IP.
+            server_hostname (str): Name to verify the certificate against,
+                defaulting to the session's.
+            timeout (float): Seconds to wait for the connection and for all
+                responses. Defaults to the largest `DNSQuery.timeout` of the batch.
+
+        Returns:
+            list: One `DNSResult` per query, in the same order.
+        """
+        if not queries:
+            return []
+        timeout, _ = _batch_timeout(queries, timeout, 0)
+        server_hostname = server_hostname or self.server_hostname or dns_server
+        return self._exchange(_unique_requests(queries), dns_server, server_hostname, timeout)
+
+    def _exchange(
+        self,
+        requests: typing.List[bytes],
+        dns_server: str,
+        server_hostname: str,
+        timeout: typing.Optional[float],
+    ) -> typing.List[DNSResult]:
+        key = (dns_server, server_hostname)
+        deadline = None if timeout is None else time.perf_counter_ns() + int(timeout * 1e9)
+        results: typing.List[typing.Optional[DNSResult]] = [None] * len(requests)
+        todo = list(range(len(requests)))
+        for attempt in (1, 2):
+            conn = self._connections.get(key)
+            reused = conn is not None
+            if conn is None:
+                try:
+                    conn = self._connect(key, dns_server, server_hostname, deadline)
+                except OSError as error:
+                    _fail(results, todo, _setup_status(error), attempt, error)
+                    break
+                self._connections[key] = conn
+            setup, conn.setup = conn.setup, None
+
+            pending = {_LENGTH.unpack_from(requests[i])[0]: i for i in todo}
+            stream = b"".join(_LENGTH.pack(len(requests[i])) + requests[i] for i in todo)
+            status, error = DNSStatus.Ok, None
+            try:
+                conn.sock.settimeout(_remaining(deadline))
+                sent_ns = time.perf_counter_ns()
+                conn.sock.sendall(stream)
+                while pending:
+                    message = conn.read_message(deadline)
+                    received_ns = time.perf_counter_ns()
+                    if message is None:
+                        status = DNSStatus.ReceiveError
+                        break
+                    if len(message) < 2:
+                        continue
+                    index = pending.pop(_LENGTH.unpack_from(message)[0], None)
+                    if index is None:
+                        continue
+                    results[index] = DNSResult(
+                        wire=message,
+                        latency_ns=float(received_ns - sent_ns),
+                        attempts=attempt,
+                        transport=DNSTransport.Tls,
+                    )
+            except socket.timeout as timed_out:
+                status, error = DNSStatus.Timeout, timed_out
+            except ssl.SSLError as tls_error:
+                status, error = DNSStatus.ReceiveError, tls_error
+            except (BrokenPipeError, ConnectionResetError) as closed:
+                status, error = DNSStatus.ReceiveError, closed
+            except OSError as socket_error:
+                status, error = DNSStatus.SendError, socket_error
+
+            if setup is not None:
+                # The setup is charged to the first query sent over the connection
+                first = results[todo[0]]
+                if first is None:
+                    first = results[todo[0]] = DNSResult(
+                        response=None, latency_ns=0.0, attempts=attempt, transport=DNSTransport.Tls
+                    )
+                first.connect_ns, first.tls_handshake_ns, first.tls_resumed = setup
+            if conn.sock.session is not None:
+                self._tls_sessions[key] = conn.sock.session
+            todo = list(pending.values())
+            if not todo:
+                break
+            self._drop(key)
+            # An idle connection may have been closed by the server; reconnect once
+            if not (reused and status == DNSStatus.ReceiveError and attempt == 1):
+                _fail(results, todo, status, attempt, error)
+                break
+        return results
+
+    def _connect(
+        self,
+        key: typing.Tuple[str, str],
+        dns_server: str,
+        server_hostname: str,
+        deadline: typing.Optional[int],
+    ) -> _Connection:
+        """
+        Opens a TLS connection to `dns_server`, resuming the TLS session of
+        an earlier connection to it when there is one.
+        """
+        family = socket.AF_INET6 if ":" in dns_server else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(_remaining(deadline))
+            start_ns = time.perf_counter_ns()
+            sock.connect((dns_server, self.port))
+            connected_ns = time.perf_counter_ns()
+            tls = self.context.wrap_socket(
+                sock,
+                server_hostname=server_hostname,
+                session=self._tls_sessions.get(key),
+                do_handshake_on_connect=False,
+            )
+        except BaseException:
+            sock.close()
+            raise
+        try:
+            tls.settimeout(_remaining(deadline))
+            tls.do_handshake()
+        except BaseException:
+            tls.close()
+            raise
+        handshake_ns = time.perf_counter_ns()
+        return _Connection(tls, float(connected_ns - start_ns), float(handshake_ns - connected_ns))
+
+    def _drop(self, key: typing.Tuple[str, str]) -> None:
+        conn = self._connections.pop(key, None)
+        if conn is not None:
+            conn.close()
+
+    def disconnect(self, dns_server: str, server_hostname: typing.Optional[str] = None) -> None:
+        """
+        Closes the connection to `dns_server`, keeping its TLS session so the
+        next query measures a resumed handshake.
+        """
+        self._drop((dns_server, server_hostname or self.server_hostname or dns_server))
+
+    def close(self) -> None:
+        """
+        Closes every connection and forgets the TLS sessions.
+        """
+        for key in list(self._connections):
+            self._drop(key)
+        self._tls_sessions.clear()
+
+    def __enter__(self) -> "DoTSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def send_dns_query_tls(
+    query: typing.Union[DNSQuery, bytes, bytearray, memoryview],
+    dns_server: str,
+    server_hostname: typing.Optional[str] = None,
+    context: typing.Optional[ssl.SSLContext] = None,
+    port: int = DOT_PORT,
+) -> DNSResult:
+    """
+    Sends one DNS query over a new DNS-over-TLS connection.
+
+    Args:
+        query (DNSQuery or bytes-like): The DNS query to send.
+        dns_server (str): The target DNS server IP.
+        server_hostname (str): Name to verify the certificate against,
+            defaulting to the server address.
+        context (ssl.SSLContext): TLS settings, see `DoTSession`.
+        port (int): TCP port of the resolver.
+
+    Returns:
+        DNSResult: The response, latency and connection timings.
+
+    Example:
+        ```py
+        from measure_dns import DNSQuery, send_dns_query_tls
+        result = send_dns_query_tls(DNSQuery("example.com", "A"), "1.1.1.1", "cloudflare-dns.com")
+        print(result.connect_ns, result.tls_handshake_ns, result.latency_ns)
+        ```
+    """
+    with DoTSession(context, server_hostname, port) as session:
+        return session.query(query, dns_server)
+
+
+def _remaining(deadline: typing.Optional[int]) -> typing.Optional[float]:
+    """
+    Returns the seconds left until `deadline`, for `socket.settimeout`.
+    """
+    if deadline is None:
+        return None
+    remaining = deadline - time.perf_counter_ns()
+    if remaining <= 0:
+        raise socket.timeout("timed out")
+    return remaining / 1e9
+
+
+def _setup_status(error: OSError) -> DNSStatus:
+    """
+    Maps an error raised while opening a connection to a `DNSStatus`.
+    """
+    if isinstance(error, socket.timeout):
+        return DNSStatus.Timeout
+    if error.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH):
+        return DNSStatus.Unreachable
+    return DNSStatus.SocketError
+
+
+def _fail(
+    results: typing.List[typing.Optional[DNSResult]],
+    indices: typing.Iterable[int],
+    status: DNSStatus,
+    attempts: int,
+    error: typing.Optional[BaseException],
+) -> None:
+    """
+    Records `status` for the queries at `indices`, keeping the connection
+    timings a failed first query may already carry.
+    """
+    error_code = getattr(error, "errno", None) or 0
+    for index in indices:
+        result = results[index]
+        if result is None:
+            results[index] = DNSResult(
+                response=None,
+                latency_ns=0.0,
+                status=status,
+                error_code=error_code,
+                attempts=attempts,
+                transport=DNSTransport.Tls,
+            )
+        elif result.wire is None:
+            result.status, result.error_code, result.attempts = status, error_code, attempts
@@ -0,0 +1,473 @@
+import collections
+import math
+import threading
+import time
+import typing
+
+from dataclasses import dataclass, field
+
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+
+from .dns_packet import (
+    DNS_PORT,
+    DNSFlags,
+    DNSQuery,
+    DNSResult,
+    DNSStatus,
+    SourceOptions,
+    send_dns_query,
+)
+
+# Root server hints (IANA root.hints, IPv4)
+ROOT_SERVERS = (
+    ("a.root-servers.net", "198.41.0.4"),
+    ("b.root-servers.net", "170.247.170.2"),
+    ("c.root-servers.net", "192.33.4.12"),
+    ("d.root-servers.net", "199.7.91.13"),
+    ("e.root-servers.net", "192.203.230.10"),
+    ("f.root-servers.net", "192.5.5.241"),
+    ("g.root-servers.net", "192.112.36.4"),
+    ("h.root-servers.net", "198.97.190.53"),
+    ("i.root-servers.net", "192.36.148.17"),
+    ("j.root-servers.net", "192.58.128.30"),
+    ("k.root-servers.net", "193.0.14.129"),
+    ("l.root-servers.net", "199.7.83.42"),
+    ("m.root-servers.net", "202.12.27.33"),
+)
+# Queries a single trace may send, counting those for nameserver addresses
+DEFAULT_MAX_HOPS = 32
+
+# CNAMEs followed before a trace gives up
+_MAX_CNAMES = 8
+# Nameservers without glue whose address is itself traced, nested
+_MAX_NESTING = 3
+# Responses that make the trace try the next nameserver of the zone
+_RETRY_RCODES = (dns.rcode.SERVFAIL, dns.rcode.REFUSED, dns.rcode.NOTIMP)
+
+
+class TraceHop(typing.NamedTuple):
+    """
+    One query of a resolution trace.
+
+    Attributes:
+        qname (str): The name asked for. It differs from the traced name
+            when a CNAME was followed or a nameserver address was looked up.
+        zone (str): The zone the server was asked as a nameserver of.
+        server (str): IP address of the server.
+        server_name (str): Host name of the server, from the NS record.
+        latency_ns (float): Round-trip time in nanoseconds.
+        response_size (int): Size of the response in bytes, 0 without one.
+        status (DNSStatus): Outcome of the query.
+        rcode (int): RCODE of the response, or `None` without one.
+        referral (str): The zone the server delegated to, or `None` if it
+            did not refer the query onwards.
+    """
+
+    qname: str
+    zone: str
+    server: str
+    server_name: str
+    latency_ns: float
+    response_size: int
+    status: DNSStatus
+    rcode: typing.Optional[int]
+    referral: typing.Optional[str]
+
+
+@dataclass
+class TraceResult:
+    """
+    Outcome of `trace_resolution`.
+
+    Attributes:
+        qname (str): The traced name.
+        rdtype (str): The traced record type.
+        hops (list): Every `TraceHop` in the order the queries were sent,
+            including failed queries and lookups of nameserver addresses.
+        result (DNSResult): The final response, or the last failed query if
+            the trace did not finish.
+        complete (bool): Whether the trace reached a final response: an
+            answer, NXDOMAIN, or NOERROR without data or referral.
+        skipped_hops (int): Referrals answered from the delegation cache
+            instead of being queried.
+        saved_ns (float): Latency those referrals took when they were
+            queried, an estimate of the time the cache saved.
+
+    Example:
+        ```py
+        from measure_dns import trace_resolution
+        trace = trace_resolution("www.example.com", "A")
+        for hop in trace.hops:
+            print(hop.zone, hop.server, hop.latency_ns)
+        ```
+    """
+
+    qname: str
+    rdtype: str
+    hops: typing.List[TraceHop] = field(default_factory=list)
+    result: typing.Optional[DNSResult] = None
+    complete: bool = False
+    skipped_hops: int = 0
+    saved_ns: float = 0.0
+
+    @property
+    def latency_ns(self) -> float:
+        """
+        Total latency of the queries the trace sent, in nanoseconds.
+        """
+        return sum(hop.latency_ns for hop in self.hops)
+
+    @property
+    def response(self) -> typing.Optional[dns.message.Message]:
+        """
+        The decoded final response, or `None` without one.
+        """
+        return self.result.response if self.result is not None else None
+
+
+class DelegationCacheInfo(typing.NamedTuple):
+    """
+    Statistics of a `DelegationCache`.
+
+    Attributes:
+        hits (int): Lookups that started below the root from a cached zone.
+        misses (int): Lookups that had to start at the root servers.
+        currsize (int): Number of zones currently cached.
+        saved_hops (int): Referrals skipped thanks to the cache.
+        saved_ns (float): Latency of the skipped referrals when they were
+            queried, in nanoseconds.
+    """
+
+    hits: int
+    misses: int
+    currsize: int
+    saved_hops: int
+    saved_ns: float
+
+    @property
+    def hit_ratio(self) -> float:
+        """
+        Fraction of the lookups that were hits.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class _Delegation:
+    """
+    Nameservers of one zone, as `[name, address]` pairs whose address is
+    `None` until known, with what it cost to learn them from the root.
+    """
+
+    __slots__ = ("zone", "servers", "expires", "depth", "path_ns")
+
+    def __init__(self, zone: dns.name.Name, servers: list, expires: float, depth: int, path_ns: float):
+        self.zone = zone
+        self.servers = servers
+        self.expires = expires
+        self.depth = depth
+        self.path_ns = path_ns
+
+
+class DelegationCache:
+    """
+    TTL-respecting cache of zone delegations and their glue.
+
+    Each referral a trace follows is stored under the delegated zone with
+    its nameservers and addresses until the smallest TTL of the NS and glue
+    records has passed. Later traces start at the deepest cached zone above
+    their name, so tracing many names under one zone only queries the root
+    and the TLD once.
+
+    Args:
+        roots (Sequence[Tuple[str, str]]): `(name, address)` pairs of the
+            root servers, where every trace that misses the cache starts.
+        maxsize (int): Maximum number of zones kept. The least recently used
+            zone is evicted first.
+
+    Example:
+        ```py
+        from measure_dns import DelegationCache, trace_resolution
+        cache = DelegationCache()
+        trace_resolution("ns1.testprotocol.in", "A", cache=cache)
+        trace_resolution("ns2.testprotocol.in", "A", cache=cache)
+        print(cache.cache_info().hit_ratio)
+        ```
+    """
+
+    def __init__(self, roots: typing.Sequence[typing.Tuple[str, str]] = ROOT_SERVERS, maxsize: int = 4096):
+        if maxsize < 0:
+            raise ValueError("maxsize must not be negative")
+        if not roots:
+            raise ValueError("At least one root server is required")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.saved_hops = 0
+        self.saved_ns = 0.0
+        self._root = _Delegation(
+            dns.name.root, [[dns.name.from_text(name), address] for name, address in roots], math.inf, 0, 0.0
+        )
+        self._zones: "collections.OrderedDict[dns.name.Name, _Delegation]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, qname: dns.name.Name) -> _Delegation:
+        """
+        Returns the deepest unexpired delegation above or at `qname`, which
+        is the root servers if none is cached.
+        """
+        now = time.monotonic()
+        name = qname
+        with self._lock:
+            while name != dns.name.root:
+                delegation = self._zones.get(name)
+                if delegation is not None:
+                    if delegation.expires > now:
+                        self._zones.move_to_end(name)
+                        self.hits += 1
+                        self.saved_hops += delegation.depth
+                        self.saved_ns += delegation.path_ns
+                        return delegation
+                    del self._zones[name]
+                name = name.parent()
+            self.misses += 1
+            return self._root
+
+    def _store(
+        self, zone: dns.name.Name, servers: list, ttl: int, parent: _Delegation, latency_ns: float
+    ) -> _Delegation:
+        """
+        Caches the delegation of `zone` learned from a server of `parent`.
+        """
+        delegation = _Delegation(
+            zone, servers, time.monotonic() + ttl, parent.depth + 1, parent.path_ns + latency_ns
+        )
+        if self.maxsize == 0 or ttl <= 0:
+            return delegation
+        with self._lock:
+            self._zones[zone] = delegation
+            self._zones.move_to_end(zone)
+            if len(self._zones) > self.maxsize:
+                self._zones.popitem(last=False)
+        return delegation
+
+    def cache_info(self) -> DelegationCacheInfo:
+        """
+        Returns the hit and miss counters, the size of the cache and the
+        hops and time it saved.
+        """
+        return DelegationCacheInfo(self.hits, self.misses, len(self._zones), self.saved_hops, self.saved_ns)
+
+    def clear(self) -> None:
+        """
+        Drops every cached delegation and resets the counters.
+        """
+        with self._lock:
+            self._zones.clear()
+            self.hits = 0
+            self.misses = 0
+            self.saved_hops = 0
+            self.saved_ns = 0.0
+
+    def __len__(self) -> int:
+        return len(self._zones)
+
+
+class _Tracer:
+    """
+    Settings and state of one `trace_resolution` call.
+    """
+
+    def __init__(self, trace: TraceResult, cache: DelegationCache, extra_flags, port, timeout, source, max_hops):
+        self.trace = trace
+        self.cache = cache
+        self.extra_flags = extra_flags
+        self.port = port
+        self.timeout = timeout
+        self.source = source
+        self.max_hops = max_hops
+        self.glue_type = dns.rdatatype.AAAA if extra_flags & DNSFlags.PreResolve6 else dns.rdatatype.A
+
+    def resolve(self, qname: dns.name.Name, rdtype: dns.rdatatype.RdataType, nesting: int) -> typing.Optional[DNSResult]:
+        """
+        Walks the referrals for `qname` from the deepest cached zone down,
+        following CNAMEs, and returns the final response. Returns `None` if
+        no final response was reached, with the last failed query in
+        `trace.result`.
+        """
+        for _ in range(_MAX_CNAMES + 1):
+            delegation = self.cache._lookup(qname)
+            self.trace.skipped_hops += delegation.depth
+            self.trace.saved_ns += delegation.path_ns
+            while True:
+                result, hop = self._ask(delegation, qname, rdtype, nesting)
+                if hop is None:
+                    return None
+                response = result.response
+                if not isinstance(response, dns.message.Message):
+                    return None
+                if response.rcode() != dns.rcode.NOERROR:
+                    return result
+                if response.get_rrset(response.answer, qname, dns.rdataclass.IN, rdtype) is not None:
+                    return result
+                cname = response.get_rrset(response.answer, qname, dns.rdataclass.IN, dns.rdatatype.CNAME)
+                if cname is not None:
+                    qname = cname[0].target
+                    break
+                referral = self._referral(response, delegation.zone, qname)
+                if referral is None:
+                    return result
+                zone, servers, ttl = referral
+                self.trace.hops[-1] = hop._replace(referral=zone.to_text())
+                delegation = self.cache._store(zone, servers, ttl, delegation, hop.latency_ns)
+        return None
+
+    def _ask(
+        self, delegation: _Delegation, qname: dns.name.Name, rdtype: dns.rdatatype.RdataType, nesting: int
+    ) -> typing.Tuple[typing.Optional[DNSResult], typing.Optional[TraceHop]]:
+        """
+        Sends the query to the nameservers of `delegation` in turn until one
+        of them gives a usable response, and returns it with its hop. The
+        hop is `None` if none did.
+        """
+        for server in delegation.servers:
+            name, address = server
+            if address is None:
+                address = self._address_of(name, nesting)
+                if address is None:
+                    continue
+                server[1] = address
+            if len(self.trace.hops) >= self.max_hops:
+                return None, None
+
+            query = DNSQuery(qname, rdtype, flags=0, timeout=self.timeout)
+            result = send_dns_query(query, address, self.extra_flags, port=self.port, source=self.source)
+            rcode = result.rcode
+            hop = TraceHop(
+                qname.to_text(),
+                delegation.zone.to_text(),
+                address,
+                name.to_text(),
+                result.latency_ns,
+                len(result.wire) if result.wire is not None else 0,
+                result.status,
+                rcode,
+                None,
+            )
+            self.trace.hops.append(hop)
+            self.trace.result = result
+            if result.status == DNSStatus.Ok and rcode not in _RETRY_RCODES:
+                return result, hop
+        return None, None
+
+    def _address_of(self, name: dns.name.Name, nesting: int) -> typing.Optional[str]:
+        """
+        Traces the address of a nameserver that came without glue.
+        """
+        if nesting >= _MAX_NESTING:
+            return None
+        result = self.resolve(name, self.glue_type, nesting + 1)
+        if result is None:
+            return None
+        answer = result.response.get_rrset(result.response.answer, name, dns.rdataclass.IN, self.glue_type)
+        return answer[0].address if answer is not None else None
+
+    def _referral(
+        self, response: dns.message.Message, zone: dns.name.Name, qname: dns.name.Name
+    ) -> typing.Optional[typing.Tuple[dns.name.Name, list, int]]:
+        """
+        Returns the zone, nameservers and TTL of a referral to a zone below
+        `zone` that contains `qname`, or `None` if `response` is not one.
+        """
+        for rrset in response.authority:
+            if (
+                rrset.rdtype != dns.rdatatype.NS
+                or rrset.name == zone
+                or not rrset.name.is_subdomain(zone)
+                or not qname.is_subdomain(rrset.name)
+            ):
+                continue
+            servers, ttl = [], rrset.ttl
+            for rdata in rrset:
+                glue = response.get_rrset(response.additional, rdata.target, dns.rdataclass.IN, self.glue_type)
+                if glue is not None:
+                    ttl = min(ttl, glue.ttl)
+                servers.append([rdata.target, glue[0].address if glue is not None else None])
+            # Nameservers with glue are asked first
+            servers.sort(key=lambda server: server[1] is None)
+            return rrset.name, servers, ttl
+        return None
+
+
+def trace_resolution(
+    qname: typing.Union[dns.name.Name, str],
+    rdtype: typing.Union[dns.rdatatype.RdataType, str] = "A",
+    cache: typing.Optional[DelegationCache] = None,
+    extra_flags: DNSFlags = DNSFlags.TcFallback,
+    port: int = DNS_PORT,
+    timeout: typing.Optional[float] = 2.0,
+    source: typing.Optional[SourceOptions] = None,
+    max_hops: int = DEFAULT_MAX_HOPS,
+) -> TraceResult:
+    """
+    Resolves a name iteratively from the root servers down to its
+    authoritative servers and times every hop.
+
+    Each hop is a non-recursive query sent through `send_dns_query`, so it
+    is timed by the native layer like any other measurement. Referrals are
+    followed through their glue; nameservers without glue have their
+    address traced too, and CNAMEs are followed. When a server does not
+    respond, or answers SERVFAIL or REFUSED, the next nameserver of the zone
+    is asked. Every referral is stored in `cache`, and a trace starts at the
+    deepest zone cached for its name, so only the hops below it are sent.
+
+    Args:
+        qname (str or Name): The name to resolve.
+        rdtype (str or RdataType): The record type to resolve.
+        cache (DelegationCache): Delegations to start from and add to,
+            defaulting to the shared `delegation_cache`.
+        extra_flags (DNSFlags): Control flags of every hop. The default
+            `DNSFlags.TcFallback` resends truncated referrals over TCP.
+            With `DNSFlags.PreResolve6` the AAAA glue is used, which needs
+            IPv6 root servers in the cache.
+        port (int): Destination port of every server.
+        timeout (float): Seconds to wait for each server.
+        source (SourceOptions): Local address and source ports to send from.
+        max_hops (int): Maximum number of queries the trace may send.
+
+    Returns:
+        TraceResult: The hops, the final response and the hops the cache
+        saved.
+
+    Example:
+        ```py
+        from measure_dns import trace_resolution
+        trace = trace_resolution("testprotocol.in", "NS")
+        print(trace.complete, trace.latency_ns, trace.response.answer)
+        for hop in trace.hops:
+            print(f"{hop.zone:<20} {hop.server:<16} {hop.latency_ns / 1e6:.2f} ms {hop.response_size} B")
+        ```
+
+    Note:
+        Hops answered from the cache are not sent again, so `latency_ns` of
+        a warm trace only covers the servers below the cached zone; add
+        `saved_ns` for the latency of a cold resolution.
+    """
+    if max_hops < 1:
+        raise ValueError("max_hops must be positive")
+    qname = dns.name.from_text(qname) if isinstance(qname, str) else qname
+    rdtype = dns.rdatatype.RdataType.make(rdtype)
+    trace = TraceResult(qname.to_text(), dns.rdatatype.to_text(rdtype))
+    tracer = _Tracer(trace, delegation_cache if cache is None else cache, extra_flags, port, timeout, source, max_hops)
+    final = tracer.resolve(qname, rdtype, 0)
+    if final is not None:
+        trace.result, trace.complete = final, True
+    return trace
+
+
+# Process-wide cache used by traces that are not given one
+delegation_cache = DelegationCache()
@@ -8,8 +8,20 @@ requires = ["dnspython"]
 install_requires = ["wheel"]
 tests_require = ["pytest"]
 docs_require = ["mkdocs", "mkdocs-material", "mkdocstrings[python]"]
+numpy_require = ["numpy"]
 develop_require = ["black" + "isort"] + tests_require + docs_require
 
+# The native core is built as a plain shared library that `measure_dns`
+# loads through ctypes; it has no Python module init function and is never
+# imported. Builds are portable (no `-march`); a source checkout without it
+# falls back to a cached build for the local CPU at first import.
+measuredns = Extension(
+    "measure_dns._measuredns",
+    sources=["measure_dns/native/measuredns.c"],
+    extra_compile_args=["-O2", "-pthread", "-fno-strict-overflow", "-Wsign-compare"],
+    extra_link_args=["-pthread"],
+)
+
 setup(
     name="py-measuredns",
     version="0.1",
@@ -19,15 +31,17 @@ setup(
     include_package_data=True,
     ## Include data files
     package_data={
-        "measure_dns": ["measuredns.c"],
+        "measure_dns": ["native/measuredns.c"],
     },
+    ext_modules=[measuredns],
     requires=requires,
     install_requires=install_requires,
     tests_require=tests_require,
     extras_require={
-        "all": requires + install_requires + tests_require + docs_require,
+        "all": requires + install_requires + tests_require + docs_require + numpy_require,
         "develop": develop_require,
         "docs": docs_require,
+        "numpy": numpy_require,
     },
     author_email="arnav.das88@gmail.com",
     url="https://docs.python.org/extending/building",
@@ -0,0 +1,20 @@
+import pytest
+
+from measure_dns.stub import StubServer
+
+STUB_ADDRESS = "127.0.0.1"
+
+
+@pytest.fixture(scope="session")
+def stub_server():
+    """
+    A minimal UDP and TCP DNS server on the loopback interface that answers
+    every A query with 127.0.0.1 and ignores names under `drop.`.
+    """
+    server = StubServer(STUB_ADDRESS, tcp=True)
+    try:
+        server.start()
+    except PermissionError:
+        pytest.skip("binding the stub server to port 53 requires privileges")
+    yield STUB_ADDRESS
+    server.stop()
@@ -0,0 +1,85 @@
+import asyncio
+import ctypes
+import errno
+import gc
+from types import SimpleNamespace
+
+from dns.rdatatype import A
+
+from measure_dns import AsyncMeasurer, DNSQuery, DNSStatus, send_dns_query_async
+from measure_dns import aio
+from measure_dns.aio import _default_measurers
+
+
+def test_async_many_in_flight(stub_server):
+    async def run():
+        async with AsyncMeasurer() as measurer:
+            queries = [DNSQuery(qname=f"host{i}.example", rdtype="A") for i in range(300)]
+            results = await asyncio.gather(
+                *(measurer.query(query, stub_server) for query in queries)
+            )
+            assert len(measurer._channels) == 1
+            return queries, results
+
+    queries, results = asyncio.run(run())
+    for query, result in zip(queries, results):
+        assert result is not None
+        assert result.latency_ns > 0
+        assert result.response.question[0].name.to_text() == query.qname + "."
+        assert any(rr.rdtype == A for rr in result.response.answer)
+
+
+def test_async_timeout(stub_server):
+    async def run():
+        async with AsyncMeasurer() as measurer:
+            result = await measurer.query(
+                DNSQuery(qname="drop.example", rdtype="A", timeout=0.1, retries=1),
+                stub_server,
+            )
+            assert not any(channel.pending for channel in measurer._channels.values())
+            return result
+
+    result = asyncio.run(run())
+    assert not result
+    assert result.status == DNSStatus.Timeout
+    assert result.attempts == 2
+
+
+def test_send_dns_query_async(stub_server):
+    result = asyncio.run(
+        send_dns_query_async(DNSQuery(qname="example.com", rdtype="A"), stub_server)
+    )
+    assert result is not None
+    assert result.response.question[0].name.to_text() == "example.com."
+
+
+def test_default_measurer_closed_with_loop(stub_server):
+    async def run():
+        await send_dns_query_async(DNSQuery(qname="example.com", rdtype="A"), stub_server)
+        measurer = _default_measurers[asyncio.get_running_loop()]
+        assert measurer._session._handles
+        return measurer
+
+    measurer = asyncio.run(run())
+    gc.collect()
+    assert not measurer._session._handles and not measurer._channels
+
+
+def test_drain_stops_on_socket_errors(stub_server, monkeypatch):
+    calls = []
+
+    def recv(*args):
+        calls.append(args)
+        ctypes.set_errno(errno.ECONNREFUSED if len(calls) == 1 else errno.EBADF)
+        return -1
+
+    async def run():
+        async with AsyncMeasurer() as measurer:
+            channel = measurer._channel(stub_server, measurer.extra_flags)
+            monkeypatch.setattr(aio, "dns_lib", SimpleNamespace(dns_session_recv=recv))
+            # The ICMP error is skipped, the socket error ends the drain
+            measurer._on_readable(channel)
+            monkeypatch.undo()
+
+    asyncio.run(run())
+    assert len(calls) == 2
@@ -1,7 +1,7 @@
 import pytest
 from dns.rdatatype import A
 
-from measure_dns import DNSQuery, send_dns_query
+from measure_dns import DNSQuery, DNSStatus, send_dns_query
 
 # Mock DNS server — replace with a controlled test server if needed
 TEST_DNS_SERVER = "8.8.8.8"  # or use a mock server / local resolver
@@ -29,9 +29,11 @@ def test_send_dns_query_invalid_domain():
     assert result.latency_ns > 0
     assert len(result.response.answer) == 0
 
-# def test_send_dns_query_invalid_server():
-#     query = DNSQuery(qname="example.com", rdtype="A")
-#     # Use an unreachable IP to simulate failure
-#     invalid_server = "192.0.2.1"
-#     result = send_dns_query(query, invalid_server)
-#     assert result is None
+def test_send_dns_query_invalid_server():
+    query = DNSQuery(qname="example.com", rdtype="A", timeout=0.5, retries=1)
+    # Use an unreachable IP to simulate failure
+    invalid_server = "192.0.2.1"
+    result = send_dns_query(query, invalid_server)
+    assert not result
+    assert result.response is None
+    assert result.status in (DNSStatus.Timeout, DNSStatus.Unreachable)
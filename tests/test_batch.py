@@ -0,0 +1,39 @@
+from dns.rdatatype import A
+
+from measure_dns import DNSQuery, DNSStatus, send_dns_queries
+
+
+def test_send_dns_queries_matches_replies(stub_server):
+    queries = [DNSQuery(qname=f"host{i}.example", rdtype="A") for i in range(200)]
+    results = send_dns_queries(queries, stub_server)
+    assert len(results) == len(queries)
+    for query, result in zip(queries, results):
+        assert result is not None
+        assert result.latency_ns > 0
+        assert result.response.question[0].name.to_text() == query.qname + "."
+        assert any(rr.rdtype == A for rr in result.response.answer)
+
+
+def test_send_dns_queries_reports_lost_queries(stub_server):
+    queries = [
+        DNSQuery(qname="answered.example", rdtype="A"),
+        DNSQuery(qname="drop.example", rdtype="A"),
+    ]
+    answered, lost = send_dns_queries(queries, stub_server, timeout=0.1, retries=1)
+    assert answered and answered.status == DNSStatus.Ok
+    assert not lost
+    assert lost.response is None
+    assert lost.status == DNSStatus.Timeout
+    assert lost.attempts == 2
+
+
+def test_send_dns_queries_duplicate_ids(stub_server):
+    queries = [DNSQuery(qname=f"dup{i}.example", rdtype="A", id=7) for i in range(5)]
+    results = send_dns_queries(queries, stub_server)
+    assert all(results)
+    names = [result.response.question[0].name.to_text() for result in results]
+    assert names == [f"dup{i}.example." for i in range(5)]
+
+
+def test_send_dns_queries_empty():
+    assert send_dns_queries([], "127.0.0.1") == []
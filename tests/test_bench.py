@@ -0,0 +1,89 @@
+import json
+import random
+
+import pytest
+
+from measure_dns import DNSQuery
+from measure_dns.bench import LatencyHistogram, load_query_mix, main, run_benchmark, run_threaded_benchmark
+
+
+def test_histogram_percentiles():
+    values = [random.randint(1_000, 50_000_000) for _ in range(10_000)]
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for percent in (50, 90, 99, 99.9):
+        exact = values[int(len(values) * percent / 100) - 1]
+        assert histogram.percentile(percent) == pytest.approx(exact, rel=0.01)
+    assert histogram.percentile(100) == values[-1]
+    assert histogram.min == values[0]
+    assert histogram.count == len(values)
+
+    other = LatencyHistogram()
+    other.record(100_000_000)
+    histogram.merge(other)
+    assert histogram.max == 100_000_000 and histogram.count == len(values) + 1
+    assert LatencyHistogram().percentile(50) == 0.0
+
+
+def test_load_query_mix(tmp_path):
+    mix = tmp_path / "mix.txt"
+    mix.write_text("# comment\nexample.com A 3\n\nexample.com NS  # inline comment\n")
+    queries, weights = load_query_mix(str(mix), timeout=0.5)
+    assert [(query.qname, query.rdtype) for query in queries] == [
+        ("example.com", "A"),
+        ("example.com", "NS"),
+    ]
+    assert weights == [3.0, 1.0]
+    assert queries[0].timeout == 0.5
+
+    mix.write_text("example.com\n")
+    with pytest.raises(ValueError):
+        load_query_mix(str(mix))
+
+
+def test_closed_loop_benchmark(stub_server):
+    report = run_benchmark(
+        [DNSQuery("bench.example", "A"), DNSQuery("bench.example", "NS")],
+        stub_server,
+        duration=0.5,
+        concurrency=8,
+        weights=[1, 1],
+    )
+    assert report.sent > 0
+    assert report.received == report.sent
+    assert report.lost == report.errors == 0
+    assert report.throughput_qps > 0
+    assert 0 < report.latency.percentile(50) <= report.latency.percentile(99)
+
+
+def test_paced_benchmark_counts_loss(stub_server):
+    queries = [DNSQuery("bench.example", "A", timeout=0.2), DNSQuery("drop.example", "A", timeout=0.2)]
+    report = run_benchmark(queries, stub_server, duration=0.5, qps=200)
+    assert report.sent == pytest.approx(100, abs=10)
+    assert report.lost == report.sent // 2
+    assert report.loss_ratio == pytest.approx(0.5, abs=0.02)
+
+
+def test_threaded_benchmark(stub_server):
+    queries = [DNSQuery("bench.example", "A", timeout=1)]
+    single = run_threaded_benchmark(queries, stub_server, threads=3, duration=0.3)
+    batched = run_threaded_benchmark(queries, stub_server, threads=2, duration=0.3, batch_size=8)
+    for report in (single, batched):
+        assert report.received == report.sent > 0
+        assert report.latency.count == report.received
+        assert report.duration_s >= 0.3
+    assert batched.sent % 8 == 0
+    with pytest.raises(ValueError):
+        run_threaded_benchmark(queries, stub_server, threads=0)
+
+
+def test_cli_with_bundled_stub(capsys):
+    try:
+        main(["--stub", "--server", "127.0.0.4", "--duration", "0.3", "--concurrency", "4", "--json"])
+    except PermissionError:
+        pytest.skip("binding the stub server to port 53 requires privileges")
+    report = json.loads(capsys.readouterr().out)
+    assert report["received"] == report["sent"] > 0
+    assert report["latency_ns"]["p50"] > 0
@@ -0,0 +1,280 @@
+import asyncio
+import ctypes
+import json
+import socket
+import struct
+import threading
+import time
+from types import SimpleNamespace
+
+import dns.message
+import pytest
+
+from measure_dns import (
+    AsyncMeasurer,
+    DNSQuery,
+    DNSServer,
+    MeasurementSession,
+    Monitor,
+    SourceOptions,
+    build_dns_query,
+    capture,
+    fanout_query,
+    read_capture,
+    read_exchanges,
+    send_dns_queries,
+    send_dns_query,
+)
+from measure_dns.bench import main, run_replay
+from measure_dns.capture import LINKTYPE_RAW, PCAP_MAGIC_NS, PcapWriter
+from measure_dns.stub import StubServer
+
+PORT = 10653
+STUB = "127.0.0.51"
+SILENT = "127.0.0.58"
+
+
+@pytest.fixture(scope="module")
+def stub():
+    # The silent socket takes queries and never answers them
+    silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent.bind((SILENT, PORT))
+    with StubServer(STUB, PORT) as server:
+        yield server
+    silent.close()
+
+
+@pytest.fixture
+def campaign(stub, tmp_path):
+    """
+    Captures queries sent through every query path, 50 ms apart.
+    """
+    path = str(tmp_path / "campaign.pcap")
+    capture.start(path, buffer_size=256)
+    try:
+        results = [send_dns_query(DNSQuery("single.example", "A", id=1), STUB, port=PORT)]
+        time.sleep(0.05)
+        results += send_dns_queries([DNSQuery(f"{i}.batch.example", "A", id=10 + i) for i in range(4)], STUB, port=PORT)
+        time.sleep(0.05)
+        results += fanout_query(DNSQuery("fanout.example", "A", id=20, timeout=0.05), [STUB, SILENT], port=PORT).values()
+        time.sleep(0.05)
+        with MeasurementSession(port=PORT) as session:
+            results.append(session.query(DNSQuery("session.example", "AAAA", id=30), STUB))
+            results += session.query_batch([DNSQuery(f"{i}.session.example", "A", id=40 + i) for i in range(2)], STUB)
+    finally:
+        capture.stop()
+    return path, results
+
+
+def test_capture_records_every_path(campaign):
+    path, results = campaign
+    assert capture.writer is None
+    exchanges = read_exchanges(path)
+    assert len(exchanges) == len(results) == 10
+    names = [dns.message.from_wire(exchange.request).question[0].name.to_text() for exchange in exchanges]
+    assert names[:6] == ["single.example.", "0.batch.example.", "1.batch.example.", "2.batch.example.", "3.batch.example.", "fanout.example."]
+    assert {(exchange.server, exchange.port) for exchange in exchanges} == {(STUB, PORT), (SILENT, PORT)}
+    # The fan-out gives the second server the next DNS ID
+    assert [dns.message.from_wire(exchange.request).id for exchange in exchanges[5:7]] == [20, 21]
+
+    for exchange, result in zip(exchanges, results):
+        if result:
+            assert exchange.latency_ns == pytest.approx(result.latency_ns, abs=1)
+        else:
+            assert exchange.latency_ns is None and exchange.server == SILENT
+    timestamps = [exchange.timestamp_ns for exchange in exchanges]
+    assert timestamps == sorted(timestamps)
+    assert timestamps[-1] - timestamps[0] >= 150e6
+
+
+def test_pcap_format(campaign):
+    path, _ = campaign
+    with open(path, "rb") as capture_file:
+        data = capture_file.read()
+    magic, major, minor, _, _, snaplen, linktype = struct.unpack_from("<IHHiIII", data)
+    assert (magic, major, minor, linktype) == (PCAP_MAGIC_NS, 2, 4, LINKTYPE_RAW)
+
+    offset, packets = 24, 0
+    while offset < len(data):
+        seconds, nanoseconds, captured, original = struct.unpack_from("<IIII", data, offset)
+        assert captured == original and nanoseconds < 1_000_000_000
+        ip = data[offset + 16 : offset + 16 + captured]
+        assert ip[0] == 0x45 and ip[9] == 17
+        assert struct.unpack("!H", ip[2:4])[0] == captured
+        # A valid header checksum sums to 0xFFFF
+        total = sum(struct.unpack("!10H", ip[:20]))
+        assert (total & 0xFFFF) + (total >> 16) == 0xFFFF
+        offset += 16 + captured
+        packets += 1
+    assert packets == 10 + 9  # One query was not answered
+
+    packets = list(read_capture(path))
+    responses = [packet for packet in packets if packet.source == STUB]
+    assert len(responses) == 9 and all(packet.source_port == PORT for packet in responses)
+    # Queries come from the real local address of their socket
+    queries = [packet for packet in packets if packet.destination_port == PORT]
+    assert all(packet.source == "127.0.0.1" and packet.source_port for packet in queries)
+    assert {(packet.destination, packet.destination_port) for packet in responses} <= {
+        (packet.source, packet.source_port) for packet in queries
+    }
+
+
+def test_capture_async_and_monitor(stub, tmp_path):
+    path = str(tmp_path / "sockets.pcap")
+
+    async def measure():
+        async with AsyncMeasurer(port=PORT) as measurer:
+            return await asyncio.gather(
+                *(measurer.query(DNSQuery(f"{i}.async.example", "A", id=50 + i), STUB) for i in range(3)),
+                measurer.query(DNSQuery("lost.async.example", "A", id=60, timeout=0.05), SILENT),
+            )
+
+    capture.start(path)
+    try:
+        results = asyncio.run(measure())
+        with Monitor([(STUB, DNSQuery("monitor.example", "A", id=70), 0.02)], port=PORT) as monitor:
+            monitor.run(0.05)
+    finally:
+        capture.stop()
+
+    exchanges = read_exchanges(path)
+    ids = [dns.message.from_wire(exchange.request).id for exchange in exchanges]
+    assert ids[:4] == [50, 51, 52, 60] and set(ids[4:]) == {70}
+    assert len(ids) - 4 == monitor.stats(0).sent
+    for exchange, result in zip(exchanges, results):
+        if result:
+            # Both ends come from the native clock of the socket
+            assert exchange.latency_ns == pytest.approx(result.latency_ns, abs=1)
+        else:
+            assert exchange.latency_ns is None and exchange.server == SILENT
+    assert all(exchange.latency_ns for exchange in exchanges[4:])
+    assert all(packet.source_port for packet in read_capture(path) if packet.destination_port == PORT)
+
+
+def test_capture_cli(stub, tmp_path, capsys):
+    # The default benchmark mode runs on the asynchronous path
+    path = str(tmp_path / "bench.pcap")
+    main(["--server", STUB, "--port", str(PORT), "--duration", "0.2", "--qps", "50", "--capture", path, "--json"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["sent"] > 0
+    assert len(read_exchanges(path)) == report["sent"]
+
+
+def test_source_options_and_ipv6(tmp_path):
+    path = str(tmp_path / "v6.pcap")
+    with StubServer("::1", PORT):
+        capture.start(path)
+        try:
+            result = send_dns_query(DNSQuery("v6.example", "A"), "::1", port=PORT, source=SourceOptions("::1", 10654))
+        finally:
+            capture.stop()
+    assert result
+    query, response = read_capture(path)
+    assert (query.source, query.source_port, query.destination, query.destination_port) == ("::1", 10654, "::1", PORT)
+    assert (response.source, response.destination_port) == ("::1", 10654)
+    assert response.timestamp_ns - query.timestamp_ns == pytest.approx(result.latency_ns, abs=1)
+
+
+def test_unsent_slots_and_mixed_families(tmp_path):
+    # A fan-out bound to an IPv6 source also sends to an IPv4 server, and
+    # leaves slots it never sent from unset
+    path = str(tmp_path / "mixed.pcap")
+    servers = [DNSServer("::1", PORT), DNSServer("127.0.0.1", PORT), DNSServer("::1", PORT)]
+    requests = [build_dns_query(f"{i}.mixed.example", "A", id=i) for i in range(3)]
+    local = (ctypes.c_ubyte * 16)(*socket.inet_pton(socket.AF_INET6, "::1"))
+    unreported = (ctypes.c_ubyte * 16)()
+    slots = [
+        SimpleNamespace(sent_ns=1000, local_address=local, local_port=10654, response_size=0, latency_ns=0),
+        SimpleNamespace(sent_ns=2000, local_address=unreported, local_port=0, response_size=0, latency_ns=0),
+        SimpleNamespace(sent_ns=0, local_address=unreported, local_port=0, response_size=0, latency_ns=0),
+    ]
+    with PcapWriter(path) as pcap:
+        pcap._write_responses(servers, SourceOptions("::1", 10654), requests, slots, 3)
+    packets = list(read_capture(path))
+    assert [(packet.source, packet.destination) for packet in packets] == [("::1", "::1"), ("0.0.0.0", "127.0.0.1")]
+    assert [dns.message.from_wire(packet.payload).id for packet in packets] == [0, 1]
+    # Each query is stamped with the native send time of its own slot
+    assert packets[1].timestamp_ns - packets[0].timestamp_ns == 1000
+
+
+def test_read_tcpdump_capture(tmp_path):
+    # A big-endian microsecond capture of Ethernet frames with a VLAN tag
+    query = build_dns_query("tcpdump.example", "A", id=7)
+    response = dns.message.make_response(dns.message.from_wire(query)).to_wire()
+
+    def frame(source, destination, source_port, destination_port, payload):
+        udp = struct.pack("!HHHH", source_port, destination_port, 8 + len(payload), 0) + payload
+        ip = struct.pack(
+            "!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+            socket.inet_aton(source), socket.inet_aton(destination),
+        )
+        return b"\x00" * 12 + b"\x81\x00\x00\x01\x08\x00" + ip + udp
+
+    path = tmp_path / "tcpdump.pcap"
+    records = b"".join(
+        struct.pack(">IIII", 1700000000, microseconds, len(packet), len(packet)) + packet
+        for microseconds, packet in (
+            (100, frame("192.0.2.1", "192.0.2.53", 40000, 53, query)),
+            (100, b"\x00" * 12 + b"\x08\x06" + b"\x00" * 28),  # ARP
+            (2600, frame("192.0.2.53", "192.0.2.1", 53, 40000, response)),
+        )
+    )
+    path.write_bytes(struct.pack(">IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1) + records)
+
+    (exchange,) = read_exchanges(str(path))
+    assert exchange == (1700000000_000100000, "192.0.2.53", 53, query, 2500000.0)
+
+    path.write_bytes(b"not a capture at all")
+    with pytest.raises(ValueError):
+        list(read_capture(str(path)))
+
+
+def test_close_waits_for_writes(tmp_path):
+    path = str(tmp_path / "closing.pcap")
+    pcap = PcapWriter(path)
+    with pcap._lock:
+        # A write in progress holds the lock; close must not run under it
+        closer = threading.Thread(target=pcap.close)
+        closer.start()
+        closer.join(0.05)
+        assert closer.is_alive() and not pcap._file.closed
+        pcap._append(1, "192.0.2.1", 40000, "192.0.2.53", 53, build_dns_query("late.example", "A"))
+    closer.join()
+    (packet,) = read_capture(path)
+    assert packet.destination == "192.0.2.53"
+    # Writes after the close are dropped
+    pcap._write_responses([DNSServer("192.0.2.53")], None, [b""], [SimpleNamespace(sent_ns=1)], 1)
+
+
+def test_capture_is_exclusive(tmp_path):
+    capture.start(str(tmp_path / "first.pcap"))
+    try:
+        with pytest.raises(RuntimeError):
+            capture.start(str(tmp_path / "second.pcap"))
+    finally:
+        capture.stop()
+
+
+def test_replay(campaign):
+    path, _ = campaign
+    report = run_replay(path, STUB, speed=1.0, timeout=0.05, port=PORT)
+    assert report.sent == 10
+    assert (report.received, report.lost) == (10, 0)  # The stub answers the query the silent server dropped
+    assert report.captured.count == 9
+    assert report.captured_duration_s >= 0.15
+    # The replay keeps the spacing of the capture
+    assert report.duration_s >= report.captured_duration_s
+
+    fast = run_replay(path, STUB, speed=0, port=PORT)
+    assert fast.received == 10 and fast.duration_s < report.duration_s
+    text = fast.format()
+    assert "replay" in text and "capture" in text
+
+
+def test_replay_cli(campaign, capsys):
+    path, _ = campaign
+    main(["--replay", path, "--server", STUB, "--port", str(PORT), "--speed", "0", "--json"])
+    report = json.loads(capsys.readouterr().out)
+    assert report["received"] == report["sent"] == 10
+    assert report["captured"]["received"] == 9
+    assert report["captured"]["latency_ns"]["p50"] > 0
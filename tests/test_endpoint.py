@@ -0,0 +1,116 @@
+import errno
+import socket
+import threading
+
+import pytest
+
+from measure_dns import (
+    DNSFlags,
+    DNSQuery,
+    DNSStatus,
+    MeasurementSession,
+    SourceOptions,
+    send_dns_queries,
+    send_dns_query,
+)
+from measure_dns.stub import StubServer, _stub_response
+
+ADDRESS = "127.0.0.1"
+STUB_PORT = 10153
+RECORDER_PORT = 10154
+
+
+class PeerRecorder:
+    """
+    Answers queries on a high port and records the address each came from.
+    """
+
+    def __init__(self):
+        self.peers = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((ADDRESS, RECORDER_PORT))
+        self.sock.settimeout(0.1)
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while self.running:
+            try:
+                wire, peer = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            self.peers.append(peer)
+            self.sock.sendto(_stub_response(wire), peer)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+@pytest.fixture(scope="module")
+def high_port_stub():
+    with StubServer(ADDRESS, STUB_PORT, tcp=True):
+        yield ADDRESS
+
+
+@pytest.fixture
+def recorder():
+    server = PeerRecorder()
+    yield server
+    server.close()
+
+
+def test_destination_port(high_port_stub):
+    query = DNSQuery("port.example", "A", timeout=1)
+    assert send_dns_query(query, high_port_stub, port=STUB_PORT).status == DNSStatus.Ok
+    results = send_dns_queries([query] * 3, high_port_stub, port=STUB_PORT)
+    assert [result.status for result in results] == [DNSStatus.Ok] * 3
+    with MeasurementSession(DNSFlags.Tcp, port=STUB_PORT) as session:
+        assert session.query(query, high_port_stub).status == DNSStatus.Ok
+
+
+def test_bind_address_and_pinned_port(recorder):
+    source = SourceOptions("127.0.0.2", ports=45000)
+    result = send_dns_query(DNSQuery("pin.example", "A"), ADDRESS, port=RECORDER_PORT, source=source)
+    assert result.status == DNSStatus.Ok
+    assert recorder.peers == [("127.0.0.2", 45000)]
+
+
+def test_source_port_rotation(recorder):
+    source = SourceOptions(ports=(45010, 45013), rotate_every=2)
+    with MeasurementSession(port=RECORDER_PORT, source=source) as session:
+        for i in range(8):
+            assert session.query(DNSQuery(f"rotate{i}.example", "A"), ADDRESS).status == DNSStatus.Ok
+    ports = [port for _, port in recorder.peers]
+    assert set(ports) == {45010, 45011, 45012, 45013}
+    assert ports[0::2] == ports[1::2]
+    assert len(set(ports[0::2])) == 4
+
+
+def test_source_port_in_use(recorder):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as taken:
+        taken.bind(("0.0.0.0", 45020))
+        result = send_dns_query(
+            DNSQuery("busy.example", "A"), ADDRESS, port=RECORDER_PORT, source=SourceOptions(ports=45020)
+        )
+        assert result.status == DNSStatus.SocketError
+        assert result.error_code == errno.EADDRINUSE
+        # A range skips the port in use
+        result = send_dns_query(
+            DNSQuery("busy.example", "A"), ADDRESS, port=RECORDER_PORT, source=SourceOptions(ports=(45020, 45021))
+        )
+        assert result.status == DNSStatus.Ok
+    assert recorder.peers[-1][1] == 45021
+
+
+def test_invalid_endpoints():
+    query = DNSQuery("invalid.example", "A")
+    for port, source in ((0, None), (70000, None), (53, SourceOptions(ports=(2000, 1000)))):
+        with pytest.raises(ValueError):
+            send_dns_query(query, ADDRESS, port=port, source=source)
+    with pytest.raises(ValueError):
+        MeasurementSession(source=SourceOptions(rotate_every=-1))
+    result = send_dns_query(query, ADDRESS, source=SourceOptions("2001:db8::1"))
+    assert result.status == DNSStatus.SocketError
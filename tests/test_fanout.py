@@ -0,0 +1,128 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from measure_dns import DNSFlags, DNSQuery, DNSServer, DNSStatus, DNSTransport, ResponseBuffer, fanout_query
+from measure_dns.stub import StubServer, _stub_response
+
+PORT = 10453
+STUBS = [f"127.0.0.{i}" for i in range(31, 36)]
+DEAD = "127.0.0.39"
+DELAY = 0.1
+
+
+class DelayedServer:
+    """
+    Answers every query after `delay` seconds, optionally from another
+    address than the one the query was sent to.
+    """
+
+    def __init__(self, address, delay, reply_from=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, PORT))
+        self.sock.settimeout(0.1)
+        self.reply_sock = self.sock
+        if reply_from is not None:
+            self.reply_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.reply_sock.bind((reply_from, PORT))
+        self.delay = delay
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while self.running:
+            try:
+                wire, peer = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            threading.Timer(self.delay, self.reply_sock.sendto, (_stub_response(wire), peer)).start()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+        if self.reply_sock is not self.sock:
+            self.reply_sock.close()
+
+
+@pytest.fixture(scope="module")
+def stubs():
+    servers = [StubServer(address, PORT, tcp=True) for address in STUBS + ["::1"]]
+    for server in servers:
+        server.start()
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def test_fanout_mixed_families(stubs):
+    servers = STUBS + ["::1", DNSServer("::1", PORT), DEAD]
+    buffer = ResponseBuffer()
+    table = fanout_query(DNSQuery("fanout.example", "A", timeout=1), servers, port=PORT, buffer=buffer)
+
+    assert list(table) == servers
+    for server in servers[:-1]:
+        result = table[server]
+        assert result.status == DNSStatus.Ok and result.attempts == 1 and result.latency_ns > 0
+        assert str(result.response.question[0].name) == "fanout.example."
+    assert table[DEAD].status == DNSStatus.Unreachable and not table[DEAD]
+    # Every server was sent the query once, each with its own DNS ID
+    assert [server.queries for server in stubs] == [1] * len(STUBS) + [2]
+    assert len({table[server].header.id for server in servers[:-1]}) == len(servers) - 1
+
+
+def test_fanout_tc_fallback(stubs):
+    query = DNSQuery("big.example", "A", timeout=1)
+    table = fanout_query(query, STUBS[:2], port=PORT)
+    assert [result.status for result in table.values()] == [DNSStatus.Truncated] * 2
+
+    table = fanout_query(query, STUBS[:2], DNSFlags.TcFallback, port=PORT)
+    for result in table.values():
+        assert result.status == DNSStatus.Ok and result.transport == DNSTransport.Tcp
+        assert len(result.response.answer[0]) == 200 and result.attempts == 2
+
+
+def test_fanout_takes_one_round_trip():
+    addresses = [f"127.0.0.{i}" for i in range(51, 59)]
+    servers = [DelayedServer(address, DELAY) for address in addresses]
+    try:
+        start = time.monotonic()
+        table = fanout_query(DNSQuery("slow.example", "A", timeout=1), addresses, port=PORT)
+        elapsed = time.monotonic() - start
+    finally:
+        for server in servers:
+            server.close()
+
+    assert all(result.status == DNSStatus.Ok for result in table.values())
+    assert all(DELAY * 1e9 <= result.latency_ns < 2 * DELAY * 1e9 for result in table.values())
+    # Sequential queries would take len(addresses) * DELAY
+    assert elapsed < 2.5 * DELAY
+
+
+def test_fanout_timeouts_and_spoofed_replies(stubs):
+    # Replies that come from another address than the one queried are ignored
+    spoofer = DelayedServer("127.0.0.61", 0, reply_from="127.0.0.62")
+    try:
+        table = fanout_query(
+            DNSQuery("fanout.example", "A", timeout=0.2, retries=1), [STUBS[0], "127.0.0.61"], port=PORT
+        )
+    finally:
+        spoofer.close()
+    assert table[STUBS[0]].status == DNSStatus.Ok and table[STUBS[0]].attempts == 1
+    assert table["127.0.0.61"].status == DNSStatus.Timeout and table["127.0.0.61"].attempts == 2
+
+    table = fanout_query(DNSQuery("drop.example", "A", timeout=0.1), STUBS, port=PORT)
+    assert [result.status for result in table.values()] == [DNSStatus.Timeout] * len(STUBS)
+
+
+def test_fanout_invalid_arguments():
+    query = DNSQuery("fanout.example", "A")
+    assert fanout_query(query, []) == {}
+    with pytest.raises(ValueError):
+        fanout_query(query, [STUBS[0], STUBS[0]])
+    for flag in (DNSFlags.Tcp, DNSFlags.PdmMetric, DNSFlags.KernelTimestamp):
+        with pytest.raises(ValueError):
+            fanout_query(query, STUBS, flag)
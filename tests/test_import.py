@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+from measure_dns.bench import measure_import_time
+from measure_dns.compiler import ensure_measuredns
+
+# Generous, so a loaded machine does not fail the test; a regression that
+# imports dnspython or asyncio eagerly still shows up in the module check
+IMPORT_BUDGET_S = 0.25
+DEFERRED_MODULES = ("dns", "asyncio", "ssl", "concurrent.futures", "subprocess", "tempfile")
+
+
+def test_import_is_side_effect_free():
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, measure_dns; print(','.join(m for m in sys.argv[1:] if m in sys.modules))",
+            *DEFERRED_MODULES,
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert process.stdout == "\n"
+    assert process.stderr == ""
+
+
+def test_lazy_exports():
+    import measure_dns
+
+    assert {"AsyncMeasurer", "DoTSession", "measure_many"} <= set(dir(measure_dns))
+    assert measure_dns.measure_many.__module__ == "measure_dns.parallel"
+
+
+def test_import_time():
+    assert measure_import_time(runs=3) < IMPORT_BUDGET_S
+
+
+def test_cached_build(tmp_path, monkeypatch):
+    monkeypatch.setenv("MEASURE_DNS_CACHE", str(tmp_path))
+    monkeypatch.delenv("MEASURE_DNS_LIBRARY", raising=False)
+    monkeypatch.setattr(ensure_measuredns, "installed_library_path", lambda: None)
+
+    path = ensure_measuredns.ensure_measuredns()
+    assert os.path.dirname(path) == str(tmp_path)
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+    built = os.stat(path).st_mtime_ns
+    # A second import finds the build instead of compiling again
+    assert ensure_measuredns.ensure_measuredns() == path
+    assert os.stat(path).st_mtime_ns == built
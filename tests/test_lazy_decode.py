@@ -0,0 +1,68 @@
+import dns.flags
+import dns.message
+import dns.rcode
+import pytest
+
+from measure_dns import (
+    DNSQuery,
+    DNSResult,
+    DNSStatus,
+    build_dns_query,
+    parse_dns_header,
+    send_dns_queries,
+    send_dns_query,
+)
+
+
+def test_parse_dns_header():
+    query = dns.message.make_query("example.com", "A", id=0x1234)
+    response = dns.message.make_response(query)
+    response.set_rcode(dns.rcode.NXDOMAIN)
+    response.flags |= dns.flags.TC
+    header = parse_dns_header(response.to_wire())
+    assert header.id == 0x1234
+    assert header.rcode == dns.rcode.NXDOMAIN
+    assert header.truncated
+    assert (header.qdcount, header.ancount, header.nscount, header.arcount) == (1, 0, 0, 0)
+    assert header.flags == response.flags | response.rcode()
+
+    assert not parse_dns_header(build_dns_query("example.com", "A")).truncated
+    with pytest.raises(ValueError):
+        parse_dns_header(b"\x00" * 11)
+
+
+def test_response_decoded_on_first_access(stub_server):
+    result = send_dns_query(DNSQuery(qname="lazy.example", rdtype="A"), stub_server)
+    assert "_response" not in vars(result)
+    assert result
+    assert result.rcode == dns.rcode.NOERROR
+    assert result.header.ancount == 1
+    assert "_response" not in vars(result)
+
+    response = result.response
+    assert response.question[0].name.to_text() == "lazy.example."
+    assert result.response is response
+
+
+def test_repr_and_equality_do_not_decode(stub_server):
+    first, second = send_dns_queries([DNSQuery(qname="same.example", rdtype="A", id=7)] * 2, stub_server)
+    assert "same.example" not in repr(first) and "wire=" in repr(first)
+    assert first != second  # The batch gives the second query a new ID
+    assert first == DNSResult(
+        wire=first.wire, latency_ns=first.latency_ns, additional_params=first.additional_params
+    )
+    assert "_response" not in vars(first) and "_response" not in vars(second)
+
+
+def test_batch_results_are_lazy(stub_server):
+    queries = [DNSQuery(qname=f"lazy{i}.example", rdtype="A") for i in range(10)]
+    results = send_dns_queries(queries, stub_server)
+    assert all(result.header.ancount == 1 for result in results)
+    assert all("_response" not in vars(result) for result in results)
+
+
+def test_result_without_response():
+    result = DNSResult(response=None, latency_ns=0.0, additional_params=[], status=DNSStatus.Timeout)
+    assert not result
+    assert result.response is None
+    assert result.header is None and result.rcode is None
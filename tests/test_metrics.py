@@ -0,0 +1,187 @@
+import asyncio
+import socket
+import threading
+import urllib.request
+
+import pytest
+
+from measure_dns import (
+    AsyncMeasurer,
+    DNSQuery,
+    MeasurementSession,
+    Metrics,
+    build_dns_query,
+    decode_dns_response,
+    fanout_query,
+    metrics,
+    send_dns_queries,
+    send_dns_query,
+)
+from measure_dns.bench import main
+from measure_dns.metrics import STAGES
+from measure_dns.stub import StubServer
+
+PORT = 10553
+STUB = "127.0.0.41"
+SILENT = "127.0.0.48"
+DEAD = "127.0.0.49"
+
+
+@pytest.fixture(scope="module")
+def stub():
+    # The silent socket takes queries and never answers them
+    silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent.bind((SILENT, PORT))
+    with StubServer(STUB, PORT) as server:
+        yield server
+    silent.close()
+
+
+@pytest.fixture
+def recording():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+
+def test_disabled_records_nothing(stub):
+    metrics.reset()
+    assert not metrics.enabled
+    result = send_dns_query(DNSQuery("example.com", "A"), STUB, port=PORT)
+    assert result.response is not None
+    snapshot = metrics.snapshot()
+    assert not any(snapshot.counters.values())
+    assert all(stats.count == 0 for stats in snapshot.stages.values())
+
+
+def test_single_queries(stub, recording):
+    query = DNSQuery("example.com", "A")
+    size = len(build_dns_query("example.com", "A"))
+    for _ in range(5):
+        assert send_dns_query(query, STUB, port=PORT).response is not None
+    send_dns_query(DNSQuery("example.com", "A", timeout=0.05), SILENT, port=PORT)
+    send_dns_query(DNSQuery("example.com", "A", timeout=0.05), DEAD, port=PORT)
+
+    snapshot = recording.snapshot()
+    assert snapshot.counters["sent"] == 7
+    assert snapshot.counters["received"] == 5
+    assert snapshot.counters["timeouts"] == 1
+    assert snapshot.counters["errors"] == 1  # ICMP port unreachable
+    assert snapshot.counters["bytes_sent"] == 7 * size
+    assert snapshot.counters["bytes_received"] > 5 * size
+    for stage in ("build", "marshal", "syscall", "wait"):
+        assert snapshot.stages[stage].count == 7
+    # The timed out query waited its whole timeout
+    assert snapshot.stages["wait"].percentile(100) >= 50e6
+    assert snapshot.stages["decode"].count == 5
+
+
+def test_batches_and_fanout(stub, recording):
+    queries = [DNSQuery(f"{i}.example.com", "A") for i in range(8)]
+    results = send_dns_queries(queries, STUB, port=PORT)
+    with MeasurementSession(port=PORT) as session:
+        session.query(queries[0], STUB)
+        session.query_batch(queries, STUB)
+    fanout_query(DNSQuery("example.com", "A", timeout=0.05), [STUB, SILENT], port=PORT)
+
+    snapshot = recording.snapshot()
+    assert snapshot.counters["received"] == 8 + 1 + 8 + 1
+    assert snapshot.counters["timeouts"] == 1
+    assert snapshot.stages["build"].count == 4
+    assert snapshot.stages["wait"].total_ns >= max(result.latency_ns for result in results)
+
+
+def test_async_queries(stub, recording):
+    size = len(build_dns_query("example.com", "A"))
+
+    async def measure():
+        async with AsyncMeasurer(port=PORT) as measurer:
+            return await asyncio.gather(
+                *(measurer.query(DNSQuery("example.com", "A"), STUB) for _ in range(4)),
+                measurer.query(DNSQuery("example.com", "A", timeout=0.05, retries=1), SILENT),
+            )
+
+    results = asyncio.run(measure())
+    snapshot = recording.snapshot()
+    assert snapshot.counters["sent"] == 4 + 2
+    assert snapshot.counters["received"] == 4
+    assert snapshot.counters["timeouts"] == 1
+    assert snapshot.counters["bytes_sent"] == 6 * size
+    assert snapshot.counters["bytes_received"] > 4 * size
+    assert snapshot.stages["build"].count == 5
+    assert snapshot.stages["syscall"].count == 6
+    assert snapshot.stages["wait"].count == 5
+    assert snapshot.stages["wait"].percentile(100) >= 100e6
+    assert snapshot.stages["wait"].total_ns >= sum(result.latency_ns for result in results[:4])
+
+
+def test_metrics_cli(stub, capsys):
+    # The default benchmark mode runs on the asynchronous path
+    metrics.reset()
+    try:
+        main(["--server", STUB, "--port", str(PORT), "--duration", "0.2", "--qps", "50", "--metrics"])
+    finally:
+        metrics.disable()
+    sent = metrics.snapshot().counters["sent"]
+    metrics.reset()
+    assert sent > 0
+    assert f"measure_dns_queries_sent_total {sent}" in capsys.readouterr().out.splitlines()
+
+
+def test_decode_errors(recording):
+    assert "error" in decode_dns_response(b"\x00\x01")
+    snapshot = recording.snapshot()
+    assert snapshot.counters["decode_errors"] == 1
+    assert snapshot.stages["decode"].count == 1
+
+
+def test_threads_are_summed(stub):
+    instance = Metrics(enabled=True)
+
+    def record():
+        for _ in range(100):
+            instance._record_decode(1000, False)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = instance.snapshot().stages["decode"]
+    assert (stats.count, stats.total_ns, stats.mean_ns) == (400, 400_000, 1000.0)
+    assert stats.buckets[10] == 400  # 1000 ns lies in [512, 1024)
+    assert stats.percentile(50) == 1024.0
+
+    instance.reset()
+    assert instance.snapshot().stages["decode"].count == 0
+
+
+def test_openmetrics(stub, recording):
+    send_dns_query(DNSQuery("example.com", "A"), STUB, port=PORT).response
+    text = recording.to_openmetrics()
+    lines = text.splitlines()
+    assert lines[-1] == "# EOF"
+    assert "# TYPE measure_dns_queries_sent counter" in lines
+    assert "measure_dns_queries_sent_total 1" in lines
+    assert "measure_dns_responses_received_total 1" in lines
+    assert "# TYPE measure_dns_stage_seconds histogram" in lines
+    for stage in STAGES:
+        assert f'measure_dns_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} 1' in lines
+        assert f'measure_dns_stage_seconds_count{{stage="{stage}"}} 1' in lines
+    buckets = [int(line.rsplit(" ", 1)[1]) for line in lines if line.startswith('measure_dns_stage_seconds_bucket{stage="wait"')]
+    assert buckets == sorted(buckets)
+
+
+def test_serve(recording):
+    recording._record_decode(2000, True)
+    server = recording.serve(port=10554)
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:10554/metrics", timeout=2) as reply:
+            assert reply.headers["Content-Type"].startswith("application/openmetrics-text")
+            body = reply.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert "measure_dns_decode_errors_total 1" in body.splitlines()
@@ -0,0 +1,109 @@
+import ctypes
+import errno
+import math
+from types import SimpleNamespace
+
+import pytest
+
+from measure_dns import DNSFlags, DNSQuery, DNSStatus, Monitor
+from measure_dns import monitor as monitor_module
+from measure_dns.monitor import _percentile
+from measure_dns.stub import StubServer
+
+ADDRESS = "127.0.0.1"
+STUB_PORT = 10353
+
+
+@pytest.fixture(scope="module")
+def stub():
+    with StubServer(ADDRESS, STUB_PORT, process=True):
+        yield ADDRESS
+
+
+def test_monitor_keeps_schedule_and_stats(stub):
+    results = []
+    targets = [
+        (stub, DNSQuery("fast.example", "A", timeout=0.5), 0.05),
+        (stub, DNSQuery("slow.example", "A", timeout=0.5), 0.2),
+        (stub, DNSQuery("drop.example", "A", timeout=0.1), 0.1),
+    ]
+    with Monitor(targets, port=STUB_PORT, window=8, on_result=lambda *args: results.append(args)) as monitor:
+        monitor.run(duration=1.0)
+        fast, slow, lost = monitor.stats()
+
+    assert fast.sent in range(19, 22) and slow.sent in range(4, 7)
+    assert fast.lost == 0 and fast.loss_ratio == 0.0
+    assert 0 < fast.min_ns <= fast.p50_ns <= fast.p99_ns
+    assert lost.received == 0 and lost.lost >= 8
+    assert lost.loss_ratio == 1.0 and lost.p50_ns is None
+    assert monitor.max_lag < 0.05
+
+    by_target = {}
+    for index, result in results:
+        by_target.setdefault(index, []).append(result)
+    assert all(result.status == DNSStatus.Ok for result in by_target[0])
+    assert str(by_target[1][0].response.question[0].name) == "slow.example."
+    assert {result.status for result in by_target[2]} == {DNSStatus.Timeout}
+
+
+def test_monitor_many_targets(stub):
+    interval = 0.5
+    targets = [(stub, DNSQuery(f"t{i}.example", "A", timeout=1), interval) for i in range(5000)]
+    with Monitor(targets, port=STUB_PORT) as monitor:
+        monitor.run(duration=4 * interval)
+        stats = monitor.stats()
+    # One probe per interval and target, give or take the jitter at both ends
+    assert {target.sent for target in stats} <= {3, 4, 5}
+    sent = sum(target.sent for target in stats)
+    assert sent == pytest.approx(4 * len(targets), rel=0.02)
+    assert sum(target.received for target in stats) >= 0.99 * sent
+    assert monitor.max_lag < 0.1
+
+
+def test_monitor_runs_out_of_ids(stub):
+    results = []
+    targets = [(stub, DNSQuery("full.example", "A"), 1.0)]
+    with Monitor(targets, port=STUB_PORT, on_result=lambda *args: results.append(args)) as monitor:
+        target = monitor._targets[0]
+        target.channel = monitor._channel(target)
+        target.channel.pending.update((query_id, (target, 0, 0)) for query_id in range(65536))
+        monitor._send(target, 0.0)
+        stats = monitor.stats(0)
+    assert (stats.sent, stats.errors) == (1, 1)
+    ((index, result),) = results
+    assert (index, result.status, result.error_code) == (0, DNSStatus.SendError, errno.EBUSY)
+
+
+def test_monitor_drain_stops_on_socket_errors(stub, monkeypatch):
+    calls = []
+
+    def recv(*args):
+        calls.append(args)
+        ctypes.set_errno(errno.ECONNREFUSED if len(calls) == 1 else errno.EBADF)
+        return -1
+
+    with Monitor([(stub, DNSQuery("example.com", "A"), 1.0)], port=STUB_PORT) as monitor:
+        target = monitor._targets[0]
+        channel = monitor._channel(target)
+        monkeypatch.setattr(monitor_module, "dns_lib", SimpleNamespace(dns_session_recv=recv))
+        # The ICMP error is skipped, the socket error ends the drain
+        monitor._drain(channel)
+        monkeypatch.undo()
+    assert len(calls) == 2
+
+
+def test_monitor_rejects_bad_settings():
+    query = DNSQuery("example.com", "A")
+    for kwargs in ({"jitter": 0.6}, {"window": 0}, {"extra_flags": DNSFlags.Tcp}):
+        with pytest.raises(ValueError):
+            Monitor([(ADDRESS, query, 1.0)], **kwargs)
+    with pytest.raises(ValueError):
+        Monitor([(ADDRESS, query, 0)])
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert _percentile(values, 50) == 50
+    assert _percentile(values, 99) == 99
+    assert _percentile([7.0], 99) == 7.0
+    assert math.isfinite(_percentile(values, 0))
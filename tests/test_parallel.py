@@ -0,0 +1,63 @@
+import itertools
+
+from measure_dns import DNSQuery, DNSResult, DNSStatus, DNSTransport, build_dns_query, measure_many
+from measure_dns.native import PDMOption
+from measure_dns.parallel import _pack_result, _unpack_results
+
+
+def test_measure_many_keeps_job_order(stub_server):
+    queries = [DNSQuery(qname=f"many{i}.example", rdtype="A") for i in range(40)]
+    queries.append(DNSQuery(qname="drop.example", rdtype="A", timeout=0.2))
+    jobs = list(itertools.product(queries, [stub_server]))
+    results = measure_many(jobs, workers=3, chunk_size=8)
+    assert len(results) == len(jobs)
+    for (query, _), result in zip(jobs[:-1], results[:-1]):
+        assert result.status == DNSStatus.Ok
+        assert result.latency_ns > 0
+        assert result.response.question[0].name.to_text() == query.qname + "."
+    assert results[-1].status == DNSStatus.Timeout
+    assert results[-1].response is None
+
+
+def test_measure_many_unreachable_server(stub_server):
+    jobs = [(DNSQuery(qname="one.example", rdtype="A", timeout=0.2), server) for server in (stub_server, "127.0.0.2")]
+    ok, failed = measure_many(jobs, workers=2)
+    assert ok.status == DNSStatus.Ok
+    assert failed.status in (DNSStatus.Unreachable, DNSStatus.Timeout)
+    assert measure_many([]) == []
+
+
+def test_result_records_round_trip():
+    wire = build_dns_query("example.com", "A", id=77)
+    option = PDMOption(option_type=0x0F, opt_len=10, psntp=5, psnlr=4, deltatlr=3, deltatls=2)
+    results = [
+        DNSResult(
+            latency_ns=1234.0,
+            additional_params=[option],
+            attempts=2,
+            kernel_latency_ns=1000.0,
+            hardware_timestamps=True,
+            wire=wire,
+        ),
+        DNSResult(response=None, status=DNSStatus.Unreachable, error_code=111, attempts=1),
+    ]
+    records = b"".join(_pack_result(index, result) for index, result in enumerate(results, 10))
+    (first_index, first), (second_index, second) = _unpack_results(records)
+
+    assert (first_index, second_index) == (10, 11)
+    assert first.wire == wire and first.response.id == 77
+    assert (first.latency_ns, first.attempts, first.kernel_latency_ns) == (1234.0, 2, 1000.0)
+    assert first.hardware_timestamps
+    assert bytes(first.additional_params[0]) == bytes(option)
+    assert not second
+    assert (second.status, second.error_code, second.kernel_latency_ns) == (DNSStatus.Unreachable, 111, None)
+    assert (first.transport, first.connect_ns) == (DNSTransport.Udp, None)
+
+
+def test_result_records_keep_transport():
+    wire = build_dns_query("example.com", "A", id=78)
+    result = DNSResult(latency_ns=5000.0, wire=wire, transport=DNSTransport.Tcp, connect_ns=1234.0)
+    ((index, unpacked),) = _unpack_results(_pack_result(3, result))
+    assert index == 3
+    assert (unpacked.transport, unpacked.connect_ns, unpacked.latency_ns) == (DNSTransport.Tcp, 1234.0, 5000.0)
+    assert unpacked.wire == wire
@@ -0,0 +1,110 @@
+import struct
+
+import pytest
+
+from measure_dns import (
+    DNSResult,
+    ResponseBuffer,
+    decode_pdm,
+    latency_breakdown,
+    pdm_from_responses,
+    pdm_from_results,
+    pdm_time_ns,
+)
+from measure_dns.dns_packet import _result_from_response
+from measure_dns.native import PDMOption
+
+numpy = pytest.importorskip("numpy")
+
+
+def _header(psntp, psnlr, deltatlr, deltatls, scale_dtlr, scale_dtls, padding=b""):
+    option = struct.pack("!BBBBHHHH", 0x0F, 10, scale_dtlr, scale_dtls, psntp, psnlr, deltatlr, deltatls)
+    return bytes([17, 1]) + padding + option
+
+
+def test_pdm_time_ns():
+    assert pdm_time_ns(1000, 0) == pytest.approx(1e-6)
+    assert pdm_time_ns(14896, 36) == pytest.approx(14896 * 2**36 / 1e9)
+    deltas = numpy.array([1, 2, 3], dtype=numpy.uint16)
+    scales = numpy.array([30, 31, 32], dtype=numpy.uint8)
+    assert pdm_time_ns(deltas, scales).tolist() == pytest.approx([2**30 / 1e9, 2**32 / 1e9, 3 * 2**32 / 1e9])
+
+
+def test_decode_pdm_headers():
+    headers = [
+        _header(1, 2, 3, 4, 5, 6).ljust(32, b"\x00"),
+        _header(0xFFFE, 0x1234, 500, 600, 30, 31, padding=b"\x00").ljust(32, b"\x00"),
+        _header(7, 8, 9, 10, 11, 12, padding=b"\x01\x02\x00\x00").ljust(32, b"\x00"),
+        bytes([17, 1, 0x1E, 2, 0, 0]).ljust(32, b"\x00"),
+    ]
+    for batch in (headers, b"".join(headers), numpy.frombuffer(b"".join(headers), numpy.uint8).reshape(4, 32)):
+        pdm = decode_pdm(batch)
+        assert pdm["valid"].tolist() == [True, True, True, False]
+        assert pdm["psntp"].tolist() == [1, 0xFFFE, 7, 0]
+        assert pdm["psnlr"].tolist() == [2, 0x1234, 8, 0]
+        assert pdm["deltatlr"].tolist() == [3, 500, 9, 0]
+        assert pdm["deltatls"].tolist() == [4, 600, 10, 0]
+        assert pdm["scale_dtlr"].tolist() == [5, 30, 11, 0]
+        assert pdm["scale_dtls"].tolist() == [6, 31, 12, 0]
+
+    # Headers too short to hold the option are not read out of bounds
+    assert decode_pdm([b"\x11\x01\x0f\x0a"])["valid"].tolist() == [False]
+    assert len(decode_pdm(b"")) == 0
+
+
+def test_latency_breakdown():
+    latency_ns = numpy.array([5_000_000.0, 2_000_000.0, 1_000.0])
+    deltatlr = numpy.array([14896, 0, 123], dtype=numpy.uint16)
+    scale_dtlr = numpy.array([36, 0, 40], dtype=numpy.uint8)
+    server_ns, network_ns = latency_breakdown(latency_ns, deltatlr, scale_dtlr, [True, True, False])
+    assert server_ns[:2].tolist() == pytest.approx([14896 * 2**36 / 1e9, 0.0])
+    assert network_ns[:2].tolist() == pytest.approx([5_000_000 - 14896 * 2**36 / 1e9, 2_000_000.0])
+    assert numpy.isnan(server_ns[2]) and numpy.isnan(network_ns[2])
+
+
+def test_pdm_from_results_and_responses():
+    option = PDMOption.from_buffer_copy(_header(9, 8, 700, 600, 20, 21)[2:])
+    assert (option.psntp, option.deltatlr, option.scale_dtlr) == (9, 700, 20)
+    pdm = pdm_from_results([DNSResult(additional_params=[option]), DNSResult(response=None)])
+    assert pdm["valid"].tolist() == [True, False]
+    assert (pdm["psntp"][0], pdm["psnlr"][0], pdm["deltatlr"][0], pdm["deltatls"][0]) == (9, 8, 700, 600)
+
+    buffer = ResponseBuffer(capacity=3)
+    slots = buffer.reserve(3)
+    for slot, params in zip(slots, ((59,), (41, 59), ())):
+        slot.num_additional_params = len(params)
+        for index, param_type in enumerate(params):
+            slot.additional_params[index].type = param_type
+            header = _header(index + 1, 0, 100 * (index + 1), 0, 10, 0).ljust(32, b"\x00")
+            slot.additional_params[index].data[:] = header
+    pdm = pdm_from_responses(buffer)
+    assert pdm["valid"].tolist() == [True, True, False]
+    # The first destination options header of a slot is decoded
+    assert pdm["deltatlr"].tolist() == [100, 200, 0]
+    assert len(pdm_from_responses(buffer, 1)) == 1
+    with pytest.raises(ValueError):
+        pdm_from_responses(buffer, 4)
+
+
+def test_results_find_padded_options():
+    buffer = ResponseBuffer(capacity=3)
+    slots = buffer.reserve(3)
+    headers = (
+        _header(1, 2, 3, 4, 5, 6, padding=b"\x00"),
+        _header(7, 8, 9, 10, 11, 12, padding=b"\x01\x02\x00\x00"),
+        bytes([17, 1, 0x1E, 2, 0, 0]),
+    )
+    for slot, header in zip(slots, headers):
+        slot.response_size = 12  # An empty DNS header
+        slot.num_additional_params = 1
+        slot.additional_params[0].type = 59
+        slot.additional_params[0].data[:] = header.ljust(32, b"\x00")
+    pdm = pdm_from_responses(buffer)
+    results = [_result_from_response(slot) for slot in slots]
+    # Results locate the option like `decode_pdm`, and drop headers without one
+    for row, result in zip(pdm[:2], results):
+        (option,) = result.additional_params
+        assert option.option_type == 0x0F
+        assert (option.psntp, option.psnlr, option.deltatlr, option.deltatls) == tuple(row[["psntp", "psnlr", "deltatlr", "deltatls"]])
+        assert (option.scale_dtlr, option.scale_dtls) == (row["scale_dtlr"], row["scale_dtls"])
+    assert results[2].additional_params == []
@@ -0,0 +1,107 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from measure_dns import DNSFlags, DNSQuery, DNSStatus, MeasurementSession, pdm_time_ns
+from measure_dns.stub import _stub_response
+
+SERVER = "::1"
+SERVER_PSN = 1000
+_PDM = struct.Struct("!BBBBHHHH")
+
+
+def _pdm_header(psntp):
+    option = _PDM.pack(0x0F, 10, 0, 0, psntp, 0, 0, 0)
+    return bytes([socket.IPPROTO_UDP, 1]) + option + b"\x00\x00"
+
+
+class PDMResponder:
+    """
+    Answers queries on [::1]:53 with its own PDM option and records the PDM
+    options the queries carried.
+    """
+
+    def __init__(self):
+        self.options = []
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVDSTOPTS, 1)
+        self.sock.bind((SERVER, 53))
+        self.sock.settimeout(0.1)
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        psn = SERVER_PSN
+        while self.running:
+            try:
+                wire, ancdata, _, peer = self.sock.recvmsg(512, socket.CMSG_SPACE(64))
+            except socket.timeout:
+                continue
+            for level, kind, data in ancdata:
+                if level == socket.IPPROTO_IPV6 and kind == socket.IPV6_DSTOPTS:
+                    self.options.append(_PDM.unpack_from(data, 2))
+            response = _stub_response(wire)
+            if response is not None:
+                self.sock.sendmsg(
+                    [response], [(socket.IPPROTO_IPV6, socket.IPV6_DSTOPTS, _pdm_header(psn))], 0, peer
+                )
+                psn += 1
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+@pytest.fixture
+def responder():
+    try:
+        server = PDMResponder()
+    except PermissionError:
+        pytest.skip("binding to port 53 requires privileges")
+    except OSError as error:
+        pytest.skip(f"IPv6 loopback unavailable: {error}")
+    yield server
+    server.close()
+
+
+def test_pdm_flow_tracks_psn_and_deltas(responder):
+    with MeasurementSession(DNSFlags.PdmMetric) as session:
+        first = session.query(DNSQuery("flow.example", "A"), SERVER)
+        flow = session.pdm_flow(SERVER)
+        if flow is None:
+            pytest.skip("setting IPv6 destination options requires CAP_NET_RAW")
+        assert first.status == DNSStatus.Ok
+        assert first.additional_params[0].psntp == SERVER_PSN
+        time.sleep(0.01)
+        session.query(DNSQuery("flow.example", "A"), SERVER)
+        session.query_batch([DNSQuery(f"flow{i}.example", "A") for i in range(3)], SERVER)
+        flow = session.pdm_flow(SERVER)
+
+    assert (flow.packets_sent, flow.packets_received) == (5, 5)
+    assert flow.psn_last_received == SERVER_PSN + 4
+    assert flow.last_received_ns > flow.last_sent_ns > 0
+
+    options = responder.options
+    assert len(options) == 5
+    psns = [option[4] for option in options]
+    assert psns == [(psns[0] + i) & 0xFFFF for i in range(5)]
+    assert flow.psn_next == (psns[0] + 5) & 0xFFFF
+
+    # The first packet has nothing to refer to
+    _, _, scale_dtlr, scale_dtls, _, psnlr, deltatlr, deltatls = options[0]
+    assert (psnlr, deltatlr, deltatls) == (0, 0, 0)
+    # The second one reports the 10 ms pause and the first round trip
+    _, _, scale_dtlr, scale_dtls, _, psnlr, deltatlr, deltatls = options[1]
+    assert psnlr == SERVER_PSN
+    assert 10e6 <= pdm_time_ns(deltatlr, scale_dtlr) < 1e9
+    assert 0 < pdm_time_ns(deltatls, scale_dtls) <= first.latency_ns * 1.01
+
+
+def test_pdm_flow_is_per_socket():
+    with MeasurementSession() as session:
+        assert session.pdm_flow(SERVER) is None
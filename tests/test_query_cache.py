@@ -0,0 +1,79 @@
+import dns.edns
+import dns.message
+
+from measure_dns import DNSQuery, QueryCache, build_dns_query, query_cache, send_dns_query
+
+
+def test_cached_wire_matches_dnspython():
+    cache = QueryCache()
+    query = DNSQuery(qname="example.com", rdtype="AAAA", use_edns=0, want_dnssec=True, id=4242)
+    expected = build_dns_query("example.com", "AAAA", use_edns=0, want_dnssec=True, id=4242)
+    assert cache.wire(query) == expected
+    assert cache.wire(query) == expected
+    assert cache.cache_info() == (1, 1, 1024, 1)
+
+
+def test_cache_patches_id():
+    cache = QueryCache()
+    cache.wire(DNSQuery(qname="example.com", rdtype="A", id=1))
+    wire = cache.wire(DNSQuery(qname="example.com", rdtype="A", id=0xBEEF))
+    assert wire[:2] == b"\xbe\xef"
+    assert dns.message.from_wire(wire).id == 0xBEEF
+    assert cache.hits == 1
+
+    query = DNSQuery(qname="example.com", rdtype="A")
+    ids = {dns.message.from_wire(cache.wire(query)).id for _ in range(20)}
+    assert len(ids) > 1
+
+
+def test_cache_keys_on_wire_fields():
+    cache = QueryCache()
+    ecs = [dns.edns.ECSOption("192.0.2.0", 24)]
+    cache.wire(DNSQuery(qname="example.com", rdtype="A", use_edns=0, options=ecs))
+    cache.wire(DNSQuery(qname="example.com", rdtype="A", use_edns=0, options=[dns.edns.ECSOption("192.0.2.0", 24)]))
+    cache.wire(DNSQuery(qname="example.com", rdtype="A", use_edns=0, options=[dns.edns.ECSOption("198.51.100.0", 24)]))
+    # Timeouts and retries do not change the wire format
+    cache.wire(DNSQuery(qname="example.com", rdtype="A", timeout=1.0, retries=3))
+    cache.wire(DNSQuery(qname="example.com", rdtype="A"))
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_cache_padding():
+    cache = QueryCache()
+    query = DNSQuery(qname="example.com", rdtype="A", use_edns=0, pad=128, id=7)
+    cache.wire(query)
+    wire = cache.wire(query)
+    assert wire == build_dns_query("example.com", "A", use_edns=0, pad=128, id=7)
+    assert len(wire) % 128 == 0
+
+
+def test_cache_lru_eviction():
+    cache = QueryCache(maxsize=2)
+    first, second, third = (DNSQuery(qname=f"{name}.example", rdtype="A") for name in ("a", "b", "c"))
+    cache.wire(first)
+    cache.wire(second)
+    cache.wire(first)  # "a" becomes the most recently used
+    cache.wire(third)  # evicts "b"
+    assert len(cache) == 2
+    cache.wire(first)
+    cache.wire(second)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+    cache.clear()
+    assert cache.cache_info() == (0, 0, 2, 0)
+
+
+def test_cache_disabled():
+    cache = QueryCache(maxsize=0)
+    query = DNSQuery(qname="example.com", rdtype="A", id=9)
+    assert cache.wire(query) == cache.wire(query)
+    assert cache.cache_info() == (0, 2, 0, 0)
+
+
+def test_send_dns_query_uses_cache(stub_server):
+    query = DNSQuery(qname="cached.example", rdtype="A")
+    send_dns_query(query, stub_server)
+    hits = query_cache.hits
+    result = send_dns_query(query, stub_server)
+    assert query_cache.hits == hits + 1
+    assert result.response.question[0].name.to_text() == "cached.example."
@@ -0,0 +1,54 @@
+import pickle
+import socket
+
+import pytest
+
+from measure_dns import DNSFlags, DNSQuery, DNSServer, DNSStatus, MeasurementSession, send_dns_queries, send_dns_query
+from measure_dns.dns_packet import _server_of
+
+
+def test_server_address_is_packed_once():
+    server = DNSServer("127.0.0.1", 5353)
+    assert (server.address, server.use_ipv6) == ("127.0.0.1", False)
+    assert server.sockaddr == socket.AF_INET.to_bytes(2, "little") + b"\x14\xe9\x7f\x00\x00\x01" + b"\x00" * 8
+    assert server._native() is server._native()
+    ipv6 = DNSServer("::1")
+    assert ipv6.use_ipv6 and len(ipv6.sockaddr) == 28
+    # String servers share one cached object
+    assert _server_of("127.0.0.1", 53, 0) is _server_of("127.0.0.1", 53, DNSFlags.PdmMetric)
+
+
+def test_hostname_resolution_and_ttl(monkeypatch):
+    server = DNSServer("localhost", extra_flags=DNSFlags.PreResolve4, ttl=60)
+    assert server.address == "127.0.0.1"
+    calls = []
+    resolve = server.resolve
+    monkeypatch.setattr(server, "resolve", lambda: calls.append(1) or resolve())
+    server.sockaddr
+    assert calls == []
+    server._expires = 0
+    server.sockaddr
+    assert calls == [1]
+    # Addresses never expire
+    assert DNSServer("127.0.0.1")._expires is None
+
+
+def test_invalid_servers():
+    for port, ttl in ((0, 1), (65536, 1), (53, -1)):
+        with pytest.raises(ValueError):
+            DNSServer("127.0.0.1", port, ttl=ttl)
+    with pytest.raises(socket.gaierror):
+        DNSServer("no-such-host.invalid")
+
+
+def test_queries_to_a_server_object(stub_server):
+    server = DNSServer("localhost", extra_flags=DNSFlags.PreResolve4)
+    query = DNSQuery("server.example", "A", timeout=1)
+    assert send_dns_query(query, server).status == DNSStatus.Ok
+    assert [result.status for result in send_dns_queries([query] * 3, server)] == [DNSStatus.Ok] * 3
+    with MeasurementSession() as session:
+        assert session.query(query, server).status == DNSStatus.Ok
+        assert session.query(query, stub_server).status == DNSStatus.Ok
+        # The string and the resolved hostname share the socket to 127.0.0.1
+        assert len(session._handles) == 1
+    assert pickle.loads(pickle.dumps(server)).sockaddr == server.sockaddr
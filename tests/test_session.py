@@ -0,0 +1,30 @@
+from dns.rdatatype import A
+
+from measure_dns import DNSQuery, DNSStatus, MeasurementSession
+
+
+def test_session_reuses_socket(stub_server):
+    with MeasurementSession() as session:
+        first = session.query(DNSQuery(qname="one.example", rdtype="A"), stub_server)
+        handle = dict(session._handles)
+        second = session.query(DNSQuery(qname="two.example", rdtype="A"), stub_server)
+        assert session._handles == handle
+    assert first is not None and second is not None
+    assert second.latency_ns > 0
+    assert second.response.question[0].name.to_text() == "two.example."
+    assert any(rr.rdtype == A for rr in second.response.answer)
+    assert session._handles == {}
+
+
+def test_session_query_batch(stub_server):
+    queries = [DNSQuery(qname=f"host{i}.example", rdtype="A") for i in range(50)]
+    queries.append(DNSQuery(qname="drop.example", rdtype="A"))
+    with MeasurementSession() as session:
+        results = session.query_batch(queries, stub_server, timeout=0.2)
+        lost = session.query(DNSQuery(qname="drop.example", rdtype="A", timeout=0.1), stub_server)
+        # A follow-up query must not pick up anything left over from the batch
+        follow_up = session.query(DNSQuery(qname="after.example", rdtype="A"), stub_server)
+    assert all(results[:-1])
+    assert not results[-1]
+    assert lost.status == DNSStatus.Timeout
+    assert follow_up.response.question[0].name.to_text() == "after.example."
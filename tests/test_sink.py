@@ -0,0 +1,143 @@
+import math
+import struct
+
+import pytest
+
+from measure_dns import (
+    DNSQuery,
+    DNSResult,
+    DNSStatus,
+    MeasurementSession,
+    ResponseBuffer,
+    ResultSink,
+    build_dns_query,
+    iter_records,
+    read_qnames,
+    read_results,
+)
+from measure_dns.native import PDMOption
+from measure_dns.sink import RECORD_SIZE, UNKNOWN_QNAME, pack_address, unpack_address
+
+
+def test_addresses_round_trip():
+    for address in ("192.0.2.1", "2001:db8::1", "::1"):
+        packed = pack_address(address)
+        assert len(packed) == 16
+        assert unpack_address(packed) == address
+
+
+def test_sink_streams_session_batches(tmp_path, stub_server):
+    path = str(tmp_path / "results.bin")
+    queries = [DNSQuery(qname=f"sink{i}.example", rdtype="A") for i in range(20)]
+    queries.append(DNSQuery(qname="drop.example", rdtype="NS", timeout=0.1))
+    with ResultSink(path) as sink, MeasurementSession() as session:
+        assert session.query_batch_into(sink, queries, stub_server) == 20
+        # Names already seen are not interned twice
+        session.query_batch_into(sink, queries[:2], stub_server)
+        assert sink.records == 23
+
+    records = list(iter_records(path))
+    assert len(records) == 23
+    assert len(read_qnames(path)) == 21
+    answered = records[0]
+    assert answered["qname"] == "sink0.example"
+    assert answered["server"] == stub_server
+    assert (answered["rdtype"], answered["rcode"], answered["status"]) == (1, 0, DNSStatus.Ok)
+    assert answered["latency_ns"] > 0 and answered["response_size"] > 12
+    assert math.isnan(answered["kernel_latency_ns"])
+    lost = records[20]
+    assert (lost["qname"], lost["rdtype"], lost["rcode"]) == ("drop.example", 2, -1)
+    assert lost["status"] == DNSStatus.Timeout and lost["response_size"] == 0
+    assert records[21]["qname_id"] == records[0]["qname_id"]
+
+
+def test_sink_resolves_hostnames(tmp_path, stub_server):
+    path = str(tmp_path / "results.bin")
+    queries = [DNSQuery(qname=f"host{i}.example", rdtype="A") for i in range(3)]
+    with ResultSink(path) as sink:
+        with MeasurementSession() as session:
+            session.query_batch_into(sink, queries, "localhost")
+        sink.write(queries[0], "fe80::1%lo", DNSResult(response=None))
+    records = list(iter_records(path))
+    assert [record["server"] for record in records[:3]] in (["127.0.0.1"] * 3, ["::1"] * 3)
+    assert records[3]["server"] == "fe80::1"
+
+
+def test_sink_appends_and_writes_results(tmp_path):
+    path = str(tmp_path / "results.bin")
+    wire = build_dns_query("example.com", "A")
+    option = PDMOption(psntp=7, psnlr=6, deltatlr=5, deltatls=4, scale_dtlr=3, scale_dtls=2)
+    with ResultSink(path) as sink:
+        sink.write(
+            DNSQuery("example.com", "AAAA"),
+            "2001:db8::53",
+            DNSResult(latency_ns=1500.0, additional_params=[option], kernel_latency_ns=900.0, wire=wire),
+            timestamp_ns=42,
+        )
+    with ResultSink(path) as sink:
+        sink.write(wire, "192.0.2.53", DNSResult(response=None, status=DNSStatus.Unreachable))
+        sink.write(DNSQuery("example.com", "A"), "192.0.2.53", DNSResult(response=None))
+
+    first, second, third = iter_records(path)
+    assert (first["timestamp_ns"], first["latency_ns"], first["kernel_latency_ns"]) == (42, 1500.0, 900.0)
+    assert (first["rdtype"], first["server"], first["response_size"]) == (28, "2001:db8::53", len(wire))
+    assert first["has_pdm"] == 1
+    assert (first["pdm_psntp"], first["pdm_psnlr"], first["pdm_deltatlr"], first["pdm_deltatls"]) == (7, 6, 5, 4)
+    assert (first["pdm_scale_dtlr"], first["pdm_scale_dtls"]) == (3, 2)
+    assert second["qname_id"] == UNKNOWN_QNAME and second["qname"] is None
+    assert second["status"] == DNSStatus.Unreachable
+    assert third["qname_id"] == first["qname_id"]
+
+
+def test_sink_replaces_stale_qnames(tmp_path):
+    path = tmp_path / "probes.bin"
+    with ResultSink(str(path)) as sink:
+        sink.write(DNSQuery("old.example", "A"), "192.0.2.53", DNSResult(response=None))
+    path.unlink()
+    with ResultSink(str(path)) as sink:
+        sink.write(DNSQuery("new.example", "A"), "192.0.2.53", DNSResult(response=None))
+    assert [record["qname"] for record in iter_records(str(path))] == ["new.example"]
+    assert read_qnames(str(path)) == ["new.example"]
+
+
+def test_sink_records_only_pdm_options(tmp_path):
+    path = str(tmp_path / "slots.bin")
+    option = struct.pack("!BBBBHHHH", 0x0F, 10, 3, 2, 7, 6, 5, 4)
+    headers = (bytes([17, 1, 0]) + option, bytes([17, 1, 0x1E, 2, 0xAA, 0xBB]))
+    slots = ResponseBuffer(capacity=2).reserve(2)
+    with ResultSink(path) as sink:
+        for slot, header in zip(slots, headers):
+            slot.num_additional_params = 1
+            slot.additional_params[0].type = 59
+            slot.additional_params[0].data[:] = header.ljust(32, b"\x00")
+            sink._write_response(DNSQuery("pdm.example", "A"), "2001:db8::53", slot, 0)
+    padded, other = iter_records(path)
+    assert padded["has_pdm"] == 1
+    assert (padded["pdm_psntp"], padded["pdm_psnlr"], padded["pdm_deltatlr"], padded["pdm_deltatls"]) == (7, 6, 5, 4)
+    assert (padded["pdm_scale_dtlr"], padded["pdm_scale_dtls"]) == (3, 2)
+    assert other["has_pdm"] == 0 and other["pdm_psntp"] == 0
+
+
+def test_sink_rejects_foreign_files(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\x00" * RECORD_SIZE)
+    with pytest.raises(ValueError):
+        ResultSink(str(path))
+
+
+def test_read_results_as_numpy(tmp_path, stub_server):
+    numpy = pytest.importorskip("numpy")
+    path = str(tmp_path / "results.bin")
+    queries = [DNSQuery(qname=f"np{i}.example", rdtype="A") for i in range(50)]
+    with ResultSink(path) as sink, MeasurementSession() as session:
+        session.query_batch_into(sink, queries, stub_server)
+
+    for mmap in (True, False):
+        records = read_results(path, mmap=mmap)
+        assert records.dtype.itemsize == RECORD_SIZE
+        assert len(records) == 50
+        assert (records["rcode"] == 0).all()
+        assert (records["latency_ns"] > 0).all()
+        assert numpy.isnan(records["kernel_latency_ns"]).all()
+        names = read_qnames(path)
+        assert [names[i] for i in records["qname_id"]] == [query.qname for query in queries]
@@ -0,0 +1,52 @@
+import os
+import resource
+
+from measure_dns import (
+    DNSQuery,
+    MeasurementSession,
+    ResponseBuffer,
+    send_dns_queries,
+    send_dns_query,
+)
+
+# Set MEASURE_DNS_SOAK_QUERIES=1000000 for the full soak run
+SOAK_QUERIES = int(os.environ.get("MEASURE_DNS_SOAK_QUERIES", "10000"))
+MAX_GROWTH_BYTES = 1 << 20
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _assert_flat_rss(run, iterations: int):
+    run(min(iterations, 2000))  # Warm up allocator pools and caches
+    before = _rss_bytes()
+    run(iterations)
+    growth = _rss_bytes() - before
+    assert growth < MAX_GROWTH_BYTES, f"RSS grew by {growth} bytes"
+
+
+def test_send_dns_query_soak(stub_server):
+    query = DNSQuery(qname="soak.example", rdtype="A")
+    buffer = ResponseBuffer()
+
+    def run(count):
+        for i in range(count):
+            # Alternate between fresh and reused response storage
+            assert send_dns_query(query, stub_server, buffer=buffer if i % 2 else None)
+
+    _assert_flat_rss(run, SOAK_QUERIES)
+
+
+def test_session_batch_soak(stub_server):
+    queries = [DNSQuery(qname=f"soak{i}.example", rdtype="A") for i in range(100)]
+    buffer = ResponseBuffer()
+
+    def run(count):
+        with MeasurementSession() as session:
+            for _ in range(count // (2 * len(queries))):
+                assert all(session.query_batch(queries, stub_server))
+                assert all(send_dns_queries(queries, stub_server, buffer=buffer))
+
+    _assert_flat_rss(run, SOAK_QUERIES)
@@ -0,0 +1,104 @@
+import pytest
+
+from measure_dns import (
+    DNSFlags,
+    DNSQuery,
+    DNSStatus,
+    DNSTransport,
+    MeasurementSession,
+    ResponseBuffer,
+    send_dns_queries,
+    send_dns_query,
+)
+
+# The stub server answers names under `big.` with 200 A records (3.2 KB)
+BIG_ANSWERS = 200
+
+
+def test_tcp_query(stub_server):
+    result = send_dns_query(DNSQuery("example.com", "A"), stub_server, DNSFlags.Tcp)
+    assert result.status == DNSStatus.Ok
+    assert result.transport == DNSTransport.Tcp
+    assert result.connect_ns > 0 and result.latency_ns > 0
+    assert result.response.answer[0][0].address == "127.0.0.1"
+
+
+def test_tcp_batch_is_pipelined_on_one_connection(stub_server):
+    queries = [DNSQuery(f"tcp{i}.example", "A") for i in range(50)]
+    queries.append(DNSQuery("drop.example", "A", timeout=0.1))
+    results = send_dns_queries(queries, stub_server, DNSFlags.Tcp)
+    assert [result.status for result in results[:50]] == [DNSStatus.Ok] * 50
+    assert results[50].status == DNSStatus.Timeout
+    for query, result in zip(queries, results):
+        if result.status == DNSStatus.Ok:
+            assert str(result.response.question[0].name) == query.qname + "."
+    # The handshake is charged to the first query sent over the connection
+    assert sum(result.connect_ns is not None for result in results) == 1
+
+
+def test_tcp_session_keeps_connection(stub_server):
+    with MeasurementSession(DNSFlags.Tcp) as session:
+        first = session.query(DNSQuery("keep.example", "A"), stub_server)
+        second = session.query(DNSQuery("keep.example", "A"), stub_server)
+        batch = session.query_batch([DNSQuery(f"keep{i}.example", "A") for i in range(10)], stub_server)
+    assert first.connect_ns is not None and second.connect_ns is None
+    assert all(result.connect_ns is None and result.status == DNSStatus.Ok for result in batch)
+
+
+def test_tcp_large_response(stub_server):
+    result = send_dns_query(DNSQuery("big.example", "A", timeout=2), stub_server, DNSFlags.Tcp)
+    assert result.status == DNSStatus.Ok
+    assert len(result.wire) > 3000
+    assert len(result.response.answer[0]) == BIG_ANSWERS
+
+
+def test_tcp_grows_supplied_buffer(stub_server):
+    buffer = ResponseBuffer()
+    result = send_dns_query(DNSQuery("big.example", "A", timeout=2), stub_server, DNSFlags.Tcp, buffer)
+    assert result.status == DNSStatus.Ok
+    assert len(result.response.answer[0]) == BIG_ANSWERS
+    assert buffer.response_size == 65535
+
+    with MeasurementSession(DNSFlags.Tcp, buffer=ResponseBuffer()) as session:
+        result = session.query(DNSQuery("big.example", "A", timeout=2), stub_server)
+    assert result.status == DNSStatus.Ok and len(result.response.answer[0]) == BIG_ANSWERS
+
+
+def test_large_edns_response_over_udp(stub_server):
+    query = DNSQuery("big.example", "A", use_edns=0, payload=4096)
+    buffer = ResponseBuffer(response_size=4096)
+    result = send_dns_query(query, stub_server, buffer=buffer)
+    assert result.status == DNSStatus.Ok and result.transport == DNSTransport.Udp
+    assert len(result.response.answer[0]) == BIG_ANSWERS
+
+    # A buffer too small for the response reports it as truncated
+    result = send_dns_query(query, stub_server, buffer=ResponseBuffer(response_size=512))
+    assert result.status == DNSStatus.Truncated
+    assert len(result.wire) == 512
+
+
+def test_tc_fallback(stub_server):
+    queries = [DNSQuery("big.example", "A"), DNSQuery("small.example", "A")]
+    plain = send_dns_queries(queries, stub_server)
+    assert plain[0].status == DNSStatus.Truncated and plain[0].response.flags & 0x0200
+    assert plain[1].status == DNSStatus.Ok
+
+    fallback = send_dns_queries(queries, stub_server, DNSFlags.TcFallback)
+    assert [result.status for result in fallback] == [DNSStatus.Ok, DNSStatus.Ok]
+    assert [result.transport for result in fallback] == [DNSTransport.Tcp, DNSTransport.Udp]
+    assert fallback[0].attempts == 2 and fallback[0].connect_ns is not None
+    assert len(fallback[0].response.answer[0]) == BIG_ANSWERS
+
+    single = send_dns_query(queries[0], stub_server, DNSFlags.TcFallback)
+    assert single.status == DNSStatus.Ok and single.transport == DNSTransport.Tcp
+
+
+def test_response_buffer_size():
+    buffer = ResponseBuffer(capacity=2, response_size=2048)
+    assert buffer.response_size == 2048
+    slots = buffer.reserve(4, 4096)
+    assert (buffer.capacity, buffer.response_size) == (4, 4096)
+    assert [slot.response_capacity for slot in slots] == [4096] * 4
+    for size in (0, 65536):
+        with pytest.raises(ValueError):
+            ResponseBuffer(response_size=size)
@@ -0,0 +1,51 @@
+import threading
+
+from measure_dns import DNSFlags, DNSQuery, DNSStatus, ResponseBuffer, send_dns_queries, send_dns_query
+
+THREADS = 8
+ROUNDS = 50
+
+
+def _stress(stub_server, worker):
+    errors = []
+    start = threading.Barrier(THREADS)
+
+    def run(thread):
+        start.wait()
+        try:
+            worker(thread)
+        except Exception as error:  # Surfaced by the assertion below
+            errors.append(error)
+
+    threads = [threading.Thread(target=run, args=(thread,)) for thread in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_concurrent_single_queries(stub_server, capfd):
+    def worker(thread):
+        buffer = ResponseBuffer()
+        for i in range(ROUNDS):
+            query = DNSQuery(f"t{thread}-q{i}.example", "A", timeout=2)
+            result = send_dns_query(query, stub_server, buffer=buffer)
+            assert result.status == DNSStatus.Ok
+            assert str(result.response.question[0].name) == query.qname + "."
+
+    _stress(stub_server, worker)
+    assert capfd.readouterr().err == ""
+
+
+def test_concurrent_batches(stub_server):
+    def worker(thread):
+        for i in range(ROUNDS // 10):
+            flags = DNSFlags.Tcp if i % 2 else DNSFlags.NoFlag
+            queries = [DNSQuery(f"t{thread}-b{i}-q{j}.example", "A", timeout=2) for j in range(20)]
+            results = send_dns_queries(queries, stub_server, flags)
+            assert [result.status for result in results] == [DNSStatus.Ok] * len(queries)
+            for query, result in zip(queries, results):
+                assert str(result.response.question[0].name) == query.qname + "."
+
+    _stress(stub_server, worker)
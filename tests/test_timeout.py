@@ -0,0 +1,26 @@
+from measure_dns import DNSQuery, DNSStatus, send_dns_query
+
+
+def test_send_dns_query_ok_status(stub_server):
+    result = send_dns_query(DNSQuery(qname="example.com", rdtype="A"), stub_server)
+    assert result
+    assert result.status == DNSStatus.Ok
+    assert result.attempts == 1
+
+
+def test_send_dns_query_timeout_and_retries(stub_server):
+    query = DNSQuery(qname="drop.example", rdtype="A", timeout=0.05, retries=2)
+    result = send_dns_query(query, stub_server)
+    assert not result
+    assert result.status == DNSStatus.Timeout
+    assert result.attempts == 3
+
+
+def test_send_dns_query_unreachable():
+    # Nothing listens on this loopback address, so the kernel answers with
+    # an ICMP port unreachable
+    query = DNSQuery(qname="example.com", rdtype="A", timeout=1)
+    result = send_dns_query(query, "127.0.0.2")
+    assert result.status == DNSStatus.Unreachable
+    assert result.error_code != 0
+
@@ -0,0 +1,54 @@
+import asyncio
+
+from measure_dns import (
+    AsyncMeasurer,
+    DNSFlags,
+    DNSQuery,
+    MeasurementSession,
+    send_dns_queries,
+    send_dns_query,
+)
+
+
+def _assert_kernel_latency(result):
+    assert result
+    assert result.kernel_latency_ns is not None
+    assert 0 < result.kernel_latency_ns <= result.latency_ns
+
+
+def test_kernel_timestamps_disabled_by_default(stub_server):
+    result = send_dns_query(DNSQuery(qname="example.com", rdtype="A"), stub_server)
+    assert result.kernel_latency_ns is None
+    assert not result.hardware_timestamps
+
+
+def test_send_dns_query_kernel_timestamps(stub_server):
+    result = send_dns_query(
+        DNSQuery(qname="example.com", rdtype="A"), stub_server, DNSFlags.KernelTimestamp
+    )
+    _assert_kernel_latency(result)
+
+
+def test_batch_kernel_timestamps(stub_server):
+    queries = [DNSQuery(qname=f"host{i}.example", rdtype="A") for i in range(100)]
+    for result in send_dns_queries(queries, stub_server, DNSFlags.KernelTimestamp):
+        _assert_kernel_latency(result)
+
+
+def test_session_kernel_timestamps(stub_server):
+    with MeasurementSession(DNSFlags.KernelTimestamp) as session:
+        for i in range(3):
+            query = DNSQuery(qname=f"host{i}.example", rdtype="A")
+            _assert_kernel_latency(session.query(query, stub_server))
+
+
+def test_async_kernel_timestamps(stub_server):
+    async def run():
+        async with AsyncMeasurer(DNSFlags.KernelTimestamp) as measurer:
+            queries = [DNSQuery(qname=f"host{i}.example", rdtype="A") for i in range(50)]
+            return await asyncio.gather(
+                *(measurer.query(query, stub_server) for query in queries)
+            )
+
+    for result in asyncio.run(run()):
+        _assert_kernel_latency(result)
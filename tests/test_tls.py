@@ -0,0 +1,100 @@
+import shutil
+import ssl
+import subprocess
+
+import pytest
+
+from measure_dns import DNSQuery, DNSStatus, DNSTransport, DoTSession, send_dns_query_tls
+from measure_dns.stub import StubServer
+
+ADDRESS = "127.0.0.1"
+UDP_PORT = 10053
+DOT_PORT = 10853
+HOSTNAME = "dot.test"
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if shutil.which("openssl") is None:
+        pytest.skip("generating a test certificate requires the openssl command")
+    directory = tmp_path_factory.mktemp("dot")
+    cert, key = str(directory / "cert.pem"), str(directory / "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-nodes", "-days", "1",
+            "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+            "-keyout", key, "-out", cert, "-subj", f"/CN={HOSTNAME}",
+            "-addext", f"subjectAltName=DNS:{HOSTNAME}",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+@pytest.fixture(scope="module")
+def dot_server(certificate):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    server = StubServer(ADDRESS, UDP_PORT, tls_context=context, tls_port=DOT_PORT)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client_context(certificate):
+    return ssl.create_default_context(cafile=certificate[0])
+
+
+def test_dot_phases_and_connection_reuse(dot_server, client_context):
+    with DoTSession(client_context, HOSTNAME, DOT_PORT) as session:
+        first = session.query(DNSQuery("first.example", "A"), ADDRESS)
+        second = session.query(DNSQuery("second.example", "A"), ADDRESS)
+
+    assert first.status == DNSStatus.Ok and first.transport == DNSTransport.Tls
+    assert first.response.answer[0][0].address == "127.0.0.1"
+    assert first.connect_ns > 0 and first.tls_handshake_ns > 0 and first.latency_ns > 0
+    assert first.tls_resumed is False
+    assert second.status == DNSStatus.Ok
+    assert (second.connect_ns, second.tls_handshake_ns, second.tls_resumed) == (None, None, None)
+
+
+def test_dot_batch_is_pipelined(dot_server, client_context):
+    connections = dot_server.connections
+    queries = [DNSQuery(f"dot{i}.example", "A") for i in range(20)]
+    queries.append(DNSQuery("drop.example", "A", timeout=0.2))
+    with DoTSession(client_context, HOSTNAME, DOT_PORT) as session:
+        results = session.query_batch(queries, ADDRESS)
+
+    assert [result.status for result in results[:20]] == [DNSStatus.Ok] * 20
+    assert results[20].status == DNSStatus.Timeout
+    for query, result in zip(queries[:20], results):
+        assert str(result.response.question[0].name) == query.qname + "."
+    assert [result.tls_handshake_ns is not None for result in results] == [True] + [False] * 20
+    assert dot_server.connections == connections + 1
+
+
+def test_dot_session_resumption(dot_server, client_context):
+    with DoTSession(client_context, HOSTNAME, DOT_PORT) as session:
+        full = session.query(DNSQuery("full.example", "A"), ADDRESS)
+        session.disconnect(ADDRESS)
+        resumed = session.query(DNSQuery("resumed.example", "A"), ADDRESS)
+
+    assert full.tls_resumed is False
+    assert resumed.status == DNSStatus.Ok
+    assert resumed.tls_resumed is True and resumed.tls_handshake_ns > 0
+
+
+def test_send_dns_query_tls(dot_server, client_context):
+    result = send_dns_query_tls(DNSQuery("once.example", "A"), ADDRESS, HOSTNAME, client_context, DOT_PORT)
+    assert result.status == DNSStatus.Ok and result.connect_ns is not None
+
+
+def test_dot_failures(dot_server, client_context):
+    # The certificate does not match the name
+    result = send_dns_query_tls(DNSQuery("example.com", "A"), ADDRESS, "other.test", client_context, DOT_PORT)
+    assert result.status == DNSStatus.SocketError and result.wire is None
+    # Nothing listens on the UDP port over TCP
+    result = send_dns_query_tls(DNSQuery("example.com", "A"), ADDRESS, HOSTNAME, client_context, UDP_PORT)
+    assert result.status == DNSStatus.Unreachable
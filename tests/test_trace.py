@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+from measure_dns import DelegationCache, DNSStatus, trace_resolution
+from measure_dns.stub import StubServer
+
+PORT = 10253
+ROOT, TLD, AUTH, OTHER_AUTH, DEAD = "127.0.0.21", "127.0.0.22", "127.0.0.23", "127.0.0.1", "127.0.0.29"
+ROOTS = [("root.test", ROOT)]
+
+
+@pytest.fixture(scope="module")
+def hierarchy():
+    servers = [
+        StubServer(ROOT, PORT, delegations={"in": [("a.nic.in", TLD)]}),
+        StubServer(
+            TLD,
+            PORT,
+            delegations={
+                "testprotocol.in": [("ns1.testprotocol.in", AUTH)],
+                "failover.in": [("ns0.failover.in", DEAD), ("ns1.failover.in", AUTH)],
+                # The nameserver is in another zone, so it comes without glue
+                "glueless.in": [("ns.testprotocol.in", None)],
+            },
+            delegation_ttl=1,
+        ),
+        # Answers every A query with 127.0.0.1, where the glueless zone is served
+        StubServer(AUTH, PORT),
+        StubServer(OTHER_AUTH, PORT),
+    ]
+    for server in servers:
+        server.start()
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def test_cold_trace(hierarchy):
+    cache = DelegationCache(ROOTS)
+    trace = trace_resolution("ns1.testprotocol.in", "A", cache=cache, port=PORT)
+
+    assert trace.complete and trace.result.status == DNSStatus.Ok
+    assert trace.response.answer[0][0].address == "127.0.0.1"
+    assert [(hop.zone, hop.server, hop.referral) for hop in trace.hops] == [
+        (".", ROOT, "in."),
+        ("in.", TLD, "testprotocol.in."),
+        ("testprotocol.in.", AUTH, None),
+    ]
+    assert all(hop.latency_ns > 0 and hop.response_size > 0 for hop in trace.hops)
+    assert trace.latency_ns == sum(hop.latency_ns for hop in trace.hops)
+    assert (trace.skipped_hops, trace.saved_ns) == (0, 0.0)
+    assert cache.cache_info()[:3] == (0, 1, 2)
+
+
+def test_cached_delegations_skip_hops(hierarchy):
+    cache = DelegationCache(ROOTS)
+    cold = trace_resolution("ns1.testprotocol.in", "A", cache=cache, port=PORT)
+    warm = trace_resolution("ns2.testprotocol.in", "AAAA", cache=cache, port=PORT)
+
+    assert warm.complete
+    assert [(hop.zone, hop.server) for hop in warm.hops] == [("testprotocol.in.", AUTH)]
+    assert warm.skipped_hops == 2
+    assert warm.saved_ns == cold.hops[0].latency_ns + cold.hops[1].latency_ns
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.saved_hops, info.hit_ratio) == (1, 1, 2, 0.5)
+
+
+def test_delegations_expire(hierarchy):
+    cache = DelegationCache(ROOTS)
+    trace_resolution("ns1.testprotocol.in", "A", cache=cache, port=PORT)
+    time.sleep(1.1)
+    # The TLD referral has expired but the root referral to in. has not
+    trace = trace_resolution("ns1.testprotocol.in", "A", cache=cache, port=PORT)
+    assert [hop.zone for hop in trace.hops] == ["in.", "testprotocol.in."]
+    assert trace.skipped_hops == 1
+
+
+def test_failover_and_glueless_nameservers(hierarchy):
+    cache = DelegationCache(ROOTS)
+    trace = trace_resolution("www.failover.in", "A", cache=cache, port=PORT, timeout=0.5)
+    assert trace.complete
+    assert [(hop.server, hop.status) for hop in trace.hops[2:]] == [
+        (DEAD, DNSStatus.Unreachable),
+        (AUTH, DNSStatus.Ok),
+    ]
+
+    trace = trace_resolution("www.glueless.in", "A", cache=cache, port=PORT)
+    assert trace.complete
+    # The address of ns.testprotocol.in is traced before the zone is asked
+    assert [(hop.qname, hop.zone) for hop in trace.hops] == [
+        ("www.glueless.in.", "in."),
+        ("ns.testprotocol.in.", "in."),
+        ("ns.testprotocol.in.", "testprotocol.in."),
+        ("www.glueless.in.", "glueless.in."),
+    ]
+    assert trace.hops[-1].server == OTHER_AUTH
+
+
+def test_hop_limit(hierarchy):
+    trace = trace_resolution("ns1.testprotocol.in", "A", cache=DelegationCache(ROOTS), port=PORT, max_hops=2)
+    assert not trace.complete and len(trace.hops) == 2
+    assert trace.result.status == DNSStatus.Ok
@@ -0,0 +1,64 @@
+import dns.message
+
+from measure_dns import (
+    DNSQuery,
+    MeasurementSession,
+    ResponseBuffer,
+    build_dns_query,
+    parse_dns_header,
+    send_dns_queries,
+    send_dns_query,
+)
+from measure_dns.dns_packet import _unique_requests
+
+
+def test_raw_request_buffers(stub_server):
+    wire = build_dns_query("raw.example", "A", id=0x4242)
+    for request in (wire, bytearray(wire), memoryview(wire), memoryview(bytearray(wire))):
+        result = send_dns_query(request, stub_server)
+        assert result.header.id == 0x4242
+        assert result.response.question[0].name.to_text() == "raw.example."
+
+
+def test_raw_batch_requests(stub_server):
+    requests = [build_dns_query(f"raw{i}.example", "A") for i in range(5)]
+    requests.append(DNSQuery(qname="mixed.example", rdtype="A"))
+    results = send_dns_queries([bytearray(request) for request in requests[:-1]] + requests[-1:], stub_server)
+    names = [result.response.question[0].name.to_text() for result in results]
+    assert names == [f"raw{i}.example." for i in range(5)] + ["mixed.example."]
+
+
+def test_batch_keeps_caller_buffers():
+    wires = [bytearray(build_dns_query(f"keep{i}.example", "A", id=7)) for i in range(3)]
+    requests = _unique_requests([memoryview(wires[0]), wires[1], memoryview(wires[2])])
+    # The first request keeps its ID and buffer; the duplicates are copied
+    # with new IDs, leaving the caller's buffers untouched
+    assert requests[0].obj is wires[0]
+    assert all(wire[:2] == b"\x00\x07" for wire in wires)
+    assert len({bytes(request[:2]) for request in requests}) == 3
+    assert [bytes(request[2:]) for request in requests] == [bytes(wire[2:]) for wire in wires]
+
+
+def test_zero_copy_responses(stub_server):
+    buffer = ResponseBuffer(zero_copy=True)
+    first = send_dns_query(DNSQuery(qname="first.example", rdtype="A"), stub_server, buffer=buffer)
+    assert isinstance(first.wire, memoryview)
+    assert first.header.ancount == 1
+    assert dns.message.from_wire(bytes(first.wire)).question[0].name.to_text() == "first.example."
+
+    # The view points into the buffer, so the next query reuses its memory
+    second = send_dns_query(DNSQuery(qname="second.example", rdtype="A"), stub_server, buffer=buffer)
+    assert parse_dns_header(first.wire).id == second.header.id
+    assert second.response.question[0].name.to_text() == "second.example."
+
+
+def test_session_zero_copy_batch(stub_server):
+    queries = [DNSQuery(qname=f"view{i}.example", rdtype="A") for i in range(20)]
+    with MeasurementSession(buffer=ResponseBuffer(zero_copy=True)) as session:
+        results = session.query_batch(queries, stub_server)
+        assert all(isinstance(result.wire, memoryview) for result in results)
+        names = [result.response.question[0].name.to_text() for result in results]
+    assert names == [query.qname + "." for query in queries]
+
+    with MeasurementSession() as session:
+        assert isinstance(session.query(queries[0], stub_server).wire, bytes)